@@ -3,7 +3,7 @@ Triboka Analytics ESG - Sistema de Reportes Avanzados
 Métricas de sostenibilidad, impacto ambiental y trazabilidad
 """
 
-from flask import Blueprint, render_template, jsonify, request, session, send_file
+from flask import Blueprint, render_template, jsonify, request, session, send_file, redirect, url_for
 from datetime import datetime, timedelta
 import sqlite3
 import json
@@ -17,14 +17,34 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 import matplotlib
 matplotlib.use('Agg')  # Use non-interactive backend
-import matplotlib.pyplot as plt
 import seaborn as sns
 import base64
 import pandas as pd
+import hashlib
+import os
+from matplotlib.figure import Figure
+
+from services.cache import LocalLRUCache
+from services.report_jobs import report_jobs, REPORT_INLINE_WAIT
 
 # Crear blueprint para analytics
 analytics_bp = Blueprint('analytics', __name__, url_prefix='/analytics')
 
+# Gráficos PNG memoizados por (tipo, hash de datos) y agregados ESG precalculados
+_chart_cache = LocalLRUCache(max_entries=int(os.getenv('ANALYTICS_CHART_CACHE_SIZE', 64)))
+CHART_CACHE_TTL = int(os.getenv('ANALYTICS_CHART_CACHE_TTL', 86400))
+_esg_cache = LocalLRUCache(max_entries=4)
+ESG_AGGREGATES_TTL = int(os.getenv('ESG_AGGREGATES_TTL', 60))
+
+# Series compartidas entre los datos de la página y sus gráficos
+CARBON_MONTHLY = [45.2, 42.8, 39.6, 37.1, 35.8, 33.4, 31.2, 29.8, 28.5, 27.1, 25.8, 24.3]
+GOVERNANCE_CERTIFICATIONS = {
+    'organic': 67,
+    'fair_trade': 45,
+    'rainforest_alliance': 38,
+    'utz': 28
+}
+
 def get_db_connection():
     """Obtener conexión a la base de datos"""
     import os
@@ -36,21 +56,40 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+def esg_aggregates():
+    """Volumen total y conteos de lotes calculados en SQL (cacheados unos segundos)"""
+    cached = _esg_cache.get('aggregates')
+    if cached is not None:
+        return json.loads(cached)
+    
+    conn = get_db_connection()
+    try:
+        total_volume = conn.execute(
+            'SELECT COALESCE(SUM(total_volume_mt), 0) FROM export_contracts'
+        ).fetchone()[0]
+        total_lots, organic_lots = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(CASE WHEN instr(certifications, 'Organic') > 0 THEN 1 ELSE 0 END), 0) "
+            "FROM producer_lots"
+        ).fetchone()
+    finally:
+        conn.close()
+    
+    aggregates = {
+        'total_volume': float(total_volume),
+        'total_lots': total_lots,
+        'organic_lots': organic_lots
+    }
+    _esg_cache.set('aggregates', json.dumps(aggregates), ESG_AGGREGATES_TTL)
+    return aggregates
+
 def generate_esg_metrics():
     """Generar métricas ESG simuladas basadas en datos reales"""
-    conn = get_db_connection()
-    
-    # Obtener datos de contratos y lotes
-    contracts = conn.execute('SELECT * FROM export_contracts').fetchall()
-    lots = conn.execute('SELECT * FROM producer_lots').fetchall()
-    companies = conn.execute('SELECT * FROM companies').fetchall()
-    
-    conn.close()
+    aggregates = esg_aggregates()
     
     # Métricas ESG calculadas
-    total_volume = sum([c['total_volume_mt'] for c in contracts if c['total_volume_mt']])
-    total_lots = len(lots)
-    organic_lots = len([l for l in lots if l['certifications'] and 'Organic' in l['certifications']])
+    total_volume = aggregates['total_volume']
+    total_lots = aggregates['total_lots']
+    organic_lots = aggregates['organic_lots']
     
     esg_data = {
         'environmental': {
@@ -122,10 +161,65 @@ def generate_esg_metrics():
     
     return esg_data
 
+def chart_spec(chart_type, data, title, labels=None):
+    """Serie de un gráfico (también se entrega cruda para renderizarla en el navegador)"""
+    return {'type': chart_type, 'title': title, 'labels': list(labels) if labels else None, 'data': list(data)}
+
+def page_chart_specs(page):
+    """Series de los gráficos de cada página de analytics"""
+    if page == 'dashboard':
+        return {
+            # Emisiones de Carbono por mes (simulado)
+            'carbon_trend': chart_spec('line', CARBON_MONTHLY[:6], 'Reducción de Emisiones CO₂ (tCO₂)',
+                                       ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun']),
+            'certifications': chart_spec('bar', [67, 45, 38, 28], 'Lotes por Certificación',
+                                         ['Orgánico', 'Fair Trade', 'Rainforest Alliance', 'UTZ']),
+            'esg_distribution': chart_spec('pie', [85.2, 88.7, 88.9], 'Distribución Puntaje ESG',
+                                           ['Ambiental', 'Social', 'Gobernanza']),
+            'social_impact': chart_spec('bar', [18, 67, 5, 156], 'Impacto Social (Cantidad)',
+                                        ['Escuelas', 'Becas', 'Proyectos', 'Capacitaciones'])
+        }
+    if page == 'environmental':
+        return {
+            'carbon_monthly': chart_spec('line', CARBON_MONTHLY, 'Emisiones Mensuales CO₂ (tCO₂)',
+                                         ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']),
+            'biodiversity_species': chart_spec('pie', [87, 23, 234, 156], 'Especies Monitoreadas',
+                                               ['Aves', 'Mamíferos', 'Insectos', 'Plantas'])
+        }
+    if page == 'social-impact':
+        return {
+            'premium_distribution': chart_spec('pie', [45000, 38000, 42000], 'Distribución Premium Fair Trade (USD)',
+                                               ['Educación', 'Salud', 'Infraestructura']),
+            'welfare_indicators': chart_spec('bar', [91.2, 88.5, 89.3, 92.1], 'Indicadores de Bienestar (%)',
+                                             ['Seguridad', 'Capacitación', 'Salud', 'Empleo'])
+        }
+    if page == 'governance':
+        return {
+            'audit_results': chart_spec('pie', [42, 3, 0], 'Resultados de Auditorías',
+                                        ['Aprobadas', 'Condicionales', 'Rechazadas']),
+            'certification_types': chart_spec('bar', list(GOVERNANCE_CERTIFICATIONS.values()), 'Certificaciones por Tipo',
+                                              [c.replace('_', ' ').title() for c in GOVERNANCE_CERTIFICATIONS])
+        }
+    return None
+
+def render_page_charts(page):
+    """Gráficos PNG (base64) de una página, memoizados"""
+    return {name: create_chart(spec['type'], spec['data'], spec['title'], spec['labels'])
+            for name, spec in page_chart_specs(page).items()}
+
 def create_chart(chart_type, data, title, labels=None):
-    """Crear gráfico y retornar como base64"""
-    plt.style.use('default')
-    fig, ax = plt.subplots(figsize=(10, 6))
+    """Crear gráfico y retornar como base64 (memoizado por tipo y hash de los datos)"""
+    key = hashlib.sha1(json.dumps([chart_type, data, title, labels], default=str).encode()).hexdigest()
+    img_b64 = _chart_cache.get(key)
+    if img_b64 is None:
+        img_b64 = _render_chart(chart_type, data, title, labels)
+        _chart_cache.set(key, img_b64, CHART_CACHE_TTL)
+    return img_b64
+
+def _render_chart(chart_type, data, title, labels=None):
+    """Renderizar el PNG con una Figure propia (sin estado global de pyplot)"""
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
     
     # Configurar colores Triboka
     triboka_colors = ['#2E8B57', '#90EE90', '#228B22', '#32CD32', '#006400']
@@ -158,16 +252,12 @@ def create_chart(chart_type, data, title, labels=None):
             ax.set_xticks(range(len(labels)))
             ax.set_xticklabels(labels, rotation=45, ha='right')
     
-    plt.tight_layout()
+    fig.tight_layout()
     
     # Convertir a base64
     img_buffer = io.BytesIO()
-    plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
-    img_buffer.seek(0)
-    img_b64 = base64.b64encode(img_buffer.getvalue()).decode()
-    plt.close()
-    
-    return img_b64
+    fig.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
+    return base64.b64encode(img_buffer.getvalue()).decode()
 
 @analytics_bp.route('/dashboard')
 def analytics_dashboard():
@@ -178,37 +268,14 @@ def analytics_dashboard():
     # Generar métricas ESG
     esg_data = generate_esg_metrics()
     
-    # Crear gráficos
-    charts = {}
-    
-    # Gráfico de Emisiones de Carbono por mes (simulado)
-    months = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun']
-    carbon_data = [45.2, 42.8, 39.6, 37.1, 35.8, 33.4]
-    charts['carbon_trend'] = create_chart('line', carbon_data, 
-                                        'Reducción de Emisiones CO₂ (tCO₂)', months)
-    
-    # Gráfico de Certificaciones
-    cert_labels = ['Orgánico', 'Fair Trade', 'Rainforest Alliance', 'UTZ']
-    cert_data = [67, 45, 38, 28]
-    charts['certifications'] = create_chart('bar', cert_data, 
-                                          'Lotes por Certificación', cert_labels)
-    
-    # Gráfico de Distribución ESG
-    esg_labels = ['Ambiental', 'Social', 'Gobernanza']
-    esg_scores = [85.2, 88.7, 88.9]
-    charts['esg_distribution'] = create_chart('pie', esg_scores, 
-                                            'Distribución Puntaje ESG', esg_labels)
-    
-    # Gráfico de Impacto Social
-    social_labels = ['Escuelas', 'Becas', 'Proyectos', 'Capacitaciones']
-    social_data = [18, 67, 5, 156]
-    charts['social_impact'] = create_chart('bar', social_data, 
-                                         'Impacto Social (Cantidad)', social_labels)
+    # Gráficos memoizados (las series crudas van en chart_series)
+    charts = render_page_charts('dashboard')
     
     return render_template('analytics_dashboard.html',
                          user=session['user'],
                          esg_data=esg_data,
-                         charts=charts)
+                         charts=charts,
+                         chart_series=page_chart_specs('dashboard'))
 
 @analytics_bp.route('/environmental')
 def environmental_report():
@@ -225,7 +292,7 @@ def environmental_report():
             'previous_year': 478.2,
             'reduction_pct': 11.0,
             'target_2025': 340.0,
-            'monthly_data': [45.2, 42.8, 39.6, 37.1, 35.8, 33.4, 31.2, 29.8, 28.5, 27.1, 25.8, 24.3]
+            'monthly_data': CARBON_MONTHLY
         },
         'water_usage': {
             'total_consumption': 1250000,  # litros
@@ -252,24 +319,14 @@ def environmental_report():
         }
     }
     
-    # Crear gráficos específicos
-    charts = {}
-    
-    # Tendencia de carbono mensual
-    months = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
-    charts['carbon_monthly'] = create_chart('line', environmental_data['carbon_footprint']['monthly_data'],
-                                          'Emisiones Mensuales CO₂ (tCO₂)', months)
-    
-    # Distribución de especies
-    species_labels = ['Aves', 'Mamíferos', 'Insectos', 'Plantas']
-    species_data = [87, 23, 234, 156]
-    charts['biodiversity_species'] = create_chart('pie', species_data,
-                                                'Especies Monitoreadas', species_labels)
+    # Gráficos específicos (memoizados)
+    charts = render_page_charts('environmental')
     
     return render_template('environmental_report.html',
                          user=session['user'],
                          environmental_data=environmental_data,
-                         charts=charts)
+                         charts=charts,
+                         chart_series=page_chart_specs('environmental'))
 
 @analytics_bp.route('/social-impact')
 def social_impact_report():
@@ -304,25 +361,14 @@ def social_impact_report():
         }
     }
     
-    # Gráficos sociales
-    charts = {}
-    
-    # Distribución de premium Fair Trade
-    premium_labels = ['Educación', 'Salud', 'Infraestructura']
-    premium_data = [45000, 38000, 42000]
-    charts['premium_distribution'] = create_chart('pie', premium_data,
-                                                'Distribución Premium Fair Trade (USD)', premium_labels)
-    
-    # Indicadores de bienestar
-    welfare_labels = ['Seguridad', 'Capacitación', 'Salud', 'Empleo']
-    welfare_scores = [91.2, 88.5, 89.3, 92.1]
-    charts['welfare_indicators'] = create_chart('bar', welfare_scores,
-                                              'Indicadores de Bienestar (%)', welfare_labels)
+    # Gráficos sociales (memoizados)
+    charts = render_page_charts('social-impact')
     
     return render_template('social_impact_report.html',
                          user=session['user'],
                          social_data=social_data,
-                         charts=charts)
+                         charts=charts,
+                         chart_series=page_chart_specs('social-impact'))
 
 @analytics_bp.route('/governance')
 def governance_report():
@@ -338,12 +384,7 @@ def governance_report():
             'public_reporting': True
         },
         'compliance': {
-            'certifications': {
-                'organic': 67,
-                'fair_trade': 45,
-                'rainforest_alliance': 38,
-                'utz': 28
-            },
+            'certifications': dict(GOVERNANCE_CERTIFICATIONS),
             'audit_results': {
                 'passed': 42,
                 'conditional': 3,
@@ -358,108 +399,47 @@ def governance_report():
         }
     }
     
-    # Gráficos de gobernanza
-    charts = {}
-    
-    # Resultados de auditorías
-    audit_labels = ['Aprobadas', 'Condicionales', 'Rechazadas']
-    audit_data = [42, 3, 0]
-    charts['audit_results'] = create_chart('pie', audit_data,
-                                         'Resultados de Auditorías', audit_labels)
-    
-    # Certificaciones por tipo
-    cert_labels = list(governance_data['compliance']['certifications'].keys())
-    cert_values = list(governance_data['compliance']['certifications'].values())
-    charts['certification_types'] = create_chart('bar', cert_values,
-                                                'Certificaciones por Tipo', 
-                                                [c.replace('_', ' ').title() for c in cert_labels])
+    # Gráficos de gobernanza (memoizados)
+    charts = render_page_charts('governance')
     
     return render_template('governance_report.html',
                          user=session['user'],
                          governance_data=governance_data,
-                         charts=charts)
+                         charts=charts,
+                         chart_series=page_chart_specs('governance'))
+
+def _session_owner():
+    """Solicitante de un reporte a partir del usuario de la sesión"""
+    user = session['user']
+    return {'user_id': user.get('id'), 'company_id': user.get('company_id')}
+
+def _inline_wait():
+    """Espera de las descargas directas (async=true devuelve el trabajo de inmediato)"""
+    return 0 if request.args.get('async', 'false').lower() == 'true' else REPORT_INLINE_WAIT
 
 @analytics_bp.route('/export/pdf/<report_type>')
 def export_pdf(report_type):
-    """Exportar reporte como PDF"""
+    """Exportar reporte como PDF (renderizado en el pool de reportes)"""
     if 'user' not in session:
         return jsonify({'error': 'No autorizado'}), 401
     
-    # Crear buffer para PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    
-    # Estilos
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        textColor=colors.HexColor('#2E8B57'),
-        alignment=1,  # Centrado
-        spaceAfter=30
-    )
-    
-    # Contenido del PDF
-    story = []
-    
-    # Título
+    payload = {'report_type': report_type}
     if report_type == 'esg':
-        title = "Reporte ESG Completo - Triboka Agro"
-        esg_data = generate_esg_metrics()
-        
-        story.append(Paragraph(title, title_style))
-        story.append(Spacer(1, 12))
-        
-        # Métricas principales
-        story.append(Paragraph("Métricas Principales", styles['Heading2']))
-        
-        metrics_data = [
-            ['Métrica', 'Valor', 'Tendencia'],
-            ['Puntaje ESG General', f"{esg_data['overall']['esg_score']}", '↗'],
-            ['Huella de Carbono', f"{esg_data['environmental']['carbon_footprint']['total_co2_tons']} tCO₂", '↘'],
-            ['Eficiencia del Agua', f"{esg_data['environmental']['water_usage']['efficiency_score']}%", '→'],
-            ['Biodiversidad', f"{esg_data['environmental']['biodiversity']['species_preserved']} especies", '↗'],
-            ['Transparencia', f"{esg_data['governance']['transparency']['blockchain_traced_pct']}%", '↗']
-        ]
-        
-        table = Table(metrics_data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2E8B57')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        story.append(table)
-        
-    else:
-        story.append(Paragraph(f"Reporte {report_type.title()}", title_style))
-    
-    # Generar PDF
-    doc.build(story)
-    buffer.seek(0)
+        payload['esg'] = generate_esg_metrics()
     
-    return send_file(
-        buffer,
-        as_attachment=True,
+    job = report_jobs.submit(
+        'esg_pdf', payload,
         download_name=f'triboka_{report_type}_report_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
+        owner=_session_owner()
     )
+    return report_jobs.respond(job, inline_wait=_inline_wait())
 
 @analytics_bp.route('/export/excel/<report_type>')
 def export_excel(report_type):
-    """Exportar datos como Excel"""
+    """Exportar datos como Excel (renderizado en el pool de reportes)"""
     if 'user' not in session:
         return jsonify({'error': 'No autorizado'}), 401
     
-    # Crear buffer para Excel
-    buffer = io.BytesIO()
-    
     # Obtener datos
     conn = get_db_connection()
     
@@ -483,21 +463,44 @@ def export_excel(report_type):
     else:
         query = 'SELECT * FROM companies'
     
-    df = pd.read_sql_query(query, conn)
+    cursor = conn.execute(query)
+    columns = [column[0] for column in cursor.description]
+    rows = [list(row) for row in cursor.fetchall()]
     conn.close()
     
-    # Escribir a Excel
-    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name=report_type.title(), index=False)
-    
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        as_attachment=True,
+    job = report_jobs.submit(
+        'excel', {'sheet_name': report_type.title(), 'columns': columns, 'rows': rows},
         download_name=f'triboka_{report_type}_data_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        owner=_session_owner()
     )
+    return report_jobs.respond(job, inline_wait=_inline_wait())
+
+@analytics_bp.route('/export/jobs/<job_id>')
+def export_job(job_id):
+    """Estado o descarga de un reporte encolado (?download=true)"""
+    if 'user' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    user = session['user']
+    job = report_jobs.status(job_id)
+    # 404 también sin permisos: no confirmar que el reporte existe
+    if not job or not (user.get('role') == 'admin' or report_jobs.is_allowed(
+            job_id, user_id=user.get('id'), company_id=user.get('company_id'))):
+        return jsonify({'error': 'Reporte no encontrado'}), 404
+    if request.args.get('download', 'false').lower() == 'true':
+        return report_jobs.respond(job)
+    return jsonify({'job': job})
+
+@analytics_bp.route('/api/series/<page>')
+def api_page_series(page):
+    """Series crudas de los gráficos de una página (renderizado en el navegador)"""
+    if 'user' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    specs = page_chart_specs(page)
+    if specs is None:
+        return jsonify({'error': f'Página no válida: {page}'}), 404
+    return jsonify(specs)
 
 @analytics_bp.route('/api/metrics')
 def api_metrics():
@@ -3,9 +3,9 @@ Actualización del servidor Flask con integración Web3
 Agregando endpoints para interactuar con smart contracts
 """
 
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, Response, stream_with_context, current_app
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt, decode_token
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
@@ -13,9 +13,12 @@ import os
 import sys
 import logging
 import json
+import gzip
+import math
 from decimal import Decimal
 from dotenv import load_dotenv
 from functools import wraps
+from sqlalchemy.orm import joinedload
 
 # Cargar variables de entorno
 load_dotenv()
@@ -27,14 +30,31 @@ logger = logging.getLogger(__name__)
 # Agregar el directorio backend al path para importaciones
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from models_simple import db, User, Company, ExportContract, ContractFixation, ProducerLot, BatchNFT, Deal, DealMember, DealNote, DealTraceLink, DealFinancePrivate, DealMessage, DigitalIdentity, DigitalSignature, KYCDocument, TraceEvent, TraceTimeline, Dispatch
+from models_simple import db, User, Company, ExportContract, ContractFixation, ProducerLot, BatchNFT, BatchLot, BlockchainTx, Deal, DealMember, DealNote, DealTraceLink, DealFinancePrivate, DealMessage, DigitalIdentity, DigitalSignature, KYCDocument, TraceEvent, TraceTimeline, Dispatch, CompanyDashboardStats
 from blockchain_service import get_blockchain_integration
+from services.pagination import encode_cursor, fetch_page, iter_phases, keyset_phases
+from services.price_feed import price_feed, start_price_feed
+from services.tx_outbox import enqueue_contract_creation, enqueue_transaction, start_tx_outbox_worker
+from services.lot_import import import_lots, detect_format, iter_rows
+from services.weighing_ingest import ingest_weighing_events
+from services.api_keys import require_api_key, set_api_key, api_key_cache, api_key_usage
+from services.deal_trace import build_deal_trace
+from services.dashboard_stats import PLATFORM_ID, get_dashboard_stats, start_dashboard_reconciler
+from services.report_jobs import report_jobs, REPORT_INLINE_WAIT
+from middleware.principal import (
+    current_principal, load_principal, invalidate_principal, deal_access_required, DEAL_PERMISSIONS
+)
+from services.timeline import append_event as append_timeline_event
+from services.trace_anchoring import build_public_verification, start_trace_anchoring
+from services.public_trace import PUBLIC_ENTITY_TYPES, get_public_snapshot
+from services.rate_limit import TokenBucketLimiter
+from services.identifiers import ALL_KINDS, LOT_KINDS, MAX_RESOLVE, load_resolved, resolve_lot
 from routes.agricultural_metadata import agricultural_metadata_bp
 from routes.contracts import contracts_bp
 from routes.fixations import fixations_bp
 from routes.traceability import traceability_bp
 from routes.erp import erp_bp
-from routes.performance import performance_bp
+from routes.performance import performance_bp, cached, cache_layer, invalidate_cache_tags
 from routes.analytics import analytics_bp
 from routes.dispatches import dispatches_bp
 from routes.dispatches import dispatches_bp
@@ -46,47 +66,6 @@ from routes.auth_routes import auth_routes_bp
 # Inicializar SocketIO globalmente
 socketio = None
 
-# =====================================
-# DECORADOR PARA AUTENTICACIÓN API KEY
-# =====================================
-
-def require_api_key(f):
-    """Decorador para validar API keys de empresas externas (AgroWeight Cloud, ERP, etc.)"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        try:
-            # Obtener API key del header Authorization
-            auth_header = request.headers.get('Authorization')
-            if not auth_header or not auth_header.startswith('Bearer '):
-                return jsonify({
-                    'error': 'API key requerida',
-                    'message': 'Debe proporcionar una API key válida en el header Authorization: Bearer {api_key}'
-                }), 401
-            
-            api_key = auth_header.replace('Bearer ', '')
-            
-            # Validar API key contra la base de datos
-            company = Company.query.filter_by(api_key=api_key).first()
-            if not company:
-                return jsonify({
-                    'error': 'API key inválida',
-                    'message': 'La API key proporcionada no corresponde a ninguna empresa registrada'
-                }), 401
-            
-            # Inyectar la compañía en el contexto de la request
-            g.company = company
-            
-            return f(*args, **kwargs)
-            
-        except Exception as e:
-            logger.error(f"Error en autenticación API key: {str(e)}")
-            return jsonify({
-                'error': 'Error de autenticación',
-                'message': 'Error interno en la validación de API key'
-            }), 500
-    
-    return decorated_function
-
 def create_app(testing=False):
     """Crear aplicación Flask"""
     app = Flask(__name__)
@@ -274,8 +253,7 @@ def get_user_context():
 def change_user_context():
     """Cambiar contexto del usuario (requiere nuevo token)"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = current_principal()
         
         if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
@@ -300,28 +278,13 @@ def change_user_context():
                 return jsonify({'error': 'Deal no encontrado'}), 404
             
             # Verificar que el usuario tenga acceso al deal
-            has_access = False
-            permissions = ['read']
-            
-            if user.id == deal.admin_id:
-                has_access = True
-                permissions = ['read', 'write', 'admin']
-            elif user.company_id == deal.producer_id:
-                has_access = True
-                permissions = ['read', 'write']
-            elif user.company_id == deal.exporter_id:
-                has_access = True
-                permissions = ['read', 'write']
-            elif user.role in ['admin', 'operator']:
-                has_access = True
-                permissions = ['read', 'write', 'admin']
-            
-            if not has_access:
+            deal_role = user.deal_role(deal)
+            if deal_role is None:
                 return jsonify({'error': 'Sin acceso al deal especificado'}), 403
             
             active_context.update({
                 'deal_id': deal_id,
-                'permissions': permissions
+                'permissions': DEAL_PERMISSIONS[deal_role]
             })
         
         # Crear nuevo token con contexto actualizado
@@ -490,6 +453,7 @@ def register():
             return jsonify({'error': 'El email ya está registrado'}), 400
         
         # Para productores, crear automáticamente una empresa si no se especifica
+        new_company_created = False
         if role == 'producer' and not company_id:
             # Crear empresa productora automáticamente
             company_name = f"Productora {name}"
@@ -501,6 +465,7 @@ def register():
             db.session.add(new_company)
             db.session.flush()
             company_id = new_company.id
+            new_company_created = True
         
         # Crear nuevo usuario
         user = User(
@@ -514,6 +479,8 @@ def register():
         
         db.session.add(user)
         db.session.commit()
+        if role == 'producer' and new_company_created:
+            invalidate_cache_tags('companies')
         
         return jsonify({'message': 'Usuario creado exitosamente'}), 201
         
@@ -711,30 +678,20 @@ def create_contract():
         db.session.add(contract)
         db.session.flush()  # Para obtener el ID
         
-        # Crear contrato en blockchain si está disponible
-        if blockchain.is_ready():
-            blockchain_contract_id = blockchain.agro_contract.create_contract(
-                buyer_address=buyer_company.blockchain_address or "0x0000000000000000000000000000000000000000",
-                exporter_address=exporter_company.blockchain_address or "0x0000000000000000000000000000000000000000",
-                contract_code=data['contract_code'],
-                product_type=data['product_type'],
-                product_grade=data['product_grade'],
-                total_volume_mt=int(data['total_volume_mt'] * 1000),  # Convertir a kg
-                differential_usd=int(data['differential_usd'] * 100),  # Convertir a centavos
-                start_date=int(contract.start_date.timestamp()),
-                end_date=int(contract.end_date.timestamp()),
-                delivery_date=int(contract.delivery_date.timestamp())
-            )
-            
-            if blockchain_contract_id:
-                contract.blockchain_contract_id = blockchain_contract_id
+        # Encolar creación del contrato en blockchain (el worker del outbox la envía)
+        blockchain_tx = None
+        if blockchain.is_ready() and blockchain.agro_contract.contract:
+            blockchain_tx = enqueue_contract_creation(contract)
         
         db.session.commit()
+        invalidate_cache_tags('contracts')
         
         return jsonify({
             'message': 'Contrato creado exitosamente',
             'contract_id': contract.id,
-            'blockchain_contract_id': contract.blockchain_contract_id
+            'blockchain_contract_id': contract.blockchain_contract_id,
+            'blockchain_status': blockchain_tx.status if blockchain_tx else None,
+            'blockchain_tx_id': blockchain_tx.id if blockchain_tx else None
         }), 201
         
     except Exception as e:
@@ -856,6 +813,7 @@ def create_contract_from_lots():
             })
         
         db.session.commit()
+        invalidate_cache_tags('contracts', 'lots')
         
         # TODO: Enviar notificación WebSocket a productores
         
@@ -1007,28 +965,31 @@ def create_fixation(contract_id):
         # Actualizar volumen fijado del contrato
         contract.fixed_volume_mt = float(contract.fixed_volume_mt) + float(fixed_quantity)
         
-        # Registrar fijación en blockchain si está disponible
-        if blockchain.is_ready() and contract.blockchain_contract_id:
+        # Encolar registro de la fijación en blockchain si está disponible; si el
+        # contrato aún no está confirmado el worker espera a su create_contract
+        blockchain_tx = None
+        if blockchain.is_ready() and blockchain.agro_contract.contract:
             # Obtener lotes asignados para esta fijación
             lot_ids = data.get('lot_ids', [])
             
-            blockchain_fixation_id = blockchain.agro_contract.register_fixation(
-                contract_id=contract.blockchain_contract_id,
-                fixed_quantity_mt=int(fixed_quantity * 1000),  # Convertir a kg
-                spot_price_usd=int(spot_price * 100),  # Convertir a centavos
-                lot_ids=lot_ids,
-                notes=data.get('notes', '')
-            )
-            
-            if blockchain_fixation_id:
-                fixation.blockchain_fixation_id = blockchain_fixation_id
+            blockchain_tx = enqueue_transaction('register_fixation', fixation.id, {
+                'export_contract_id': contract.id,
+                'contract_id': contract.blockchain_contract_id,
+                'fixed_quantity_mt': int(fixed_quantity * 1000),  # Convertir a kg
+                'spot_price_usd': int(spot_price * 100),  # Convertir a centavos
+                'lot_ids': lot_ids,
+                'notes': data.get('notes', '')
+            })
         
         db.session.commit()
+        invalidate_cache_tags('fixations', 'contracts')
         
         return jsonify({
             'message': 'Fijación creada exitosamente',
             'fixation_id': fixation.id,
             'blockchain_fixation_id': fixation.blockchain_fixation_id,
+            'blockchain_status': blockchain_tx.status if blockchain_tx else None,
+            'blockchain_tx_id': blockchain_tx.id if blockchain_tx else None,
             'total_value_usd': float(total_value),
             'contract_fixed_volume_mt': float(contract.fixed_volume_mt),
             'contract_pending_volume_mt': float(contract.total_volume_mt - contract.fixed_volume_mt)
@@ -1042,6 +1003,96 @@ def create_fixation(contract_id):
 # ENDPOINTS DE LOTES NFT
 # =====================================
 
+def _serialize_lot_listing(lot):
+    """Serializar un lote para el listado /api/lots (relaciones ya precargadas)"""
+    # Calcular precio por MT si está disponible
+    price_per_mt = None
+    if lot.purchase_price_usd and lot.weight_kg and lot.weight_kg > 0:
+        price_per_mt = float(lot.purchase_price_usd) / (float(lot.weight_kg) / 1000.0)
+
+    return {
+        'id': lot.id,
+        'lot_code': lot.lot_code,
+        'producer_company': lot.producer_company.name if lot.producer_company else None,
+        'producer_company_id': lot.producer_company_id,
+        'producer_name': lot.producer_name,
+        'farm_name': lot.farm_name,
+        'location': lot.location,
+        'product_type': lot.product_type,
+        'weight_kg': float(lot.weight_kg),
+        'weight_mt': float(lot.weight_kg) / 1000.0,
+        'quality_grade': lot.quality_grade,
+        'quality_score': float(lot.quality_score) if lot.quality_score else None,
+        'moisture_content': float(lot.moisture_content) if lot.moisture_content else None,
+        'harvest_date': lot.harvest_date.isoformat() if lot.harvest_date else None,
+        'purchase_date': lot.purchase_date.isoformat() if lot.purchase_date else None,
+        'purchase_price_usd': float(lot.purchase_price_usd) if lot.purchase_price_usd else None,
+        'price_per_mt': price_per_mt,
+        'status': lot.status,
+        'created_at': lot.created_at.isoformat(),
+        'blockchain_lot_id': lot.blockchain_lot_id,
+        'export_contract_id': lot.export_contract_id,
+        'batch_id': lot.batch_id,
+        'certifications': lot.certifications.split(',') if lot.certifications else [],
+        # Info adicional para exportadores
+        'has_contract': lot.export_contract_id is not None,
+        'purchased_by': lot.purchased_by_company.name if lot.purchased_by_company else None,
+        'created_by': lot.created_by_user.email if lot.created_by_user else None
+    }
+
+def _build_lots_query(user, args):
+    """Construir la consulta filtrada de lotes según rol y query params
+
+    Las relaciones usadas por _serialize_lot_listing se cargan con JOIN en la
+    misma consulta para evitar N+1 (producer_company, purchased_by_company, created_by_user).
+    """
+    query = ProducerLot.query.options(
+        joinedload(ProducerLot.producer_company),
+        joinedload(ProducerLot.purchased_by_company),
+        joinedload(ProducerLot.created_by_user)
+    )
+
+    # Filtrar según el rol del usuario
+    if user.role == 'producer':
+        # Productores ven solo sus lotes
+        query = query.filter_by(producer_company_id=user.company_id)
+    # Exporter: TODOS los lotes (marketplace). Admin/Operator: sin restricción
+
+    # Aplicar filtros de query params
+    status_filter = args.get('status')
+    if status_filter:
+        query = query.filter_by(status=status_filter)
+
+    location_filter = args.get('location')
+    if location_filter:
+        query = query.filter(ProducerLot.location.ilike(f'%{location_filter}%'))
+
+    quality_filter = args.get('quality_grade')
+    if quality_filter:
+        query = query.filter_by(quality_grade=quality_filter)
+
+    producer_filter = args.get('producer_id')
+    if producer_filter:
+        query = query.filter_by(producer_company_id=int(producer_filter))
+
+    min_weight = args.get('min_weight')
+    if min_weight:
+        query = query.filter(ProducerLot.weight_kg >= float(min_weight))
+
+    max_weight = args.get('max_weight')
+    if max_weight:
+        query = query.filter(ProducerLot.weight_kg <= float(max_weight))
+
+    certifications_filter = args.get('certifications')
+    if certifications_filter:
+        # Filtrar por certificación específica
+        query = query.filter(ProducerLot.certifications.ilike(f'%{certifications_filter}%'))
+
+    return query
+
+LOTS_PAGE_DEFAULT = 100
+LOTS_PAGE_MAX = 1000
+
 @app.route('/api/lots', methods=['GET'])
 @jwt_required()
 def get_lots():
@@ -1050,7 +1101,7 @@ def get_lots():
     - Producer: Solo sus lotes
     - Exporter: TODOS los lotes disponibles (marketplace)
     - Admin/Operator: Todos los lotes
-    
+
     Query params para filtros:
     - status: available, purchased, batched
     - location: filtro por ubicación
@@ -1059,116 +1110,78 @@ def get_lots():
     - producer_id: ID de empresa productora
     - min_weight: peso mínimo en kg
     - max_weight: peso máximo en kg
+
+    Modo paginado (si se envía limit o cursor):
+    - limit: tamaño de página (máx. 1000)
+    - cursor: valor next_cursor de la página anterior
+    Respuesta: {'lots': [...], 'next_cursor': str|None, 'has_more': bool}
+
+    Modo streaming:
+    - format=ndjson: un lote JSON por línea (application/x-ndjson), respeta cursor
+    - con limit, la última línea es {'next_cursor': str|None, 'has_more': bool}
     """
     try:
-        print("DEBUG: Iniciando get_lots()")
         user_id = get_jwt_identity()
-        print(f"DEBUG: user_id={user_id}")
         user = User.query.get(user_id)
-        print(f"DEBUG: user={user}, role={user.role if user else None}")
-        
+
         if not user:
-            print("DEBUG: Usuario no encontrado")
             return jsonify({'error': 'Usuario no encontrado'}), 404
-        
-        query = ProducerLot.query
-        print(f"DEBUG: Query inicial creada")
-        
-        # Filtrar según el rol del usuario
-        if user.role == 'producer':
-            # Productores ven solo sus lotes
-            query = query.filter_by(producer_company_id=user.company_id)
-            print(f"DEBUG: Filtro producer aplicado: company_id={user.company_id}")
-        elif user.role == 'exporter':
-            # EXPORTADORES VEN TODOS LOS LOTES DISPONIBLES (MARKETPLACE)
-            # Sin filtro de company_id - acceso total al marketplace
-            print("DEBUG: Role exporter - sin filtro (marketplace completo)")
-            pass
-        # Admin/Operator ven todos los lotes sin restricción
-        
-        # Aplicar filtros de query params
-        status_filter = request.args.get('status')
-        if status_filter:
-            query = query.filter_by(status=status_filter)
-        
-        location_filter = request.args.get('location')
-        if location_filter:
-            query = query.filter(ProducerLot.location.ilike(f'%{location_filter}%'))
-        
-        quality_filter = request.args.get('quality_grade')
-        if quality_filter:
-            query = query.filter_by(quality_grade=quality_filter)
-        
-        producer_filter = request.args.get('producer_id')
-        if producer_filter:
-            query = query.filter_by(producer_company_id=int(producer_filter))
-        
-        min_weight = request.args.get('min_weight')
-        if min_weight:
-            query = query.filter(ProducerLot.weight_kg >= float(min_weight))
-        
-        max_weight = request.args.get('max_weight')
-        if max_weight:
-            query = query.filter(ProducerLot.weight_kg <= float(max_weight))
-        
-        certifications_filter = request.args.get('certifications')
-        if certifications_filter:
-            # Filtrar por certificación específica
-            query = query.filter(ProducerLot.certifications.ilike(f'%{certifications_filter}%'))
-        
-        # Ordenar por fecha de cosecha (más recientes primero)
-        query = query.order_by(ProducerLot.harvest_date.desc())
-        
-        print(f"DEBUG: A punto de ejecutar query.all()")
-        lots = query.all()
-        print(f"DEBUG: Query ejecutada, {len(lots)} lotes encontrados")
-        
-        result = []
-        for lot in lots:
-            print(f"DEBUG: Procesando lot {lot.id} - {lot.lot_code}")
-            # Calcular precio por MT si está disponible
-            price_per_mt = None
-            if lot.purchase_price_usd and lot.weight_kg and lot.weight_kg > 0:
-                price_per_mt = float(lot.purchase_price_usd) / (float(lot.weight_kg) / 1000.0)
-            
-            lot_data = {
-                'id': lot.id,
-                'lot_code': lot.lot_code,
-                'producer_company': lot.producer_company.name if lot.producer_company else None,
-                'producer_company_id': lot.producer_company_id,
-                'producer_name': lot.producer_name,
-                'farm_name': lot.farm_name,
-                'location': lot.location,
-                'product_type': lot.product_type,
-                'weight_kg': float(lot.weight_kg),
-                'weight_mt': float(lot.weight_kg) / 1000.0,
-                'quality_grade': lot.quality_grade,
-                'quality_score': float(lot.quality_score) if lot.quality_score else None,
-                'moisture_content': float(lot.moisture_content) if lot.moisture_content else None,
-                'harvest_date': lot.harvest_date.isoformat() if lot.harvest_date else None,
-                'purchase_date': lot.purchase_date.isoformat() if lot.purchase_date else None,
-                'purchase_price_usd': float(lot.purchase_price_usd) if lot.purchase_price_usd else None,
-                'price_per_mt': price_per_mt,
-                'status': lot.status,
-                'created_at': lot.created_at.isoformat(),
-                'blockchain_lot_id': lot.blockchain_lot_id,
-                'export_contract_id': lot.export_contract_id,
-                'batch_id': lot.batch_id,
-                'certifications': lot.certifications.split(',') if lot.certifications else [],
-                # Info adicional para exportadores
-                'has_contract': lot.export_contract_id is not None,
-                'purchased_by': lot.purchased_by_company.name if lot.purchased_by_company else None,
-                'created_by': lot.created_by_user.email if lot.created_by_user else None
-            }
-            result.append(lot_data)
-        
-        print(f"DEBUG: Retornando {len(result)} lotes")
-        return jsonify(result)
-        
+
+        query = _build_lots_query(user, request.args)
+
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit')
+        output_format = request.args.get('format', 'json')
+
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                return jsonify({'error': 'limit debe ser un entero positivo'}), 400
+            limit = min(limit, LOTS_PAGE_MAX)
+
+        # Orden por fecha de cosecha (más recientes primero) con desempate por id
+        try:
+            phases = keyset_phases(query, ProducerLot.harvest_date, ProducerLot.id, cursor=cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if output_format == 'ndjson':
+            def generate():
+                if limit is None:
+                    for lot in iter_phases(phases):
+                        yield json.dumps(_serialize_lot_listing(lot)) + '\n'
+                    return
+
+                # Se lee una fila extra para saber si hay otra página
+                last, next_cursor = None, None
+                for index, lot in enumerate(iter_phases(phases, limit + 1)):
+                    if index == limit:
+                        next_cursor = encode_cursor(last.harvest_date, last.id)
+                        break
+                    last = lot
+                    yield json.dumps(_serialize_lot_listing(lot)) + '\n'
+                yield json.dumps({'next_cursor': next_cursor, 'has_more': next_cursor is not None}) + '\n'
+
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        if limit is None and cursor is None:
+            # Modo legacy: lista completa
+            return jsonify([_serialize_lot_listing(lot) for lot in phases[0].all()])
+
+        limit = limit or LOTS_PAGE_DEFAULT
+        lots, next_cursor = fetch_page(phases, limit, 'harvest_date')
+
+        return jsonify({
+            'lots': [_serialize_lot_listing(lot) for lot in lots],
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        })
+
     except Exception as e:
-        print(f"ERROR en get_lots: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Error en get_lots: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/lots', methods=['POST'])
@@ -1225,36 +1238,85 @@ def create_lot():
         db.session.add(lot)
         db.session.flush()
         
-        # Crear NFT en blockchain si está disponible
-        if blockchain.is_ready():
-            blockchain_lot_id = blockchain.nft_service.create_lot(
-                producer_address=producer_company.blockchain_address or "0x0000000000000000000000000000000000000000",
-                producer_name=producer_company.name,
-                farm_name=data['farm_name'],
-                location=data['location'],
-                product_type=data['product_type'],
-                weight_kg=int(data['weight_kg']),
-                quality_grade=data['quality_grade'],
-                harvest_date=int(lot.harvest_date.timestamp()),
-                certifications=data.get('certifications', []),
-                metadata_uri=data.get('metadata_uri', '')
-            )
-            
-            if blockchain_lot_id:
-                lot.blockchain_lot_id = blockchain_lot_id
+        # Encolar creación del NFT en blockchain si está disponible
+        blockchain_tx = None
+        if blockchain.is_ready() and blockchain.nft_service.contract:
+            blockchain_tx = enqueue_transaction('create_lot', lot.id, {
+                'producer_address': producer_company.blockchain_address or "0x0000000000000000000000000000000000000000",
+                'producer_name': producer_company.name,
+                'farm_name': data['farm_name'],
+                'location': data['location'],
+                'product_type': data['product_type'],
+                'weight_kg': int(data['weight_kg']),
+                'quality_grade': data['quality_grade'],
+                'harvest_date': int(lot.harvest_date.timestamp()),
+                'certifications': data.get('certifications', []),
+                'metadata_uri': data.get('metadata_uri', '')
+            })
         
         db.session.commit()
+        invalidate_cache_tags('lots')
         
         return jsonify({
             'message': 'Lote NFT creado exitosamente',
             'lot_id': lot.id,
-            'blockchain_lot_id': lot.blockchain_lot_id
+            'blockchain_lot_id': lot.blockchain_lot_id,
+            'blockchain_status': blockchain_tx.status if blockchain_tx else None,
+            'blockchain_tx_id': blockchain_tx.id if blockchain_tx else None
         }), 201
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/lots/import', methods=['POST'])
+@jwt_required()
+@impersonation_readonly_middleware
+def import_lots_bulk():
+    """Importar lotes en bloque desde CSV o NDJSON
+
+    Acepta el fichero como multipart (campo `file`) o como cuerpo de la
+    petición (text/csv, application/x-ndjson). Parámetros: format,
+    dry_run, register_blockchain. Devuelve un informe de errores por línea.
+    """
+    try:
+        user_id = get_jwt_identity()
+        user = User.query.get(user_id)
+        
+        if not user or user.role not in ['admin', 'operator', 'producer']:
+            return jsonify({'error': 'Sin permisos para crear lotes'}), 403
+        
+        upload = request.files.get('file')
+        if upload is not None:
+            stream = upload.stream
+            fmt = request.args.get('format') or detect_format(upload.filename, upload.mimetype)
+        else:
+            stream = request.stream
+            fmt = request.args.get('format') or detect_format(content_type=request.content_type)
+        
+        if fmt not in ('csv', 'ndjson'):
+            return jsonify({'error': 'Formato no reconocido, use format=csv o format=ndjson'}), 400
+        
+        report = import_lots(
+            stream, fmt, user,
+            integration=blockchain,
+            dry_run=request.args.get('dry_run', 'false').lower() == 'true',
+            register_on_chain=request.args.get('register_blockchain', 'true').lower() == 'true'
+        )
+        
+        if report['imported'] and not report['dry_run']:
+            invalidate_cache_tags('lots')
+        
+        status_code = 201 if report['imported'] and not report['dry_run'] else 200
+        if report['failed'] and not report['imported']:
+            status_code = 422
+        return jsonify(report), status_code
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error en import_lots_bulk: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 # =====================================
 # ENDPOINTS DE COMPRA DE LOTES
 # =====================================
@@ -1314,6 +1376,7 @@ def purchase_lot(lot_id):
                 # Continuar con la compra en base de datos aunque falle blockchain
         
         db.session.commit()
+        invalidate_cache_tags('lots')
         
         return jsonify({
             'message': 'Lote comprado exitosamente',
@@ -1407,29 +1470,15 @@ def get_public_available_lots():
 def get_lote_by_id(lote_id):
     """Obtener lote por ID (código interno o NFT ID) para integración con AgroWeight Cloud"""
     try:
-        print(f"DEBUG: Buscando lote con ID: {lote_id}")
-        
         # Para AgroWeight Cloud, permitir consultar cualquier lote
-        lot = ProducerLot.query.filter(
-            ((ProducerLot.lot_code == lote_id) | (ProducerLot.blockchain_lot_id == lote_id))
-        ).first()
-        
-        print(f"DEBUG: Lote encontrado: {lot}")
-        
+        lot = resolve_lot(lote_id)
         if not lot:
-            print(f"DEBUG: Lote {lote_id} no encontrado")
             return jsonify({'error': 'Lot not found'}), 404
-        
-        print(f"DEBUG: Convirtiendo lote a dict")
-        result = lot.to_dict()
-        print(f"DEBUG: Resultado: {result}")
-        
-        return jsonify(result)
-        
+
+        return jsonify(lot.to_dict())
+
     except Exception as e:
-        print(f"ERROR en get_lote_by_id: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ Error en get_lote_by_id {lote_id}: {str(e)}")
         return jsonify({'error': str(e)}), 500
     """Permitir a productores editar sus propios lotes"""
     try:
@@ -1471,6 +1520,7 @@ def get_lote_by_id(lote_id):
         lot.updated_at = datetime.utcnow()
         
         db.session.commit()
+        invalidate_cache_tags('lots')
         
         return jsonify({
             'message': 'Lote actualizado exitosamente',
@@ -1498,6 +1548,19 @@ def get_lote_by_id(lote_id):
 # ENDPOINTS DE BATCH NFT
 # =====================================
 
+def _link_batch_lots(batch, lots):
+    """Registrar en batch_lots los lotes que componen un batch
+
+    Debe llamarse en la misma transacción que crea el batch (después del flush)
+    para que el índice lote -> batch quede sincronizado con source_lot_ids.
+    """
+    for lot in lots:
+        db.session.add(BatchLot(
+            batch_id=batch.id,
+            lot_id=lot.id,
+            weight_kg=lot.weight_kg
+        ))
+
 @app.route('/api/batches', methods=['POST'])
 @jwt_required()
 @impersonation_readonly_middleware
@@ -1569,6 +1632,7 @@ def create_batch():
         for lot in lots:
             lot.status = 'batched'
             lot.batch_id = batch.id
+        _link_batch_lots(batch, lots)
         
         # Crear NFT en blockchain si está disponible
         if blockchain.is_ready():
@@ -1581,6 +1645,7 @@ def create_batch():
                 logger.warning(f"Error en batch blockchain: {blockchain_error}")
         
         db.session.commit()
+        invalidate_cache_tags('lots')
         
         return jsonify({
             'message': 'Batch creado exitosamente',
@@ -1612,22 +1677,11 @@ def get_batches():
             # Compradores ven batches que les pertenecen
             query = query.filter_by(current_owner_company_id=user.company_id)
         elif user.role == 'producer':
-            # Productores ven batches que contienen sus lotes
-            producer_lots = ProducerLot.query.filter_by(producer_company_id=user.company_id).all()
-            lot_ids = [lot.id for lot in producer_lots]
-            
-            # Buscar batches que contengan estos lotes
-            batches_with_producer_lots = []
-            all_batches = BatchNFT.query.all()
-            for batch in all_batches:
-                batch_lot_ids = batch.source_lots_list
-                if any(lot_id in batch_lot_ids for lot_id in lot_ids):
-                    batches_with_producer_lots.append(batch.id)
-            
-            if batches_with_producer_lots:
-                query = query.filter(BatchNFT.id.in_(batches_with_producer_lots))
-            else:
-                query = query.filter(BatchNFT.id == -1)  # No results
+            # Productores ven batches que contienen sus lotes (índice batch_lots)
+            producer_batch_ids = db.session.query(BatchLot.batch_id).join(
+                ProducerLot, BatchLot.lot_id == ProducerLot.id
+            ).filter(ProducerLot.producer_company_id == user.company_id)
+            query = query.filter(BatchNFT.id.in_(producer_batch_ids))
         
         batches = query.all()
         
@@ -1695,9 +1749,12 @@ def get_batch_detail(batch_id):
             has_access = (batch.current_owner_company_id == user.company_id)
         elif user.role == 'producer':
             # Verificar si el batch contiene lotes del productor
-            producer_lots = ProducerLot.query.filter_by(producer_company_id=user.company_id).all()
-            lot_ids = [lot.id for lot in producer_lots]
-            has_access = any(lot_id in batch.source_lots_list for lot_id in lot_ids)
+            has_access = db.session.query(BatchLot.id).join(
+                ProducerLot, BatchLot.lot_id == ProducerLot.id
+            ).filter(
+                BatchLot.batch_id == batch.id,
+                ProducerLot.producer_company_id == user.company_id
+            ).first() is not None
         
         if not has_access:
             return jsonify({'error': 'Sin permisos para ver este batch'}), 403
@@ -1757,11 +1814,10 @@ def get_lot_traceability(lot_id):
             has_access = (lot.purchased_by_company_id == user.company_id)
         elif user.role == 'buyer':
             # Comprador puede ver si el lote está en un batch que le pertenece
-            batches = BatchNFT.query.filter_by(current_owner_company_id=user.company_id).all()
-            for batch in batches:
-                if lot_id in batch.source_lots_list:
-                    has_access = True
-                    break
+            has_access = db.session.query(BatchLot.id).join(BatchNFT).filter(
+                BatchLot.lot_id == lot_id,
+                BatchNFT.current_owner_company_id == user.company_id
+            ).first() is not None
         
         if not has_access:
             return jsonify({'error': 'Sin permisos para ver este lote'}), 403
@@ -1833,38 +1889,42 @@ def get_lot_traceability(lot_id):
                 'color': 'primary'
             })
         
-        # Buscar batches que contienen este lote
-        batches_containing_lot = BatchNFT.query.all()
+        # Buscar batches que contienen este lote (índice batch_lots)
+        batch_links = BatchLot.query.options(
+            joinedload(BatchLot.batch).joinedload(BatchNFT.creator_company)
+        ).filter(BatchLot.lot_id == lot_id).all()
         lot_batches = []
         
-        for batch in batches_containing_lot:
-            if lot_id in batch.source_lots_list:
-                batch_data = {
-                    'id': batch.id,
-                    'batch_code': batch.batch_code,
-                    'total_weight_kg': float(batch.total_weight_kg),
-                    'status': batch.status,
-                    'created_at': batch.created_at.isoformat() if batch.created_at else None,
-                    'exporter_company': batch.exporter_company.name if batch.exporter_company else None,
-                    'blockchain_batch_id': batch.blockchain_batch_id
-                }
-                
-                # Calcular el porcentaje de contribución de este lote al batch
-                lot_weight = float(lot.weight_kg)
-                batch_data['lot_contribution_percentage'] = round((lot_weight / float(batch.total_weight_kg)) * 100, 2)
-                lot_batches.append(batch_data)
-                
-                # Agregar evento de batch al timeline
-                timeline.append({
-                    'event': 'Agregado a Batch',
-                    'timestamp': batch.created_at.isoformat() if batch.created_at else None,
-                    'actor': batch.exporter_company.name if batch.exporter_company else 'Exportadora',
-                    'description': f'Lote incluido en batch {batch.batch_code}',
-                    'tx_hash': batch.blockchain_batch_id or f'0x{"d" * 64}',
-                    'block_number': 12345681,
-                    'icon': 'boxes',
-                    'color': 'warning'
-                })
+        for link in batch_links:
+            batch = link.batch
+            exporter_company = batch.creator_company
+            batch_data = {
+                'id': batch.id,
+                'batch_code': batch.batch_code,
+                'total_weight_kg': float(batch.total_weight_kg or 0),
+                'status': batch.status,
+                'created_at': batch.created_at.isoformat() if batch.created_at else None,
+                'exporter_company': exporter_company.name if exporter_company else None,
+                'blockchain_batch_id': batch.blockchain_batch_id
+            }
+            
+            # Calcular el porcentaje de contribución de este lote al batch
+            lot_weight = float(link.weight_kg if link.weight_kg is not None else lot.weight_kg)
+            batch_total = float(batch.total_weight_kg or 0)
+            batch_data['lot_contribution_percentage'] = round((lot_weight / batch_total) * 100, 2) if batch_total > 0 else None
+            lot_batches.append(batch_data)
+            
+            # Agregar evento de batch al timeline
+            timeline.append({
+                'event': 'Agregado a Batch',
+                'timestamp': batch.created_at.isoformat() if batch.created_at else None,
+                'actor': exporter_company.name if exporter_company else 'Exportadora',
+                'description': f'Lote incluido en batch {batch.batch_code}',
+                'tx_hash': batch.blockchain_batch_id or f'0x{"d" * 64}',
+                'block_number': 12345681,
+                'icon': 'boxes',
+                'color': 'warning'
+            })
         
         # Ordenar timeline por fecha
         timeline.sort(key=lambda x: x['timestamp'] if x['timestamp'] else '', reverse=True)
@@ -1894,59 +1954,51 @@ def get_lot_traceability(lot_id):
 # ENDPOINTS PARA INTEGRACIÓN CON AGROWEIGHT CLOUD
 # =====================================
 
+def _agroweight_lote_data(lote):
+    """Datos de un lote para AgroWeight Cloud"""
+    return {
+        'id': lote.id,
+        'lot_code': lote.lot_code,
+        'producer_company': lote.producer_company.name if lote.producer_company else None,
+        'producer_name': lote.producer_name,
+        'farm_name': lote.farm_name,
+        'location': lote.location,
+        'product_type': lote.product_type,
+        'weight_kg': float(lote.weight_kg) if lote.weight_kg else 0,
+        'quality_grade': lote.quality_grade,
+        'harvest_date': lote.harvest_date.isoformat() if lote.harvest_date else None,
+        'certifications': lote.certifications.split(',') if lote.certifications else [],
+        'status': lote.status,
+        'blockchain_lot_id': lote.blockchain_lot_id,
+        'created_at': lote.created_at.isoformat() if lote.created_at else None,
+        'metadata': {
+            'moisture_content': float(lote.moisture_content) if lote.moisture_content else None,
+            'quality_score': float(lote.quality_score) if lote.quality_score else None,
+            'certifications_list': lote.certifications.split(',') if lote.certifications else []
+        }
+    }
+
 @app.route('/api/lotes/nft/<nft_hash>', methods=['GET'])
 @require_api_key
 def get_lote_nft(nft_hash):
     """Obtener lote por NFT hash (para AgroWeight Cloud)"""
     try:
-        company = g.company
-        
-        # Buscar lote por NFT hash o blockchain_lot_id
-        lote = ProducerLot.query.filter(
-            db.or_(
-                ProducerLot.blockchain_lot_id == nft_hash,
-                ProducerLot.lot_code == nft_hash  # También permitir búsqueda por código de lote
-            )
-        ).first()
-        
+        # Buscar lote por NFT hash o, si no, por código de lote
+        lote = resolve_lot(nft_hash, kinds=('nft_id', 'lot_code'))
+
         if not lote:
             return jsonify({
                 'error': 'Lote no encontrado',
                 'message': f'No se encontró lote con hash/código: {nft_hash}'
             }), 404
-        
-        # Verificar que el lote pertenezca a la empresa que hace la consulta
+
         # Nota: En multi-tenant, cada empresa solo puede ver sus propios lotes
         # Pero para integración, permitimos acceso si el lote existe
-        
-        # Obtener información adicional del lote
-        lote_data = {
-            'id': lote.id,
-            'lot_code': lote.lot_code,
-            'producer_company': lote.producer_company.name if lote.producer_company else None,
-            'producer_name': lote.producer_name,
-            'farm_name': lote.farm_name,
-            'location': lote.location,
-            'product_type': lote.product_type,
-            'weight_kg': float(lote.weight_kg) if lote.weight_kg else 0,
-            'quality_grade': lote.quality_grade,
-            'harvest_date': lote.harvest_date.isoformat() if lote.harvest_date else None,
-            'certifications': lote.certifications.split(',') if lote.certifications else [],
-            'status': lote.status,
-            'blockchain_lot_id': lote.blockchain_lot_id,
-            'created_at': lote.created_at.isoformat() if lote.created_at else None,
-            'metadata': {
-                'moisture_content': float(lote.moisture_content) if lote.moisture_content else None,
-                'quality_score': float(lote.quality_score) if lote.quality_score else None,
-                'certifications_list': lote.certifications.split(',') if lote.certifications else []
-            }
-        }
-        
         return jsonify({
             'success': True,
-            'lote': lote_data
+            'lote': _agroweight_lote_data(lote)
         })
-        
+
     except Exception as e:
         logger.error(f"Error obteniendo lote NFT: {str(e)}")
         return jsonify({
@@ -1954,6 +2006,58 @@ def get_lote_nft(nft_hash):
             'message': str(e)
         }), 500
 
+@app.route('/api/lotes/resolver', methods=['POST'])
+@require_api_key
+def resolver_lotes():
+    """Resolver en una sola llamada los IDs escaneados (código de lote, NFT ID o código de batch)
+
+    Body: {"ids": [...], "tipos": ["lot_code", "nft_id", "batch_code"]} (tipos opcional)
+    """
+    try:
+        data = request.get_json(silent=True)
+        ids = data.get('ids') if isinstance(data, dict) else data
+        if not isinstance(ids, list) or not ids:
+            return jsonify({
+                'error': 'Datos requeridos',
+                'message': 'Se requiere una lista "ids" con los identificadores escaneados'
+            }), 400
+        if len(ids) > MAX_RESOLVE:
+            return jsonify({
+                'error': 'Demasiados identificadores',
+                'message': f'Máximo {MAX_RESOLVE} identificadores por llamada'
+            }), 413
+
+        kinds = data.get('tipos') if isinstance(data, dict) and data.get('tipos') else LOT_KINDS + ('batch_code',)
+        unknown = [kind for kind in kinds if kind not in ALL_KINDS]
+        if unknown:
+            return jsonify({
+                'error': 'Tipo no válido',
+                'message': f'Tipos permitidos: {", ".join(ALL_KINDS)}'
+            }), 400
+
+        ids = [str(identifier).strip() for identifier in ids if identifier is not None and str(identifier).strip()]
+        resolved = load_resolved(ids, kinds)
+
+        resultados = {}
+        for identifier, (kind, entity) in resolved.items():
+            if kind == 'batch_code':
+                resultados[identifier] = {'tipo': kind, 'batch': entity.to_dict()}
+            else:
+                resultados[identifier] = {'tipo': kind, 'lote': _agroweight_lote_data(entity)}
+
+        return jsonify({
+            'success': True,
+            'resultados': resultados,
+            'no_encontrados': [identifier for identifier in dict.fromkeys(ids) if identifier not in resolved]
+        })
+
+    except Exception as e:
+        logger.error(f"Error resolviendo identificadores: {str(e)}")
+        return jsonify({
+            'error': 'Error interno del servidor',
+            'message': str(e)
+        }), 500
+
 @app.route('/api/lotes/<int:lote_id>/eventos', methods=['POST'])
 @require_api_key
 def registrar_evento_lote(lote_id):
@@ -1975,57 +2079,29 @@ def registrar_evento_lote(lote_id):
                 'message': 'Campo "tipo" es obligatorio'
             }), 400
         
-        # Buscar el lote
-        lote = ProducerLot.query.get(lote_id)
-        if not lote:
-            return jsonify({
-                'error': 'Lote no encontrado',
-                'message': f'No se encontró lote con ID: {lote_id}'
-            }), 404
-        
-        # Crear evento de trazabilidad
-        evento = TraceEvent(
-            entity_type='lot',
-            entity_id=lote_id,
-            event_type=data['tipo'],
-            event_data=json.dumps(data),
-            user_id=None,  # Evento desde API externa
-            blockchain_tx_hash=None,  # Se puede agregar después
-            created_at=datetime.utcnow()
-        )
-        
-        db.session.add(evento)
-        db.session.commit()
-        
-        # Crear timeline entry si no existe
-        timeline_entry = TraceTimeline.query.filter_by(
-            entity_type='lot',
-            entity_id=lote_id,
-            event_type=data['tipo']
-        ).first()
-        
-        if not timeline_entry:
-            timeline_entry = TraceTimeline(
-                entity_type='lot',
-                entity_id=lote_id,
-                event_type=data['tipo'],
-                title=f"Evento: {data['tipo']}",
-                description=data.get('descripcion', f"Evento {data['tipo']} registrado desde AgroWeight Cloud"),
-                event_data=json.dumps(data),
-                created_at=datetime.utcnow()
-            )
-            db.session.add(timeline_entry)
-            db.session.commit()
+        # Mismo camino que la ingesta por lotes (id_evento opcional en este endpoint)
+        report = ingest_weighing_events([(1, {**data, 'lote_id': lote_id})], company, require_key=False)
+        if report['registrados']:
+            invalidate_cache_tags('traceability')
+        if not report['eventos']:
+            error = report['errores'][0]['errors'][0]
+            if error.startswith('Lote no encontrado'):
+                return jsonify({
+                    'error': 'Lote no encontrado',
+                    'message': f'No se encontró lote con ID: {lote_id}'
+                }), 404
+            return jsonify({'error': 'Evento inválido', 'message': error}), 400
         
+        evento = report['eventos'][0]
         return jsonify({
             'success': True,
-            'message': 'Evento registrado exitosamente',
+            'message': 'Evento registrado exitosamente' if evento['estado'] == 'registrado' else 'Evento ya registrado',
             'evento': {
-                'id': evento.id,
-                'tipo': evento.event_type,
+                'id': evento['evento_id'],
+                'tipo': data['tipo'],
                 'lote_id': lote_id,
                 'company_id': company.id,
-                'timestamp': evento.created_at.isoformat(),
+                'timestamp': evento.get('timestamp'),
                 'data': data
             }
         })
@@ -2038,6 +2114,48 @@ def registrar_evento_lote(lote_id):
             'message': str(e)
         }), 500
 
+@app.route('/api/lotes/eventos', methods=['POST'])
+@require_api_key
+def registrar_eventos_lotes():
+    """Registrar lecturas de básculas en bloque (para AgroWeight Cloud)
+
+    Acepta un array JSON (o {"eventos": [...]}) o un stream NDJSON
+    (application/x-ndjson). Cada lectura lleva id_evento, lote_id y tipo;
+    reenviar un id_evento ya registrado no lo duplica.
+    """
+    try:
+        company = g.company
+        
+        if detect_format(content_type=request.content_type) == 'ndjson':
+            rows = iter_rows(request.stream, 'ndjson')
+        else:
+            data = request.get_json(silent=True)
+            eventos = data.get('eventos') if isinstance(data, dict) else data
+            if not isinstance(eventos, list):
+                return jsonify({
+                    'error': 'Datos requeridos',
+                    'message': 'Se requiere un array de eventos, {"eventos": [...]} o un stream NDJSON'
+                }), 400
+            rows = ((index, row if isinstance(row, dict) else {'__error__': 'Cada evento debe ser un objeto JSON'})
+                    for index, row in enumerate(eventos, start=1))
+        
+        report = ingest_weighing_events(rows, company)
+        if report['registrados']:
+            invalidate_cache_tags('traceability')
+        
+        status_code = 201 if report['registrados'] else 200
+        if report['rechazados'] and not report['eventos']:
+            status_code = 422
+        return jsonify(report), status_code
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error registrando eventos en bloque: {str(e)}")
+        return jsonify({
+            'error': 'Error interno del servidor',
+            'message': str(e)
+        }), 500
+
 @app.route('/api/batch-nft', methods=['POST'])
 @require_api_key
 def crear_batch_nft():
@@ -2080,6 +2198,7 @@ def crear_batch_nft():
         
         # Procesar lotes y calcular peso total
         lote_ids = []
+        valid_lotes = []
         total_weight = 0.0
         
         for lote_info in lotes_data:
@@ -2088,8 +2207,12 @@ def crear_batch_nft():
                 continue
                 
             lote = ProducerLot.query.get(lote_id)
+            # Un lote repetido se cuenta una sola vez (batch_lots es único por lote)
+            if lote and lote in valid_lotes:
+                continue
             if lote and lote.status in ['purchased', 'batched']:
                 lote_ids.append(lote_id)
+                valid_lotes.append(lote)
                 total_weight += float(lote.weight_kg) if lote.weight_kg else 0
         
         if len(lote_ids) == 0:
@@ -2115,11 +2238,10 @@ def crear_batch_nft():
         db.session.flush()  # Para obtener el ID
         
         # Actualizar estado de los lotes originales
-        for lote_id in lote_ids:
-            lote = ProducerLot.query.get(lote_id)
-            if lote:
-                lote.status = 'batched'
-                lote.batch_id = batch.id
+        for lote in valid_lotes:
+            lote.status = 'batched'
+            lote.batch_id = batch.id
+        _link_batch_lots(batch, valid_lotes)
         
         # Generar hash blockchain simulado
         import hashlib
@@ -2171,61 +2293,63 @@ def get_dashboard_analytics():
         
         if user.role in ['admin', 'operator']:
             # Métricas generales para administradores
+            stats = get_dashboard_stats(PLATFORM_ID)
             result = {
-                'total_contracts': ExportContract.query.count(),
-                'active_contracts': ExportContract.query.filter_by(status='active').count(),
-                'total_volume_mt': db.session.query(db.func.sum(ExportContract.total_volume_mt)).scalar() or 0,
-                'fixed_volume_mt': db.session.query(db.func.sum(ExportContract.fixed_volume_mt)).scalar() or 0,
-                'total_lots': ProducerLot.query.count(),
-                'available_lots': ProducerLot.query.filter_by(status='available').count(),
-                'total_companies': Company.query.count(),
+                'total_contracts': stats['contracts_total'],
+                'active_contracts': stats['contracts_active'],
+                'total_volume_mt': stats['contracts_volume_mt'],
+                'fixed_volume_mt': stats['contracts_fixed_volume_mt'],
+                'total_lots': stats['lots_total'],
+                'available_lots': stats['lots_available'],
+                'total_companies': stats['companies_total'],
                 'blockchain_status': blockchain.get_status()
             }
             
         elif user.role == 'exporter':
             # Métricas para exportador
-            contracts = ExportContract.query.filter_by(exporter_company_id=user.company_id)
+            stats = get_dashboard_stats(user.company_id)
             
-            # Obtener IDs de productores con los que hay contratos (convenio establecido)
-            producer_ids_with_contracts = db.session.query(ExportContract.exporter_company_id).filter(
+            # Productores con los que hay contratos (convenio establecido) y sus
+            # lotes disponibles, leídos de sus contadores en una sola consulta
+            producer_ids = db.session.query(ExportContract.exporter_company_id).filter(
                 ExportContract.buyer_company_id == user.company_id,
                 ExportContract.status.in_(['active', 'completed'])
-            ).distinct().all()
-            producer_ids = [pid[0] for pid in producer_ids_with_contracts]
-            
-            # Lotes disponibles SOLO de productores con convenio
-            available_lots_with_contract = ProducerLot.query.filter(
-                ProducerLot.producer_company_id.in_(producer_ids),
-                ProducerLot.status == 'available'
-            ).count() if producer_ids else 0
+            ).distinct()
+            producers_with_contract, available_lots_with_contract = db.session.query(
+                db.session.query(db.func.count()).select_from(producer_ids.subquery()).scalar_subquery(),
+                db.session.query(db.func.coalesce(db.func.sum(CompanyDashboardStats.lots_available), 0)).filter(
+                    CompanyDashboardStats.company_id.in_(producer_ids.scalar_subquery())
+                ).scalar_subquery()
+            ).one()
             
             result = {
-                'my_contracts': contracts.count(),
-                'active_contracts': contracts.filter_by(status='active').count(),
-                'total_volume_mt': db.session.query(db.func.sum(ExportContract.total_volume_mt)).filter_by(exporter_company_id=user.company_id).scalar() or 0,
-                'fixed_volume_mt': db.session.query(db.func.sum(ExportContract.fixed_volume_mt)).filter_by(exporter_company_id=user.company_id).scalar() or 0,
-                'my_fixations': ContractFixation.query.join(ExportContract).filter(ExportContract.exporter_company_id == user.company_id).count(),
+                'my_contracts': stats['exporter_contracts'],
+                'active_contracts': stats['exporter_active_contracts'],
+                'total_volume_mt': stats['exporter_volume_mt'],
+                'fixed_volume_mt': stats['exporter_fixed_volume_mt'],
+                'my_fixations': stats['exporter_fixations'],
                 'available_lots_with_contract': available_lots_with_contract,
-                'producers_with_contract': len(producer_ids)
+                'producers_with_contract': producers_with_contract
             }
             
         elif user.role == 'buyer':
             # Métricas para comprador
-            contracts = ExportContract.query.filter_by(buyer_company_id=user.company_id)
+            stats = get_dashboard_stats(user.company_id)
             result = {
-                'my_contracts': contracts.count(),
-                'active_contracts': contracts.filter_by(status='active').count(),
-                'total_volume_mt': db.session.query(db.func.sum(ExportContract.total_volume_mt)).filter_by(buyer_company_id=user.company_id).scalar() or 0,
-                'fixed_volume_mt': db.session.query(db.func.sum(ExportContract.fixed_volume_mt)).filter_by(buyer_company_id=user.company_id).scalar() or 0
+                'my_contracts': stats['buyer_contracts'],
+                'active_contracts': stats['buyer_active_contracts'],
+                'total_volume_mt': stats['buyer_volume_mt'],
+                'fixed_volume_mt': stats['buyer_fixed_volume_mt']
             }
             
         elif user.role == 'producer':
             # Métricas para productor
+            stats = get_dashboard_stats(user.company_id)
             result = {
-                'my_lots': ProducerLot.query.filter_by(producer_company_id=user.company_id).count(),
-                'available_lots': ProducerLot.query.filter_by(producer_company_id=user.company_id, status='available').count(),
-                'total_weight_kg': db.session.query(db.func.sum(ProducerLot.weight_kg)).filter_by(producer_company_id=user.company_id).scalar() or 0,
-                'assigned_lots': ProducerLot.query.filter_by(producer_company_id=user.company_id).filter(ProducerLot.export_contract_id.isnot(None)).count()
+                'my_lots': stats['lots_total'],
+                'available_lots': stats['lots_available'],
+                'total_weight_kg': stats['lots_weight_kg'],
+                'assigned_lots': stats['lots_assigned']
             }
         
         # Convertir Decimals a float para JSON
@@ -2410,26 +2534,77 @@ def get_esg_data():
 # ENDPOINTS ADICIONALES
 # =====================================
 
+@cached(timeout=1800, key_prefix="companies")
+def _list_companies():
+    """Lista de empresas serializada (cache de dos niveles, tag 'companies')"""
+    result = []
+    for company in Company.query.all():
+        result.append({
+            'id': company.id,
+            'name': company.name,
+            'country': company.country,
+            'plan_type': getattr(company, 'plan_type', None),
+            'wallet_address': getattr(company, 'wallet_address', None),
+            'is_active': getattr(company, 'is_active', True)
+        })
+    return result
+
 @app.route('/api/companies', methods=['GET'])
 @jwt_required()
 def get_companies():
     """Obtener lista de empresas"""
     try:
-        companies = Company.query.all()
+        return jsonify(_list_companies())
         
-        result = []
-        for company in companies:
-            company_data = {
-                'id': company.id,
-                'name': company.name,
-                'country': company.country,
-                'plan_type': getattr(company, 'plan_type', None),
-                'wallet_address': getattr(company, 'wallet_address', None),
-                'is_active': getattr(company, 'is_active', True)
-            }
-            result.append(company_data)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/companies/<int:company_id>/api-key', methods=['POST'])
+@jwt_required()
+def rotate_company_api_key(company_id):
+    """Generar (o rotar) la API key de integración de una empresa
+
+    La clave se devuelve en claro solo en esta respuesta; la anterior deja de
+    ser válida al instante en este proceso y, en el resto, al expirar la cache
+    (API_KEY_CACHE_TTL).
+    """
+    try:
+        current_user = User.query.get(get_jwt_identity())
+        if not current_user or (current_user.role != 'admin' and current_user.company_id != company_id):
+            return jsonify({'error': 'No tienes permisos para gestionar la API key de esta empresa'}), 403
         
-        return jsonify(result)
+        company = Company.query.get(company_id)
+        if not company:
+            return jsonify({'error': 'Empresa no encontrada'}), 404
+        
+        api_key = set_api_key(company)
+        db.session.commit()
+        logger.info(f"🔑 API key rotada para empresa {company_id} ({company.api_key_prefix}...)")
+        
+        return jsonify({
+            'success': True,
+            'company_id': company_id,
+            'api_key': api_key,
+            'api_key_prefix': company.api_key_prefix
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/companies/api-keys/usage', methods=['GET'])
+@jwt_required()
+def get_api_key_usage():
+    """Contadores de uso por API key (por prefijo) de este proceso - Solo administradores"""
+    try:
+        current_user = User.query.get(get_jwt_identity())
+        if not current_user or current_user.role != 'admin':
+            return jsonify({'error': 'Acceso denegado'}), 403
+        
+        return jsonify({
+            'keys': api_key_usage.snapshot(),
+            'cache': api_key_cache.stats()
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2605,6 +2780,7 @@ def update_user(user_id):
             user.set_password(data['password'])
         
         db.session.commit()
+        invalidate_principal(user.id)
         
         print(f"User updated successfully: {user.id}")
         return jsonify({
@@ -2653,6 +2829,7 @@ def delete_user(user_id):
         # Eliminar el usuario
         db.session.delete(user)
         db.session.commit()
+        invalidate_principal(user_id)
         
         print(f"User deleted successfully: {user_id}")
         return jsonify({'message': 'Usuario eliminado exitosamente'})
@@ -2662,46 +2839,83 @@ def delete_user(user_id):
         print(f"Error deleting user: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def _outbox_company_clause(company_id):
+    """Transacciones del outbox de entidades de la empresa (lotes, contratos y fijaciones)"""
+    company_contracts = db.session.query(ExportContract.id).filter(db.or_(
+        ExportContract.exporter_company_id == company_id,
+        ExportContract.buyer_company_id == company_id
+    ))
+    return db.or_(
+        db.and_(BlockchainTx.entity_type == 'lot', BlockchainTx.entity_id.in_(
+            db.session.query(ProducerLot.id).filter(db.or_(
+                ProducerLot.producer_company_id == company_id,
+                ProducerLot.purchased_by_company_id == company_id
+            ))
+        )),
+        db.and_(BlockchainTx.entity_type == 'contract', BlockchainTx.entity_id.in_(company_contracts)),
+        db.and_(BlockchainTx.entity_type == 'fixation', BlockchainTx.entity_id.in_(
+            db.session.query(ContractFixation.id).filter(ContractFixation.export_contract_id.in_(company_contracts))
+        ))
+    )
+
+def _outbox_query_for(user):
+    """Outbox visible para el usuario: todo para admin, solo su empresa para el resto"""
+    query = BlockchainTx.query
+    if user.role != 'admin':
+        if not user.company_id:
+            return query.filter(db.false())
+        query = query.filter(_outbox_company_clause(user.company_id))
+    return query
+
 @app.route('/api/blockchain/transactions', methods=['GET'])
+@jwt_required()
 def get_blockchain_transactions():
-    """Obtener transacciones recientes del blockchain"""
+    """Obtener transacciones recientes del blockchain (desde el outbox)"""
     try:
-        # Simulamos transacciones por ahora - en producción sería desde blockchain
-        transactions = [
-            {
-                'id': 1,
-                'hash': '0x1234567890abcdef1234567890abcdef12345678',
-                'type': 'contract_creation',
-                'status': 'confirmed',
-                'timestamp': datetime.now().isoformat(),
-                'gas_cost': '0.0045',
-                'block_number': 12345678
-            },
-            {
-                'id': 2,
-                'hash': '0xabcdef1234567890abcdef1234567890abcdef12',
-                'type': 'fixation_registered',
-                'status': 'confirmed',
-                'timestamp': (datetime.now() - timedelta(hours=2)).isoformat(),
-                'gas_cost': '0.0023',
-                'block_number': 12345677
-            },
-            {
-                'id': 3,
-                'hash': '0x567890abcdef1234567890abcdef1234567890ab',
-                'type': 'nft_mint',
-                'status': 'pending',
-                'timestamp': (datetime.now() - timedelta(minutes=30)).isoformat(),
-                'gas_cost': '0.0078',
-                'block_number': None
-            }
-        ]
+        user = current_principal()
+        if not user:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        query = _outbox_query_for(user)
+        if request.args.get('status'):
+            query = query.filter_by(status=request.args.get('status'))
+        
+        transactions = []
+        for tx in query.order_by(BlockchainTx.id.desc()).limit(limit).all():
+            transactions.append({
+                'id': tx.id,
+                'hash': tx.tx_hash,
+                'type': tx.kind,
+                'status': tx.status,
+                'timestamp': (tx.confirmed_at or tx.submitted_at or tx.created_at).isoformat(),
+                'gas_used': tx.gas_used,
+                'block_number': tx.block_number
+            })
         
         return jsonify(transactions)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/blockchain/transactions/<int:tx_id>', methods=['GET'])
+@jwt_required()
+def get_blockchain_transaction(tx_id):
+    """Consultar el estado de una transacción encolada (pending/sending/submitted/confirmed/failed)"""
+    try:
+        user = current_principal()
+        if not user:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+
+        tx = _outbox_query_for(user).filter(BlockchainTx.id == tx_id).first()
+        if not tx:
+            return jsonify({'error': 'Transacción no encontrada'}), 404
+        
+        return jsonify(tx.to_dict())
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/lots/available-for-batch', methods=['GET'])
 @jwt_required()
 def get_lots_available_for_batch():
@@ -3081,6 +3295,10 @@ def create_export_batch_with_nft():
         db.session.add(batch)
         db.session.flush()
         
+        # Indexar los lotes del ERP que existen en Triboka (por código de lote)
+        known_lots = ProducerLot.query.filter(ProducerLot.lot_code.in_(lot_ids_list)).all()
+        _link_batch_lots(batch, known_lots)
+        
         # Generar hash blockchain
         import hashlib
         import json
@@ -3157,20 +3375,12 @@ def get_producer_dashboard():
         if not user or user.role not in ['producer', 'admin']:
             return jsonify({'error': 'Acceso denegado'}), 403
         
-        # Obtener lotes del productor
-        lots_query = ProducerLot.query.filter_by(producer_company_id=user.company_id)
-        all_lots = lots_query.all()
-        
-        # Métricas
-        total_lots = len(all_lots)
-        available_lots = len([l for l in all_lots if l.status == 'available'])
-        purchased_lots = len([l for l in all_lots if l.status == 'purchased'])
-        total_weight = sum([float(l.weight_kg) for l in all_lots])
-        total_revenue = sum([float(l.purchase_price_usd or 0) for l in all_lots if l.purchase_price_usd])
+        # Métricas precalculadas de la empresa
+        stats = get_dashboard_stats(user.company_id)
         
         # Formatear lotes para el frontend
         lots_data = []
-        for lot in all_lots[:20]:  # Últimos 20 lotes
+        for lot in ProducerLot.query.filter_by(producer_company_id=user.company_id).limit(20):  # Últimos 20 lotes
             lots_data.append({
                 'id': lot.id,
                 'lot_code': lot.lot_code,
@@ -3189,11 +3399,11 @@ def get_producer_dashboard():
         
         return jsonify({
             'metrics': {
-                'total_lots': total_lots,
-                'available_lots': available_lots,
-                'purchased_lots': purchased_lots,
-                'total_weight_kg': total_weight,
-                'total_revenue_usd': total_revenue
+                'total_lots': stats['lots_total'],
+                'available_lots': stats['lots_available'],
+                'purchased_lots': stats['lots_purchased'],
+                'total_weight_kg': stats['lots_weight_kg'],
+                'total_revenue_usd': stats['lots_revenue_usd']
             },
             'lots': lots_data
         })
@@ -3213,27 +3423,24 @@ def get_exporter_dashboard():
         if not user or user.role not in ['exporter', 'admin']:
             return jsonify({'error': 'Acceso denegado'}), 403
         
+        # Métricas precalculadas de la empresa y de la plataforma
+        stats = get_dashboard_stats(user.company_id)
+        platform_stats = get_dashboard_stats(PLATFORM_ID)
+        
         # Lotes comprados por el exportador
-        purchased_lots = ProducerLot.query.join(ExportContract).filter(
-            ExportContract.exporter_company_id == user.company_id,
-            ProducerLot.status == 'purchased'
-        ).all()
+        purchased_lots = ProducerLot.query.filter_by(
+            purchased_by_company_id=user.company_id, status='purchased'
+        ).limit(20).all()
         
         # Lotes disponibles para comprar
-        available_lots = ProducerLot.query.filter_by(status='available').all()
+        available_lots = ProducerLot.query.filter_by(status='available').limit(20).all()
         
         # Batches creados por el exportador
-        batches = BatchNFT.query.filter_by(exporter_company_id=user.company_id).all()
-        
-        # Métricas
-        total_purchased_lots = len(purchased_lots)
-        total_weight_purchased = sum([float(l.weight_kg) for l in purchased_lots])
-        total_batches = len(batches)
-        total_batch_weight = sum([float(b.total_weight_kg) for b in batches])
+        batches = BatchNFT.query.filter_by(creator_company_id=user.company_id).limit(10).all()
         
         # Formatear lotes disponibles
         available_lots_data = []
-        for lot in available_lots[:20]:  # Primeros 20
+        for lot in available_lots:  # Primeros 20
             available_lots_data.append({
                 'id': lot.id,
                 'lot_code': lot.lot_code,
@@ -3249,7 +3456,7 @@ def get_exporter_dashboard():
         
         # Formatear lotes comprados
         purchased_lots_data = []
-        for lot in purchased_lots[:20]:
+        for lot in purchased_lots:
             purchased_lots_data.append({
                 'id': lot.id,
                 'lot_code': lot.lot_code,
@@ -3263,11 +3470,11 @@ def get_exporter_dashboard():
         
         return jsonify({
             'metrics': {
-                'total_purchased_lots': total_purchased_lots,
-                'total_weight_purchased_kg': total_weight_purchased,
-                'total_batches': total_batches,
-                'total_batch_weight_kg': total_batch_weight,
-                'available_lots_count': len(available_lots)
+                'total_purchased_lots': stats['purchased_lots'],
+                'total_weight_purchased_kg': stats['purchased_weight_kg'],
+                'total_batches': stats['batches_total'],
+                'total_batch_weight_kg': stats['batches_weight_kg'],
+                'available_lots_count': platform_stats['lots_available']
             },
             'available_lots': available_lots_data,
             'purchased_lots': purchased_lots_data,
@@ -3277,7 +3484,7 @@ def get_exporter_dashboard():
                 'total_weight_kg': float(b.total_weight_kg),
                 'status': b.status,
                 'created_at': b.created_at.isoformat()
-            } for b in batches[:10]]
+            } for b in batches]
         })
         
     except Exception as e:
@@ -3295,39 +3502,48 @@ def get_buyer_dashboard():
         if not user or user.role not in ['buyer', 'admin']:
             return jsonify({'error': 'Acceso denegado'}), 403
         
+        # Métricas precalculadas de la plataforma
+        stats = get_dashboard_stats(PLATFORM_ID)
+        
         # Batches disponibles para comprar
-        available_batches = BatchNFT.query.filter_by(status='available').all()
+        available_batches = BatchNFT.query.options(joinedload(BatchNFT.creator_company)).filter_by(
+            status='available'
+        ).limit(20).all()
         
         # Batches comprados (si implementas la compra de batches)
         # purchased_batches = BatchNFT.query.filter_by(buyer_company_id=user.company_id).all()
         
+        # Lotes fuente de los batches mostrados (índice batch_lots) en una consulta
+        source_lots = {}
+        for batch_id, quality_grade in db.session.query(BatchLot.batch_id, ProducerLot.quality_grade).join(
+            ProducerLot, ProducerLot.id == BatchLot.lot_id
+        ).filter(BatchLot.batch_id.in_([b.id for b in available_batches])):
+            source_lots.setdefault(batch_id, []).append(quality_grade)
+        
         # Formatear batches disponibles
         batches_data = []
-        for batch in available_batches[:20]:
-            # Obtener lotes del batch
-            source_lots = ProducerLot.query.filter_by(batch_nft_id=batch.id).all()
-            
+        for batch in available_batches:
             # Calcular quality_grade del batch basado en los lotes fuente
-            quality_grades = [lot.quality_grade for lot in source_lots if lot.quality_grade]
+            quality_grades = [grade for grade in source_lots.get(batch.id, []) if grade]
             batch_quality_grade = quality_grades[0] if quality_grades else 'N/A'
             
             batches_data.append({
                 'id': batch.id,
                 'batch_code': batch.batch_code,
-                'exporter_name': batch.exporter_company.name if batch.exporter_company else 'N/A',
-                'total_weight_kg': float(batch.total_weight_kg),
+                'exporter_name': batch.creator_company.name if batch.creator_company else 'N/A',
+                'total_weight_kg': float(batch.total_weight_kg or 0),
                 'quality_grade': batch_quality_grade,
                 'status': batch.status,
-                'created_at': batch.created_at.isoformat(),
-                'source_lots_count': len(source_lots),
-                'certifications': batch.certifications.split(',') if batch.certifications else [],
-                'location': batch.port_of_shipment or 'N/A'
+                'created_at': batch.created_at.isoformat() if batch.created_at else None,
+                'source_lots_count': len(source_lots.get(batch.id, [])),
+                'certifications': [],
+                'location': batch.location or 'N/A'
             })
         
         return jsonify({
             'metrics': {
-                'available_batches': len(available_batches),
-                'total_weight_available_kg': sum([float(b.total_weight_kg) for b in available_batches])
+                'available_batches': stats['batches_available'],
+                'total_weight_available_kg': stats['batches_available_weight_kg']
             },
             'batches': batches_data
         })
@@ -3342,63 +3558,41 @@ def get_buyer_dashboard():
 
 @app.route('/api/market/cacao-prices', methods=['GET'])
 def get_cacao_prices():
-    """Obtener precios actuales del cacao basados en contratos activos y mercado spot real (Yahoo Finance)"""
-    from decimal import Decimal
-    import statistics
-    from datetime import datetime, timedelta
-    import yfinance as yf
+    """Obtener precios actuales del cacao basados en contratos activos y mercado spot
+
+    El precio spot sale del snapshot del price feed (sondeado en segundo plano
+    y guardado en price_ticks); esta petición nunca llama a servicios externos.
+    """
+    from datetime import datetime
     
     try:
+        start_price_feed(app)
         
         # ========================================
-        # 1. OBTENER PRECIO SPOT REAL (YAHOO FINANCE)
+        # 1. PRECIO SPOT (SNAPSHOT DEL PRICE FEED)
         # ========================================
-        spot_price = 3250.0  # Valor por defecto
-        daily_change = 0.0
-        
-        try:
-            # Ticker del cacao en Yahoo Finance: CC=F (Cocoa Futures)
-            cacao = yf.Ticker("CC=F")
-            
-            # Obtener datos históricos de los últimos 5 días
-            hist = cacao.history(period="5d")
-            
-            if not hist.empty and len(hist) >= 2:
-                # Precio más reciente (último cierre)
-                current_price = float(hist['Close'].iloc[-1])
-                
-                # Convertir de USD/ton a USD/MT (métrica ton)
-                # CC=F está en USD por tonelada corta (2000 lbs)
-                # 1 tonelada métrica = 2204.62 lbs
-                spot_price = current_price * (2204.62 / 2000.0)
-                
-                # Calcular cambio diario
-                if len(hist) >= 2:
-                    prev_price = float(hist['Close'].iloc[-2])
-                    daily_change = ((current_price - prev_price) / prev_price) * 100
-                
-                logger.info(f"✅ Precio spot real obtenido: ${spot_price:.2f}/MT (cambio: {daily_change:+.2f}%)")
-            else:
-                logger.warning("⚠️ No se pudieron obtener datos de Yahoo Finance, usando valor por defecto")
-                
-        except Exception as e:
-            logger.error(f"❌ Error obteniendo precio de Yahoo Finance: {str(e)}")
-            # Continuar con valor por defecto
+        market_snapshot = price_feed.latest_snapshot()
+        spot_price = market_snapshot['spot']['price']
         
         # ========================================
-        # 2. OBTENER LOTES CON PRECIOS REALES DE BD
+        # 2. AGREGADOS DE LOTES CON PRECIOS REALES DE BD
         # ========================================
-        purchased_lots = ProducerLot.query.filter(
+        # Un único agregado SQL: número de lotes, volumen y precio medio por MT
+        lots_count, lots_weight_kg, lots_avg_price_mt = db.session.query(
+            db.func.count(ProducerLot.id),
+            db.func.sum(ProducerLot.weight_kg),
+            db.func.avg(ProducerLot.purchase_price_usd * 1000.0 / ProducerLot.weight_kg)
+        ).filter(
             ProducerLot.status.in_(['purchased', 'batched']),
             ProducerLot.purchase_price_usd.isnot(None),
             ProducerLot.weight_kg > 0
-        ).all()
+        ).one()
         
-        logger.info(f"📊 Lotes encontrados en BD: {len(purchased_lots)}")
+        lots_count = lots_count or 0
+        total_lots_weight_mt = float(lots_weight_kg or 0) / 1000.0
+        
+        logger.info(f"📊 Lotes encontrados en BD: {lots_count}")
         
-        # ========================================
-        # 3. CALCULAR PRECIO PROMEDIO DE CONTRATOS ACTIVOS (DATOS REALES)
-        # ========================================
         # ========================================
         # 3. CALCULAR PRECIO PROMEDIO DE CONTRATOS ACTIVOS (DATOS REALES)
         # ========================================
@@ -3407,23 +3601,12 @@ def get_cacao_prices():
         # - Cuando se fija un precio, se fija según el spot de ese momento
         # - El diferencial es FIJO en USD, no porcentual
         
-        contract_prices = []
-        total_contract_weight = 0.0
+        total_contract_weight = total_lots_weight_mt
         
         # Si hay lotes con precios reales en BD, usar esos datos
-        if purchased_lots and len(purchased_lots) > 0:
-            for lot in purchased_lots:
-                weight_mt = float(lot.weight_kg) / 1000.0  # Convertir kg a toneladas métricas
-                if weight_mt > 0 and lot.purchase_price_usd:
-                    price_per_mt = float(lot.purchase_price_usd) / weight_mt
-                    contract_prices.append(price_per_mt)
-                    total_contract_weight += weight_mt
-                    
-                    logger.debug(f"  - {lot.lot_code}: ${lot.purchase_price_usd} / {weight_mt:.2f} MT = ${price_per_mt:.2f}/MT")
-            
-            # Precio promedio real de contratos en BD
-            avg_contract_price = statistics.mean(contract_prices)
-            logger.info(f"💰 Precio promedio contratos (BD real): ${avg_contract_price:.2f}/MT (de {len(contract_prices)} lotes)")
+        if lots_count > 0:
+            avg_contract_price = float(lots_avg_price_mt)
+            logger.info(f"💰 Precio promedio contratos (BD real): ${avg_contract_price:.2f}/MT (de {lots_count} lotes)")
         else:
             # Si no hay lotes en BD, aplicar lógica de negocio estándar
             # Diferencial típico: -$1000 a -$1200 bajo el spot
@@ -3438,25 +3621,11 @@ def get_cacao_prices():
         # LÓGICA DE NEGOCIO:
         # - El precio fijado se establece según el spot del momento de la fijación
         # - Típicamente: Spot - $1000 a $1200 (diferencial estándar del mercado)
+        # Los lotes fijados son los mismos purchased/batched del agregado anterior
         
-        fixed_lots = ProducerLot.query.filter(
-            ProducerLot.status.in_(['purchased', 'batched']),
-            ProducerLot.purchase_price_usd.isnot(None),
-            ProducerLot.weight_kg > 0
-        ).all()
-        
-        fixed_prices = []
-        total_fixed_volume = 0.0
-        
-        if fixed_lots and len(fixed_lots) > 0:
-            for lot in fixed_lots:
-                weight_mt = float(lot.weight_kg) / 1000.0
-                if weight_mt > 0 and lot.purchase_price_usd:
-                    price_per_mt = float(lot.purchase_price_usd) / weight_mt
-                    fixed_prices.append(price_per_mt)
-                    total_fixed_volume += weight_mt
-            
-            avg_fixed_price = statistics.mean(fixed_prices) if fixed_prices else spot_price - 1100
+        if lots_count > 0:
+            avg_fixed_price = float(lots_avg_price_mt)
+            total_fixed_volume = total_lots_weight_mt
             logger.info(f"🔒 Precio fijado promedio (BD real): ${avg_fixed_price:.2f}/MT, Volumen: {total_fixed_volume:.2f} MT")
         else:
             # Precio fijado según lógica de negocio: Spot - $1100 (promedio de rango)
@@ -3467,16 +3636,13 @@ def get_cacao_prices():
         # ========================================
         # 5. CALCULAR NÚMERO DE CONTRATOS ACTIVOS (REAL)
         # ========================================
-        active_contracts = ExportContract.query.filter(
+        active_contracts, contract_volume_sum = db.session.query(
+            db.func.count(ExportContract.id),
+            db.func.sum(ExportContract.total_volume_mt)
+        ).filter(
             ExportContract.status.in_(['active', 'pending'])
-        ).count()
-        
-        total_contract_volume = ExportContract.query.filter(
-            ExportContract.status.in_(['active', 'pending']),
-            ExportContract.total_volume_mt.isnot(None)
-        ).all()
-        
-        contract_volume_sum = sum([float(c.total_volume_mt or 0) for c in total_contract_volume])
+        ).one()
+        contract_volume_sum = float(contract_volume_sum or 0)
         
         logger.info(f"📄 Contratos activos: {active_contracts}, Volumen total: {contract_volume_sum:.2f} MT")
         
@@ -3527,45 +3693,16 @@ def get_cacao_prices():
         # ========================================
         # 7. ESTADÍSTICAS DE MERCADO (52 SEMANAS)
         # ========================================
-        try:
-            cacao = yf.Ticker("CC=F")
-            hist_year = cacao.history(period="1y")
-            
-            if not hist_year.empty:
-                year_low = float(hist_year['Low'].min()) * (2204.62 / 2000.0)
-                year_high = float(hist_year['High'].max()) * (2204.62 / 2000.0)
-                
-                # Calcular volatilidad (desviación estándar de retornos diarios)
-                returns = hist_year['Close'].pct_change().dropna()
-                volatility = float(returns.std()) * 100 * (252 ** 0.5)  # Anualizada
-                
-                logger.info(f"📈 Rango anual: ${year_low:.2f} - ${year_high:.2f}, Volatilidad: {volatility:.2f}%")
-            else:
-                year_low = spot_price * 0.85
-                year_high = spot_price * 1.30
-                volatility = 15.0
-        except Exception as e:
-            logger.error(f"Error obteniendo datos históricos: {str(e)}")
-            year_low = spot_price * 0.85
-            year_high = spot_price * 1.30
-            year_low = spot_price * 0.85
-            year_high = spot_price * 1.30
-            volatility = 15.0
+        # Rango anual y volatilidad precalculados en el snapshot del price feed
         
         # ========================================
         # 8. RETORNAR RESPUESTA CON DATOS REALES
         # ========================================
         response_data = {
-            'spot': {
-                'price': round(spot_price, 2),
-                'change': round(daily_change, 2),
-                'currency': 'USD',
-                'unit': 'MT',
-                'source': 'Yahoo Finance (CC=F)'
-            },
+            'spot': market_snapshot['spot'],
             'contracts': {
                 'avgPrice': round(avg_contract_price, 2),
-                'activeCount': active_contracts if active_contracts > 0 else len(purchased_lots),
+                'activeCount': active_contracts if active_contracts > 0 else lots_count,
                 'totalVolume': round(contract_volume_sum if contract_volume_sum > 0 else total_contract_weight, 2)
             },
             'fixed': {
@@ -3579,11 +3716,8 @@ def get_cacao_prices():
                 'type': differential_type,
                 'explanation': 'Productores: -$1,400 a -$1,600/MT | Exportadoras: -$1,000 a -$1,200/MT'
             },
-            'market': {
-                'rangeMin': round(year_low, 2),
-                'rangeMax': round(year_high, 2),
-                'volatility': round(volatility, 2)
-            },
+            'market': market_snapshot['market'],
+            'staleness': market_snapshot['staleness'],
             'business_logic': {
                 'differential_producers': {
                     'min': -1600,
@@ -3613,9 +3747,9 @@ def get_cacao_prices():
                 'fixing_logic': 'Al fijar precio: Spot del momento - diferencial negociado'
             },
             'timestamp': datetime.utcnow().isoformat(),
-            'source': 'Yahoo Finance (CC=F) + Triboka Database',
+            'source': f"{market_snapshot['spot']['source']} + Triboka Database",
             'data_points': {
-                'lots_analyzed': len(purchased_lots),
+                'lots_analyzed': lots_count,
                 'contracts_active': active_contracts,
                 'total_fixed_mt': round(total_fixed_volume, 2)
             }
@@ -3790,35 +3924,12 @@ def create_deal():
 
 @app.route('/api/deals/<int:deal_id>', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para ver este deal')
 def get_deal_detail(deal_id):
     """Obtener detalles de un deal específico"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        user_role_in_deal = 'viewer'
-        
-        if user.id == deal.admin_id:
-            has_access = True
-            user_role_in_deal = 'admin'
-        elif user.company_id and user.company_id == deal.producer_id:
-            has_access = True
-            user_role_in_deal = 'producer'
-        elif user.company_id and user.company_id == deal.exporter_id:
-            has_access = True
-            user_role_in_deal = 'exporter'
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-            user_role_in_deal = 'admin'
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para ver este deal'}), 403
+        deal = g.deal
+        user_role_in_deal = g.deal_role
         
         deal_data = deal.to_dict(role=user_role_in_deal)
         
@@ -3915,35 +4026,12 @@ def invite_deal_member(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/notes', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para ver notas de este deal')
 def get_deal_notes(deal_id):
     """Obtener notas de un deal según permisos"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        user_role_in_deal = 'viewer'
-        
-        if user.id == deal.admin_id:
-            has_access = True
-            user_role_in_deal = 'admin'
-        elif user.company_id == deal.producer_id:
-            has_access = True
-            user_role_in_deal = 'producer'
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-            user_role_in_deal = 'exporter'
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-            user_role_in_deal = 'admin'
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para ver notas de este deal'}), 403
+        user_id = g.principal.id
+        user_role_in_deal = g.deal_role
         
         # Filtrar notas según permisos
         query = DealNote.query.filter_by(deal_id=deal_id)
@@ -3981,35 +4069,12 @@ def get_deal_notes(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/notes', methods=['POST'])
 @jwt_required()
+@deal_access_required('Sin permisos para crear notas en este deal')
 def create_deal_note(deal_id):
     """Crear nueva nota en un deal"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        user_role_in_deal = 'viewer'
-        
-        if user.id == deal.admin_id:
-            has_access = True
-            user_role_in_deal = 'admin'
-        elif user.company_id == deal.producer_id:
-            has_access = True
-            user_role_in_deal = 'producer'
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-            user_role_in_deal = 'exporter'
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-            user_role_in_deal = 'admin'
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para crear notas en este deal'}), 403
+        user_id = g.principal.id
+        user_role_in_deal = g.deal_role
         
         data = request.get_json()
         
@@ -4059,30 +4124,10 @@ def create_deal_note(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/messages', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para ver mensajes de este deal')
 def get_deal_messages(deal_id):
     """Obtener mensajes del deal"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para ver mensajes de este deal'}), 403
-
         messages = DealMessage.query.filter_by(deal_id=deal_id).order_by(DealMessage.created_at.asc()).all()
 
         result = []
@@ -4098,35 +4143,17 @@ def get_deal_messages(deal_id):
 
         return jsonify(result)
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-
-@app.route('/api/deals/<int:deal_id>/messages', methods=['POST'])
-@jwt_required()
-def create_deal_message(deal_id):
-    """Crear mensaje en el deal"""
-    try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-
-        # Verificar permisos para enviar mensajes
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para enviar mensajes en este deal'}), 403
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/deals/<int:deal_id>/messages', methods=['POST'])
+@jwt_required()
+@deal_access_required('Sin permisos para enviar mensajes en este deal')
+def create_deal_message(deal_id):
+    """Crear mensaje en el deal"""
+    try:
+        user_id = g.principal.id
 
         data = request.get_json()
         if 'content' not in data or not data['content'].strip():
@@ -4259,308 +4286,29 @@ def update_deal_finance(deal_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+DEAL_TRACE_CACHE_TTL = int(os.getenv('DEAL_TRACE_CACHE_TTL', 300))
+
+def get_deal_trace_cached(deal):
+    """Trazabilidad ensamblada del deal, cacheada por deal
+
+    Se invalida con el tag deal_trace:<id> (nuevos enlaces o archivos) y con
+    los tags de lotes, contratos y fijaciones que ya emiten sus endpoints.
+    """
+    include_blockchain = blockchain.is_ready()
+    return cache_layer.get_or_compute(
+        f'deal_trace:{deal.id}:{int(include_blockchain)}',
+        lambda: build_deal_trace(deal, include_blockchain=include_blockchain),
+        ttl=DEAL_TRACE_CACHE_TTL,
+        tags=(f'deal_trace:{deal.id}', 'lots', 'contracts', 'fixations')
+    )
+
 @app.route('/api/deals/<int:deal_id>/trace', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para ver trazabilidad de este deal')
 def get_deal_trace(deal_id):
     """Obtener trazabilidad completa del deal con timeline blockchain"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para ver trazabilidad de este deal'}), 403
-        
-        # Obtener enlaces de trazabilidad del deal
-        trace_links = DealTraceLink.query.filter_by(deal_id=deal_id).all()
-        
-        # Crear timeline completa de eventos
-        timeline_events = []
-        
-        # 1. Evento de creación del deal
-        timeline_events.append({
-            'id': f'deal_created_{deal.id}',
-            'type': 'deal_created',
-            'title': 'Acuerdo Creado',
-            'description': f'Acuerdo #{deal.id} creado entre productor y exportadora',
-            'timestamp': deal.created_at.isoformat(),
-            'actor': 'Sistema Triboka',
-            'icon': 'handshake',
-            'color': 'primary',
-            'metadata': {
-                'deal_id': deal.id,
-                'producer_company': deal.producer.name if deal.producer else None,
-                'exporter_company': deal.exporter.name if deal.exporter else None,
-                'admin': deal.admin.name if deal.admin else None
-            }
-        })
-        
-        # 2. Procesar cada enlace de trazabilidad
-        for link in trace_links:
-            lote_ids = link.get_lote_ids()
-            batch_ids = link.get_batch_ids()
-            events = link.get_events()
-            
-            # Eventos de lotes
-            if lote_ids:
-                lotes = ProducerLot.query.filter(ProducerLot.id.in_(lote_ids)).all()
-                for lote in lotes:
-                    # Evento de creación del lote
-                    timeline_events.append({
-                        'id': f'lote_created_{lote.id}',
-                        'type': 'lote_created',
-                        'title': f'Lote {lote.lot_code} Creado',
-                        'description': f'Lote registrado por {lote.producer_company.name if lote.producer_company else "Productor"}',
-                        'timestamp': lote.created_at.isoformat(),
-                        'actor': lote.producer_company.name if lote.producer_company else 'Productor',
-                        'icon': 'seedling',
-                        'color': 'success',
-                        'metadata': {
-                            'lote_id': lote.id,
-                            'lote_code': lote.lot_code,
-                            'weight_kg': float(lote.weight_kg),
-                            'quality_grade': lote.quality_grade,
-                            'location': lote.location,
-                            'blockchain_lot_id': lote.blockchain_lot_id
-                        }
-                    })
-                    
-                    # Evento de cosecha
-                    if lote.harvest_date:
-                        timeline_events.append({
-                            'id': f'lote_harvest_{lote.id}',
-                            'type': 'harvest',
-                            'title': f'Cosecha {lote.lot_code}',
-                            'description': f'Cosecha realizada en {lote.farm_name or "finca"}',
-                            'timestamp': lote.harvest_date.isoformat(),
-                            'actor': lote.producer_company.name if lote.producer_company else 'Productor',
-                            'icon': 'leaf',
-                            'color': 'success',
-                            'metadata': {
-                                'lote_id': lote.id,
-                                'farm_name': lote.farm_name,
-                                'location': lote.location
-                            }
-                        })
-                    
-                    # Evento de compra (si está purchased)
-                    if lote.status in ['purchased', 'batched'] and lote.purchase_date:
-                        buyer_name = 'Exportadora'
-                        if lote.purchased_by_company:
-                            buyer_name = lote.purchased_by_company.name
-                        
-                        timeline_events.append({
-                            'id': f'lote_purchased_{lote.id}',
-                            'type': 'purchase',
-                            'title': f'Lote {lote.lot_code} Comprado',
-                            'description': f'Adquirido por {buyer_name}',
-                            'timestamp': lote.purchase_date.isoformat(),
-                            'actor': buyer_name,
-                            'icon': 'shopping-cart',
-                            'color': 'info',
-                            'metadata': {
-                                'lote_id': lote.id,
-                                'buyer': buyer_name,
-                                'purchase_price': float(lote.purchase_price_usd) if lote.purchase_price_usd else None
-                            }
-                        })
-            
-            # Eventos de batches
-            if batch_ids:
-                batches = BatchNFT.query.filter(BatchNFT.id.in_(batch_ids)).all()
-                for batch in batches:
-                    timeline_events.append({
-                        'id': f'batch_created_{batch.id}',
-                        'type': 'batch_created',
-                        'title': f'Batch {batch.batch_code} Creado',
-                        'description': f'Batch creado por {batch.creator_company.name if batch.creator_company else "Exportadora"}',
-                        'timestamp': batch.created_at.isoformat(),
-                        'actor': batch.creator_company.name if batch.creator_company else 'Exportadora',
-                        'icon': 'boxes',
-                        'color': 'warning',
-                        'metadata': {
-                            'batch_id': batch.id,
-                            'batch_code': batch.batch_code,
-                            'total_weight_kg': float(batch.total_weight_kg),
-                            'batch_type': batch.batch_type,
-                            'location': batch.location,
-                            'blockchain_batch_id': batch.blockchain_batch_id
-                        }
-                    })
-            
-            # Eventos personalizados del enlace
-            if events:
-                for event in events:
-                    if isinstance(event, dict):
-                        timeline_events.append({
-                            'id': f'custom_event_{event.get("id", "unknown")}',
-                            'type': event.get('type', 'custom'),
-                            'title': event.get('title', 'Evento Personalizado'),
-                            'description': event.get('description', ''),
-                            'timestamp': event.get('timestamp', datetime.utcnow().isoformat()),
-                            'actor': event.get('actor', 'Sistema'),
-                            'icon': event.get('icon', 'circle'),
-                            'color': event.get('color', 'secondary'),
-                            'metadata': event.get('metadata', {})
-                        })
-        
-        # 3. Eventos de contratos relacionados
-        if deal.producer_company and deal.exporter_company:
-            # Buscar contratos entre estas compañías
-            contracts = ExportContract.query.filter(
-                ((ExportContract.exporter_company_id == deal.producer_id) & 
-                 (ExportContract.buyer_company_id == deal.exporter_id)) |
-                ((ExportContract.exporter_company_id == deal.exporter_id) & 
-                 (ExportContract.buyer_company_id == deal.producer_id))
-            ).all()
-            
-            for contract in contracts:
-                # Evento de creación del contrato
-                timeline_events.append({
-                    'id': f'contract_created_{contract.id}',
-                    'type': 'contract_created',
-                    'title': f'Contrato {contract.contract_code} Creado',
-                    'description': f'Contrato entre {contract.exporter_company.name if contract.exporter_company else "Exportadora"} y {contract.buyer_company.name if contract.buyer_company else "Comprador"}',
-                    'timestamp': contract.created_at.isoformat(),
-                    'actor': 'Sistema Triboka',
-                    'icon': 'file-contract',
-                    'color': 'primary',
-                    'metadata': {
-                        'contract_id': contract.id,
-                        'contract_code': contract.contract_code,
-                        'total_volume_mt': float(contract.total_volume_mt),
-                        'status': contract.status,
-                        'blockchain_contract_id': contract.blockchain_contract_id
-                    }
-                })
-                
-                # Fijaciones del contrato
-                fixations = ContractFixation.query.filter_by(export_contract_id=contract.id).all()
-                for fixation in fixations:
-                    timeline_events.append({
-                        'id': f'fixation_created_{fixation.id}',
-                        'type': 'fixation',
-                        'title': f'Fijación de Precio',
-                        'description': f'Precio fijado: ${fixation.spot_price_usd} USD + ${contract.differential_usd} diferencial',
-                        'timestamp': fixation.fixation_date.isoformat(),
-                        'actor': contract.exporter_company.name if contract.exporter_company else 'Exportadora',
-                        'icon': 'dollar-sign',
-                        'color': 'success',
-                        'metadata': {
-                            'fixation_id': fixation.id,
-                            'fixed_quantity_mt': float(fixation.fixed_quantity_mt),
-                            'spot_price_usd': float(fixation.spot_price_usd),
-                            'differential_usd': float(contract.differential_usd),
-                            'total_value_usd': float(fixation.total_value_usd)
-                        }
-                    })
-        
-        # 4. Eventos de mensajes importantes del deal
-        important_messages = DealMessage.query.filter_by(deal_id=deal_id).filter(
-            DealMessage.message_type.in_(['system', 'file_upload'])
-        ).order_by(DealMessage.created_at.asc()).all()
-        
-        for msg in important_messages:
-            if msg.message_type == 'file_upload':
-                timeline_events.append({
-                    'id': f'message_{msg.id}',
-                    'type': 'file_upload',
-                    'title': 'Archivo Compartido',
-                    'description': msg.content,
-                    'timestamp': msg.created_at.isoformat(),
-                    'actor': msg.author.name if msg.author else 'Usuario',
-                    'icon': 'paperclip',
-                    'color': 'info',
-                    'metadata': {
-                        'message_id': msg.id,
-                        'attachments': json.loads(msg.attachments) if msg.attachments else []
-                    }
-                })
-            elif msg.message_type == 'system':
-                timeline_events.append({
-                    'id': f'message_{msg.id}',
-                    'type': 'system_event',
-                    'title': 'Evento del Sistema',
-                    'description': msg.content,
-                    'timestamp': msg.created_at.isoformat(),
-                    'actor': 'Sistema Triboka',
-                    'icon': 'cog',
-                    'color': 'secondary',
-                    'metadata': {
-                        'message_id': msg.id
-                    }
-                })
-        
-        # 5. Eventos simulados de blockchain (para demo)
-        # En producción, estos vendrían del servicio blockchain real
-        blockchain_events = []
-        if blockchain.is_ready():
-            # Aquí se integrarían eventos reales del blockchain
-            # Por ahora, simulamos algunos eventos
-            for lote in ProducerLot.query.filter(ProducerLot.id.in_(sum([link.get_lote_ids() for link in trace_links], []))).all():
-                if lote.blockchain_lot_id:
-                    blockchain_events.append({
-                        'id': f'blockchain_lote_{lote.id}',
-                        'type': 'blockchain_mint',
-                        'title': f'NFT Lote {lote.lot_code} Creado',
-                        'description': f'Lote tokenizado en blockchain como NFT',
-                        'timestamp': lote.created_at.isoformat(),
-                        'actor': 'Blockchain Triboka',
-                        'icon': 'gem',
-                        'color': 'purple',
-                        'metadata': {
-                            'blockchain_lot_id': lote.blockchain_lot_id,
-                            'network': 'Polygon',
-                            'contract': 'ProducerLotNFT'
-                        }
-                    })
-        
-        timeline_events.extend(blockchain_events)
-        
-        # Ordenar timeline por timestamp (más antiguos primero)
-        timeline_events.sort(key=lambda x: x['timestamp'])
-        
-        # Crear resumen de trazabilidad
-        trace_summary = {
-            'deal_id': deal_id,
-            'total_events': len(timeline_events),
-            'date_range': {
-                'start': timeline_events[0]['timestamp'] if timeline_events else None,
-                'end': timeline_events[-1]['timestamp'] if timeline_events else None
-            },
-            'entities': {
-                'lotes': len(set([e['metadata'].get('lote_id') for e in timeline_events if e['metadata'].get('lote_id')])),
-                'batches': len(set([e['metadata'].get('batch_id') for e in timeline_events if e['metadata'].get('batch_id')])),
-                'contracts': len(set([e['metadata'].get('contract_id') for e in timeline_events if e['metadata'].get('contract_id')])),
-                'blockchain_events': len([e for e in timeline_events if 'blockchain' in e['type']])
-            }
-        }
-        
-        return jsonify({
-            'summary': trace_summary,
-            'timeline': timeline_events,
-            'trace_links': [{
-                'id': link.id,
-                'lote_ids': link.get_lote_ids(),
-                'batch_ids': link.get_batch_ids(),
-                'events': link.get_events(),
-                'created_at': link.created_at.isoformat()
-            } for link in trace_links]
-        })
+        return jsonify(get_deal_trace_cached(g.deal))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4593,6 +4341,7 @@ def add_deal_trace(deal_id):
         
         db.session.add(trace_link)
         db.session.commit()
+        invalidate_cache_tags(f'deal_trace:{deal_id}')
         
         return jsonify({
             'message': 'Trazabilidad agregada exitosamente',
@@ -4626,23 +4375,13 @@ def handle_join_deal(data):
         
         # Verificar permisos del usuario para el deal
         deal = Deal.query.get(deal_id)
-        user = User.query.get(user_id)
+        principal = load_principal(user_id)
         
-        if not deal or not user:
+        if not deal or not principal:
             emit('error', {'message': 'Deal o usuario no encontrado'})
             return
         
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
+        if not principal.can_access_deal(deal):
             emit('error', {'message': 'Sin permisos para acceder a este deal'})
             return
         
@@ -4653,8 +4392,8 @@ def handle_join_deal(data):
         # Notificar a otros usuarios en la sala
         emit('user_joined', {
             'user_id': user_id,
-            'user_name': user.name,
-            'message': f'{user.name} se unió al chat'
+            'user_name': principal.name,
+            'message': f'{principal.name} se unió al chat'
         }, room=room, skip_sid=True)
         
         # Confirmar unión al usuario
@@ -4674,17 +4413,48 @@ def handle_leave_deal(data):
             room = f'deal_{deal_id}'
             leave_room(room)
             
-            user = User.query.get(user_id)
-            if user:
+            principal = load_principal(user_id)
+            if principal:
                 emit('user_left', {
                     'user_id': user_id,
-                    'user_name': user.name,
-                    'message': f'{user.name} salió del chat'
+                    'user_name': principal.name,
+                    'message': f'{principal.name} salió del chat'
                 }, room=room, skip_sid=True)
         
     except Exception as e:
         emit('error', {'message': str(e)})
 
+@socketio.on('watch_report')
+def handle_watch_report(data):
+    """Suscribirse al evento report_ready de un trabajo de reporte (requiere 'token' JWT)"""
+    try:
+        try:
+            principal = load_principal(decode_token(data.get('token') or '')[current_app.config['JWT_IDENTITY_CLAIM']])
+        except Exception:
+            principal = None
+        if principal is None:
+            emit('error', {'message': 'Token requerido'})
+            return
+
+        job = report_jobs.status(data.get('job_id'))
+        if not job or not _can_access_report(job['id'], principal):
+            emit('error', {'message': 'Reporte no encontrado'})
+            return
+        
+        join_room(f"report_{job['id']}")
+        # Si ya terminó, responder de inmediato
+        if job['status'] != 'pending':
+            emit('report_ready', job)
+        
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+def notify_report_ready(job):
+    """Avisar por WebSocket a los clientes suscritos al reporte"""
+    socketio.emit('report_ready', job, room=f"report_{job['id']}")
+
+report_jobs.add_listener(notify_report_ready)
+
 @socketio.on('send_message')
 def handle_send_message(data):
     """Enviar mensaje en tiempo real"""
@@ -4700,23 +4470,13 @@ def handle_send_message(data):
         
         # Verificar permisos
         deal = Deal.query.get(deal_id)
-        user = User.query.get(user_id)
+        principal = load_principal(user_id)
         
-        if not deal or not user:
+        if not deal or not principal:
             emit('error', {'message': 'Deal o usuario no encontrado'})
             return
         
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
+        if not principal.can_access_deal(deal):
             emit('error', {'message': 'Sin permisos para enviar mensajes'})
             return
         
@@ -4737,7 +4497,7 @@ def handle_send_message(data):
             'id': msg.id,
             'deal_id': msg.deal_id,
             'author_id': msg.author_id,
-            'author_name': msg.author.name if msg.author else 'Usuario',
+            'author_name': principal.name,
             'content': msg.content,
             'attachments': json.loads(msg.attachments) if msg.attachments else [],
             'created_at': msg.created_at.isoformat(),
@@ -4763,12 +4523,12 @@ def handle_typing_start(data):
         user_id = data.get('user_id')
         
         if deal_id and user_id:
-            user = User.query.get(user_id)
+            principal = load_principal(user_id)
             room = f'deal_{deal_id}'
             
             emit('user_typing', {
                 'user_id': user_id,
-                'user_name': user.name if user else 'Usuario',
+                'user_name': principal.name if principal else 'Usuario',
                 'is_typing': True
             }, room=room, skip_sid=True)
             
@@ -4783,12 +4543,12 @@ def handle_typing_stop(data):
         user_id = data.get('user_id')
         
         if deal_id and user_id:
-            user = User.query.get(user_id)
+            principal = load_principal(user_id)
             room = f'deal_{deal_id}'
             
             emit('user_typing', {
                 'user_id': user_id,
-                'user_name': user.name if user else 'Usuario',
+                'user_name': principal.name if principal else 'Usuario',
                 'is_typing': False
             }, room=room, skip_sid=True)
             
@@ -4801,29 +4561,13 @@ def handle_typing_stop(data):
 
 @app.route('/api/deals/<int:deal_id>/upload', methods=['POST'])
 @jwt_required()
+@deal_access_required('Sin permisos para subir archivos')
 def upload_deal_file(deal_id):
     """Subir archivo al deal con etiquetas de confidencialidad"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para subir archivos'}), 403
+        principal = g.principal
+        user_id = principal.id
+        deal = g.deal
         
         if 'file' not in request.files:
             return jsonify({'error': 'Archivo requerido'}), 400
@@ -4859,7 +4603,7 @@ def upload_deal_file(deal_id):
             confidentiality = 'PUBLIC'
         
         # Solo admin puede subir archivos SOLO_ADMIN
-        if confidentiality == 'SOLO_ADMIN' and user.id != deal.admin_id and user.role not in ['admin', 'operator']:
+        if confidentiality == 'SOLO_ADMIN' and principal.id != deal.admin_id and principal.role not in ['admin', 'operator']:
             return jsonify({'error': 'Solo admin puede subir archivos privados'}), 403
         
         # Crear registro del archivo
@@ -4871,7 +4615,7 @@ def upload_deal_file(deal_id):
             'file_size': os.path.getsize(file_path),
             'file_type': file_extension,
             'uploaded_by': user_id,
-            'uploaded_by_name': user.name,
+            'uploaded_by_name': principal.name,
             'confidentiality': confidentiality,
             'description': description,
             'uploaded_at': datetime.utcnow().isoformat()
@@ -4888,6 +4632,7 @@ def upload_deal_file(deal_id):
         
         db.session.add(system_message)
         db.session.commit()
+        invalidate_cache_tags(f'deal_trace:{deal_id}')
         
         # Notificar via WebSocket
         room = f'deal_{deal_id}'
@@ -4907,35 +4652,12 @@ def upload_deal_file(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/files', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para ver archivos')
 def get_deal_files(deal_id):
     """Obtener lista de archivos del deal según permisos"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos básicos
-        has_access = False
-        user_role_in_deal = 'viewer'
-        
-        if user.id == deal.admin_id:
-            has_access = True
-            user_role_in_deal = 'admin'
-        elif user.company_id == deal.producer_id:
-            has_access = True
-            user_role_in_deal = 'producer'
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-            user_role_in_deal = 'exporter'
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-            user_role_in_deal = 'admin'
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para ver archivos'}), 403
+        deal = g.deal
+        user_role_in_deal = g.deal_role
         
         # Obtener mensajes con archivos
         file_messages = DealMessage.query.filter_by(
@@ -4975,35 +4697,12 @@ def get_deal_files(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/files/<file_id>/download', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para descargar archivos')
 def download_deal_file(deal_id, file_id):
     """Descargar archivo del deal"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos básicos
-        has_access = False
-        user_role_in_deal = 'viewer'
-        
-        if user.id == deal.admin_id:
-            has_access = True
-            user_role_in_deal = 'admin'
-        elif user.company_id == deal.producer_id:
-            has_access = True
-            user_role_in_deal = 'producer'
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-            user_role_in_deal = 'exporter'
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-            user_role_in_deal = 'admin'
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para descargar archivos'}), 403
+        deal = g.deal
+        user_role_in_deal = g.deal_role
         
         # Buscar el archivo en los mensajes
         file_messages = DealMessage.query.filter_by(
@@ -5053,30 +4752,10 @@ def download_deal_file(deal_id, file_id):
 
 @app.route('/api/deals/<int:deal_id>/messages/search', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para buscar mensajes')
 def search_deal_messages(deal_id):
     """Buscar mensajes en el deal con filtros avanzados"""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para buscar mensajes'}), 403
-        
         # Parámetros de búsqueda
         query = request.args.get('q', '').strip()
         author_id = request.args.get('author_id')
@@ -5143,282 +4822,80 @@ def search_deal_messages(deal_id):
 
 @app.route('/api/deals/<int:deal_id>/trace/export', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para exportar trazabilidad')
 def export_deal_trace_pdf(deal_id):
-    """Exportar trazabilidad completa del deal en PDF"""
+    """Exportar trazabilidad completa del deal en PDF
+
+    El PDF se renderiza en el pool de reportes; con async=true se responde
+    202 con el trabajo (consultar /api/reports/<id> o esperar report_ready).
+    """
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para exportar trazabilidad'}), 403
-        
-        # Obtener datos de trazabilidad (reutilizar lógica del endpoint GET)
-        from io import BytesIO
-        
-        # Obtener timeline completa (código similar al endpoint GET)
-        trace_links = DealTraceLink.query.filter_by(deal_id=deal_id).all()
-        timeline_events = []
-        
-        # Evento de creación del deal
-        timeline_events.append({
-            'type': 'deal_created',
-            'title': 'Acuerdo Creado',
-            'description': f'Acuerdo #{deal.id} creado entre productor y exportadora',
-            'timestamp': deal.created_at.isoformat(),
-            'actor': 'Sistema Triboka',
-            'metadata': {
-                'deal_id': deal.id,
-                'producer_company': deal.producer.name if deal.producer else None,
-                'exporter_company': deal.exporter.name if deal.exporter else None
-            }
-        })
-        
-        # Procesar enlaces de trazabilidad (versión simplificada)
-        for link in trace_links:
-            lote_ids = link.get_lote_ids()
-            if lote_ids:
-                lotes = ProducerLot.query.filter(ProducerLot.id.in_(lote_ids)).all()
-                for lote in lotes:
-                    timeline_events.append({
-                        'type': 'lote_created',
-                        'title': f'Lote {lote.lot_code} Creado',
-                        'description': f'Lote registrado por {lote.producer_company.name if lote.producer_company else "Productor"}',
-                        'timestamp': lote.created_at.isoformat(),
-                        'actor': lote.producer_company.name if lote.producer_company else 'Productor',
-                        'metadata': {
-                            'lote_code': lote.lot_code,
-                            'weight_kg': float(lote.weight_kg),
-                            'quality_grade': lote.quality_grade
-                        }
-                    })
-        
-        # Generar PDF
-        from reportlab.lib import colors
-        from reportlab.lib.pagesizes import letter, A4
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-        from reportlab.lib.units import inch
-        
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        styles = getSampleStyleSheet()
-        
-        # Estilos personalizados
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=16,
-            spaceAfter=30,
-            alignment=1  # Centrado
-        )
-        
-        subtitle_style = ParagraphStyle(
-            'CustomSubtitle',
-            parent=styles['Heading2'],
-            fontSize=14,
-            spaceAfter=20
-        )
-        
-        normal_style = styles['Normal']
-        event_style = ParagraphStyle(
-            'EventStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            leftIndent=20
-        )
-        
-        # Contenido del PDF
-        content = []
-        
-        # Título
-        content.append(Paragraph("Certificado de Trazabilidad Triboka Agro", title_style))
-        content.append(Spacer(1, 12))
-        
-        # Información del deal
-        content.append(Paragraph("Información del Acuerdo", subtitle_style))
-        deal_info = [
-            ["ID del Acuerdo:", str(deal.id)],
-            ["Productor:", deal.producer.name if deal.producer else "N/A"],
-            ["Exportadora:", deal.exporter.name if deal.exporter else "N/A"],
-            ["Admin:", deal.admin.name if deal.admin else "N/A"],
-            ["Fecha de Creación:", deal.created_at.strftime("%Y-%m-%d %H:%M:%S")],
-            ["Estado:", deal.status.title()]
-        ]
-        
-        deal_table = Table(deal_info, colWidths=[2*inch, 4*inch])
-        deal_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
-            ('TEXTCOLOR', (0, 0), (0, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        content.append(deal_table)
-        content.append(Spacer(1, 20))
-        
-        # Timeline de eventos
-        content.append(Paragraph("Línea de Tiempo de Trazabilidad", subtitle_style))
-        content.append(Spacer(1, 12))
-        
-        # Ordenar eventos por timestamp
-        timeline_events.sort(key=lambda x: x['timestamp'])
-        
-        for event in timeline_events[:50]:  # Limitar a 50 eventos para evitar PDFs muy largos
-            try:
-                event_date = datetime.fromisoformat(event['timestamp'].replace('Z', '+00:00'))
-                date_str = event_date.strftime("%Y-%m-%d %H:%M:%S")
-            except:
-                date_str = event['timestamp']
-            
-            event_text = f"<b>{date_str}</b> - <b>{event['title']}</b><br/>" \
-                        f"<i>{event['actor']}</i><br/>" \
-                        f"{event['description']}"
-            
-            content.append(Paragraph(event_text, event_style))
-            content.append(Spacer(1, 8))
-        
-        # Información adicional
-        content.append(Spacer(1, 20))
-        content.append(Paragraph("Información Adicional", subtitle_style))
-        
-        additional_info = [
-            ["Total de Eventos:", str(len(timeline_events))],
-            ["Período de Trazabilidad:", f"{timeline_events[0]['timestamp'][:10] if timeline_events else 'N/A'} - {timeline_events[-1]['timestamp'][:10] if timeline_events else 'N/A'}"],
-            ["Generado por:", user.name],
-            ["Fecha de Generación:", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")],
-            ["Sistema:", "Triboka Agro - Plataforma de Trazabilidad Blockchain"]
-        ]
-        
-        additional_table = Table(additional_info, colWidths=[2.5*inch, 3.5*inch])
-        additional_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
-            ('TEXTCOLOR', (0, 0), (0, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 9),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        content.append(additional_table)
-        
-        # Pie de página
-        content.append(Spacer(1, 30))
-        footer_text = """
-        <para alignment="center" fontSize="8">
-        Este certificado de trazabilidad es generado por el sistema Triboka Agro y certifica la autenticidad 
-        de la cadena de suministro desde la finca hasta la exportación. La información contenida en este 
-        documento está respaldada por registros blockchain inmutables.
-        </para>
-        """
-        content.append(Paragraph(footer_text, ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, alignment=1)))
-        
-        # Generar PDF
-        doc.build(content)
-        buffer.seek(0)
-        
-        # Retornar PDF como respuesta
-        from flask import send_file
-        return send_file(
-            buffer,
-            as_attachment=True,
+        principal = g.principal
+        deal = g.deal
+        
+        # Timeline compartido con el endpoint GET (ya ordenado)
+        payload = {
+            'deal_info': [
+                ["ID del Acuerdo:", str(deal.id)],
+                ["Productor:", deal.producer.name if deal.producer else "N/A"],
+                ["Exportadora:", deal.exporter.name if deal.exporter else "N/A"],
+                ["Admin:", deal.admin.name if deal.admin else "N/A"],
+                ["Fecha de Creación:", deal.created_at.strftime("%Y-%m-%d %H:%M:%S")],
+                ["Estado:", (deal.status or '').title()]
+            ],
+            'timeline': get_deal_trace_cached(deal)['timeline'],
+            'generated_by': principal.name
+        }
+        job = report_jobs.submit(
+            'deal_trace_pdf', payload,
             download_name=f'trazabilidad_deal_{deal_id}_{datetime.utcnow().strftime("%Y%m%d_%H%M%S")}.pdf',
-            mimetype='application/pdf'
+            owner={'user_id': principal.id, 'company_id': principal.company_id, 'deal_id': deal.id}
         )
         
+        inline_wait = 0 if request.args.get('async', 'false').lower() == 'true' else REPORT_INLINE_WAIT
+        return report_jobs.respond(job, inline_wait=inline_wait)
+        
     except Exception as e:
         return jsonify({'error': f'Error generando PDF: {str(e)}'}), 500
 
+def _can_access_report(job_id, principal):
+    """El reporte lo pidió el usuario o su empresa, o el usuario tiene acceso a su deal"""
+    if principal.role == 'admin':
+        return True
+    return report_jobs.is_allowed(job_id, user_id=principal.id, company_id=principal.company_id,
+                                  can_access_deal=principal.can_access_deal)
+
+@app.route('/api/reports/<job_id>', methods=['GET'])
+@jwt_required()
+def get_report_job(job_id):
+    """Estado de un trabajo de reporte"""
+    principal = current_principal()
+    job = report_jobs.status(job_id)
+    # 404 también sin permisos: no confirmar que el reporte existe
+    if not job or not principal or not _can_access_report(job_id, principal):
+        return jsonify({'error': 'Reporte no encontrado'}), 404
+    return jsonify({'job': job})
+
+@app.route('/api/reports/<job_id>/download', methods=['GET'])
+@jwt_required()
+def download_report(job_id):
+    """Descargar el artefacto de un reporte (ETag, 304 si no cambió)"""
+    principal = current_principal()
+    job = report_jobs.status(job_id)
+    if not job or not principal or not _can_access_report(job_id, principal):
+        return jsonify({'error': 'Reporte no encontrado'}), 404
+    if job['status'] == 'pending':
+        return jsonify({'error': 'Reporte en proceso', 'job': job}), 409
+    return report_jobs.respond(job)
+
 @app.route('/api/deals/<int:deal_id>/trace/filter', methods=['GET'])
 @jwt_required()
+@deal_access_required('Sin permisos para filtrar trazabilidad')
 def filter_deal_trace(deal_id):
     """Filtrar eventos de trazabilidad por tipo, fecha, actor, etc."""
     try:
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'error': 'Deal no encontrado'}), 404
-        
-        # Verificar permisos
-        has_access = False
-        if user.id == deal.admin_id:
-            has_access = True
-        elif user.company_id == deal.producer_id:
-            has_access = True
-        elif user.company_id == deal.exporter_id:
-            has_access = True
-        elif user.role in ['admin', 'operator']:
-            has_access = True
-        
-        if not has_access:
-            return jsonify({'error': 'Sin permisos para filtrar trazabilidad'}), 403
-        
-        # Obtener timeline completa (reutilizar lógica)
-        trace_links = DealTraceLink.query.filter_by(deal_id=deal_id).all()
-        timeline_events = []
-        
-        # ... [código para generar timeline_events, igual que en get_deal_trace]
-        
-        # Evento de creación del deal
-        timeline_events.append({
-            'id': f'deal_created_{deal.id}',
-            'type': 'deal_created',
-            'title': 'Acuerdo Creado',
-            'description': f'Acuerdo #{deal.id} creado entre productor y exportadora',
-            'timestamp': deal.created_at.isoformat(),
-            'actor': 'Sistema Triboka',
-            'icon': 'handshake',
-            'color': 'primary',
-            'metadata': {
-                'deal_id': deal.id,
-                'producer_company': deal.producer.name if deal.producer else None,
-                'exporter_company': deal.exporter.name if deal.exporter else None,
-                'admin': deal.admin.name if deal.admin else None
-            }
-        })
-        
-        # Procesar enlaces de trazabilidad (simplificado)
-        for link in trace_links:
-            lote_ids = link.get_lote_ids()
-            if lote_ids:
-                lotes = ProducerLot.query.filter(ProducerLot.id.in_(lote_ids)).all()
-                for lote in lotes:
-                    timeline_events.append({
-                        'id': f'lote_created_{lote.id}',
-                        'type': 'lote_created',
-                        'title': f'Lote {lote.lot_code} Creado',
-                        'description': f'Lote registrado por {lote.producer_company.name if lote.producer_company else "Productor"}',
-                        'timestamp': lote.created_at.isoformat(),
-                        'actor': lote.producer_company.name if lote.producer_company else 'Productor',
-                        'icon': 'seedling',
-                        'color': 'success',
-                        'metadata': {
-                            'lote_id': lote.id,
-                            'lote_code': lote.lot_code,
-                            'weight_kg': float(lote.weight_kg),
-                            'quality_grade': lote.quality_grade,
-                            'location': lote.location,
-                            'blockchain_lot_id': lote.blockchain_lot_id
-                        }
-                    })
+        # Timeline compartido con el endpoint GET
+        timeline_events = get_deal_trace_cached(g.deal)['timeline']
         
         # Aplicar filtros
         event_type = request.args.get('type')
@@ -5957,28 +5434,20 @@ def create_trace_event():
             except Exception as sign_error:
                 logger.warning(f"Error firmando evento: {sign_error}")
         
-        # Registrar en blockchain si está disponible y es evento importante
-        important_events = ['lot_creation', 'batch_creation', 'export', 'certification']
-        if blockchain.is_ready() and event_type in important_events:
-            try:
-                # Intentar registrar en blockchain
-                tx_hash = _register_event_on_chain(trace_event)
-                if tx_hash:
-                    trace_event.blockchain_tx_hash = tx_hash
-                    trace_event.blockchain_block_number = blockchain.w3.eth.block_number
-                    trace_event.blockchain_timestamp = datetime.utcnow()
-            except Exception as blockchain_error:
-                logger.warning(f"Error registrando en blockchain: {blockchain_error}")
+        # El registro on-chain se hace por lotes: el evento queda pendiente hasta
+        # el siguiente anclaje Merkle (services.trace_anchoring)
         
-        # Actualizar timeline
-        _update_timeline_stats(entity_type, str(entity_id))
+        # Agregar al timeline append-only de la entidad
+        append_timeline_event(trace_event)
         
         db.session.commit()
+        invalidate_cache_tags('traceability')
         
         return jsonify({
             'message': 'Evento de trazabilidad registrado exitosamente',
             'event': trace_event.to_dict(include_private=True),
-            'blockchain_registered': trace_event.blockchain_tx_hash is not None
+            'blockchain_registered': trace_event.blockchain_tx_hash is not None,
+            'anchor_status': 'pending_anchor'
         }), 201
         
     except Exception as e:
@@ -6099,45 +5568,62 @@ def get_trace_timeline(entity_type, entity_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Verificación pública: max-age para navegadores/CDN y token bucket por IP
+PUBLIC_TRACE_MAX_AGE = int(os.getenv('PUBLIC_TRACE_MAX_AGE', 60))
+public_trace_limiter = TokenBucketLimiter(
+    rate=float(os.getenv('PUBLIC_TRACE_RATE', 5)),
+    burst=int(os.getenv('PUBLIC_TRACE_BURST', 30))
+)
+# Proxies (nginx) de los que se acepta X-Real-IP como IP del cliente
+TRUSTED_PROXIES = {ip.strip() for ip in os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if ip.strip()}
+
+def _client_ip():
+    if request.remote_addr in TRUSTED_PROXIES and request.headers.get('X-Real-IP'):
+        return request.headers['X-Real-IP']
+    return request.remote_addr or 'unknown'
+
 @app.route('/api/public/trace/verify/<entity_type>/<entity_id>', methods=['GET'])
 def verify_trace_public(entity_type, entity_id):
-    """API pública para verificar trazabilidad (sin autenticación)"""
+    """API pública para verificar trazabilidad (sin autenticación)
+
+    Se sirve desde el snapshot comprimido de la entidad (services.public_trace)
+    con ETag fuerte: los escaneos repetidos reciben 304 y el resto una sola
+    lectura de public_trace_snapshots. Limitado por IP con un token bucket.
+    """
     try:
+        allowed, retry_after = public_trace_limiter.allow(_client_ip())
+        if not allowed:
+            response = jsonify({'error': 'Demasiadas solicitudes, intente más tarde'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            return response
+        
         # Validar tipo de entidad
-        allowed_types = ['lot', 'batch', 'contract']
-        if entity_type not in allowed_types:
+        if entity_type not in PUBLIC_ENTITY_TYPES:
             return jsonify({'error': 'Tipo de entidad no válido'}), 400
         
-        # Obtener timeline público
-        timeline = TraceTimeline.query.filter_by(
-            entity_type=entity_type,
-            entity_id=str(entity_id)
-        ).first()
-        
-        if not timeline:
+        snapshot = get_public_snapshot(entity_type, entity_id, build_public_verification)
+        if snapshot is None:
             return jsonify({'error': 'Entidad no encontrada o sin trazabilidad'}), 404
         
-        # Obtener solo eventos públicos
-        events = TraceEvent.query.filter_by(
-            entity_type=entity_type,
-            entity_id=str(entity_id),
-            is_public=True
-        ).order_by(TraceEvent.event_timestamp.asc()).all()
-        
-        # Información básica de verificación
-        verification_info = {
-            'entity_type': entity_type,
-            'entity_id': entity_id,
-            'total_events': len(events),
-            'blockchain_events': sum(1 for e in events if e.blockchain_tx_hash),
-            'last_update': timeline.last_event_timestamp.isoformat() if timeline.last_event_timestamp else None,
-            'verification_status': 'verified' if events else 'no_data',
-            'events': [event.to_dict(include_private=False) for event in events]
-        }
-        
-        return jsonify(verification_info), 200
+        # Representaciones distintas (gzip / sin comprimir) llevan ETags distintos
+        etag, payload = snapshot
+        use_gzip = request.accept_encodings['gzip'] > 0
+        representation_etag = f"{etag}-gz" if use_gzip else etag
+        if request.if_none_match.contains_weak(etag) or request.if_none_match.contains_weak(f"{etag}-gz"):
+            response = Response(status=304)
+        else:
+            response = Response(payload if use_gzip else gzip.decompress(payload), mimetype='application/json')
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(representation_etag)
+        response.headers['Cache-Control'] = f'public, max-age={PUBLIC_TRACE_MAX_AGE}'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
         
     except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error en verificación pública {entity_type}/{entity_id}: {str(e)}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
 @app.route('/api/trace/event/<int:event_id>', methods=['GET'])
@@ -6255,52 +5741,6 @@ def _check_trace_permissions(user, entity_type, entity_id):
         logger.error(f"Error verificando permisos de trazabilidad: {e}")
         return False
 
-def _register_event_on_chain(trace_event):
-    """Registrar evento en blockchain si está disponible"""
-    try:
-        if not blockchain.is_ready():
-            return None
-        
-        # Preparar datos para blockchain
-        event_data = {
-            'eventType': trace_event.event_type,
-            'entityType': trace_event.entity_type,
-            'entityId': trace_event.entity_id,
-            'eventHash': trace_event.get_event_hash(),
-            'timestamp': int(trace_event.event_timestamp.timestamp()),
-            'actor': trace_event.actor_name
-        }
-        
-        # Intentar registrar usando el servicio de blockchain
-        # Esto dependerá de los contratos inteligentes disponibles
-        if hasattr(blockchain, 'register_trace_event'):
-            tx_hash = blockchain.register_trace_event(event_data)
-            return tx_hash
-        
-        return None
-        
-    except Exception as e:
-        logger.error(f"Error registrando evento en blockchain: {e}")
-        return None
-
-def _update_timeline_stats(entity_type, entity_id):
-    """Actualizar estadísticas del timeline"""
-    try:
-        timeline = TraceTimeline.query.filter_by(
-            entity_type=entity_type,
-            entity_id=entity_id
-        ).first()
-        
-        if not timeline:
-            timeline = TraceTimeline(entity_type=entity_type, entity_id=entity_id)
-            db.session.add(timeline)
-        
-        timeline.update_stats()
-        db.session.commit()
-        
-    except Exception as e:
-        logger.error(f"Error actualizando estadísticas del timeline: {e}")
-
 # =====================================
 # ENDPOINTS DE MATCHMAKING B2B
 # =====================================
@@ -6909,4 +6349,16 @@ if __name__ == '__main__':
     print("💬 WebSocket Chat: ws://localhost:5003/socket.io (desarrollo) | wss://app.triboka.com/socket.io (producción)")
     print("🔗 Blockchain integration:", "✅ Ready" if blockchain.is_ready() else "⚠️ Not configured")
     
+    # Sondeo de precios de mercado en segundo plano
+    start_price_feed(app)
+    
+    # Envío de transacciones blockchain encoladas
+    start_tx_outbox_worker(app, blockchain)
+    
+    # Anclaje Merkle periódico de eventos de trazabilidad
+    start_trace_anchoring(app, blockchain)
+    
+    # Reconciliación periódica de los contadores del dashboard
+    start_dashboard_reconciler(app)
+    
     socketio.run(app, debug=False, host='0.0.0.0', port=9091, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Benchmark de AnalyticsEngine: agregados en SQL frente a cargar filas ORM
+Siembra una base SQLite temporal con N contratos/fijaciones/lotes/eventos y
+compara la versión anterior (.all() + Counter/NumPy/pandas en Python) con
+las consultas GROUP BY actuales sobre la misma ventana de 90 días.
+
+Uso: python benchmark_analytics.py [--rows 50000] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+
+# Base temporal propia: app_web3 se conecta a DATABASE_URL al importarse
+BENCH_DIR = tempfile.mkdtemp(prefix='triboka-bench-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(BENCH_DIR, 'bench.db')}"
+
+from models_simple import db, Company, ContractFixation, ExportContract, ProducerLot, TraceEvent
+from routes.analytics import AnalyticsEngine
+from app_web3 import app
+
+EVENT_TYPES = ['PRODUCER_INIT', 'RECEPCIÓN', 'CALIDAD', 'DRYING', 'FERMENTATION', 'SHIPMENT']
+
+
+def seed(rows: int):
+    """Insertar `rows` filas de cada tabla repartidas en los últimos 90 días"""
+    random.seed(42)
+    today = datetime.utcnow()
+
+    def when():
+        return today - timedelta(days=random.randint(0, 89), minutes=random.randint(0, 1440))
+
+    buyers = [Company(name=f'Comprador {i}', company_type='buyer') for i in range(20)]
+    db.session.add_all(buyers)
+    db.session.flush()
+    db.session.bulk_insert_mappings(ExportContract, [{
+        'contract_code': f'BENCH-C-{i}',
+        'buyer_company_id': random.choice(buyers).id,
+        'product_type': random.choice(['Cacao CCN51', 'Cacao Nacional', 'Cacao Fino']),
+        'total_volume_mt': random.randint(5, 50),
+        'differential_usd': random.choice([0, 100, 150, 200]),
+        'status': random.choice(['draft', 'active', 'completed']),
+        'created_at': when()
+    } for i in range(rows)])
+    db.session.bulk_insert_mappings(ContractFixation, [{
+        'export_contract_id': random.randint(1, rows),
+        'fixed_quantity_mt': random.randint(1, 10),
+        'spot_price_usd': random.uniform(2500, 4000),
+        'total_value_usd': random.uniform(5000, 40000),
+        'fixation_date': when(),
+        'created_at': when()
+    } for _ in range(rows)])
+    db.session.bulk_insert_mappings(ProducerLot, [{
+        'lot_code': f'BENCH-L-{i}',
+        'weight_kg': random.randint(200, 3000),
+        'quality_grade': random.choice(['A', 'B', 'C', None]),
+        'moisture_content': random.choice([None, 6.5, 7, 7.5, 8]),
+        'created_at': when()
+    } for i in range(rows)])
+    db.session.bulk_insert_mappings(TraceEvent, [{
+        'event_type': random.choice(EVENT_TYPES),
+        'entity_type': random.choice(['lot', 'batch']),
+        'entity_id': str(random.randint(1, rows // 10 or 1)),
+        'title': 'Evento',
+        'measurements': json.dumps({'defect_rate': random.uniform(0, 10)}),
+        'event_timestamp': when()
+    } for _ in range(rows)])
+    db.session.commit()
+
+
+def legacy_metrics(start_date: date, end_date: date):
+    """Versión anterior: cargar las filas de la ventana y agregar en Python"""
+    contracts = ExportContract.query.filter(ExportContract.created_at >= start_date,
+                                            ExportContract.created_at <= end_date).all()
+    Counter(c.status for c in contracts), Counter(c.product_type for c in contracts)
+    sum(float(c.total_volume_mt) for c in contracts if c.total_volume_mt)
+    np.mean([float(c.differential_usd) for c in contracts if c.differential_usd])
+
+    lots = ProducerLot.query.filter(ProducerLot.created_at >= start_date, ProducerLot.created_at <= end_date).all()
+    Counter(l.quality_grade for l in lots if l.quality_grade)
+    np.mean([float(l.moisture_content) for l in lots if l.moisture_content])
+
+    events = TraceEvent.query.filter(TraceEvent.event_timestamp >= start_date,
+                                     TraceEvent.event_timestamp <= end_date).all()
+    Counter(e.event_type for e in events), Counter(e.event_timestamp.date().isoformat() for e in events)
+    [json.loads(e.measurements)['defect_rate'] for e in events if e.event_type == 'CALIDAD' and e.measurements]
+
+    fixations = ContractFixation.query.filter(ContractFixation.fixation_date >= start_date,
+                                              ContractFixation.fixation_date <= end_date).all()
+    df = pd.DataFrame([{
+        'price': float(f.spot_price_usd),
+        'product_type': f.export_contract.product_type if f.export_contract else 'Unknown',
+        'buyer': f.export_contract.buyer_company.name if f.export_contract and f.export_contract.buyer_company else None,
+        'value': float(f.total_value_usd or 0)
+    } for f in fixations if f.spot_price_usd])
+    df.groupby('product_type')['price'].agg(['mean', 'std', 'count'])
+    df.groupby('buyer')['value'].sum().nlargest(10)
+    np.percentile(df['price'], [5, 25, 50, 75, 95])
+
+
+def sql_metrics(start_date: date, end_date: date):
+    """Versión actual (sin el decorador de cache)"""
+    engine = AnalyticsEngine()
+    AnalyticsEngine.get_supply_chain_metrics.__wrapped__(engine, start_date, end_date)
+    AnalyticsEngine.get_financial_analytics.__wrapped__(engine, start_date, end_date)
+    AnalyticsEngine.get_quality_analytics.__wrapped__(engine, start_date, end_date)
+
+
+def timed(fn, repeat: int, *args) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.expire_all()
+        started = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - started)
+        db.session.remove()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de agregados de analytics')
+    parser.add_argument('--rows', type=int, default=50000, help='Filas por tabla')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeticiones (se toma la mejor)')
+    args = parser.parse_args()
+
+    try:
+        with app.app_context():
+            db.create_all()
+            print(f"🌱 Sembrando {args.rows} filas por tabla...")
+            seed(args.rows)
+
+            end_date, start_date = date.today() + timedelta(days=1), date.today() - timedelta(days=90)
+            legacy = timed(legacy_metrics, args.repeat, start_date, end_date)
+            current = timed(sql_metrics, args.repeat, start_date, end_date)
+
+            print(f"🐢 Filas ORM + Python: {legacy * 1000:.1f} ms")
+            print(f"🚀 GROUP BY en SQL:    {current * 1000:.1f} ms")
+            print(f"📈 Mejora: {legacy / current:.1f}x")
+            db.session.remove()
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
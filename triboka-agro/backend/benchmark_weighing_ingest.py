@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la ingesta de eventos de básculas (AgroWeight Cloud)
+Siembra una base SQLite temporal con N lotes y compara el ritmo (eventos/s) de:
+- Un evento por petición (camino anterior): buscar el lote, insertar el
+  evento con commit y actualizar el timeline con otro commit. Con dos commits
+  por lectura es lento, así que se mide sobre menos lecturas (--legacy-events)
+- Ingesta por bloques: una consulta de lotes y claves, INSERT multi-fila,
+  un agregado de timeline por lote y un commit por bloque
+
+Uso: python benchmark_weighing_ingest.py [--events 20000] [--legacy-events 500] [--lots 200]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Base temporal propia: app_web3 se conecta a DATABASE_URL al importarse
+BENCH_DIR = tempfile.mkdtemp(prefix='triboka-bench-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(BENCH_DIR, 'bench.db')}"
+
+from models_simple import db, Company, ProducerLot, TraceEvent
+from services.timeline import append_event
+from services.weighing_ingest import ingest_weighing_events
+from app_web3 import app
+
+
+def seed(lots: int) -> int:
+    company = Company(name='AgroWeight Cloud', company_type='producer')
+    db.session.add(company)
+    db.session.flush()
+    db.session.bulk_insert_mappings(ProducerLot, [{
+        'lot_code': f'BENCH-L-{i}',
+        'producer_company_id': company.id,
+        'weight_kg': random.randint(200, 3000)
+    } for i in range(lots)])
+    db.session.commit()
+    return company.id
+
+
+def readings(events: int, lots: int, prefix: str):
+    start = datetime(2025, 3, 1)
+    return [(i + 1, {
+        'id_evento': f'{prefix}-{i}',
+        'lote_id': random.randint(1, lots),
+        'tipo': random.choice(['PESAJE', 'HUMEDAD']),
+        'peso_kg': round(random.uniform(50, 1500), 1),
+        'humedad': round(random.uniform(6, 9), 1),
+        'timestamp': (start + timedelta(seconds=i)).isoformat()
+    }) for i in range(events)]
+
+
+def legacy_ingest(rows, company_id: int):
+    """Camino anterior: una lectura por petición con dos commits"""
+    company = db.session.get(Company, company_id)
+    for _, row in rows:
+        lot = db.session.get(ProducerLot, row['lote_id'])
+        event = TraceEvent(event_type=row['tipo'], entity_type='lot', entity_id=str(lot.id),
+                           title=f"Evento: {row['tipo']}", actor_name=company.name,
+                           event_data=json.dumps(row),
+                           measurements=json.dumps({'weight_kg': row['peso_kg'], 'moisture_content': row['humedad']}),
+                           event_timestamp=datetime.fromisoformat(row['timestamp']))
+        db.session.add(event)
+        db.session.commit()
+        append_event(event)
+        db.session.commit()
+
+
+def timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - started
+    db.session.remove()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de ingesta de eventos de básculas')
+    parser.add_argument('--events', type=int, default=20000, help='Lecturas a registrar')
+    parser.add_argument('--legacy-events', type=int, default=500, help='Lecturas del camino anterior')
+    parser.add_argument('--lots', type=int, default=200, help='Lotes distintos')
+    args = parser.parse_args()
+    random.seed(42)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            print(f"🌱 Sembrando {args.lots} lotes...")
+            company_id = seed(args.lots)
+
+            legacy = args.legacy_events / timed(
+                legacy_ingest, readings(args.legacy_events, args.lots, 'legacy'), company_id)
+            batch_rows = readings(args.events, args.lots, 'batch')
+            batch = args.events / timed(ingest_weighing_events, batch_rows, db.session.get(Company, company_id))
+            resend = args.events / timed(ingest_weighing_events, batch_rows, db.session.get(Company, company_id))
+
+            print(f"🐢 Evento a evento ({args.legacy_events}):  {legacy:,.0f} eventos/s")
+            print(f"🚀 Por bloques ({args.events}):     {batch:,.0f} eventos/s")
+            print(f"🔁 Reenvío (duplicados):  {resend:,.0f} eventos/s")
+            print(f"📈 Mejora: {batch / legacy:.1f}x")
+            db.session.remove()
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,13 @@ Sistema de conexión blockchain para Triboka Agro
 
 import json
 import os
+import threading
 from web3 import Web3
 # Para Web3 v7+ no se necesita geth_poa_middleware
 # from web3.middleware import geth_poa_middleware
+from web3.exceptions import TransactionNotFound
 from eth_account import Account
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
 import logging
 from decimal import Decimal
 
@@ -23,6 +25,32 @@ from blockchain_config import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class NonceManager:
+    """Asignación local de nonces para la cuenta emisora
+
+    Consulta get_transaction_count una sola vez (incluyendo pendientes) y
+    luego incrementa en memoria. Tras un envío fallido se debe llamar a
+    reset() para resincronizar con el nodo.
+    """
+
+    def __init__(self, w3, address: str):
+        self.w3 = w3
+        self.address = address
+        self._next = None
+        self._lock = threading.Lock()
+
+    def next_nonce(self) -> int:
+        with self._lock:
+            if self._next is None:
+                self._next = self.w3.eth.get_transaction_count(self.address, 'pending')
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def reset(self):
+        with self._lock:
+            self._next = None
+
 class BlockchainService:
     """Servicio para interactuar con los smart contracts"""
     
@@ -33,8 +61,11 @@ class BlockchainService:
         self.w3 = None
         self.contracts = {}
         self.account = None
+        self.nonces = None
         self._setup_web3()
         self._load_contracts()
+        if self.w3 is not None and self.account is not None:
+            self.nonces = NonceManager(self.w3, self.account.address)
 
     def _load_config(self):
         """Cargar configuración de contratos"""
@@ -155,34 +186,90 @@ class BlockchainService:
             logger.error(f"Error estimating gas: {e}")
             return 100000  # Default gas limit
 
-    def send_transaction(self, transaction) -> Optional[str]:
-        """Enviar transacción firmada"""
+    def sign_transaction(self, transaction) -> Tuple[str, str]:
+        """Asignar nonce local y firmar sin enviar; retorna (tx_hash, raw_tx en hex)
+
+        El hash se conoce antes del envío, así la transacción firmada puede
+        guardarse y reenviarse tal cual (mismo nonce, mismo hash).
+        """
         if not self.account:
-            logger.error("No account configured for transactions")
-            return None
+            raise RuntimeError("No account configured for transactions")
 
         try:
-            # Configurar transacción
             transaction.update({
-                'nonce': self.w3.eth.get_transaction_count(self.account.address),
+                'nonce': self.nonces.next_nonce(),
                 'gas': self.estimate_gas(transaction),
                 'gasPrice': self.w3.eth.gas_price,
                 'chainId': self.w3.eth.chain_id
             })
-
-            # Firmar transacción
             signed_txn = self.w3.eth.account.sign_transaction(transaction, self.account.key)
-            
-            # Enviar transacción
-            tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-            
-            logger.info(f"✅ Transaction sent: {tx_hash.hex()}")
-            return tx_hash.hex()
-            
+        except Exception:
+            # El nonce asignado no llegó a usarse: resincronizar con el nodo
+            self.nonces.reset()
+            raise
+        return signed_txn.hash.hex(), signed_txn.rawTransaction.hex()
+
+    def broadcast_raw_transaction(self, raw_tx: str) -> str:
+        """Enviar una transacción ya firmada (reenviarla no crea otra transacción)"""
+        tx_hash = self.w3.eth.send_raw_transaction(bytes.fromhex(raw_tx[2:] if raw_tx.startswith('0x') else raw_tx))
+        logger.info(f"✅ Transaction sent: {tx_hash.hex()}")
+        return tx_hash.hex()
+
+    def is_known_transaction(self, tx_hash: str) -> bool:
+        """True si el nodo ya tiene la transacción (en mempool o minada)"""
+        try:
+            return self.w3.eth.get_transaction(tx_hash) is not None
+        except TransactionNotFound:
+            return False
+
+    def submit_transaction(self, transaction) -> str:
+        """Firmar y enviar una transacción con nonce local (lanza excepción si falla)"""
+        _, raw_tx = self.sign_transaction(transaction)
+        try:
+            return self.broadcast_raw_transaction(raw_tx)
+        except Exception:
+            self.nonces.reset()
+            raise
+
+    def send_transaction(self, transaction) -> Optional[str]:
+        """Enviar transacción firmada"""
+        if not self.account:
+            logger.error("No account configured for transactions")
+            return None
+
+        try:
+            return self.submit_transaction(transaction)
         except Exception as e:
             logger.error(f"❌ Transaction failed: {e}")
             return None
 
+    def get_receipts(self, tx_hashes: List[str]) -> Dict[str, Optional[Dict]]:
+        """Obtener recibos de varias transacciones sin esperar (None si sigue pendiente)
+
+        Usa una petición JSON-RPC por lotes cuando el proveedor la soporta.
+        """
+        receipts = {}
+        if not tx_hashes:
+            return receipts
+
+        try:
+            with self.w3.batch_requests() as batch:
+                for tx_hash in tx_hashes:
+                    batch.add(self.w3.eth.get_transaction_receipt(tx_hash))
+                results = batch.execute()
+            for tx_hash, receipt in zip(tx_hashes, results):
+                receipts[tx_hash] = dict(receipt) if receipt else None
+            return receipts
+        except Exception as e:
+            logger.debug(f"Batch receipt request not available, falling back: {e}")
+
+        for tx_hash in tx_hashes:
+            try:
+                receipts[tx_hash] = dict(self.w3.eth.get_transaction_receipt(tx_hash))
+            except TransactionNotFound:
+                receipts[tx_hash] = None
+        return receipts
+
     def wait_for_transaction_receipt(self, tx_hash: str, timeout: int = 60) -> Optional[Dict]:
         """Esperar confirmación de transacción"""
         try:
@@ -200,39 +287,50 @@ class AgroExportContractService:
         self.blockchain = blockchain_service
         self.contract = blockchain_service.get_contract('AgroExportContract')
 
-    def create_contract(self, 
-                       buyer_address: str,
-                       exporter_address: str,
-                       contract_code: str,
-                       product_type: str,
-                       product_grade: str,
-                       total_volume_mt: int,
-                       differential_usd: int,
-                       start_date: int,
-                       end_date: int,
-                       delivery_date: int) -> Optional[str]:
-        """Crear nuevo contrato de exportación"""
+    def create_contract_call(self,
+                             buyer_address: str,
+                             exporter_address: str,
+                             contract_code: str,
+                             product_type: str,
+                             product_grade: str,
+                             total_volume_mt: int,
+                             differential_usd: int,
+                             start_date: int,
+                             end_date: int,
+                             delivery_date: int):
+        """Preparar la llamada createContract (sin enviarla)"""
+        return self.contract.functions.createContract(
+            buyer_address,
+            exporter_address,
+            contract_code,
+            product_type,
+            product_grade,
+            total_volume_mt,
+            differential_usd,
+            start_date,
+            end_date,
+            delivery_date
+        )
+
+    def extract_contract_id(self, receipt: Dict) -> Optional[str]:
+        """Extraer el ID del evento ContractCreated de un recibo"""
+        logs = self.contract.events.ContractCreated().process_receipt(receipt)
+        if logs:
+            return logs[0]['args']['contractId'].hex()
+        return None
+
+    def create_contract(self, **kwargs) -> Optional[str]:
+        """Crear nuevo contrato de exportación (síncrono, espera el recibo)
+
+        Las rutas de la API usan el outbox (services.tx_outbox) para no bloquear.
+        """
         
         if not self.contract:
             logger.error("AgroExportContract not loaded")
             return None
 
         try:
-            # Preparar transacción
-            function = self.contract.functions.createContract(
-                buyer_address,
-                exporter_address,
-                contract_code,
-                product_type,
-                product_grade,
-                total_volume_mt,
-                differential_usd,
-                start_date,
-                end_date,
-                delivery_date
-            )
-
-            transaction = function.build_transaction({
+            transaction = self.create_contract_call(**kwargs).build_transaction({
                 'from': self.blockchain.account.address if self.blockchain.account else None
             })
 
@@ -241,12 +339,10 @@ class AgroExportContractService:
             if tx_hash:
                 receipt = self.blockchain.wait_for_transaction_receipt(tx_hash)
                 if receipt and receipt['status'] == 1:
-                    # Extraer contract ID del evento
-                    logs = self.contract.events.ContractCreated().process_receipt(receipt)
-                    if logs:
-                        contract_id = logs[0]['args']['contractId']
-                        logger.info(f"✅ Contract created with ID: {contract_id.hex()}")
-                        return contract_id.hex()
+                    contract_id = self.extract_contract_id(receipt)
+                    if contract_id:
+                        logger.info(f"✅ Contract created with ID: {contract_id}")
+                        return contract_id
             
             return None
 
@@ -254,38 +350,46 @@ class AgroExportContractService:
             logger.error(f"❌ Error creating contract: {e}")
             return None
 
-    def register_fixation(self,
-                         contract_id: str,
-                         fixed_quantity_mt: int,
-                         spot_price_usd: int,
-                         lot_ids: List[int],
-                         notes: str = "") -> Optional[str]:
-        """Registrar nueva fijación"""
+    def register_fixation_call(self,
+                               contract_id: str,
+                               fixed_quantity_mt: int,
+                               spot_price_usd: int,
+                               lot_ids: List[int],
+                               notes: str = ""):
+        """Preparar la llamada registerFixation (sin enviarla)"""
+        # Convertir contract_id a bytes32
+        if isinstance(contract_id, str):
+            if contract_id.startswith('0x'):
+                contract_id_bytes = bytes.fromhex(contract_id[2:])
+            else:
+                contract_id_bytes = bytes.fromhex(contract_id)
+        else:
+            contract_id_bytes = contract_id
+
+        return self.contract.functions.registerFixation(
+            contract_id_bytes,
+            fixed_quantity_mt,
+            spot_price_usd,
+            lot_ids,
+            notes
+        )
+
+    def extract_fixation_id(self, receipt: Dict) -> Optional[str]:
+        """Extraer el ID del evento FixationRegistered de un recibo"""
+        logs = self.contract.events.FixationRegistered().process_receipt(receipt)
+        if logs:
+            return logs[0]['args']['fixationId'].hex()
+        return None
+
+    def register_fixation(self, **kwargs) -> Optional[str]:
+        """Registrar nueva fijación (síncrono, espera el recibo)"""
         
         if not self.contract:
             logger.error("AgroExportContract not loaded")
             return None
 
         try:
-            # Convertir contract_id a bytes32
-            if isinstance(contract_id, str):
-                if contract_id.startswith('0x'):
-                    contract_id_bytes = bytes.fromhex(contract_id[2:])
-                else:
-                    contract_id_bytes = bytes.fromhex(contract_id)
-            else:
-                contract_id_bytes = contract_id
-
-            # Preparar transacción
-            function = self.contract.functions.registerFixation(
-                contract_id_bytes,
-                fixed_quantity_mt,
-                spot_price_usd,
-                lot_ids,
-                notes
-            )
-
-            transaction = function.build_transaction({
+            transaction = self.register_fixation_call(**kwargs).build_transaction({
                 'from': self.blockchain.account.address if self.blockchain.account else None
             })
 
@@ -294,12 +398,10 @@ class AgroExportContractService:
             if tx_hash:
                 receipt = self.blockchain.wait_for_transaction_receipt(tx_hash)
                 if receipt and receipt['status'] == 1:
-                    # Extraer fixation ID del evento
-                    logs = self.contract.events.FixationRegistered().process_receipt(receipt)
-                    if logs:
-                        fixation_id = logs[0]['args']['fixationId']
-                        logger.info(f"✅ Fixation registered with ID: {fixation_id.hex()}")
-                        return fixation_id.hex()
+                    fixation_id = self.extract_fixation_id(receipt)
+                    if fixation_id:
+                        logger.info(f"✅ Fixation registered with ID: {fixation_id}")
+                        return fixation_id
             
             return None
 
@@ -351,39 +453,47 @@ class ProducerLotNFTService:
         self.blockchain = blockchain_service
         self.contract = blockchain_service.get_contract('ProducerLotNFT')
 
-    def create_lot(self,
-                   producer_address: str,
-                   producer_name: str,
-                   farm_name: str,
-                   location: str,
-                   product_type: str,
-                   weight_kg: int,
-                   quality_grade: str,
-                   harvest_date: int,
-                   certifications: List[str],
-                   metadata_uri: str = "") -> Optional[int]:
-        """Crear nuevo lote NFT"""
+    def create_lot_call(self,
+                        producer_address: str,
+                        producer_name: str,
+                        farm_name: str,
+                        location: str,
+                        product_type: str,
+                        weight_kg: int,
+                        quality_grade: str,
+                        harvest_date: int,
+                        certifications: List[str],
+                        metadata_uri: str = ""):
+        """Preparar la llamada createLot (sin enviarla)"""
+        return self.contract.functions.createLot(
+            producer_address,
+            producer_name,
+            farm_name,
+            location,
+            product_type,
+            weight_kg,
+            quality_grade,
+            harvest_date,
+            certifications,
+            metadata_uri
+        )
+
+    def extract_lot_id(self, receipt: Dict) -> Optional[int]:
+        """Extraer el ID del evento LotCreated de un recibo"""
+        logs = self.contract.events.LotCreated().process_receipt(receipt)
+        if logs:
+            return logs[0]['args']['lotId']
+        return None
+
+    def create_lot(self, **kwargs) -> Optional[int]:
+        """Crear nuevo lote NFT (síncrono, espera el recibo)"""
         
         if not self.contract:
             logger.error("ProducerLotNFT not loaded")
             return None
 
         try:
-            # Preparar transacción
-            function = self.contract.functions.createLot(
-                producer_address,
-                producer_name,
-                farm_name,
-                location,
-                product_type,
-                weight_kg,
-                quality_grade,
-                harvest_date,
-                certifications,
-                metadata_uri
-            )
-
-            transaction = function.build_transaction({
+            transaction = self.create_lot_call(**kwargs).build_transaction({
                 'from': self.blockchain.account.address if self.blockchain.account else None
             })
 
@@ -392,10 +502,8 @@ class ProducerLotNFTService:
             if tx_hash:
                 receipt = self.blockchain.wait_for_transaction_receipt(tx_hash)
                 if receipt and receipt['status'] == 1:
-                    # Extraer lot ID del evento
-                    logs = self.contract.events.LotCreated().process_receipt(receipt)
-                    if logs:
-                        lot_id = logs[0]['args']['lotId']
+                    lot_id = self.extract_lot_id(receipt)
+                    if lot_id is not None:
                         logger.info(f"✅ Lot NFT created with ID: {lot_id}")
                         return lot_id
             
@@ -434,6 +542,36 @@ class ProducerLotNFTService:
             logger.error(f"❌ Error getting lot info: {e}")
             return None
 
+class DocumentRegistryService:
+    """Servicio específico para DocumentRegistry"""
+    
+    # DocumentType.Other en DocumentRegistry.sol
+    DOC_TYPE_OTHER = 8
+    
+    def __init__(self, blockchain_service: BlockchainService):
+        self.blockchain = blockchain_service
+        self.contract = blockchain_service.get_contract('DocumentRegistry')
+
+    def anchor_root_call(self, anchor_id: int, merkle_root: str, leaf_count: int, metadata: str = ""):
+        """Preparar issueDocument con una raíz Merkle de eventos como documentHash"""
+        entity_id = Web3.keccak(text=f"trace-anchor:{anchor_id}")
+        return self.contract.functions.issueDocument(
+            entity_id,
+            self.DOC_TYPE_OTHER,
+            f"TraceAnchor #{anchor_id} ({leaf_count} eventos)",
+            bytes.fromhex(merkle_root),
+            "",
+            0,
+            metadata
+        )
+
+    def extract_document_id(self, receipt: Dict) -> Optional[str]:
+        """Extraer el documentId del evento DocumentIssued de un recibo"""
+        logs = self.contract.events.DocumentIssued().process_receipt(receipt)
+        if logs:
+            return logs[0]['args']['documentId'].hex()
+        return None
+
 class BlockchainIntegration:
     """Clase principal para integración blockchain"""
     
@@ -441,6 +579,7 @@ class BlockchainIntegration:
         self.blockchain = BlockchainService(config_path)
         self.agro_contract = AgroExportContractService(self.blockchain)
         self.nft_service = ProducerLotNFTService(self.blockchain)
+        self.document_registry = DocumentRegistryService(self.blockchain)
 
     def is_ready(self) -> bool:
         """Verificar si la integración está lista"""
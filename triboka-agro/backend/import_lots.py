@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Importación masiva de lotes desde CSV o NDJSON (cosechas de cooperativas)
+
+Uso:
+    python import_lots.py cosecha.csv --user-id 1
+    python import_lots.py cosecha.ndjson --user-id 1 --dry-run
+    python import_lots.py cosecha.csv --user-id 1 --report errores.json
+
+El registro en blockchain se encola en el outbox y lo envía el worker
+(python -m services.tx_outbox).
+"""
+
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models_simple import db, User
+from services.lot_import import import_lots, detect_format, CHUNK_SIZE
+from routes.performance import invalidate_cache_tags
+from app_web3 import app, blockchain
+
+
+def main():
+    """Función principal para ejecutar el script desde línea de comandos."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Importación masiva de lotes Triboka')
+    parser.add_argument('path', help='Fichero .csv, .ndjson o .jsonl')
+    parser.add_argument('--user-id', type=int, required=True, help='Usuario que crea los lotes')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help='Formato (por defecto según la extensión)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Filas por bloque de inserción')
+    parser.add_argument('--dry-run', action='store_true', help='Solo validar, sin escribir')
+    parser.add_argument('--no-blockchain', action='store_true', help='No encolar el registro en blockchain')
+    parser.add_argument('--report', help='Guardar el informe completo en este fichero JSON')
+
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.path)
+    if fmt is None:
+        print("❌ Formato no reconocido, use --format csv o --format ndjson")
+        sys.exit(1)
+
+    with app.app_context():
+        user = db.session.get(User, args.user_id)
+        if user is None or user.role not in ['admin', 'operator', 'producer']:
+            print(f"❌ Usuario {args.user_id} no encontrado o sin permisos para crear lotes")
+            sys.exit(1)
+
+        print(f"📦 Importando {args.path} ({fmt})...")
+        with open(args.path, 'rb') as stream:
+            report = import_lots(
+                stream, fmt, user,
+                integration=blockchain,
+                chunk_size=args.chunk_size,
+                dry_run=args.dry_run,
+                register_on_chain=not args.no_blockchain
+            )
+
+        if report['imported'] and not args.dry_run:
+            invalidate_cache_tags('lots')
+
+    print(f"✅ Lotes {'válidos' if args.dry_run else 'importados'}: {report['imported']}/{report['total_rows']}")
+    if report['queued_on_chain']:
+        print(f"⛓️  Registros blockchain encolados: {report['queued_on_chain']}")
+    if report['failed']:
+        print(f"⚠️  Filas con errores: {report['failed']}")
+        for error in report['errors'][:20]:
+            print(f"   línea {error['line']}: {'; '.join(error['errors'])}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📝 Informe guardado en {args.report}")
+
+    if report['failed'] and not report['imported']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
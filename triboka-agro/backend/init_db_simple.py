@@ -7,6 +7,7 @@ import os
 import sys
 from flask import Flask
 from models_simple import db, Company, User, ExportContract
+from services.api_keys import set_api_key
 
 # Configurar aplicación
 app = Flask(__name__)
@@ -25,9 +26,9 @@ def init_db():
             name="AgroExport Demo S.A.",
             email="info@agroexport.com",
             company_type="exporter",
-            country="Perú",
-            api_key="demo_key_123"
+            country="Perú"
         )
+        set_api_key(company, "demo_key_123")
         db.session.add(company)
         db.session.commit()
 
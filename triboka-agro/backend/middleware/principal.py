@@ -0,0 +1,135 @@
+"""
+Contexto de autorización por petición para Triboka
+La identidad del usuario se carga una vez por petición (g.principal), con una
+cache en memoria de TTL corto indexada por el jti del JWT; el acceso a deals
+se memoiza dentro de la petición
+"""
+
+import os
+from collections import namedtuple
+from functools import wraps
+from typing import Dict, Optional
+
+from flask import g, jsonify
+from flask_jwt_extended import get_jwt, get_jwt_identity
+
+from models_simple import db, Deal, User
+from services.cache import LocalLRUCache
+
+# Snapshot inmutable del usuario: se comparte entre peticiones sin riesgo de
+# instancias ORM desacopladas de la sesión
+Identity = namedtuple('Identity', ['id', 'role', 'company_id', 'name', 'email', 'active'])
+
+IDENTITY_TTL = float(os.getenv('AUTH_IDENTITY_TTL', 30))
+
+_identity_cache = LocalLRUCache(max_entries=int(os.getenv('AUTH_IDENTITY_CACHE_SIZE', 4096)))
+
+# Rol dentro del deal -> permisos del contexto activo
+DEAL_PERMISSIONS = {
+    'admin': ['read', 'write', 'admin'],
+    'producer': ['read', 'write'],
+    'exporter': ['read', 'write']
+}
+
+
+class Principal:
+    """Usuario autenticado de la petición actual"""
+
+    def __init__(self, identity: Identity):
+        self.identity = identity
+        self._deal_roles: Dict[int, Optional[str]] = {}
+
+    def __getattr__(self, name):
+        # id, role, company_id, name, email, active
+        return getattr(self.identity, name)
+
+    def load_user(self) -> Optional[User]:
+        """Instancia ORM completa, solo para handlers que la necesiten"""
+        return db.session.get(User, self.identity.id)
+
+    def deal_role(self, deal) -> Optional[str]:
+        """Rol del usuario en el deal ('admin', 'producer', 'exporter') o None sin acceso
+
+        Acepta el Deal o su ID; el resultado se memoiza durante la petición.
+        """
+        deal_id = deal if isinstance(deal, int) else deal.id
+        if deal_id not in self._deal_roles:
+            if isinstance(deal, int):
+                deal = db.session.get(Deal, deal_id)
+            self._deal_roles[deal_id] = self._resolve_deal_role(deal) if deal else None
+        return self._deal_roles[deal_id]
+
+    def can_access_deal(self, deal) -> bool:
+        return self.deal_role(deal) is not None
+
+    def _resolve_deal_role(self, deal) -> Optional[str]:
+        if self.id == deal.admin_id:
+            return 'admin'
+        if self.company_id and self.company_id == deal.producer_id:
+            return 'producer'
+        if self.company_id and self.company_id == deal.exporter_id:
+            return 'exporter'
+        if self.role in ['admin', 'operator']:
+            return 'admin'
+        return None
+
+
+def _load_identity(user_id) -> Optional[Identity]:
+    user = db.session.get(User, int(user_id))
+    if user is None:
+        return None
+    return Identity(user.id, user.role, user.company_id, user.name, user.email, user.active)
+
+
+def load_principal(user_id, cache_key: Optional[str] = None) -> Optional[Principal]:
+    """Construir el Principal de un usuario usando la cache de identidades"""
+    cache_key = cache_key or f'uid:{user_id}'
+    identity = _identity_cache.get(cache_key)
+    if identity is None:
+        identity = _load_identity(user_id)
+        if identity is None:
+            return None
+        _identity_cache.set(cache_key, identity, IDENTITY_TTL, tags=[f'user:{identity.id}'])
+    return Principal(identity)
+
+
+def current_principal() -> Optional[Principal]:
+    """Principal de la petición (requiere @jwt_required); se carga una vez y queda en g"""
+    if 'principal' not in g:
+        user_id = get_jwt_identity()
+        jti = get_jwt().get('jti')
+        g.principal = load_principal(user_id, cache_key=f'jti:{jti}' if jti else None) if user_id else None
+    return g.principal
+
+
+def invalidate_principal(user_id: int) -> int:
+    """Descartar las identidades cacheadas de un usuario (tras cambiar rol/empresa)"""
+    return _identity_cache.invalidate_tag(f'user:{user_id}')
+
+
+def deal_access_required(message: str = 'Sin permisos para acceder a este deal'):
+    """Decorador para rutas /deals/<deal_id>: carga el deal y verifica el acceso
+
+    Deja g.principal, g.deal y g.deal_role disponibles para el handler.
+    Debe ir después de @jwt_required().
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            principal = current_principal()
+            if principal is None:
+                return jsonify({'error': 'Usuario no encontrado'}), 404
+
+            deal = db.session.get(Deal, kwargs['deal_id'])
+            if not deal:
+                return jsonify({'error': 'Deal no encontrado'}), 404
+
+            role = principal.deal_role(deal)
+            if role is None:
+                return jsonify({'error': message}), 403
+
+            g.deal = deal
+            g.deal_role = role
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
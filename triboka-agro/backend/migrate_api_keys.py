@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Script para guardar las API keys de empresas como prefijo + hash:
+- Agrega las columnas api_key_prefix y api_key_hash a companies
+- Calcula prefijo y SHA-256 de las claves existentes y vacía la columna en claro
+
+Es idempotente: solo procesa empresas que aún tienen la clave en claro. Las
+integraciones siguen usando la misma clave.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+from models_simple import db, Company
+from services.api_keys import set_api_key
+from app_web3 import app
+
+NEW_COLUMNS = {
+    'api_key_prefix': 'VARCHAR(16)',
+    'api_key_hash': 'VARCHAR(64)',
+}
+
+
+def migrate_api_keys():
+    with app.app_context():
+        existing = {column['name'] for column in inspect(db.engine).get_columns('companies')}
+        for name, column_type in NEW_COLUMNS.items():
+            if name in existing:
+                print(f"ℹ️  Campo {name} ya existe")
+                continue
+            db.session.execute(text(f"ALTER TABLE companies ADD COLUMN {name} {column_type}"))
+            print(f"✅ Campo {name} agregado")
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_companies_api_key_prefix ON companies (api_key_prefix)"))
+        db.session.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_companies_api_key_hash ON companies (api_key_hash)"))
+        db.session.commit()
+
+        companies = Company.query.filter(Company.api_key.isnot(None), Company.api_key != '').all()
+        print(f"🔑 Empresas con API key en claro: {len(companies)}")
+        for company in companies:
+            set_api_key(company, company.api_key)
+        db.session.commit()
+
+        print(f"✅ Empresas con API key hasheada: {Company.query.filter(Company.api_key_hash.isnot(None)).count()}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_api_keys()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Script para poblar la tabla batch_lots (índice lote -> batch)
+a partir de las columnas JSON existentes en batch_nfts:
+- source_lot_ids: IDs de lote (o códigos de lote en batches creados desde ERP)
+- source_lot_weights: pesos en el mismo orden (opcional)
+
+Es idempotente: los pares (batch_id, lot_id) ya indexados se omiten.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models_simple import db, ProducerLot, BatchNFT, BatchLot
+from app_web3 import app
+
+
+def resolve_lot_ids(raw_ids):
+    """Traducir la lista JSON de un batch a IDs de ProducerLot
+
+    Acepta IDs numéricos y códigos de lote (batches de exportación del ERP).
+    """
+    numeric_ids = []
+    codes = []
+    for raw in raw_ids:
+        if isinstance(raw, int) or (isinstance(raw, str) and raw.isdigit()):
+            numeric_ids.append(int(raw))
+        elif raw:
+            codes.append(str(raw))
+
+    resolved = {}
+    if numeric_ids:
+        for lot in ProducerLot.query.filter(ProducerLot.id.in_(numeric_ids)).all():
+            resolved[lot.id] = lot
+    if codes:
+        for lot in ProducerLot.query.filter(ProducerLot.lot_code.in_(codes)).all():
+            resolved[lot.id] = lot
+
+    # Mantener el orden original para emparejar con source_lot_weights
+    ordered = []
+    by_code = {lot.lot_code: lot for lot in resolved.values()}
+    for raw in raw_ids:
+        if isinstance(raw, int) or (isinstance(raw, str) and raw.isdigit()):
+            lot = resolved.get(int(raw))
+        else:
+            lot = by_code.get(str(raw))
+        ordered.append(lot)
+    return ordered
+
+
+def backfill_batch_lots():
+    """Poblar batch_lots desde batch_nfts.source_lot_ids"""
+    with app.app_context():
+        print("🔄 Poblando índice batch_lots...")
+
+        # Crea la tabla batch_lots si no existe
+        db.create_all()
+
+        existing = set(db.session.query(BatchLot.batch_id, BatchLot.lot_id).all())
+        created = 0
+        unresolved = 0
+
+        batches = BatchNFT.query.all()
+        print(f"🔗 Batches encontrados: {len(batches)}")
+
+        for batch in batches:
+            raw_ids = batch.source_lots_list
+            weights = batch.source_lots_weights_list
+            lots = resolve_lot_ids(raw_ids)
+
+            for index, lot in enumerate(lots):
+                if lot is None:
+                    unresolved += 1
+                    continue
+                if (batch.id, lot.id) in existing:
+                    continue
+
+                weight = weights[index] if index < len(weights) else lot.weight_kg
+                db.session.add(BatchLot(batch_id=batch.id, lot_id=lot.id, weight_kg=weight))
+                existing.add((batch.id, lot.id))
+                created += 1
+
+        db.session.commit()
+
+        print(f"✅ Vínculos creados: {created}")
+        if unresolved:
+            print(f"⚠️  Referencias de lote sin resolver: {unresolved}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    backfill_batch_lots()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Script para poblar la tabla company_dashboard_stats (contadores del dashboard):
+- Lotes, peso e ingresos por empresa productora y lotes comprados por empresa
+- Contratos y fijaciones por empresa exportadora y compradora
+- Batches por empresa creadora y totales de la plataforma (company_id = 0)
+
+Es idempotente: los contadores se recalculan con GROUP BY y se reemplazan
+dentro de una transacción (es lo mismo que hace la reconciliación periódica).
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models_simple import db, CompanyDashboardStats
+from services.dashboard_stats import rebuild_dashboard_stats
+from app_web3 import app
+
+
+def migrate_dashboard_stats():
+    with app.app_context():
+        # Crea la tabla company_dashboard_stats si no existe
+        db.create_all()
+        print("🔄 Recalculando contadores del dashboard...")
+        rows = rebuild_dashboard_stats(db.session.connection())
+        db.session.commit()
+        print(f"📊 Filas de contadores: {rows}")
+        print(f"✅ Empresas con contadores: {CompanyDashboardStats.query.filter(CompanyDashboardStats.company_id != 0).count()}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_dashboard_stats()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Script para poblar la tabla entity_access (acceso empresa -> entidad):
+- Lotes por empresa productora y compradora
+- Batches por empresa creadora
+- Lotes agrupados en batches (via batch_lots) para el creador del batch
+
+Es idempotente: la proyección se reconstruye con INSERT ... SELECT dentro
+de una transacción, así que puede ejecutarse de nuevo para reconciliar.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import String, cast, insert, literal, select
+
+from models_simple import db, BatchLot, BatchNFT, EntityAccess, ProducerLot
+from app_web3 import app
+
+COLUMNS = ['company_id', 'entity_type', 'entity_id', 'relation']
+
+
+def projection_selects():
+    """SELECTs que generan cada relación de acceso"""
+    return {
+        'producer': select(ProducerLot.producer_company_id, literal('lot'),
+                           cast(ProducerLot.id, String), literal('producer'))
+        .where(ProducerLot.producer_company_id.isnot(None)),
+        'purchaser': select(ProducerLot.purchased_by_company_id, literal('lot'),
+                            cast(ProducerLot.id, String), literal('purchaser'))
+        .where(ProducerLot.purchased_by_company_id.isnot(None)),
+        'creator': select(BatchNFT.creator_company_id, literal('batch'),
+                          cast(BatchNFT.id, String), literal('creator'))
+        .where(BatchNFT.creator_company_id.isnot(None)),
+        'batch': select(BatchNFT.creator_company_id, literal('lot'),
+                        cast(BatchLot.lot_id, String), literal('batch'))
+        .join(BatchNFT, BatchNFT.id == BatchLot.batch_id)
+        .where(BatchNFT.creator_company_id.isnot(None))
+        .distinct(),
+    }
+
+
+def rebuild_entity_access():
+    """Reconstruir entity_access desde lotes, batches y batch_lots"""
+    print("🔄 Reconstruyendo entity_access...")
+    db.session.query(EntityAccess).delete(synchronize_session=False)
+    for relation, query in projection_selects().items():
+        result = db.session.execute(insert(EntityAccess.__table__).from_select(COLUMNS, query))
+        print(f"🔗 {relation}: {result.rowcount} filas")
+    db.session.commit()
+
+
+def migrate_entity_access():
+    with app.app_context():
+        # Crea la tabla entity_access si no existe
+        db.create_all()
+        rebuild_entity_access()
+        print(f"✅ Filas de acceso: {EntityAccess.query.count()}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_entity_access()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Script para poblar la tabla external_identifiers (índice de identificadores
+que escanean AgroWeight y las apps de campo) a partir de:
+- producer_lots.lot_code y producer_lots.blockchain_lot_id (NFT ID)
+- batch_nfts.batch_code
+
+Es idempotente: reconstruye el índice completo en una sola transacción.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models_simple import db, ExternalIdentifier
+from services.identifiers import backfill_identifiers, identifier_map
+from app_web3 import app
+
+
+def backfill_external_identifiers():
+    """Reconstruir external_identifiers desde lotes y batches"""
+    with app.app_context():
+        print("🔄 Poblando índice external_identifiers...")
+
+        # Crea la tabla external_identifiers si no existe
+        db.create_all()
+
+        connection = db.session.connection()
+        connection.execute(ExternalIdentifier.__table__.delete())
+        created = backfill_identifiers(connection)
+        db.session.commit()
+        identifier_map.clear()
+
+        print(f"✅ Identificadores indexados: {created}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    backfill_external_identifiers()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Script para recrear el índice de paginación de /api/lots con el mismo orden
+que el listado (harvest_date DESC NULLS LAST, id DESC):
+- Elimina ix_producer_lots_harvest_date_id si existe (versión ascendente)
+- Lo crea con la definición de models_simple para el motor en uso
+
+Es idempotente: se puede ejecutar varias veces.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect
+
+from models_simple import db, ProducerLot
+from app_web3 import app
+
+INDEX_NAME = 'ix_producer_lots_harvest_date_id'
+
+
+def migrate_lots_keyset_index():
+    with app.app_context():
+        db.create_all()
+        indexes = [index for index in ProducerLot.__table__.indexes if index.name == INDEX_NAME]
+        existing = {index['name'] for index in inspect(db.engine).get_indexes('producer_lots')}
+
+        with db.engine.begin() as connection:
+            if INDEX_NAME in existing:
+                indexes[0].drop(connection)
+                print(f"🗑️  Índice {INDEX_NAME} eliminado")
+            for index in indexes:
+                index.create(connection)
+        print(f"✅ Índice {INDEX_NAME} creado (harvest_date DESC NULLS LAST, id DESC)")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_lots_keyset_index()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Script para crear el registro de cambios de la sincronización delta (sync_changes):
+- Registra como upsert los lotes, contratos, fijaciones, batches y despachos
+  existentes, para que un cliente con sync_token 0 descargue el catálogo completo
+- Compacta el registro (deja la última entrada por entidad y empresa)
+
+Es idempotente: la carga inicial solo se hace si sync_changes está vacía, y
+compactar no cambia el resultado del delta para ningún token.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models_simple import db, SyncChange
+from services.change_log import backfill_change_log, compact_change_log
+from app_web3 import app
+
+
+def migrate_sync_change_log():
+    with app.app_context():
+        # Crea las tablas sync_changes y sync_mutations si no existen
+        db.create_all()
+        if SyncChange.query.first() is None:
+            print("🔄 Registrando filas existentes en sync_changes...")
+            rows = backfill_change_log(db.session.connection())
+            print(f"📱 Entradas iniciales: {rows}")
+        removed = compact_change_log(db.session.connection())
+        db.session.commit()
+        print(f"🧹 Entradas compactadas: {removed}")
+        print(f"✅ Entradas en el registro: {SyncChange.query.count()}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_sync_change_log()
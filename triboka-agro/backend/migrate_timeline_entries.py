@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Script para poblar la tabla timeline_entries (timeline append-only):
+- Entradas de los blobs trace_timelines.events_json (si la columna existe
+  en la base de datos desplegada)
+- Eventos de trace_events que aún no tienen entrada
+
+Es idempotente: las claves (entidad, entry_key) ya migradas se omiten.
+Con --clear-blobs se vacía events_json una vez migrado.
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+from models_simple import db, TraceEvent, TimelineEntry
+from services.timeline import entry_mapping
+from app_web3 import app
+
+CHUNK_SIZE = 1000
+
+# Campos del blob que pasan a columnas propias; el resto va a data_json
+ENTRY_COLUMNS = {'id', 'type', 'event_type', 'title', 'description', 'timestamp', 'actor', 'blockchain_tx_hash'}
+
+
+def _parse_timestamp(value, fallback):
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        return parsed.replace(tzinfo=None) if parsed.tzinfo else parsed
+    except (TypeError, ValueError):
+        return fallback
+
+
+def blob_entry_mappings(timeline_row, existing_keys, event_ids):
+    """Traducir un blob events_json a mappings de TimelineEntry"""
+    timeline_id, entity_type, entity_id, events_json, created_at = timeline_row
+    try:
+        items = json.loads(events_json) if events_json else []
+    except ValueError:
+        print(f"⚠️  events_json inválido en timeline {timeline_id}, se omite")
+        return []
+
+    mappings = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        entry_key = str(item.get('id') or f'legacy_{timeline_id}_{index}')
+        if (entity_type, entity_id, entry_key) in existing_keys:
+            continue
+        existing_keys.add((entity_type, entity_id, entry_key))
+
+        event_id = None
+        if entry_key.startswith('event_') and entry_key[6:].isdigit() and int(entry_key[6:]) in event_ids:
+            event_id = int(entry_key[6:])
+
+        mappings.append({
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'entry_key': entry_key,
+            'entry_type': item.get('type') or 'traceability_event',
+            'event_id': event_id,
+            'event_type': item.get('event_type'),
+            'title': item.get('title'),
+            'description': item.get('description'),
+            'occurred_at': _parse_timestamp(item.get('timestamp'), created_at or datetime.utcnow()),
+            'actor_name': item.get('actor'),
+            'data_json': json.dumps({k: v for k, v in item.items() if k not in ENTRY_COLUMNS}),
+            'blockchain_tx_hash': item.get('blockchain_tx_hash')
+        })
+    return mappings
+
+
+def migrate_timeline_entries(clear_blobs=False):
+    """Poblar timeline_entries desde events_json y trace_events"""
+    with app.app_context():
+        print("🔄 Poblando timeline_entries...")
+
+        # Crea la tabla timeline_entries si no existe
+        db.create_all()
+
+        existing_keys = set(db.session.query(
+            TimelineEntry.entity_type, TimelineEntry.entity_id, TimelineEntry.entry_key
+        ).all())
+        from_blobs = 0
+
+        columns = {c['name'] for c in inspect(db.engine).get_columns('trace_timelines')}
+        if 'events_json' in columns:
+            event_ids = {event_id for (event_id,) in db.session.query(TraceEvent.id)}
+            rows = db.session.execute(text(
+                "SELECT id, entity_type, entity_id, events_json, created_at FROM trace_timelines "
+                "WHERE events_json IS NOT NULL AND events_json != '' AND events_json != '[]'"
+            )).fetchall()
+            print(f"📜 Timelines con events_json: {len(rows)}")
+
+            for row in rows:
+                created_at = row[4]
+                if isinstance(created_at, str):
+                    created_at = _parse_timestamp(created_at, None)
+                mappings = blob_entry_mappings((row[0], row[1], str(row[2]), row[3], created_at),
+                                               existing_keys, event_ids)
+                for start in range(0, len(mappings), CHUNK_SIZE):
+                    db.session.bulk_insert_mappings(TimelineEntry, mappings[start:start + CHUNK_SIZE])
+                from_blobs += len(mappings)
+            db.session.commit()
+
+            if clear_blobs:
+                db.session.execute(text("UPDATE trace_timelines SET events_json = NULL"))
+                db.session.commit()
+                print("🧹 events_json vaciado")
+        else:
+            print("ℹ️  trace_timelines no tiene columna events_json, solo se migran eventos")
+
+        # Eventos sin entrada en el timeline (por bloques de IDs)
+        from_events = 0
+        pending_ids = [event_id for (event_id,) in db.session.query(TraceEvent.id).outerjoin(
+            TimelineEntry, TimelineEntry.event_id == TraceEvent.id
+        ).filter(TimelineEntry.id.is_(None)).order_by(TraceEvent.id)]
+        print(f"🔗 Eventos sin entrada: {len(pending_ids)}")
+
+        for start in range(0, len(pending_ids), CHUNK_SIZE):
+            events = TraceEvent.query.filter(TraceEvent.id.in_(pending_ids[start:start + CHUNK_SIZE])).all()
+            chunk = []
+            for event in events:
+                mapping = entry_mapping(event)
+                key = (mapping['entity_type'], mapping['entity_id'], mapping['entry_key'])
+                if key in existing_keys:
+                    continue
+                existing_keys.add(key)
+                chunk.append(mapping)
+            db.session.bulk_insert_mappings(TimelineEntry, chunk)
+            db.session.commit()
+            from_events += len(chunk)
+
+        print(f"✅ Entradas desde events_json: {from_blobs}")
+        print(f"✅ Entradas desde trace_events: {from_events}")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_timeline_entries(clear_blobs='--clear-blobs' in sys.argv)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Script para guardar la transacción firmada en el outbox blockchain:
+- Crea la tabla blockchain_tx_outbox si no existe
+- Agrega la columna raw_tx (el worker la reenvía tal cual tras una caída)
+
+Es idempotente: si la columna ya existe no se modifica nada.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+from models_simple import db
+from app_web3 import app
+
+
+def migrate_tx_outbox():
+    with app.app_context():
+        db.create_all()
+        existing = {column['name'] for column in inspect(db.engine).get_columns('blockchain_tx_outbox')}
+        if 'raw_tx' in existing:
+            print("ℹ️  Campo raw_tx ya existe")
+        else:
+            db.session.execute(text("ALTER TABLE blockchain_tx_outbox ADD COLUMN raw_tx TEXT"))
+            db.session.commit()
+            print("✅ Campo raw_tx agregado")
+        print("🎉 Migración completada exitosamente!")
+
+
+if __name__ == '__main__':
+    migrate_tx_outbox()
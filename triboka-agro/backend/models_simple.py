@@ -83,7 +83,10 @@ class Company(db.Model):
     email = db.Column(db.String(255))
     company_type = db.Column(db.String(50))  # producer, exporter, buyer
     country = db.Column(db.String(100))
-    api_key = db.Column(db.String(100), unique=True)  # API key for external integrations
+    api_key = db.Column(db.String(100), unique=True)  # Legacy: clave en claro (migrate_api_keys.py la vacía)
+    # API key para integraciones externas: prefijo indexado + SHA-256 (ver services/api_keys.py)
+    api_key_prefix = db.Column(db.String(16), index=True)
+    api_key_hash = db.Column(db.String(64), unique=True)
     blockchain_address = db.Column(db.String(100))
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -259,6 +262,15 @@ class ProducerLot(db.Model):
             }
         }
 
+# Paginación keyset de /api/lots: mismo orden que el listado (harvest_date DESC NULLS LAST, id DESC).
+# SQLite y MySQL ordenan los NULL como el menor valor (en DESC ya quedan al final) y no
+# admiten NULLS LAST en un índice; PostgreSQL los pone primero si no se indica.
+db.Index('ix_producer_lots_harvest_date_id',
+         ProducerLot.harvest_date.desc().nulls_last(), ProducerLot.id.desc()).ddl_if(dialect='postgresql')
+db.Index('ix_producer_lots_harvest_date_id',
+         ProducerLot.harvest_date.desc(), ProducerLot.id.desc()).ddl_if(
+    callable_=lambda ddl, target, bind, dialect=None, **kw: dialect.name != 'postgresql')
+
 class BatchNFT(db.Model):
     __tablename__ = 'batch_nfts'
     
@@ -314,6 +326,189 @@ class BatchNFT(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class BatchLot(db.Model):
+    """Índice normalizado lote -> batch (espejo de BatchNFT.source_lot_ids)
+
+    Permite responder "¿en qué batches está este lote?" con una búsqueda indexada
+    en lugar de decodificar el JSON de todos los batches.
+    """
+    __tablename__ = 'batch_lots'
+    __table_args__ = (
+        db.UniqueConstraint('batch_id', 'lot_id', name='uq_batch_lots_batch_lot'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey('batch_nfts.id'), nullable=False, index=True)
+    lot_id = db.Column(db.Integer, db.ForeignKey('producer_lots.id'), nullable=False, index=True)
+    weight_kg = db.Column(db.Numeric(10, 2))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    batch = db.relationship('BatchNFT', backref='lot_links')
+    lot = db.relationship('ProducerLot', backref='batch_links')
+
+class EntityAccess(db.Model):
+    """Proyección de acceso empresa -> entidad para filtrar trazabilidad
+
+    Una fila por relación (producer, purchaser, creator, batch); se mantiene
+    en services.entity_access al crear, comprar o agrupar lotes. Los listados
+    filtran con un EXISTS indexado en lugar de listas IN de IDs.
+    """
+    __tablename__ = 'entity_access'
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'entity_type', 'entity_id', 'relation', name='uq_entity_access'),
+        db.Index('ix_entity_access_entity', 'entity_type', 'entity_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
+    entity_type = db.Column(db.String(50), nullable=False)  # 'lot', 'batch'
+    entity_id = db.Column(db.String(100), nullable=False)  # mismo formato que TraceEvent.entity_id
+    relation = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CompanyDashboardStats(db.Model):
+    """Contadores precalculados de los dashboards por empresa
+
+    Una fila por empresa (company_id = 0 para los totales de la plataforma);
+    services.dashboard_stats aplica los deltas en la misma transacción que los
+    cambios de lotes, contratos, fijaciones y batches, y un job periódico la
+    reconcilia con GROUP BY. Cada dashboard se sirve leyendo una fila por PK.
+    """
+    __tablename__ = 'company_dashboard_stats'
+
+    company_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # sin FK: 0 = plataforma
+    # Lotes producidos por la empresa
+    lots_total = db.Column(db.Integer, nullable=False, default=0)
+    lots_available = db.Column(db.Integer, nullable=False, default=0)
+    lots_purchased = db.Column(db.Integer, nullable=False, default=0)
+    lots_assigned = db.Column(db.Integer, nullable=False, default=0)
+    lots_weight_kg = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    lots_revenue_usd = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    # Lotes comprados por la empresa (status purchased)
+    purchased_lots = db.Column(db.Integer, nullable=False, default=0)
+    purchased_weight_kg = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    # Contratos como exportador y como comprador
+    exporter_contracts = db.Column(db.Integer, nullable=False, default=0)
+    exporter_active_contracts = db.Column(db.Integer, nullable=False, default=0)
+    exporter_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    exporter_fixed_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    exporter_fixations = db.Column(db.Integer, nullable=False, default=0)
+    buyer_contracts = db.Column(db.Integer, nullable=False, default=0)
+    buyer_active_contracts = db.Column(db.Integer, nullable=False, default=0)
+    buyer_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    buyer_fixed_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    # Batches creados por la empresa
+    batches_total = db.Column(db.Integer, nullable=False, default=0)
+    batches_weight_kg = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    # Solo en la fila de plataforma (company_id = 0)
+    contracts_total = db.Column(db.Integer, nullable=False, default=0)
+    contracts_active = db.Column(db.Integer, nullable=False, default=0)
+    contracts_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    contracts_fixed_volume_mt = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    batches_available = db.Column(db.Integer, nullable=False, default=0)
+    batches_available_weight_kg = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    companies_total = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SyncChange(db.Model):
+    """Registro de cambios para la sincronización delta de la app móvil
+
+    Una fila por cambio y empresa afectada (company_id = 0 recibe todos los
+    cambios, para admin); services.change_log la llena en la misma transacción
+    que los cambios de lotes, contratos, fijaciones, batches y despachos. El id
+    es el token de sincronización: el cliente pide los cambios con id > token
+    (get_delta no lo avanza sobre entradas aún sin asentar, ver change_log).
+    """
+    __tablename__ = 'sync_changes'
+    __table_args__ = (
+        db.Index('ix_sync_changes_company_id', 'company_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, nullable=False)  # sin FK: 0 = plataforma
+    entity_type = db.Column(db.String(20), nullable=False)  # 'lot', 'contract', 'fixation', 'batch', 'dispatch'
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)  # 'upsert', 'delete' (tombstone)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class SyncMutation(db.Model):
+    """Mutaciones offline ya aplicadas desde /api/sync/sync/push
+
+    La clave (user_id, mutation_id) hace idempotente el reenvío de una cola
+    offline: una mutación repetida devuelve el resultado guardado.
+    """
+    __tablename__ = 'sync_mutations'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'mutation_id', name='uq_sync_mutation'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    mutation_id = db.Column(db.String(64), nullable=False)  # UUID generado por el cliente
+    entity_type = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer)
+    status = db.Column(db.String(20), nullable=False)  # 'applied', 'rejected', 'conflict'
+    result_json = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BlockchainTx(db.Model):
+    """Outbox de transacciones blockchain
+
+    Las rutas encolan la transacción en la misma transacción de BD que la
+    entidad; un worker asigna nonces, la envía y consulta el recibo. Al
+    confirmarse se copian los datos on-chain a la entidad de origen. La
+    transacción firmada (raw_tx, nonce, tx_hash) se guarda antes de enviarla.
+    """
+    __tablename__ = 'blockchain_tx_outbox'
+    __table_args__ = (
+        db.Index('ix_blockchain_tx_outbox_status_id', 'status', 'id'),
+        db.Index('ix_blockchain_tx_outbox_entity', 'entity_type', 'entity_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # create_contract, register_fixation, create_lot
+    entity_type = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    args_json = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sending, submitted, confirmed, failed
+    nonce = db.Column(db.Integer)
+    tx_hash = db.Column(db.String(100), index=True)
+    raw_tx = db.Column(db.Text)  # Transacción firmada (hex), se reenvía tal cual
+    block_number = db.Column(db.Integer)
+    gas_used = db.Column(db.Integer)
+    result_id = db.Column(db.String(100))  # ID extraído del evento (contractId, fixationId, lotId)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    submitted_at = db.Column(db.DateTime)
+    confirmed_at = db.Column(db.DateTime)
+    
+    @property
+    def args(self):
+        import json
+        return json.loads(self.args_json) if self.args_json else {}
+    
+    def to_dict(self):
+        """Convertir a diccionario para JSON"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'entity_type': self.entity_type,
+            'entity_id': self.entity_id,
+            'status': self.status,
+            'nonce': self.nonce,
+            'tx_hash': self.tx_hash,
+            'block_number': self.block_number,
+            'gas_used': self.gas_used,
+            'result_id': self.result_id,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'submitted_at': self.submitted_at.isoformat() if self.submitted_at else None,
+            'confirmed_at': self.confirmed_at.isoformat() if self.confirmed_at else None
+        }
+
 # ========================================
 # DEAL ROOMS - Admin Broker Mode
 # ========================================
@@ -751,6 +946,160 @@ class TraceTimeline(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class TimelineEntry(db.Model):
+    """Entrada append-only del timeline de una entidad
+
+    Sustituye al blob TraceTimeline.events_json: agregar un evento es un
+    INSERT y leer el timeline una consulta ordenada por índice.
+    """
+    __tablename__ = 'timeline_entries'
+    __table_args__ = (
+        db.UniqueConstraint('entity_type', 'entity_id', 'entry_key', name='uq_timeline_entries_entity_key'),
+        db.Index('ix_timeline_entries_entity_time', 'entity_type', 'entity_id', 'occurred_at', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.String(100), nullable=False)
+    entry_key = db.Column(db.String(100), nullable=False)  # 'event_<id>' o ID del blob migrado
+    entry_type = db.Column(db.String(50), default='traceability_event', nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('trace_events.id'), index=True)
+    event_type = db.Column(db.String(100))
+    title = db.Column(db.String(255))
+    description = db.Column(db.Text)
+    occurred_at = db.Column(db.DateTime, nullable=False)
+    actor_name = db.Column(db.String(255))
+    data_json = db.Column(db.Text)  # measurements, location, notes y campos extra
+    blockchain_tx_hash = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self, blockchain_tx_hash=None):
+        """Mismo formato que los elementos del antiguo events_json"""
+        import json
+        data = json.loads(self.data_json) if self.data_json else {}
+        return {
+            **data,
+            'id': self.entry_key,
+            'type': self.entry_type,
+            'event_type': self.event_type,
+            'title': self.title,
+            'description': self.description,
+            'timestamp': self.occurred_at.isoformat(),
+            'blockchain_tx_hash': blockchain_tx_hash or self.blockchain_tx_hash,
+            'actor': self.actor_name or 'Sistema'
+        }
+
+class TraceAnchor(db.Model):
+    """Raíz Merkle de un lote de eventos de trazabilidad anclada on-chain
+
+    Una sola transacción (DocumentRegistry.issueDocument con la raíz como hash)
+    cubre todos los eventos del árbol; cada evento guarda su prueba de inclusión.
+    """
+    __tablename__ = 'trace_anchors'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    merkle_root = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    leaf_count = db.Column(db.Integer, nullable=False)
+    first_event_id = db.Column(db.Integer)
+    last_event_id = db.Column(db.Integer)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, confirmed, failed, offchain
+    outbox_tx_id = db.Column(db.Integer, db.ForeignKey('blockchain_tx_outbox.id'))
+    document_id = db.Column(db.String(100))  # documentId en DocumentRegistry
+    blockchain_tx_hash = db.Column(db.String(100), index=True)
+    blockchain_block_number = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    anchored_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        """Convertir a diccionario para JSON"""
+        return {
+            'id': self.id,
+            'merkle_root': self.merkle_root,
+            'leaf_count': self.leaf_count,
+            'status': self.status,
+            'document_id': self.document_id,
+            'blockchain_tx_hash': self.blockchain_tx_hash,
+            'blockchain_block_number': self.blockchain_block_number,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'anchored_at': self.anchored_at.isoformat() if self.anchored_at else None
+        }
+
+class TraceEventProof(db.Model):
+    """Prueba de inclusión Merkle de un evento en su TraceAnchor"""
+    __tablename__ = 'trace_event_proofs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('trace_events.id'), nullable=False, unique=True, index=True)
+    anchor_id = db.Column(db.Integer, db.ForeignKey('trace_anchors.id'), nullable=False, index=True)
+    event_hash = db.Column(db.String(64), nullable=False)  # get_event_hash() al momento del anclaje
+    leaf_index = db.Column(db.Integer, nullable=False)
+    proof_json = db.Column(db.Text, nullable=False)  # [{"hash": ..., "position": "left"|"right"}, ...]
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    anchor = db.relationship('TraceAnchor', backref=db.backref('proofs', lazy='dynamic'))
+    event = db.relationship('TraceEvent', backref=db.backref('anchor_proof', uselist=False))
+    
+    @property
+    def proof(self):
+        import json
+        return json.loads(self.proof_json) if self.proof_json else []
+
+class IngestedEventKey(db.Model):
+    """Clave de idempotencia de eventos de básculas externas (AgroWeight Cloud)
+
+    Una fila por (empresa, id_evento): reenviar una lectura ya registrada
+    devuelve el TraceEvent existente en lugar de duplicarlo.
+    """
+    __tablename__ = 'ingested_event_keys'
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'event_key', name='uq_ingested_event_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
+    event_key = db.Column(db.String(100), nullable=False)  # id_evento enviado por la estación
+    trace_event_id = db.Column(db.Integer, db.ForeignKey('trace_events.id'), nullable=False)
+    lot_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PublicTraceSnapshot(db.Model):
+    """Respuesta materializada de la verificación pública de una entidad (QR)
+
+    payload es el JSON comprimido con gzip. Cada cambio en los eventos, pruebas
+    o anclajes de la entidad incrementa version y vacía payload; la siguiente
+    lectura lo regenera (ver services/public_trace.py).
+    """
+    __tablename__ = 'public_trace_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('entity_type', 'entity_id', name='uq_public_trace_snapshot_entity'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.String(100), nullable=False)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    etag = db.Column(db.String(64))  # SHA-256 (truncado) del JSON sin comprimir
+    payload = db.Column(db.LargeBinary)  # NULL = pendiente de regenerar
+    generated_at = db.Column(db.DateTime)
+
+class ExternalIdentifier(db.Model):
+    """Índice de identificadores externos (escaneados por básculas y apps)
+
+    Una fila por identificador: código de lote y NFT ID -> lote, código de
+    batch -> batch. Se mantiene en la misma transacción que lotes y batches
+    (ver services/identifiers.py).
+    """
+    __tablename__ = 'external_identifiers'
+    __table_args__ = (
+        db.Index('ix_external_identifiers_entity', 'kind', 'entity_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    identifier = db.Column(db.String(100), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # lot_code, nft_id, batch_code
+    entity_id = db.Column(db.Integer, nullable=False)  # producer_lots.id o batch_nfts.id
+
 # ========================================
 # ERP MODULES - Dispatch Management
 # ========================================
@@ -854,3 +1203,44 @@ class Dispatch(db.Model):
             Dispatch.dispatch_code.like(f'DSP-{year}-%')
         ).count()
         self.dispatch_code = f'DSP-{year}-{str(count + 1).zfill(3)}'
+
+# ========================================
+# MARKET DATA - Histórico de precios
+# ========================================
+
+class PriceTick(db.Model):
+    """Barra diaria de precio de mercado obtenida por el price feed
+
+    Una fila por (símbolo, fuente, fecha). La barra del día en curso se
+    actualiza en cada sondeo; fetched_at indica cuándo se confirmó por última vez.
+    """
+    __tablename__ = 'price_ticks'
+    __table_args__ = (
+        db.UniqueConstraint('symbol', 'source', 'observed_at', name='uq_price_ticks_symbol_source_observed'),
+        db.Index('ix_price_ticks_symbol_observed', 'symbol', 'observed_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.String(20), nullable=False)
+    source = db.Column(db.String(20), nullable=False)
+    observed_at = db.Column(db.DateTime, nullable=False)
+    # Precios en USD por tonelada métrica
+    open_usd_mt = db.Column(db.Numeric(12, 2))
+    high_usd_mt = db.Column(db.Numeric(12, 2))
+    low_usd_mt = db.Column(db.Numeric(12, 2))
+    close_usd_mt = db.Column(db.Numeric(12, 2), nullable=False)
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convertir a diccionario para JSON"""
+        return {
+            'symbol': self.symbol,
+            'source': self.source,
+            'observed_at': self.observed_at.isoformat() if self.observed_at else None,
+            'open': float(self.open_usd_mt) if self.open_usd_mt is not None else None,
+            'high': float(self.high_usd_mt) if self.high_usd_mt is not None else None,
+            'low': float(self.low_usd_mt) if self.low_usd_mt is not None else None,
+            'close': float(self.close_usd_mt),
+            'fetched_at': self.fetched_at.isoformat() if self.fetched_at else None
+        }
@@ -2,10 +2,11 @@ from flask import Flask, request as flask_request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_jwt_extended import decode_token, JWTManager
 import json
-import sqlite3
+import os
 from datetime import datetime
-import threading
-import time
+
+from services.notification_scheduler import NotificationScheduler
+from services.sqlite_pool import SQLitePool
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'tu_clave_secreta_aqui'
@@ -16,81 +17,162 @@ socketio = SocketIO(app, cors_allowed_origins=["http://localhost:5004", "http://
 active_connections = {}
 
 class NotificationManager:
-    def __init__(self):
-        self.db_path = 'instance/triboka_production.db'
+    # Sentencias constantes: cada conexión del pool las prepara una sola vez (cache de sqlite3)
+    INSERT_NOTIFICATION = '''
+        INSERT INTO notifications (user_id, title, message, type, category, data, priority, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    INSERT_CHAT_MESSAGE = '''
+        INSERT INTO chat_messages (room_id, sender_id, content, message_type, metadata, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+
+    def __init__(self, db_path='instance/triboka_production.db'):
+        self.db_path = db_path
+        # El servidor comparte la base con app_web3: WAL + busy_timeout y conexiones reutilizadas
+        self.pool = SQLitePool(
+            db_path,
+            size=int(os.getenv('NOTIFICATION_DB_POOL_SIZE', 5)),
+            busy_timeout=float(os.getenv('NOTIFICATION_DB_BUSY_TIMEOUT', 5))
+        )
         self.init_notification_tables()
     
+    @staticmethod
+    def _now():
+        """Mismo formato que CURRENT_TIMESTAMP, sin releer la fila insertada"""
+        return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    
     def init_notification_tables(self):
         """Inicializar tablas de notificaciones"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                message TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'info',
-                category TEXT NOT NULL DEFAULT 'system',
-                data JSON,
-                is_read BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP,
-                priority INTEGER DEFAULT 1,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_notification_settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                notification_type TEXT NOT NULL,
-                enabled BOOLEAN DEFAULT TRUE,
-                push_enabled BOOLEAN DEFAULT TRUE,
-                email_enabled BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id),
-                UNIQUE(user_id, notification_type)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                room_id TEXT NOT NULL,
-                sender_id INTEGER NOT NULL,
-                content TEXT,
-                message_type TEXT DEFAULT 'text',
-                metadata JSON,
-                is_read BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (sender_id) REFERENCES users(id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    type TEXT NOT NULL DEFAULT 'info',
+                    category TEXT NOT NULL DEFAULT 'system',
+                    data JSON,
+                    is_read BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    expires_at TIMESTAMP,
+                    priority INTEGER DEFAULT 1,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_notification_settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    notification_type TEXT NOT NULL,
+                    enabled BOOLEAN DEFAULT TRUE,
+                    push_enabled BOOLEAN DEFAULT TRUE,
+                    email_enabled BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id),
+                    UNIQUE(user_id, notification_type)
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    room_id TEXT NOT NULL,
+                    sender_id INTEGER NOT NULL,
+                    content TEXT,
+                    message_type TEXT DEFAULT 'text',
+                    metadata JSON,
+                    is_read BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (sender_id) REFERENCES users(id)
+                )
+            ''')
+            
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_notifications_user ON notifications (user_id, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_chat_messages_room ON chat_messages (room_id, created_at)')
+    
+    def create_notification(self, user_id, title, message, notification_type='info', category='system',
+                            data=None, priority=1):
+        """Crear notificación y enviarla a la sala personal del usuario"""
+        return self.create_notifications([user_id], title, message, notification_type, category, data,
+                                         priority)[0]
+    
+    def create_notifications(self, user_ids, title, message, notification_type='info', category='system',
+                             data=None, priority=1):
+        """Crear la misma notificación para varios usuarios en un solo INSERT por lotes"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        created_at = self._now()
+        payload = json.dumps(data) if data else None
+        with self.pool.transaction() as conn:
+            conn.executemany(self.INSERT_NOTIFICATION, [
+                (user_id, title, message, notification_type, category, payload, priority, created_at)
+                for user_id in user_ids
+            ])
+            # BEGIN IMMEDIATE retiene el lock de escritura: los ids del lote son consecutivos
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        
+        notifications = []
+        for notification_id, user_id in enumerate(user_ids, start=last_id - len(user_ids) + 1):
+            notification = {
+                'id': notification_id,
+                'user_id': user_id,
+                'title': title,
+                'message': message,
+                'type': notification_type,
+                'category': category,
+                'data': data,
+                'is_read': False,
+                'created_at': created_at,
+                'priority': priority
+            }
+            socketio.emit('new_notification', notification, room=f"user_{user_id}")
+            notifications.append(notification)
+        
+        return notifications
+    
+    def get_user_notifications(self, user_id, limit=50, unread_only=False):
+        """Notificaciones del usuario, más recientes primero"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, title, message, type, category, data, is_read, created_at, priority
+                FROM notifications
+                WHERE user_id = ? AND (? = 0 OR is_read = FALSE)
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, int(bool(unread_only)), limit)).fetchall()
+        
+        return [{
+            'id': row[0],
+            'user_id': user_id,
+            'title': row[1],
+            'message': row[2],
+            'type': row[3],
+            'category': row[4],
+            'data': json.loads(row[5]) if row[5] else None,
+            'is_read': bool(row[6]),
+            'created_at': row[7],
+            'priority': row[8]
+        } for row in rows]
+    
+    def mark_as_read(self, notification_id, user_id):
+        """Marcar una notificación propia como leída"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute('UPDATE notifications SET is_read = TRUE WHERE id = ? AND user_id = ?',
+                                  (notification_id, user_id))
+            return cursor.rowcount > 0
     
     def create_chat_message(self, room_id, sender_id, content, message_type='text', metadata=None):
         """Crear nuevo mensaje de chat"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO chat_messages (room_id, sender_id, content, message_type, metadata)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (room_id, sender_id, content, message_type, json.dumps(metadata) if metadata else None))
-        
-        message_id = cursor.lastrowid
-        
-        # Obtener fecha de creación
-        cursor.execute('SELECT created_at FROM chat_messages WHERE id = ?', (message_id,))
-        created_at = cursor.fetchone()[0]
-        
-        conn.commit()
-        conn.close()
+        created_at = self._now()
+        with self.pool.connection() as conn:
+            cursor = conn.execute(self.INSERT_CHAT_MESSAGE, (
+                room_id, sender_id, content, message_type, json.dumps(metadata) if metadata else None, created_at
+            ))
+            message_id = cursor.lastrowid
         
         message_data = {
             'id': message_id,
@@ -110,20 +192,15 @@ class NotificationManager:
 
     def get_chat_history(self, room_id, limit=50, offset=0):
         """Obtener historial de chat"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT m.id, m.room_id, m.sender_id, m.content, m.message_type, m.metadata, m.is_read, m.created_at, u.name
-            FROM chat_messages m
-            LEFT JOIN users u ON m.sender_id = u.id
-            WHERE m.room_id = ?
-            ORDER BY m.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', (room_id, limit, offset))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT m.id, m.room_id, m.sender_id, m.content, m.message_type, m.metadata, m.is_read, m.created_at, u.name
+                FROM chat_messages m
+                LEFT JOIN users u ON m.sender_id = u.id
+                WHERE m.room_id = ?
+                ORDER BY m.created_at DESC
+                LIMIT ? OFFSET ?
+            ''', (room_id, limit, offset)).fetchall()
         
         messages = []
         for row in rows:
@@ -143,19 +220,13 @@ class NotificationManager:
 
     def mark_chat_read(self, room_id, user_id):
         """Marcar mensajes de una sala como leídos (excepto los propios)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE chat_messages 
-            SET is_read = TRUE 
-            WHERE room_id = ? AND sender_id != ? AND is_read = FALSE
-        ''', (room_id, user_id))
-        
-        updated = cursor.rowcount
-        conn.commit()
-        conn.close()
-        return updated
+        with self.pool.connection() as conn:
+            cursor = conn.execute('''
+                UPDATE chat_messages 
+                SET is_read = TRUE 
+                WHERE room_id = ? AND sender_id != ? AND is_read = FALSE
+            ''', (room_id, user_id))
+            return cursor.rowcount
 
 notification_manager = NotificationManager()
 
@@ -325,17 +396,12 @@ def handle_internal_message(data):
             return
         
         # Guardar mensaje en base de datos
-        conn = sqlite3.connect(notification_manager.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO internal_messages (from_user_id, to_user_id, subject, message)
-            VALUES (?, ?, ?, ?)
-        ''', (from_user_id, to_user_id, subject, message))
-        
-        message_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with notification_manager.pool.connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO internal_messages (from_user_id, to_user_id, subject, message)
+                VALUES (?, ?, ?, ?)
+            ''', (from_user_id, to_user_id, subject, message))
+            message_id = cursor.lastrowid
         
         # Crear notificación para el destinatario
         notification_manager.create_notification(
@@ -353,82 +419,15 @@ def handle_internal_message(data):
         print(f"Error enviando mensaje: {e}")
         emit('message_error', {'error': str(e)})
 
-# Función para generar notificaciones automáticas del sistema
-def generate_system_notifications():
-    """Generar notificaciones automáticas basadas en eventos del sistema"""
-    while True:
-        try:
-            conn = sqlite3.connect(notification_manager.db_path)
-            cursor = conn.cursor()
-            
-            # Verificar contratos próximos a vencer
-            cursor.execute('''
-                SELECT c.id, c.contract_code, c.delivery_date, u.id as user_id, u.name
-                FROM export_contracts c
-                JOIN users u ON u.company_id = c.exporter_company_id
-                WHERE c.delivery_date <= datetime('now', '+5 days')
-                AND c.status = 'active'
-                AND c.id NOT IN (
-                    SELECT CAST(json_extract(data, '$.contract_id') AS INTEGER)
-                    FROM notifications 
-                    WHERE category = 'contract_expiry' 
-                    AND created_at > datetime('now', '-1 day')
-                )
-            ''')
-            
-            expiring_contracts = cursor.fetchall()
-            
-            for contract in expiring_contracts:
-                days_left = (datetime.fromisoformat(contract[2]) - datetime.now()).days
-                notification_manager.create_notification(
-                    contract[3],  # user_id
-                    f"Contrato próximo a vencer: {contract[1]}",
-                    f"El contrato {contract[1]} vence en {days_left} días. Revisa el estado de las fijaciones.",
-                    'warning',
-                    'contract_expiry',
-                    {'contract_id': contract[0], 'days_left': days_left},
-                    priority=3
-                )
-            
-            # Verificar lotes no asignados por mucho tiempo
-            cursor.execute('''
-                SELECT pl.id, pl.lot_code, u.id as user_id, u.name
-                FROM producer_lots pl
-                JOIN users u ON u.company_id = pl.producer_company_id
-                WHERE pl.status = 'available'
-                AND pl.created_at <= datetime('now', '-7 days')
-                AND pl.id NOT IN (
-                    SELECT CAST(json_extract(data, '$.lot_id') AS INTEGER)
-                    FROM notifications 
-                    WHERE category = 'lot_unassigned' 
-                    AND created_at > datetime('now', '-3 days')
-                )
-            ''')
-            
-            unassigned_lots = cursor.fetchall()
-            
-            for lot in unassigned_lots:
-                notification_manager.create_notification(
-                    lot[2],  # user_id
-                    f"Lote sin asignar: {lot[1]}",
-                    f"El lote {lot[1]} lleva más de 7 días sin ser asignado a un contrato.",
-                    'info',
-                    'lot_unassigned',
-                    {'lot_id': lot[0]},
-                    priority=2
-                )
-            
-            conn.close()
-            
-        except Exception as e:
-            print(f"Error generando notificaciones automáticas: {e}")
-        
-        # Esperar 1 hora antes de la próxima verificación
-        time.sleep(3600)
-
-# Iniciar hilo para notificaciones automáticas
-notification_thread = threading.Thread(target=generate_system_notifications, daemon=True)
-notification_thread.start()
+# Alertas automáticas del sistema (contratos por vencer, lotes sin asignar):
+# cola de prioridad por fecha de vencimiento en lugar de un sondeo cada hora
+notification_scheduler = NotificationScheduler(
+    connect=notification_manager.pool.new_connection,
+    notify=notification_manager.create_notifications,
+    refresh_interval=float(os.getenv('NOTIFICATION_REFRESH_INTERVAL', 5)),
+    watermark_overlap=float(os.getenv('NOTIFICATION_WATERMARK_OVERLAP', 60))
+)
+notification_scheduler.start()
 
 if __name__ == '__main__':
     print("🔔 Servidor de Notificaciones iniciado en puerto 5005")
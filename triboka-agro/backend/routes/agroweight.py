@@ -3,8 +3,12 @@ Routes for AgroWeight Cloud integration
 Minimal blueprint with lot search functionality
 """
 
+import logging
+
 from flask import Blueprint, jsonify
-from models_simple import ProducerLot
+from services.identifiers import resolve_lot
+
+logger = logging.getLogger(__name__)
 
 agroweight_bp = Blueprint('agroweight', __name__)
 
@@ -12,27 +16,13 @@ agroweight_bp = Blueprint('agroweight', __name__)
 def get_lote_by_id(lote_id):
     """Obtener lote por ID (código interno o NFT ID) para integración con AgroWeight Cloud"""
     try:
-        print(f"DEBUG: Buscando lote con ID: {lote_id}")
-
         # Para AgroWeight Cloud, permitir consultar cualquier lote
-        lot = ProducerLot.query.filter(
-            ((ProducerLot.lot_code == lote_id) | (ProducerLot.blockchain_lot_id == lote_id))
-        ).first()
-
-        print(f"DEBUG: Lote encontrado: {lot}")
-
+        lot = resolve_lot(lote_id)
         if not lot:
-            print(f"DEBUG: Lote {lote_id} no encontrado")
             return jsonify({'error': 'Lot not found'}), 404
 
-        print(f"DEBUG: Convirtiendo lote a dict")
-        result = lot.to_dict()
-        print(f"DEBUG: Resultado: {result}")
-
-        return jsonify(result)
+        return jsonify(lot.to_dict())
 
     except Exception as e:
-        print(f"ERROR en get_lote_by_id: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        logger.error(f"❌ Error en get_lote_by_id {lote_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
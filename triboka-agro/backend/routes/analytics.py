@@ -8,28 +8,56 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime, timedelta, date
 import json
 import logging
-from collections import defaultdict, Counter
+from collections import Counter
 from typing import Dict, List, Optional, Any, Tuple
-import pandas as pd
 import numpy as np
 
 from models_simple import db, ExportContract, ContractFixation, ProducerLot, BatchNFT, TraceEvent, Company, User
 from blockchain_service import get_blockchain_integration
-from routes.performance import cached, performance_monitor
+from routes.performance import cached, cache_layer, performance_monitor
 
 logger = logging.getLogger(__name__)
 
 analytics_bp = Blueprint('analytics', __name__)
 
+# Etapas de la cadena de suministro -> tipos de evento de trazabilidad
+SUPPLY_CHAIN_STAGES = {
+    'producer_init': ['PRODUCER_INIT'],
+    'reception': ['RECEPCIÓN'],
+    'quality_control': ['CALIDAD'],
+    'processing': ['DRYING', 'FERMENTATION', 'STORAGE'],
+    'export': ['EXPORT_PREPARATION', 'CUSTOMS_CLEARANCE', 'SHIPMENT']
+}
+
+def _nonzero(column):
+    """NULL para 0 y NULL (los agregados ignoran los valores vacíos como en Python)"""
+    return db.case((column != 0, column), else_=None)
+
+def _day_key(column):
+    return db.func.date(column)
+
+def _month_key(column):
+    """Mes YYYY-MM del timestamp según el motor de base de datos"""
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.strftime('%Y-%m', column)
+    return db.func.to_char(column, 'YYYY-MM')
+
+def _iso_key(value) -> str:
+    return value if isinstance(value, str) else value.isoformat()
+
+def _sample_std(values: np.ndarray) -> float:
+    """Desviación estándar muestral (0 con menos de dos valores)"""
+    return float(values.std(ddof=1)) if values.size > 1 else 0.0
+
 class AnalyticsEngine:
     """Motor de análisis para métricas avanzadas"""
 
     def __init__(self):
         self.performance_monitor = performance_monitor
 
-    @cached(timeout=300, key_prefix="analytics")
+    @cached(timeout=300, key_prefix="analytics", tags=['lots', 'contracts', 'fixations', 'traceability'])
     def get_supply_chain_metrics(self, start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict:
-        """Obtener métricas de la cadena de suministro"""
+        """Obtener métricas de la cadena de suministro (agregadas en SQL)"""
         if not start_date:
             start_date = date.today() - timedelta(days=30)
         if not end_date:
@@ -43,106 +71,127 @@ class AnalyticsEngine:
             'blockchain': {}
         }
 
-        # Métricas de contratos
-        contracts_query = ExportContract.query.filter(
+        # Métricas de contratos: un GROUP BY (status, product_type)
+        contract_rows = db.session.query(
+            ExportContract.status,
+            ExportContract.product_type,
+            db.func.count(ExportContract.id),
+            db.func.sum(ExportContract.total_volume_mt),
+            db.func.sum(_nonzero(ExportContract.differential_usd)),
+            db.func.count(_nonzero(ExportContract.differential_usd))
+        ).filter(
             ExportContract.created_at >= start_date,
             ExportContract.created_at <= end_date
-        )
-
-        contracts = contracts_query.all()
+        ).group_by(ExportContract.status, ExportContract.product_type).all()
+
+        by_status, by_product_type = Counter(), Counter()
+        differential_sum, differential_count = 0.0, 0
+        for status, product_type, count, volume, differential, with_differential in contract_rows:
+            by_status[status] += count
+            by_product_type[product_type] += count
+            differential_sum += float(differential or 0)
+            differential_count += with_differential
         metrics['contracts'] = {
-            'total': len(contracts),
-            'by_status': Counter(c.status for c in contracts),
-            'by_product_type': Counter(c.product_type for c in contracts),
-            'total_volume_mt': sum(float(c.total_volume_mt) for c in contracts if c.total_volume_mt),
-            'avg_differential': np.mean([float(c.differential_usd) for c in contracts if c.differential_usd]) if contracts else 0
+            'total': sum(by_status.values()),
+            'by_status': dict(by_status),
+            'by_product_type': dict(by_product_type),
+            'total_volume_mt': sum(float(row[3] or 0) for row in contract_rows),
+            'avg_differential': differential_sum / differential_count if differential_count else 0
         }
 
         # Métricas de fijaciones
-        fixations_query = ContractFixation.query.filter(
+        total, volume, value, spot_price = db.session.query(
+            db.func.count(ContractFixation.id),
+            db.func.sum(ContractFixation.fixed_quantity_mt),
+            db.func.sum(ContractFixation.total_value_usd),
+            db.func.avg(_nonzero(ContractFixation.spot_price_usd))
+        ).filter(
             ContractFixation.created_at >= start_date,
             ContractFixation.created_at <= end_date
-        )
-
-        fixations = fixations_query.all()
+        ).one()
         metrics['fixations'] = {
-            'total': len(fixations),
-            'total_volume_mt': sum(float(f.fixed_quantity_mt) for f in fixations if f.fixed_quantity_mt),
-            'total_value_usd': sum(float(f.total_value_usd) for f in fixations if f.total_value_usd),
-            'avg_spot_price': np.mean([float(f.spot_price_usd) for f in fixations if f.spot_price_usd]) if fixations else 0
+            'total': total,
+            'total_volume_mt': float(volume or 0),
+            'total_value_usd': float(value or 0),
+            'avg_spot_price': float(spot_price or 0)
         }
 
-        # Métricas de lotes
-        lots_query = ProducerLot.query.filter(
+        # Métricas de lotes: un GROUP BY quality_grade
+        lot_rows = db.session.query(
+            ProducerLot.quality_grade,
+            db.func.count(ProducerLot.id),
+            db.func.sum(ProducerLot.weight_kg),
+            db.func.sum(_nonzero(ProducerLot.moisture_content)),
+            db.func.count(_nonzero(ProducerLot.moisture_content))
+        ).filter(
             ProducerLot.created_at >= start_date,
             ProducerLot.created_at <= end_date
-        )
+        ).group_by(ProducerLot.quality_grade).all()
 
-        lots = lots_query.all()
+        moisture_count = sum(row[4] for row in lot_rows)
         metrics['lots'] = {
-            'total': len(lots),
-            'by_quality_grade': Counter(l.quality_grade for l in lots if l.quality_grade),
-            'total_volume_mt': sum(float(l.volume_mt) for l in lots if l.volume_mt),
-            'avg_humidity': np.mean([float(l.humidity_percent) for l in lots if l.humidity_percent]) if lots else 0,
-            'avg_fermentation_days': np.mean([l.fermentation_days for l in lots if l.fermentation_days]) if lots else 0
+            'total': sum(row[1] for row in lot_rows),
+            'by_quality_grade': {grade: count for grade, count, *_ in lot_rows if grade},
+            'total_volume_mt': sum(float(row[2] or 0) for row in lot_rows) / 1000,
+            'avg_humidity': sum(float(row[3] or 0) for row in lot_rows) / moisture_count if moisture_count else 0,
+            'avg_fermentation_days': 0  # Los lotes no registran días de fermentación
         }
 
-        # Métricas de trazabilidad
-        trace_query = TraceEvent.query.filter(
-            TraceEvent.timestamp >= start_date,
-            TraceEvent.timestamp <= end_date
-        )
-
-        trace_events = trace_query.all()
+        # Métricas de trazabilidad: GROUP BY (event_type, día) y por etapa
+        event_rows = db.session.query(
+            TraceEvent.event_type,
+            _day_key(TraceEvent.event_timestamp),
+            db.func.count(TraceEvent.id)
+        ).filter(
+            TraceEvent.event_timestamp >= start_date,
+            TraceEvent.event_timestamp <= end_date
+        ).group_by(TraceEvent.event_type, _day_key(TraceEvent.event_timestamp)).all()
+
+        by_event_type, events_per_day = Counter(), Counter()
+        for event_type, day, count in event_rows:
+            by_event_type[event_type] += count
+            events_per_day[_iso_key(day)] += count
+        total_events = sum(by_event_type.values())
         metrics['traceability'] = {
-            'total_events': len(trace_events),
-            'by_event_type': Counter(e.event_type for e in trace_events),
-            'events_per_day': self._group_events_by_date(trace_events),
-            'supply_chain_stages': self._calculate_supply_chain_progress(trace_events)
+            'total_events': total_events,
+            'by_event_type': dict(by_event_type),
+            'events_per_day': dict(events_per_day),
+            'supply_chain_stages': self._calculate_supply_chain_progress(start_date, end_date)
         }
 
         # Métricas de blockchain
         blockchain = get_blockchain_integration()
         metrics['blockchain'] = {
-            'total_transactions': len(trace_events),  # Simplificado
-            'gas_usage_estimate': len(trace_events) * 21000,  # Estimación básica
+            'total_transactions': total_events,  # Simplificado
+            'gas_usage_estimate': total_events * 21000,  # Estimación básica
             'network_status': 'active' if blockchain else 'inactive'
         }
 
         return metrics
 
-    def _group_events_by_date(self, events: List) -> Dict[str, int]:
-        """Agrupar eventos por fecha"""
-        date_counts = defaultdict(int)
-        for event in events:
-            date_str = event.timestamp.date().isoformat()
-            date_counts[date_str] += 1
-        return dict(date_counts)
-
-    def _calculate_supply_chain_progress(self, events: List) -> Dict:
-        """Calcular progreso de la cadena de suministro"""
-        # Definir etapas del proceso
-        stages = {
-            'producer_init': ['PRODUCER_INIT'],
-            'reception': ['RECEPCIÓN'],
-            'quality_control': ['CALIDAD'],
-            'processing': ['DRYING', 'FERMENTATION', 'STORAGE'],
-            'export': ['EXPORT_PREPARATION', 'CUSTOMS_CLEARANCE', 'SHIPMENT']
-        }
-
-        progress = {}
-        for stage, event_types in stages.items():
-            stage_events = [e for e in events if e.event_type in event_types]
-            progress[stage] = {
-                'events': len(stage_events),
-                'unique_batches': len(set(e.batch_nft_id for e in stage_events if e.batch_nft_id))
-            }
+    def _calculate_supply_chain_progress(self, start_date: date, end_date: date) -> Dict:
+        """Calcular progreso de la cadena de suministro (eventos y batches distintos por etapa)"""
+        stage = db.case(
+            *[(TraceEvent.event_type.in_(event_types), name) for name, event_types in SUPPLY_CHAIN_STAGES.items()],
+            else_=None
+        )
+        batch_id = db.case((TraceEvent.entity_type == 'batch', TraceEvent.entity_id), else_=None)
+        rows = dict((name, (events, batches)) for name, events, batches in db.session.query(
+            stage, db.func.count(TraceEvent.id), db.func.count(db.distinct(batch_id))
+        ).filter(
+            TraceEvent.event_timestamp >= start_date,
+            TraceEvent.event_timestamp <= end_date,
+            TraceEvent.event_type.in_([t for types in SUPPLY_CHAIN_STAGES.values() for t in types])
+        ).group_by(stage))
 
-        return progress
+        return {
+            name: {'events': rows.get(name, (0, 0))[0], 'unique_batches': rows.get(name, (0, 0))[1]}
+            for name in SUPPLY_CHAIN_STAGES
+        }
 
-    @cached(timeout=600, key_prefix="analytics")
+    @cached(timeout=600, key_prefix="analytics", tags=['contracts', 'fixations'])
     def get_financial_analytics(self, start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict:
-        """Obtener análisis financiero"""
+        """Obtener análisis financiero (agregados en SQL, percentiles desde una proyección)"""
         if not start_date:
             start_date = date.today() - timedelta(days=90)
         if not end_date:
@@ -156,67 +205,61 @@ class AnalyticsEngine:
             'market_insights': {}
         }
 
-        # Análisis de ingresos
-        fixations = ContractFixation.query.filter(
-            ContractFixation.fixation_date >= start_date,
-            ContractFixation.fixation_date <= end_date
-        ).all()
+        in_window = (ContractFixation.fixation_date >= start_date, ContractFixation.fixation_date <= end_date)
+        product_type = db.func.coalesce(ExportContract.product_type, 'Unknown')
 
-        if fixations:
-            total_revenue = sum(float(f.total_value_usd) for f in fixations if f.total_value_usd)
+        # Análisis de ingresos
+        fixation_count, total_revenue = db.session.query(
+            db.func.count(ContractFixation.id),
+            db.func.sum(ContractFixation.total_value_usd)
+        ).filter(*in_window).one()
+
+        if fixation_count:
+            total_revenue = float(total_revenue or 0)
+            month = _month_key(ContractFixation.fixation_date)
             analytics['revenue'] = {
                 'total_usd': total_revenue,
-                'avg_per_fixation': total_revenue / len(fixations),
-                'by_month': self._group_revenue_by_month(fixations),
-                'by_product_type': self._group_revenue_by_product(fixations)
+                'avg_per_fixation': total_revenue / fixation_count,
+                'by_month': {_iso_key(key): float(value) for key, value in db.session.query(
+                    month, db.func.sum(ContractFixation.total_value_usd)
+                ).filter(*in_window, ContractFixation.total_value_usd.isnot(None)).group_by(month)},
+                'by_product_type': {key: float(value) for key, value in db.session.query(
+                    product_type, db.func.sum(ContractFixation.total_value_usd)
+                ).join(ExportContract, ExportContract.id == ContractFixation.export_contract_id).filter(
+                    *in_window, ContractFixation.total_value_usd.isnot(None)
+                ).group_by(product_type)}
             }
 
-        # Tendencias de precios
-        price_data = []
-        for f in fixations:
-            if f.spot_price_usd:
-                price_data.append({
-                    'date': f.fixation_date,
-                    'price': float(f.spot_price_usd),
-                    'product_type': f.export_contract.product_type if f.export_contract else 'Unknown'
-                })
-
-        if price_data:
-            df = pd.DataFrame(price_data)
+        # Tendencias de precios: una proyección (precio, producto) en arrays
+        price_rows = db.session.query(ContractFixation.spot_price_usd, product_type).outerjoin(
+            ExportContract, ExportContract.id == ContractFixation.export_contract_id
+        ).filter(*in_window, _nonzero(ContractFixation.spot_price_usd).isnot(None)).all()
+        prices = np.array([float(price) for price, _ in price_rows])
+        products = np.array([product for _, product in price_rows], dtype=object)
+
+        if prices.size:
+            by_product = {'mean': {}, 'std': {}, 'count': {}}
+            for product in sorted(set(products)):
+                product_prices = prices[products == product]
+                by_product['mean'][product] = float(product_prices.mean())
+                by_product['std'][product] = _sample_std(product_prices)
+                by_product['count'][product] = int(product_prices.size)
             analytics['price_trends'] = {
-                'avg_price': df['price'].mean(),
-                'price_volatility': df['price'].std(),
+                'avg_price': float(prices.mean()),
+                'price_volatility': _sample_std(prices),
                 'price_range': {
-                    'min': df['price'].min(),
-                    'max': df['price'].max()
+                    'min': float(prices.min()),
+                    'max': float(prices.max())
                 },
-                'by_product': df.groupby('product_type')['price'].agg(['mean', 'std', 'count']).to_dict()
+                'by_product': by_product
             }
 
         # Insights de mercado
-        analytics['market_insights'] = self._calculate_market_insights(fixations)
+        analytics['market_insights'] = self._calculate_market_insights(fixation_count, in_window, prices)
 
         return analytics
 
-    def _group_revenue_by_month(self, fixations: List) -> Dict:
-        """Agrupar ingresos por mes"""
-        monthly_revenue = defaultdict(float)
-        for f in fixations:
-            if f.fixation_date and f.total_value_usd:
-                month_key = f.fixation_date.strftime('%Y-%m')
-                monthly_revenue[month_key] += float(f.total_value_usd)
-        return dict(monthly_revenue)
-
-    def _group_revenue_by_product(self, fixations: List) -> Dict:
-        """Agrupar ingresos por tipo de producto"""
-        product_revenue = defaultdict(float)
-        for f in fixations:
-            if f.export_contract and f.total_value_usd:
-                product_type = f.export_contract.product_type or 'Unknown'
-                product_revenue[product_type] += float(f.total_value_usd)
-        return dict(product_revenue)
-
-    def _calculate_market_insights(self, fixations: List) -> Dict:
+    def _calculate_market_insights(self, fixation_count: int, in_window: Tuple, prices: np.ndarray) -> Dict:
         """Calcular insights de mercado"""
         insights = {
             'top_buyers': [],
@@ -225,40 +268,33 @@ class AnalyticsEngine:
             'quality_premium': {}
         }
 
-        if not fixations:
+        if not fixation_count:
             return insights
 
         # Top compradores
-        buyer_revenue = defaultdict(float)
-        for f in fixations:
-            if f.export_contract and f.export_contract.buyer_company and f.total_value_usd:
-                buyer_name = f.export_contract.buyer_company.name
-                buyer_revenue[buyer_name] += float(f.total_value_usd)
-
-        insights['top_buyers'] = sorted(
-            [{'buyer': k, 'revenue_usd': v} for k, v in buyer_revenue.items()],
-            key=lambda x: x['revenue_usd'],
-            reverse=True
-        )[:10]
+        revenue = db.func.sum(ContractFixation.total_value_usd)
+        insights['top_buyers'] = [
+            {'buyer': buyer, 'revenue_usd': float(value)}
+            for buyer, value in db.session.query(Company.name, revenue)
+            .join(ExportContract, ExportContract.id == ContractFixation.export_contract_id)
+            .join(Company, Company.id == ExportContract.buyer_company_id)
+            .filter(*in_window, _nonzero(ContractFixation.total_value_usd).isnot(None))
+            .group_by(Company.name)
+            .order_by(revenue.desc())
+            .limit(10)
+        ]
 
         # Distribución de precios
-        prices = [float(f.spot_price_usd) for f in fixations if f.spot_price_usd]
-        if prices:
+        if prices.size:
+            p5, p25, p50, p75, p95 = (float(p) for p in np.percentile(prices, [5, 25, 50, 75, 95]))
             insights['price_distribution'] = {
-                'quartiles': {
-                    '25': np.percentile(prices, 25),
-                    '50': np.percentile(prices, 50),
-                    '75': np.percentile(prices, 75)
-                },
-                'outliers': {
-                    'low': np.percentile(prices, 5),
-                    'high': np.percentile(prices, 95)
-                }
+                'quartiles': {'25': p25, '50': p50, '75': p75},
+                'outliers': {'low': p5, 'high': p95}
             }
 
         return insights
 
-    @cached(timeout=300, key_prefix="analytics")
+    @cached(timeout=300, key_prefix="analytics", tags=['lots', 'traceability'])
     def get_quality_analytics(self, start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict:
         """Obtener análisis de calidad"""
         if not start_date:
@@ -273,52 +309,43 @@ class AnalyticsEngine:
             'certification_status': {}
         }
 
-        # Análisis de lotes por calidad
-        lots = ProducerLot.query.filter(
+        # Análisis de lotes por calidad (los lotes no registran días de
+        # fermentación, así que processing_efficiency queda vacío)
+        analytics['quality_distribution'] = {grade: count for grade, count in db.session.query(
+            ProducerLot.quality_grade, db.func.count(ProducerLot.id)
+        ).filter(
             ProducerLot.created_at >= start_date,
-            ProducerLot.created_at <= end_date
-        ).all()
-
-        if lots:
-            quality_grades = Counter(l.quality_grade for l in lots if l.quality_grade)
-            analytics['quality_distribution'] = dict(quality_grades)
-
-            # Eficiencia de procesamiento
-            fermentation_days = [l.fermentation_days for l in lots if l.fermentation_days]
-            if fermentation_days:
-                analytics['processing_efficiency'] = {
-                    'avg_fermentation_days': np.mean(fermentation_days),
-                    'fermentation_range': {
-                        'min': min(fermentation_days),
-                        'max': max(fermentation_days)
-                    }
-                }
-
-        # Análisis de eventos de calidad
-        quality_events = TraceEvent.query.filter(
-            TraceEvent.timestamp >= start_date,
-            TraceEvent.timestamp <= end_date,
-            TraceEvent.event_type == 'CALIDAD'
-        ).all()
-
-        if quality_events:
-            # Analizar mediciones de calidad
-            defect_rates = []
-            for event in quality_events:
-                if event.measurements:
-                    measurements = json.loads(event.measurements) if isinstance(event.measurements, str) else event.measurements
-                    if 'defect_rate' in measurements:
-                        defect_rates.append(float(measurements['defect_rate']))
-
-            if defect_rates:
-                analytics['defect_rates'] = {
-                    'avg_defect_rate': np.mean(defect_rates),
-                    'defect_rate_range': {
-                        'min': min(defect_rates),
-                        'max': max(defect_rates)
-                    },
-                    'acceptable_rate': len([r for r in defect_rates if r <= 5.0]) / len(defect_rates) * 100
-                }
+            ProducerLot.created_at <= end_date,
+            ProducerLot.quality_grade.isnot(None),
+            ProducerLot.quality_grade != ''
+        ).group_by(ProducerLot.quality_grade)}
+
+        # Análisis de eventos de calidad: solo la columna de mediciones
+        measurements = db.session.query(TraceEvent.measurements).filter(
+            TraceEvent.event_timestamp >= start_date,
+            TraceEvent.event_timestamp <= end_date,
+            TraceEvent.event_type == 'CALIDAD',
+            TraceEvent.measurements.isnot(None)
+        )
+        defect_rates = []
+        for (raw,) in measurements:
+            try:
+                values = json.loads(raw) if isinstance(raw, str) else raw
+            except ValueError:
+                continue
+            if isinstance(values, dict) and values.get('defect_rate') is not None:
+                defect_rates.append(float(values['defect_rate']))
+
+        if defect_rates:
+            rates = np.array(defect_rates)
+            analytics['defect_rates'] = {
+                'avg_defect_rate': float(rates.mean()),
+                'defect_rate_range': {
+                    'min': float(rates.min()),
+                    'max': float(rates.max())
+                },
+                'acceptable_rate': float((rates <= 5.0).mean() * 100)
+            }
 
         return analytics
 
@@ -484,53 +511,39 @@ class AnalyticsEngine:
 analytics_engine = AnalyticsEngine()
 
 class AnalyticsCache:
-    """Sistema de cache para analytics"""
+    """Sistema de cache para analytics
 
-    def __init__(self):
-        self.cache = {}
-        self.expiration_times = {}
+    Fachada sobre el cache de dos niveles compartido (routes.performance.cache_layer):
+    las claves viven bajo el namespace 'analytics' y quedan acotadas por el LRU.
+    """
+
+    namespace = 'analytics'
+
+    def __init__(self, layer=None):
+        self.layer = layer or cache_layer
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
 
     def set(self, key: str, value: Any, ttl: int = 300):
         """Almacenar valor en cache con TTL"""
-        self.cache[key] = value
-        self.expiration_times[key] = datetime.utcnow() + timedelta(seconds=ttl)
+        self.layer.set(self._key(key), value, ttl, tags=(self.namespace,))
 
     def get(self, key: str) -> Optional[Any]:
         """Obtener valor del cache si no ha expirado"""
-        if key in self.cache:
-            if datetime.utcnow() < self.expiration_times[key]:
-                return self.cache[key]
-            else:
-                # Expirado, eliminar
-                del self.cache[key]
-                del self.expiration_times[key]
-        return None
+        return self.layer.get(self._key(key))
 
     def delete(self, key: str):
         """Eliminar clave del cache"""
-        if key in self.cache:
-            del self.cache[key]
-        if key in self.expiration_times:
-            del self.expiration_times[key]
+        self.layer.delete(self._key(key))
 
     def clear(self):
-        """Limpiar todo el cache"""
-        self.cache.clear()
-        self.expiration_times.clear()
+        """Limpiar todo el cache de analytics (incluye resultados de AnalyticsEngine)"""
+        self.layer.invalidate_tags(self.namespace)
 
     def get_stats(self) -> Dict:
         """Obtener estadísticas del cache"""
-        now = datetime.utcnow()
-        expired_keys = [k for k, exp in self.expiration_times.items() if now >= exp]
-
-        # Limpiar expirados
-        for key in expired_keys:
-            self.delete(key)
-
-        return {
-            'total_keys': len(self.cache),
-            'expired_keys_cleaned': len(expired_keys)
-        }
+        return self.layer.get_stats()
 
 # Instancia global del cache de analytics
 analytics_cache = AnalyticsCache()
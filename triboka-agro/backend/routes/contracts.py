@@ -6,6 +6,8 @@ Advanced contract management with fixations, workflow, and business logic
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models_simple import db, ExportContract, ContractFixation, User, Company
+from blockchain_service import get_blockchain_integration
+from services.tx_outbox import enqueue_contract_creation
 from datetime import datetime
 import logging
 
@@ -321,6 +323,12 @@ def update_contract_status(contract_id):
         contract.status = new_status
         contract.updated_at = datetime.utcnow()
 
+        # Los borradores (también los creados offline) se registran en blockchain al activarse
+        if old_status == 'draft' and new_status == 'active':
+            blockchain = get_blockchain_integration()
+            if blockchain.is_ready() and blockchain.agro_contract.contract:
+                enqueue_contract_creation(contract)
+
         db.session.commit()
 
         logger.info(f"Contract {contract_id} status changed from {old_status} to {new_status} by user {user_id}")
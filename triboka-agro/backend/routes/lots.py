@@ -8,9 +8,10 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from sqlalchemy import desc, asc
 from datetime import datetime
 import uuid
-from functools import wraps
 
 from models_simple import ProducerLot, TraceEvent, User, Company, db
+from services.api_keys import require_api_key
+from routes.performance import invalidate_cache_tags
 # from services.blockchain_service import BlockchainService  # Commented out - service error
 # from services.lot_service import LotService  # Commented out - service not found
 
@@ -18,28 +19,6 @@ lots_bp = Blueprint('lots', __name__)
 # blockchain_service = BlockchainService()  # Commented out - service error
 # lot_service = LotService()  # Commented out - service not found
 
-def require_api_key(f):
-    """Decorador para validar API keys de empresas externas"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('Authorization')
-        if not api_key:
-            return jsonify({'error': 'API key required'}), 401
-        
-        # Remover 'Bearer ' si está presente
-        if api_key.startswith('Bearer '):
-            api_key = api_key[7:]
-        
-        # Validar API key y obtener empresa
-        company = Company.query.filter_by(api_key=api_key).first()
-        if not company:
-            return jsonify({'error': 'Invalid API key'}), 401
-        
-        # Inyectar company en request context
-        g.company = company
-        return f(*args, **kwargs)
-    return decorated_function
-
 @lots_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_lots():
@@ -203,6 +182,7 @@ def registrar_evento_lote(lot_id):
         
         db.session.add(event)
         db.session.commit()
+        invalidate_cache_tags('traceability')
         
         return jsonify({
             'success': True,
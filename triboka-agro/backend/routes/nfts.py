@@ -7,38 +7,16 @@ from flask import Blueprint, request, jsonify, g
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime
 import secrets
-from functools import wraps
 
 from models.models import NFTCertificate, User, Lot, BatchNFT, Company, db
 from services.blockchain_service import BlockchainService
 from services.nft_service import NFTService
+from services.api_keys import require_api_key
 
 nfts_bp = Blueprint('nfts', __name__)
 blockchain_service = BlockchainService()
 nft_service = NFTService()
 
-def require_api_key(f):
-    """Decorador para validar API keys de empresas externas"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('Authorization')
-        if not api_key:
-            return jsonify({'error': 'API key required'}), 401
-        
-        # Remover 'Bearer ' si está presente
-        if api_key.startswith('Bearer '):
-            api_key = api_key[7:]
-        
-        # Validar API key y obtener empresa
-        company = Company.query.filter_by(api_key=api_key).first()
-        if not company:
-            return jsonify({'error': 'Invalid API key'}), 401
-        
-        # Inyectar company en request context
-        g.company = company
-        return f(*args, **kwargs)
-    return decorated_function
-
 @nfts_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_nfts():
@@ -10,12 +10,16 @@ import json
 import logging
 import redis
 import time
+import os
+import inspect
 from functools import wraps
 from typing import Dict, List, Optional, Any, Callable
 import hashlib
 
 from models_simple import db, ExportContract, ContractFixation, ProducerLot, BatchNFT, TraceEvent, Company, User
 from blockchain_service import get_blockchain_integration
+from services.cache import TwoTierCache, scan_delete
+from services.metrics import MetricsRecorder
 
 logger = logging.getLogger(__name__)
 
@@ -35,11 +39,14 @@ REDIS_CONFIG = {
 
 # Instancia global de Redis
 redis_client = None
+# Evita reintentar la conexión en cada llamada cuando Redis está caído
+REDIS_RETRY_SECONDS = 30
+_redis_retry_at = 0.0
 
 def get_redis_client():
     """Obtener cliente Redis con inicialización lazy"""
-    global redis_client
-    if redis_client is None:
+    global redis_client, _redis_retry_at
+    if redis_client is None and time.monotonic() >= _redis_retry_at:
         try:
             redis_client = redis.Redis(**REDIS_CONFIG)
             # Probar conexión
@@ -48,6 +55,7 @@ def get_redis_client():
         except redis.ConnectionError as e:
             logger.warning(f"Redis connection failed: {str(e)}")
             redis_client = None
+            _redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
     return redis_client
 
 def cache_key(*args, **kwargs):
@@ -57,183 +65,115 @@ def cache_key(*args, **kwargs):
     key_string = "|".join(key_parts)
     return hashlib.md5(key_string.encode()).hexdigest()
 
-def cached(timeout: int = 300, key_prefix: str = ""):
-    """Decorador para caching de funciones"""
+def _call_cache_key(func, args, kwargs):
+    """Clave de cache a partir de los argumentos normalizados de una llamada
+
+    Los argumentos se enlazan a los nombres de parámetros (f(1) == f(x=1)),
+    se omite self/cls y los valores se serializan como JSON canónico.
+    """
+    try:
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = {
+            name: value for name, value in bound.arguments.items()
+            if name not in ('self', 'cls')
+        }
+    except TypeError:
+        arguments = {'args': args, 'kwargs': kwargs}
+    canonical = json.dumps(arguments, sort_keys=True, default=str)
+    return cache_key(func.__module__, func.__qualname__, canonical)
+
+# Cache de dos niveles compartido (LRU en memoria + Redis)
+cache_layer = TwoTierCache(
+    get_redis_client,
+    max_local_entries=int(os.getenv('CACHE_LOCAL_MAX_ENTRIES', 1024)),
+    local_ttl_cap=int(os.getenv('CACHE_LOCAL_TTL_CAP', 30))
+)
+
+def cached(timeout: int = 300, key_prefix: str = "", tags: Optional[List[str]] = None):
+    """Decorador para caching de funciones
+
+    El resultado se guarda en el cache de dos niveles y queda asociado a
+    key_prefix y a los tags indicados, para invalidarlo con invalidate_cache_tags().
+    """
+    all_tags = tuple(t for t in [key_prefix, *(tags or [])] if t)
+
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            redis_client = get_redis_client()
-            if not redis_client:
-                # Si no hay Redis, ejecutar función normalmente
-                return func(*args, **kwargs)
-
             # Generar clave de cache
-            cache_key_full = f"{key_prefix}:{func.__name__}:{cache_key(*args, **kwargs)}"
-
-            # Intentar obtener del cache
-            try:
-                cached_result = redis_client.get(cache_key_full)
-                if cached_result:
-                    logger.debug(f"Cache hit for {cache_key_full}")
-                    return json.loads(cached_result)
-            except Exception as e:
-                logger.warning(f"Cache read error: {str(e)}")
-
-            # Ejecutar función y cachear resultado
-            start_time = time.time()
-            result = func(*args, **kwargs)
-            execution_time = time.time() - start_time
-
-            # Solo cachear si la ejecución tomó tiempo significativo
-            if execution_time > 0.1:  # Más de 100ms
-                try:
-                    redis_client.setex(cache_key_full, timeout, json.dumps(result, default=str))
-                    logger.debug(f"Cached result for {cache_key_full}")
-                except Exception as e:
-                    logger.warning(f"Cache write error: {str(e)}")
-
-            return result
+            cache_key_full = f"{key_prefix}:{func.__name__}:{_call_cache_key(func, args, kwargs)}"
+            return cache_layer.get_or_compute(
+                cache_key_full,
+                lambda: func(*args, **kwargs),
+                ttl=timeout,
+                tags=all_tags
+            )
         return wrapper
     return decorator
 
+def invalidate_cache_tags(*tags: str) -> int:
+    """Invalidar entradas de cache asociadas a los tags (ej. 'lots' al comprar un lote)"""
+    try:
+        return cache_layer.invalidate_tags(*tags)
+    except Exception as e:
+        logger.warning(f"Error invalidating cache tags {tags}: {str(e)}")
+        return 0
+
 class PerformanceMonitor:
-    """Monitor de rendimiento para endpoints"""
+    """Monitor de rendimiento para endpoints
+
+    Las métricas se acumulan en memoria (contadores + histograma de latencias
+    con buckets fijos) y un MetricsRecorder las envía a Redis por lotes cada
+    METRICS_FLUSH_INTERVAL segundos, en lugar de varias escrituras por petición.
+    """
 
     def __init__(self):
         self.redis_client = get_redis_client()
-        # Para testing: diccionario en memoria para métricas
-        self.metrics = {}
+        self.recorder = MetricsRecorder(
+            get_redis_client,
+            flush_interval=float(os.getenv('METRICS_FLUSH_INTERVAL', 5)),
+            sample_rate=float(os.getenv('METRICS_SAMPLE_RATE', 0.01))
+        )
+        # Métricas en memoria de este proceso, por "endpoint:method"
+        self.metrics = self.recorder.endpoints
 
     def record_request(self, endpoint: str, method: str, response_time: float, status_code: int, user_id: Optional[int] = None):
-        """Registrar métricas de una petición"""
-        endpoint_key = f"{endpoint}:{method}"
-
-        # Inicializar métricas para este endpoint si no existen
-        if endpoint_key not in self.metrics:
-            self.metrics[endpoint_key] = {
-                'count': 0,
-                'response_times': [],
-                'status_codes': {},
-                'total_response_time': 0.0,
-                'min_response_time': float('inf'),
-                'max_response_time': 0.0,
-                'last_updated': datetime.utcnow().isoformat()
-            }
+        """Registrar métricas de una petición (solo memoria; Redis se actualiza por lotes)"""
+        self.recorder.record(f"{endpoint}:{method}", response_time, status_code, user_id)
 
-        # Actualizar métricas
-        metrics = self.metrics[endpoint_key]
-        metrics['count'] += 1
-        metrics['response_times'].append(response_time)
-        metrics['total_response_time'] += response_time
-        metrics['min_response_time'] = min(metrics['min_response_time'], response_time)
-        metrics['max_response_time'] = max(metrics['max_response_time'], response_time)
-        metrics['last_updated'] = datetime.utcnow().isoformat()
-
-        # Contar códigos de estado
-        status_str = str(status_code)
-        if status_str not in metrics['status_codes']:
-            metrics['status_codes'][status_str] = 0
-        metrics['status_codes'][status_str] += 1
-
-        # Mantener solo las últimas 100 mediciones de tiempo de respuesta
-        if len(metrics['response_times']) > 100:
-            # Remover la medición más antigua y ajustar totales
-            oldest_time = metrics['response_times'].pop(0)
-            metrics['total_response_time'] -= oldest_time
-            # Recalcular min/max si es necesario
-            if metrics['response_times']:
-                metrics['min_response_time'] = min(metrics['response_times'])
-                metrics['max_response_time'] = max(metrics['response_times'])
-
-        # También registrar en Redis si está disponible
-        if not self.redis_client:
-            return
-
-        timestamp = datetime.utcnow().isoformat()
-
-        # Métricas por endpoint
-        redis_endpoint_key = f"metrics:endpoint:{endpoint}:{method}"
-        self.redis_client.lpush(redis_endpoint_key, json.dumps({
-            'timestamp': timestamp,
-            'response_time': response_time,
-            'status_code': status_code,
-            'user_id': user_id
-        }))
-        # Mantener solo las últimas 1000 entradas
-        self.redis_client.ltrim(redis_endpoint_key, 0, 999)
-
-        # Contadores generales
-        self.redis_client.incr(f"counters:requests:{status_code}")
-        self.redis_client.incr("counters:requests:total")
-
-        # Tiempos de respuesta por endpoint
-        self.redis_client.lpush(f"response_times:{endpoint}", response_time)
-        self.redis_client.ltrim(f"response_times:{endpoint}", 0, 999)
+    def flush(self) -> int:
+        """Forzar el envío a Redis de las métricas pendientes"""
+        return self.recorder.flush()
 
     def get_endpoint_metrics(self, endpoint: str, method: str = None, hours: int = 24) -> Dict:
-        """Obtener métricas de un endpoint"""
+        """Obtener métricas de un endpoint
+
+        Incluye percentiles p50/p95/p99 calculados sobre el histograma.
+        """
         endpoint_key = f"{endpoint}:{method}" if method else None
 
         # Si tenemos métricas en memoria para este endpoint específico
-        if endpoint_key and endpoint_key in self.metrics:
-            metrics = self.metrics[endpoint_key]
-            return {
-                'count': metrics['count'],
-                'avg_response_time': metrics['total_response_time'] / metrics['count'] if metrics['count'] > 0 else 0,
-                'min_response_time': metrics['min_response_time'] if metrics['min_response_time'] != float('inf') else 0,
-                'max_response_time': metrics['max_response_time'],
-                'status_codes': metrics['status_codes'],
-                'last_updated': metrics['last_updated']
-            }
+        if endpoint_key:
+            local_metrics = self.recorder.snapshot(endpoint_key)
+            if local_metrics:
+                return local_metrics
 
-        # Si no hay métricas en memoria o no está disponible, intentar Redis
+        # Si no hay métricas en memoria, usar el agregado compartido en Redis
         if not self.redis_client:
             return {}
 
-        metrics = {}
-
-        # Obtener tiempos de respuesta
-        response_times_key = f"response_times:{endpoint}"
-        response_times = self.redis_client.lrange(response_times_key, 0, -1)
-
-        if response_times:
-            times = [float(t) for t in response_times]
-            metrics['response_times'] = {
-                'avg': sum(times) / len(times),
-                'min': min(times),
-                'max': max(times),
-                'count': len(times)
-            }
+        if endpoint_key:
+            endpoint_keys = [endpoint_key]
+        else:
+            endpoint_keys = [key for key in self.recorder.registered_endpoints()
+                             if key.rsplit(':', 1)[0] == endpoint]
 
-        # Obtener peticiones recientes
-        if method:
-            requests_key = f"metrics:endpoint:{endpoint}:{method}"
-            requests_data = self.redis_client.lrange(requests_key, 0, -1)
-            if requests_data:
-                requests = [json.loads(r) for r in requests_data]
-                # Filtrar por tiempo (últimas N horas)
-                cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-                recent_requests = [
-                    r for r in requests
-                    if datetime.fromisoformat(r['timestamp']) > cutoff_time
-                ]
-
-                status_counts = {}
-                for req in recent_requests:
-                    status = req['status_code']
-                    status_counts[status] = status_counts.get(status, 0) + 1
-
-                metrics['requests'] = {
-                    'total': len(recent_requests),
-                    'status_codes': status_counts,
-                    'period_hours': hours
-                }
-
-        return metrics
+        return self.recorder.read_aggregate(endpoint_keys, hours=hours) or {}
 
     def reset_metrics(self):
         """Resetear métricas (para testing)"""
-        self.metrics.clear()
+        self.recorder.reset()
 
     def get_system_metrics(self) -> Dict:
         """Obtener métricas generales del sistema"""
@@ -243,9 +183,9 @@ class PerformanceMonitor:
         metrics = {}
 
         # Contadores generales
-        total_requests = self.redis_client.get("counters:requests:total") or 0
-        error_4xx = self.redis_client.get("counters:requests:4xx") or 0
-        error_5xx = self.redis_client.get("counters:requests:5xx") or 0
+        total_requests, error_4xx, error_5xx = (value or 0 for value in self.redis_client.mget(
+            "counters:requests:total", "counters:requests:4xx", "counters:requests:5xx"
+        ))
 
         metrics['requests'] = {
             'total': int(total_requests),
@@ -357,7 +297,12 @@ def record_performance_metrics(response):
 @performance_bp.route('/cache/clear', methods=['POST'])
 @jwt_required()
 def clear_cache():
-    """Limpiar cache de Redis"""
+    """Limpiar cache por namespace
+
+    Body opcional: {'namespaces': ['lots', 'companies']} o {'namespace': 'lots'}.
+    Sin body se limpian todos los namespaces de cache registrados; las métricas
+    y contadores de rendimiento guardados en Redis no se tocan.
+    """
     try:
         user_id = get_jwt_identity()
         user = User.query.get(user_id)
@@ -365,12 +310,28 @@ def clear_cache():
         if not user or user.role not in ['admin', 'operator']:
             return jsonify({'error': 'Sin permisos para gestionar cache'}), 403
 
-        redis_client = get_redis_client()
-        if redis_client:
-            redis_client.flushdb()
-            return jsonify({'message': 'Cache limpiado exitosamente'})
+        data = request.get_json(silent=True)
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'El body debe ser un objeto JSON'}), 400
+
+        # Solo un body sin namespaces/namespace limpia todo: [] o "" son errores
+        if 'namespaces' in data or 'namespace' in data:
+            namespaces = data['namespaces'] if 'namespaces' in data else [data['namespace']]
+            if not isinstance(namespaces, list) or not namespaces or \
+                    not all(isinstance(ns, str) and ns for ns in namespaces):
+                return jsonify({'error': 'namespaces debe ser una lista no vacía de nombres de namespace'}), 400
         else:
-            return jsonify({'error': 'Redis no disponible'}), 503
+            namespaces = cache_layer.namespaces()
+
+        removed = cache_layer.invalidate_tags(*namespaces)
+
+        return jsonify({
+            'message': 'Cache limpiado exitosamente',
+            'namespaces': namespaces,
+            'keys_removed': removed
+        })
 
     except Exception as e:
         logger.error(f"Error clearing cache: {str(e)}")
@@ -395,13 +356,10 @@ def get_cache_stats():
         info = redis_client.info()
         db_size = redis_client.dbsize()
 
-        # Obtener keys por patrón
-        cache_keys = {}
-        patterns = ['contracts:*', 'fixations:*', 'lots:*', 'traceability:*', 'companies:*']
-
-        for pattern in patterns:
-            keys = redis_client.keys(pattern)
-            cache_keys[pattern] = len(keys)
+        # Claves por namespace desde el registro mantenido al escribir (SCARD, sin KEYS)
+        namespaces = ['contracts', 'fixations', 'lots', 'traceability', 'companies']
+        namespace_sizes = cache_layer.namespace_sizes(sorted(set(namespaces) | set(cache_layer.namespaces())))
+        cache_keys = {f"{name}:*": count for name, count in namespace_sizes.items()}
 
         return jsonify({
             'redis_info': {
@@ -413,7 +371,8 @@ def get_cache_stats():
             },
             'cache_stats': {
                 'total_keys': db_size,
-                'keys_by_pattern': cache_keys
+                'keys_by_pattern': cache_keys,
+                'layers': cache_layer.get_stats()
             }
         })
 
@@ -622,7 +581,7 @@ def get_fixations_cached(contract_id: Optional[int] = None) -> List[Dict]:
     fixations = query.all()
     return [fixation.to_dict() for fixation in fixations]
 
-@cached(timeout=300, key_prefix="trace_events")
+@cached(timeout=300, key_prefix="trace_events", tags=['traceability'])
 def get_trace_events_cached(batch_nft_id: Optional[int] = None, event_type: Optional[str] = None) -> List[Dict]:
     """Obtener eventos de trazabilidad con cache"""
     query = TraceEvent.query
@@ -653,12 +612,10 @@ class RedisManager:
     def __init__(self):
         self.redis_client = get_redis_client()
 
-    def set_cache(self, key: str, value: Any, ttl: int = 300) -> bool:
+    def set_cache(self, key: str, value: Any, ttl: int = 300, tags: Optional[List[str]] = None) -> bool:
         """Almacenar valor en cache con TTL"""
         try:
-            if self.redis_client:
-                return self.redis_client.setex(key, ttl, json.dumps(value, default=str))
-            return False
+            return cache_layer.set(key, value, ttl, tags or ())
         except Exception as e:
             logger.error(f"Error setting cache: {str(e)}")
             return False
@@ -666,11 +623,7 @@ class RedisManager:
     def get_cache(self, key: str) -> Optional[Any]:
         """Obtener valor del cache"""
         try:
-            if self.redis_client:
-                data = self.redis_client.get(key)
-                if data:
-                    return json.loads(data)
-            return None
+            return cache_layer.get(key)
         except Exception as e:
             logger.error(f"Error getting cache: {str(e)}")
             return None
@@ -678,25 +631,29 @@ class RedisManager:
     def delete_cache(self, key: str) -> bool:
         """Eliminar clave del cache"""
         try:
-            if self.redis_client:
-                return bool(self.redis_client.delete(key))
-            return False
+            return cache_layer.delete(key)
         except Exception as e:
             logger.error(f"Error deleting cache: {str(e)}")
             return False
 
     def clear_cache_pattern(self, pattern: str) -> int:
-        """Limpiar cache por patrón"""
+        """Limpiar cache por patrón (SCAN incremental, no bloquea Redis)"""
         try:
             if self.redis_client:
-                keys = self.redis_client.keys(pattern)
-                if keys:
-                    return self.redis_client.delete(*keys)
+                return scan_delete(self.redis_client, pattern)
             return 0
         except Exception as e:
             logger.error(f"Error clearing cache pattern: {str(e)}")
             return 0
 
+    def clear_namespace(self, namespace: str) -> int:
+        """Limpiar todas las claves registradas de un namespace (ej. 'lots')"""
+        try:
+            return cache_layer.invalidate_tags(namespace)
+        except Exception as e:
+            logger.error(f"Error clearing cache namespace: {str(e)}")
+            return 0
+
     def get_cache_stats(self) -> Dict:
         """Obtener estadísticas del cache"""
         try:
@@ -706,9 +663,10 @@ class RedisManager:
                     'connected': True,
                     'used_memory': info.get('used_memory_human', 'N/A'),
                     'total_keys': self.redis_client.dbsize(),
-                    'uptime_days': info.get('uptime_in_days', 0)
+                    'uptime_days': info.get('uptime_in_days', 0),
+                    'layers': cache_layer.get_stats()
                 }
-            return {'connected': False}
+            return {'connected': False, 'layers': cache_layer.get_stats()}
         except Exception as e:
             logger.error(f"Error getting cache stats: {str(e)}")
             return {'connected': False, 'error': str(e)}
@@ -1,43 +1,95 @@
-from flask import Blueprint, request, jsonify, g
-from middleware.auth_middleware import require_auth
+from flask import Blueprint, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+from models_simple import db, User
+from services.change_log import PLATFORM_ID, get_delta, token_for_timestamp
+from services.offline_sync import MAX_MUTATIONS, apply_offline_mutations, changed_cache_tags
+from routes.performance import invalidate_cache_tags
+import logging
 import time
 
 sync_bp = Blueprint('sync', __name__)
+logger = logging.getLogger(__name__)
+
+MAX_DELTA_LIMIT = 2000
+
+
+def _sync_company(user):
+    """Empresa cuyo registro de cambios lee el usuario (admin: toda la plataforma)"""
+    if user.role == 'admin':
+        return PLATFORM_ID
+    return user.company_id
 
 @sync_bp.route('/sync/delta', methods=['GET'])
-@require_auth(roles=['proveedor', 'admin', 'vendedor'])
+@jwt_required()
 def get_delta_updates():
     """
-    Retorna los cambios ocurridos desde `last_sync`.
+    Retorna los cambios ocurridos desde `sync_token` (o desde `last_sync` en
+    milisegundos, para clientes anteriores). El cliente guarda el `sync_token`
+    de la respuesta y repite mientras `has_more` sea true.
     """
-    last_sync_timestamp = request.args.get('last_sync', type=int, default=0)
-    
-    # Convertir timestamp a datetime si es necesario
-    # last_sync_dt = datetime.fromtimestamp(last_sync_timestamp / 1000.0)
-    
-    # Aquí consultarías tu base de datos buscando registros con updated_at > last_sync_dt
-    # Ejemplo simulado:
-    
-    response_data = {
-        'server_timestamp': int(time.time() * 1000),
-        'categories': [], # Fetch from DB where updated_at > last_sync
-        'products': [],
-        # ... otras entidades
-    }
-    
-    # Lógica real de DB (pseudo-código):
-    # categories = Category.query.filter(Category.updated_at > last_sync_dt).all()
-    # response_data['categories'] = [cat.to_dict() for cat in categories]
-    
-    return jsonify(response_data)
+    try:
+        user = User.query.get(get_jwt_identity())
+        if not user:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+
+        company_id = _sync_company(user)
+        if company_id is None:
+            return jsonify({'error': 'Usuario sin empresa asignada'}), 403
+
+        limit = max(1, min(request.args.get('limit', type=int, default=500), MAX_DELTA_LIMIT))
+        since = request.args.get('sync_token', type=int)
+        if since is None:
+            last_sync = request.args.get('last_sync', type=int, default=0)
+            since = token_for_timestamp(company_id, last_sync) if last_sync else 0
+
+        response_data = get_delta(company_id, since, limit)
+        response_data['server_timestamp'] = int(time.time() * 1000)
+        return jsonify(response_data)
+
+    except Exception as e:
+        logger.error(f"Error en sync delta: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @sync_bp.route('/sync/push', methods=['POST'])
-@require_auth()
+@jwt_required()
 def receive_offline_transaction():
     """
-    Endpoint genérico si se prefiere un solo punto de entrada para transacciones offline.
-    Alternativamente, el cliente llama a los endpoints REST normales.
+    Aplica en lote la cola de mutaciones offline del cliente:
+    {"mutations": [{"mutation_id", "entity", "op", "entity_id", "data"}, ...]}.
+    Es idempotente por mutation_id: reenviar la cola devuelve los mismos resultados.
     """
-    data = request.json
-    # Procesar data...
-    return jsonify({'status': 'success', 'synced_at': int(time.time() * 1000)})
+    try:
+        user = User.query.get(get_jwt_identity())
+        if not user:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+
+        data = request.get_json(silent=True) or {}
+        mutations = data.get('mutations')
+        if not isinstance(mutations, list):
+            return jsonify({'error': 'Campo requerido: mutations (lista)'}), 400
+        if len(mutations) > MAX_MUTATIONS:
+            return jsonify({'error': f'Máximo {MAX_MUTATIONS} mutaciones por envío'}), 413
+
+        results = apply_offline_mutations(user, mutations)
+        db.session.commit()
+        tags = changed_cache_tags(results)
+        if tags:
+            invalidate_cache_tags(*tags)
+
+        # Los cambios aplicados llegan al cliente en el siguiente /sync/delta
+        return jsonify({
+            'status': 'success',
+            'results': results,
+            'applied': sum(1 for r in results if r['status'] == 'applied' and not r.get('duplicate')),
+            'synced_at': int(time.time() * 1000)
+        })
+
+    except IntegrityError:
+        # Otro envío de la misma cola registró las mutaciones a la vez
+        db.session.rollback()
+        return jsonify({'error': 'Mutaciones en proceso por otro envío, reintente'}), 409
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error en sync push: {str(e)}")
+        return jsonify({'error': str(e)}), 500
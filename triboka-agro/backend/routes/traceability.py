@@ -7,6 +7,10 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models_simple import db, User, TraceEvent, TraceTimeline, ProducerLot, BatchNFT, Company
 from blockchain_service import get_blockchain_integration
+from services.timeline import append_event, actor_names, load_timeline, load_timeline_page
+from services.pagination import fetch_page, keyset_phases
+from services.entity_access import accessible_entities_clause
+from routes.performance import invalidate_cache_tags
 import json
 import logging
 from datetime import datetime
@@ -129,11 +133,13 @@ def create_traceability_event():
         trace_event = TraceEvent(
             event_type=event_type,
             entity_type=entity_type,
-            entity_id=entity_id,
+            entity_id=str(entity_id),
+            title=event_config['name'],
             measurements=json.dumps(measurements),
-            notes=data.get('notes', ''),
+            description=data.get('notes', ''),
             location=data.get('location', ''),
-            created_by_user_id=user_id
+            actor_id=user.id,
+            actor_name=user.name
         )
 
         db.session.add(trace_event)
@@ -169,6 +175,7 @@ def create_traceability_event():
         update_timeline(entity_type, entity_id, trace_event)
 
         db.session.commit()
+        invalidate_cache_tags('traceability')
 
         return jsonify({
             'message': 'Evento de trazabilidad creado exitosamente',
@@ -181,7 +188,7 @@ def create_traceability_event():
                 'entity_id': trace_event.entity_id,
                 'measurements': measurements,
                 'location': trace_event.location,
-                'notes': trace_event.notes,
+                'notes': trace_event.description,
                 'created_at': trace_event.created_at.isoformat(),
                 'created_by': user.name
             }
@@ -192,10 +199,21 @@ def create_traceability_event():
         logger.error(f"Error creando evento de trazabilidad: {str(e)}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
+EVENTS_PAGE_DEFAULT = 50
+EVENTS_PAGE_MAX = 500
+
+
 @traceability_bp.route('/events', methods=['GET'])
 @jwt_required()
 def get_traceability_events():
-    """Obtener eventos de trazabilidad con filtros"""
+    """Obtener eventos de trazabilidad con filtros
+
+    Paginación por cursor sobre (created_at, id), más recientes primero:
+    - limit: tamaño de página (máx. 500)
+    - cursor: valor next_cursor de la página anterior
+    - include_total=true: agregar el total exacto (COUNT adicional)
+    Con offset se mantiene la paginación clásica (incluye total).
+    """
     try:
         user_id = get_jwt_identity()
         user = User.query.get(user_id)
@@ -207,8 +225,10 @@ def get_traceability_events():
         entity_type = request.args.get('entity_type')
         entity_id = request.args.get('entity_id')
         event_type = request.args.get('event_type')
-        limit = request.args.get('limit', 50, type=int)
-        offset = request.args.get('offset', 0, type=int)
+        limit = max(1, min(request.args.get('limit', EVENTS_PAGE_DEFAULT, type=int), EVENTS_PAGE_MAX))
+        cursor = request.args.get('cursor')
+        offset = request.args.get('offset', type=int)
+        include_total = request.args.get('include_total', 'false').lower() == 'true' or offset is not None
 
         # Base query
         query = TraceEvent.query
@@ -224,22 +244,31 @@ def get_traceability_events():
         # Filtrar por permisos del usuario
         if user.role not in ['admin', 'operator']:
             # Los usuarios normales solo ven eventos de entidades a las que tienen acceso
-            allowed_entity_ids = get_allowed_entity_ids(user)
-            if allowed_entity_ids:
-                query = query.filter(TraceEvent.entity_id.in_(allowed_entity_ids))
-            else:
-                return jsonify({'events': [], 'total': 0}), 200
+            # (EXISTS sobre la proyección entity_access)
+            access_clause = accessible_entities_clause(user, TraceEvent.entity_type, TraceEvent.entity_id)
+            if access_clause is None:
+                return jsonify({'events': [], 'total': 0, 'next_cursor': None, 'has_more': False}), 200
+            query = query.filter(access_clause)
+
+        total_count = query.order_by(None).count() if include_total else None
 
-        # Ordenar por fecha de creación (más recientes primero)
-        query = query.order_by(TraceEvent.created_at.desc())
+        # Ordenar por fecha de creación (más recientes primero) con desempate por id
+        try:
+            phases = keyset_phases(query, TraceEvent.created_at, TraceEvent.id, cursor=None if offset is not None else cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if offset is not None:
+            events = phases[0].offset(offset).limit(limit).all()
+            next_cursor = None
+        else:
+            events, next_cursor = fetch_page(phases, limit, 'created_at')
 
-        # Paginación
-        total_count = query.count()
-        events = query.offset(offset).limit(limit).all()
+        # Actores de toda la página en una sola consulta
+        actors = actor_names(events)
 
         result = []
         for event in events:
-            creator = User.query.get(event.created_by_user_id)
             result.append({
                 'id': event.id,
                 'event_type': event.event_type,
@@ -248,18 +277,22 @@ def get_traceability_events():
                 'entity_id': event.entity_id,
                 'measurements': json.loads(event.measurements) if event.measurements else {},
                 'location': event.location,
-                'notes': event.notes,
+                'notes': event.description,
                 'blockchain_tx_hash': event.blockchain_tx_hash,
                 'created_at': event.created_at.isoformat(),
-                'created_by': creator.name if creator else 'Sistema'
+                'created_by': actors[event.id]
             })
 
-        return jsonify({
+        response = {
             'events': result,
             'total': total_count,
             'limit': limit,
-            'offset': offset
-        })
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if offset is not None:
+            response['offset'] = offset
+        return jsonify(response)
 
     except Exception as e:
         logger.error(f"Error obteniendo eventos de trazabilidad: {str(e)}")
@@ -268,7 +301,10 @@ def get_traceability_events():
 @traceability_bp.route('/timeline/<entity_type>/<entity_id>', methods=['GET'])
 @jwt_required()
 def get_entity_timeline(entity_type, entity_id):
-    """Obtener timeline completo de trazabilidad para una entidad"""
+    """Obtener timeline completo de trazabilidad para una entidad
+
+    Con limit o cursor devuelve páginas en orden cronológico con next_cursor.
+    """
     try:
         user_id = get_jwt_identity()
         user = User.query.get(user_id)
@@ -280,53 +316,32 @@ def get_entity_timeline(entity_type, entity_id):
         if not check_entity_permissions(user, entity_type, entity_id):
             return jsonify({'error': 'Sin acceso a esta entidad'}), 403
 
-        # Obtener eventos de trazabilidad
-        events = TraceEvent.query.filter_by(
-            entity_type=entity_type,
-            entity_id=entity_id
-        ).order_by(TraceEvent.created_at.asc()).all()
-
-        # Obtener timeline si existe
-        timeline = TraceTimeline.query.filter_by(
-            entity_type=entity_type,
-            entity_id=entity_id
-        ).first()
-
-        timeline_events = []
-        if timeline and timeline.events_json:
-            timeline_events = json.loads(timeline.events_json)
-
-        # Combinar eventos y timeline
-        complete_timeline = []
-
-        # Agregar eventos registrados
-        for event in events:
-            complete_timeline.append({
-                'id': f'event_{event.id}',
-                'type': 'traceability_event',
-                'title': TRACEABILITY_EVENTS.get(event.event_type, {}).get('name', event.event_type),
-                'description': TRACEABILITY_EVENTS.get(event.event_type, {}).get('description', ''),
-                'timestamp': event.created_at.isoformat(),
-                'measurements': json.loads(event.measurements) if event.measurements else {},
-                'location': event.location,
-                'notes': event.notes,
-                'blockchain_tx_hash': event.blockchain_tx_hash,
-                'actor': User.query.get(event.created_by_user_id).name if User.query.get(event.created_by_user_id) else 'Sistema'
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit', type=int)
+
+        if limit is None and cursor is None:
+            # Timeline completo en orden cronológico (una consulta indexada)
+            complete_timeline = load_timeline(entity_type, entity_id)
+            return jsonify({
+                'entity_type': entity_type,
+                'entity_id': entity_id,
+                'timeline': complete_timeline,
+                'total_events': len(complete_timeline)
             })
 
-        # Agregar eventos del timeline
-        for timeline_event in timeline_events:
-            if not any(t['id'] == timeline_event.get('id') for t in complete_timeline):
-                complete_timeline.append(timeline_event)
-
-        # Ordenar por timestamp
-        complete_timeline.sort(key=lambda x: x.get('timestamp', ''), reverse=False)
+        # Modo paginado por cursor (occurred_at, id)
+        limit = max(1, min(limit or EVENTS_PAGE_DEFAULT, EVENTS_PAGE_MAX))
+        try:
+            page, next_cursor = load_timeline_page(entity_type, entity_id, limit, cursor=cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         return jsonify({
             'entity_type': entity_type,
             'entity_id': entity_id,
-            'timeline': complete_timeline,
-            'total_events': len(complete_timeline)
+            'timeline': page,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
         })
 
     except Exception as e:
@@ -448,71 +463,16 @@ def check_entity_permissions(user, entity_type, entity_id):
         logger.error(f"Error checking entity permissions: {str(e)}")
         return False
 
-def get_allowed_entity_ids(user):
-    """Obtener IDs de entidades a las que el usuario tiene acceso"""
-    try:
-        allowed_ids = []
-
-        if user.role == 'producer':
-            # Lotes del productor
-            lots = ProducerLot.query.filter_by(producer_company_id=user.company_id).all()
-            allowed_ids.extend([str(lot.id) for lot in lots])
-
-        elif user.role == 'exporter':
-            # Lotes comprados por el exportador
-            purchased_lots = ProducerLot.query.filter_by(purchased_by_company_id=user.company_id).all()
-            allowed_ids.extend([str(lot.id) for lot in purchased_lots])
-
-            # Batches creados por el exportador
-            batches = BatchNFT.query.filter_by(creator_company_id=user.company_id).all()
-            allowed_ids.extend([f"batch_{batch.id}" for batch in batches])
-
-        return allowed_ids
-
-    except Exception as e:
-        logger.error(f"Error getting allowed entity IDs: {str(e)}")
-        return []
-
 def update_timeline(entity_type, entity_id, trace_event):
-    """Actualizar el timeline de trazabilidad para una entidad"""
+    """Agregar el evento al timeline append-only de su entidad"""
     try:
-        # Obtener o crear timeline
-        timeline = TraceTimeline.query.filter_by(
-            entity_type=entity_type,
-            entity_id=entity_id
-        ).first()
-
-        if not timeline:
-            timeline = TraceTimeline(
-                entity_type=entity_type,
-                entity_id=entity_id,
-                events_json=json.dumps([])
-            )
-            db.session.add(timeline)
-
-        # Obtener eventos existentes
-        events = json.loads(timeline.events_json) if timeline.events_json else []
-
-        # Agregar nuevo evento
-        new_event = {
-            'id': f'event_{trace_event.id}',
-            'type': 'traceability_event',
-            'event_type': trace_event.event_type,
-            'title': TRACEABILITY_EVENTS.get(trace_event.event_type, {}).get('name', trace_event.event_type),
-            'description': TRACEABILITY_EVENTS.get(trace_event.event_type, {}).get('description', ''),
-            'timestamp': trace_event.created_at.isoformat(),
-            'measurements': json.loads(trace_event.measurements) if trace_event.measurements else {},
-            'location': trace_event.location,
-            'notes': trace_event.notes,
-            'blockchain_tx_hash': trace_event.blockchain_tx_hash,
-            'actor': User.query.get(trace_event.created_by_user_id).name if User.query.get(trace_event.created_by_user_id) else 'Sistema'
-        }
-
-        events.append(new_event)
-
-        # Actualizar timeline
-        timeline.events_json = json.dumps(events)
-        timeline.updated_at = datetime.utcnow()
+        event_config = TRACEABILITY_EVENTS.get(trace_event.event_type, {})
+        append_event(
+            trace_event,
+            title=event_config.get('name', trace_event.event_type),
+            description=event_config.get('description', ''),
+            notes=trace_event.description
+        )
 
     except Exception as e:
         logger.error(f"Error updating timeline: {str(e)}")
@@ -546,6 +506,7 @@ class TraceabilityManager:
 
             db.session.add(event)
             db.session.commit()
+            invalidate_cache_tags('traceability')
 
             # Registrar en blockchain si está disponible
             if self.blockchain:
@@ -0,0 +1,272 @@
+"""
+API keys de empresas para integraciones externas (AgroWeight Cloud, ERP)
+Las claves no se guardan en claro: la empresa tiene un prefijo indexado para
+buscarla y el SHA-256 de la clave para validarla. Las claves ya validadas se
+cachean por proceso con TTL (se invalidan al rotar la clave) y cada clave
+acumula contadores de peticiones, errores y latencia.
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import wraps
+from typing import Dict, Optional
+
+from flask import g, jsonify, make_response, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, attributes, make_transient_to_detached
+
+from models_simple import db, Company
+from services.metrics import bucket_index, percentiles_from_buckets
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'tbk_'
+# Caracteres de la clave que se guardan en claro (identifican la clave en logs y métricas)
+PREFIX_LENGTH = 12
+RATE_WINDOW_SECONDS = 60
+
+
+def generate_api_key() -> str:
+    return KEY_PREFIX + secrets.token_urlsafe(32)
+
+
+def hash_api_key(api_key: str) -> str:
+    """SHA-256 de la clave (suficiente: son secretos aleatorios de alta entropía)"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def key_prefix(api_key: str) -> str:
+    """Inicio de la clave que se guarda en claro (como mucho un cuarto de ella,
+    para que las claves cortas anteriores a este formato no queden expuestas)"""
+    return api_key[:min(PREFIX_LENGTH, len(api_key) // 4)]
+
+
+def set_api_key(company: Company, api_key: Optional[str] = None) -> str:
+    """Asignar (o generar) la API key de una empresa y devolverla en claro
+
+    No hace commit; al hacerlo se invalida la clave anterior en la cache.
+    """
+    api_key = api_key or generate_api_key()
+    company.api_key_prefix = key_prefix(api_key)
+    company.api_key_hash = hash_api_key(api_key)
+    company.api_key = None
+    return api_key
+
+
+def _company_values(company: Company) -> Dict:
+    return {attr.key: getattr(company, attr.key) for attr in inspect(Company).column_attrs}
+
+
+class ApiKeyCache:
+    """Cache por proceso de claves validadas: hash -> columnas de la empresa
+
+    Se guardan los valores de las columnas (no la instancia ORM) para poder
+    adjuntar una copia a la sesión de cada petición sin consultar la base.
+    """
+
+    def __init__(self, ttl: float = 60, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key_hash -> (expires_at, company_id, values)
+        self._lock = threading.Lock()
+        # Se incrementa en cada invalidación: una lectura de la base iniciada
+        # antes de rotar una clave no puede volver a cachear la clave anterior
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key_hash: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key_hash]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key_hash: str, company: Company, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key_hash] = (time.monotonic() + self.ttl, company.id, _company_values(company))
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_company(self, company_id: int) -> int:
+        """Eliminar las claves cacheadas de una empresa"""
+        with self._lock:
+            self.generation += 1
+            keys = [key for key, (_, cached_id, _) in self._entries.items() if cached_id == company_id]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'ttl': self.ttl}
+
+
+class ApiKeyUsage:
+    """Contadores por clave (prefijo) en memoria del proceso
+
+    Peticiones, errores, latencia (histograma de services.metrics) y ritmo de
+    peticiones del último minuto en ventanas de un segundo.
+    """
+
+    def __init__(self):
+        self.keys: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, prefix: str, company_id: int, response_time: float, status_code: int):
+        second = int(time.time())
+        with self._lock:
+            stats = self.keys.get(prefix)
+            if stats is None:
+                stats = self.keys[prefix] = {
+                    'company_id': company_id,
+                    'count': 0,
+                    'errors': 0,
+                    'total_response_time': 0.0,
+                    'max_response_time': 0.0,
+                    'histogram': {},
+                    'window': deque(),  # [segundo, peticiones]
+                    'last_used': second
+                }
+            stats['company_id'] = company_id
+            stats['count'] += 1
+            if status_code >= 400:
+                stats['errors'] += 1
+            stats['total_response_time'] += response_time
+            stats['max_response_time'] = max(stats['max_response_time'], response_time)
+            bucket = bucket_index(response_time)
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+            stats['last_used'] = second
+
+            window = stats['window']
+            if window and window[-1][0] == second:
+                window[-1][1] += 1
+            else:
+                window.append([second, 1])
+            while window[0][0] <= second - RATE_WINDOW_SECONDS:
+                window.popleft()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        now = int(time.time())
+        with self._lock:
+            return {prefix: {
+                'company_id': stats['company_id'],
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'requests_last_minute': sum(n for second, n in stats['window']
+                                            if second > now - RATE_WINDOW_SECONDS),
+                'avg_response_time': stats['total_response_time'] / stats['count'],
+                'max_response_time': stats['max_response_time'],
+                'percentiles': percentiles_from_buckets(stats['histogram']),
+                'last_used': stats['last_used']
+            } for prefix, stats in self.keys.items()}
+
+    def reset(self):
+        with self._lock:
+            self.keys.clear()
+
+
+api_key_cache = ApiKeyCache(
+    ttl=float(os.getenv('API_KEY_CACHE_TTL', 60)),
+    max_entries=int(os.getenv('API_KEY_CACHE_SIZE', 1024))
+)
+api_key_usage = ApiKeyUsage()
+
+
+def authenticate_api_key(api_key: str) -> Optional[Company]:
+    """Empresa de la API key (desde la cache si ya se validó) o None"""
+    key_hash = hash_api_key(api_key)
+    values = api_key_cache.get(key_hash)
+    if values is not None:
+        # Copia adjunta a la sesión actual sin consultar la base
+        company = Company(**values)
+        make_transient_to_detached(company)
+        return db.session.merge(company, load=False)
+
+    generation = api_key_cache.generation
+    for company in Company.query.filter_by(api_key_prefix=key_prefix(api_key)):
+        if company.api_key_hash and hmac.compare_digest(company.api_key_hash, key_hash):
+            api_key_cache.set(key_hash, company, generation)
+            return company
+    return None
+
+
+@event.listens_for(Session, 'after_flush')
+def track_api_key_changes(session, flush_context):
+    """Invalidar la cache al rotar la clave de una empresa o eliminarla"""
+    changed = {company.id for company in session.deleted if isinstance(company, Company)}
+    changed.update(company.id for company in session.dirty if isinstance(company, Company)
+                   and attributes.get_history(company, 'api_key_hash').has_changes())
+    if changed:
+        for company_id in changed:
+            api_key_cache.invalidate_company(company_id)
+        session.info.setdefault('api_key_invalidations', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_api_keys(session):
+    # Otra vez tras el commit: una petición pudo cachear la clave anterior entre flush y commit
+    for company_id in session.info.pop('api_key_invalidations', ()):
+        api_key_cache.invalidate_company(company_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_api_key_changes(session):
+    session.info.pop('api_key_invalidations', None)
+
+
+def require_api_key(f):
+    """Decorador para validar API keys de empresas externas (AgroWeight Cloud, ERP, etc.)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            # Obtener API key del header Authorization
+            auth_header = request.headers.get('Authorization')
+            if not auth_header or not auth_header.startswith('Bearer '):
+                return jsonify({
+                    'error': 'API key requerida',
+                    'message': 'Debe proporcionar una API key válida en el header Authorization: Bearer {api_key}'
+                }), 401
+
+            api_key = auth_header.replace('Bearer ', '')
+            company = authenticate_api_key(api_key)
+            if not company:
+                return jsonify({
+                    'error': 'API key inválida',
+                    'message': 'La API key proporcionada no corresponde a ninguna empresa registrada'
+                }), 401
+
+        except Exception as e:
+            logger.error(f"Error en autenticación API key: {str(e)}")
+            return jsonify({
+                'error': 'Error de autenticación',
+                'message': 'Error interno en la validación de API key'
+            }), 500
+
+        # Inyectar la compañía en el contexto de la request
+        g.company = company
+        started = time.perf_counter()
+        response = make_response(f(*args, **kwargs))
+        api_key_usage.record(key_prefix(api_key), company.id, time.perf_counter() - started, response.status_code)
+        return response
+
+    return decorated_function
@@ -0,0 +1,354 @@
+"""
+Cache de dos niveles para Triboka
+Nivel 1: LRU en memoria del proceso (acotado, con TTL)
+Nivel 2: Redis compartido entre workers (opcional)
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Prefijo de los sets de claves por tag en Redis
+TAG_SET_PREFIX = 'cache:tags:'
+# Set con los tags/namespaces que tienen claves registradas
+NAMESPACES_KEY = 'cache:namespaces'
+# Tamaño de lote para SCAN y borrados
+SCAN_BATCH = 500
+
+
+def pack_entry(payload: str, tags: Iterable[str]) -> str:
+    """Valor guardado en Redis: tags separados por coma, salto de línea y payload JSON"""
+    return ','.join(tags) + '\n' + payload
+
+
+def unpack_entry(stored: str):
+    """(payload, tags) de un valor de Redis; los valores sin cabecera no tienen tags
+
+    json.dumps no emite saltos de línea, así que el primero separa la cabecera.
+    """
+    header, sep, payload = stored.partition('\n')
+    if not sep:
+        return stored, ()
+    return payload, tuple(tag for tag in header.split(',') if tag)
+
+
+def scan_delete(client, pattern: str, batch_size: int = SCAN_BATCH) -> int:
+    """Eliminar claves por patrón con SCAN incremental (sin bloquear como KEYS)
+
+    Usa UNLINK para que Redis libere la memoria en segundo plano.
+    """
+    deleted = 0
+    batch = []
+    for key in client.scan_iter(match=pattern, count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            deleted += client.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += client.unlink(*batch)
+    return deleted
+
+
+class LocalLRUCache:
+    """Cache LRU en memoria con TTL por entrada y límite de tamaño
+
+    Guarda el valor ya serializado (JSON) para que cada lectura entregue una
+    copia independiente y el resultado sea idéntico al que devolvería Redis.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, payload, tags)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Obtener payload serializado o None si no existe / expiró"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload, _ = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key: str, payload: str, ttl: float, tags: Iterable[str] = ()):
+        """Almacenar payload, desalojando la entrada menos usada si se excede el límite"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, payload, frozenset(tags))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Eliminar todas las entradas asociadas a un tag"""
+        with self._lock:
+            keys = [k for k, (_, _, tags) in self._entries.items() if tag in tags]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def tags(self) -> set:
+        with self._lock:
+            return set().union(*(tags for _, _, tags in self._entries.values()))
+
+    def count_tag(self, tag: str) -> int:
+        with self._lock:
+            return sum(1 for _, _, tags in self._entries.values() if tag in tags)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache:
+    """Cache LRU local delante de Redis con single-flight e invalidación por tags
+
+    - Si Redis no está disponible (o falla), se sirve solo desde memoria y se
+      reintenta Redis tras `redis_retry_seconds`.
+    - La invalidación por tags borra el nivel local del proceso que invalida y
+      las claves en Redis; no hay pub/sub, así que los demás workers pueden
+      servir su copia local hasta `local_ttl_cap` segundos (con o sin Redis).
+      Por eso el TTL local se limita siempre a `local_ttl_cap`.
+    - Redis guarda los tags junto al payload para que una copia promovida al
+      nivel local siga asociada a sus tags.
+    - Llamadas concurrentes por la misma clave en un proceso esperan al primer
+      cálculo en lugar de ejecutar la función en paralelo (single-flight).
+    """
+
+    def __init__(self, redis_getter: Callable[[], Any], max_local_entries: int = 1024,
+                 local_ttl_cap: float = 30, redis_retry_seconds: float = 30,
+                 inflight_timeout: float = 30):
+        self._redis_getter = redis_getter
+        self.local = LocalLRUCache(max_local_entries)
+        self.local_ttl_cap = local_ttl_cap
+        self.redis_retry_seconds = redis_retry_seconds
+        self.inflight_timeout = inflight_timeout
+        self._redis_down_until = 0.0
+        self._inflight: Dict[str, threading.Event] = {}
+        self._inflight_lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+        self.counters = {
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'invalidations': 0,
+            'redis_errors': 0,
+            'singleflight_waits': 0
+        }
+
+    # ------------------------------------------------------------------
+    # Utilidades internas
+    # ------------------------------------------------------------------
+
+    def _count(self, name: str, amount: int = 1):
+        with self._counters_lock:
+            self.counters[name] += amount
+
+    def _redis(self):
+        """Cliente Redis o None si está caído / en periodo de espera"""
+        if time.monotonic() < self._redis_down_until:
+            return None
+        return self._redis_getter()
+
+    def _redis_failed(self, error: Exception):
+        self._count('redis_errors')
+        self._redis_down_until = time.monotonic() + self.redis_retry_seconds
+        logger.warning(f"Cache Redis no disponible, usando solo memoria: {str(error)}")
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    def get(self, key: str) -> Optional[Any]:
+        """Obtener valor deserializado (None si no está en ningún nivel)"""
+        payload = self.local.get(key)
+        if payload is not None:
+            self._count('local_hits')
+            return json.loads(payload)
+
+        client = self._redis()
+        if client is not None:
+            try:
+                payload = client.get(key)
+            except Exception as e:
+                self._redis_failed(e)
+                payload = None
+            if payload is not None:
+                self._count('redis_hits')
+                payload, tags = unpack_entry(payload)
+                self.local.set(key, payload, self.local_ttl_cap, tags)
+                return json.loads(payload)
+
+        self._count('misses')
+        return None
+
+    def set(self, key: str, value: Any, ttl: int = 300, tags: Iterable[str] = ()) -> bool:
+        """Almacenar valor en ambos niveles asociándolo a los tags indicados"""
+        tags = tuple(tags)
+        try:
+            payload = json.dumps(value, default=str)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Valor no serializable para cache {key}: {str(e)}")
+            return False
+
+        self._count('sets')
+        self.local.set(key, payload, min(ttl, self.local_ttl_cap), tags)
+        client = self._redis()
+        if client is None:
+            return True
+
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.setex(key, ttl, pack_entry(payload, tags))
+            for tag in tags:
+                pipe.sadd(TAG_SET_PREFIX + tag, key)
+                pipe.expire(TAG_SET_PREFIX + tag, max(ttl, 3600))
+            if tags:
+                pipe.sadd(NAMESPACES_KEY, *tags)
+            pipe.execute()
+        except Exception as e:
+            self._redis_failed(e)
+        return True
+
+    def delete(self, key: str) -> bool:
+        """Eliminar una clave de ambos niveles"""
+        removed = self.local.delete(key)
+        client = self._redis()
+        if client is not None:
+            try:
+                removed = bool(client.delete(key)) or removed
+            except Exception as e:
+                self._redis_failed(e)
+        return removed
+
+    def invalidate_tags(self, *tags: str) -> int:
+        """Invalidar todas las entradas asociadas a los tags (ej. 'lots')
+
+        Recorre el set del tag con SSCAN y borra en lotes, de modo que un tag
+        con muchas claves no bloquea Redis en una sola operación.
+        """
+        removed = 0
+        client = self._redis()
+        for tag in tags:
+            removed += self.local.invalidate_tag(tag)
+            if client is None:
+                continue
+            try:
+                tag_key = TAG_SET_PREFIX + tag
+                batch = []
+                for key in client.sscan_iter(tag_key, count=SCAN_BATCH):
+                    batch.append(key)
+                    if len(batch) >= SCAN_BATCH:
+                        removed += client.unlink(*batch)
+                        batch = []
+                if batch:
+                    removed += client.unlink(*batch)
+                client.unlink(tag_key)
+                client.srem(NAMESPACES_KEY, tag)
+            except Exception as e:
+                self._redis_failed(e)
+                client = None
+        self._count('invalidations', len(tags))
+        return removed
+
+    def namespaces(self) -> List[str]:
+        """Namespaces (tags) con claves registradas en Redis o en memoria"""
+        names = set(self.local.tags())
+        client = self._redis()
+        if client is not None:
+            try:
+                names.update(client.smembers(NAMESPACES_KEY))
+            except Exception as e:
+                self._redis_failed(e)
+        return sorted(names)
+
+    def namespace_sizes(self, namespaces: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """Número de claves registradas por namespace (SCARD, O(1) por namespace)
+
+        El conteo puede incluir claves ya expiradas hasta la próxima invalidación.
+        """
+        names = list(namespaces) if namespaces is not None else self.namespaces()
+        client = self._redis()
+        if client is None:
+            return {name: self.local.count_tag(name) for name in names}
+        try:
+            pipe = client.pipeline(transaction=False)
+            for name in names:
+                pipe.scard(TAG_SET_PREFIX + name)
+            return dict(zip(names, pipe.execute()))
+        except Exception as e:
+            self._redis_failed(e)
+            return {name: self.local.count_tag(name) for name in names}
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any], ttl: int = 300,
+                       tags: Iterable[str] = ()) -> Any:
+        """Leer del cache o calcular una sola vez por clave dentro del proceso"""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self._inflight[key] = event
+
+        if not leader:
+            self._count('singleflight_waits')
+            event.wait(self.inflight_timeout)
+            value = self.get(key)
+            if value is not None:
+                return value
+            # El cálculo líder falló o expiró: calcular de forma independiente
+            return compute()
+
+        try:
+            value = compute()
+            if value is not None:
+                self.set(key, value, ttl, tags)
+            return value
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def clear_local(self):
+        """Vaciar el nivel en memoria de este proceso"""
+        self.local.clear()
+
+    def get_stats(self) -> Dict:
+        """Contadores de aciertos/fallos y estado de los niveles"""
+        with self._counters_lock:
+            stats = dict(self.counters)
+        hits = stats['local_hits'] + stats['redis_hits']
+        lookups = hits + stats['misses']
+        stats.update({
+            'hit_rate': round(hits / lookups * 100, 2) if lookups else 0,
+            'local_entries': len(self.local),
+            'local_max_entries': self.local.max_entries,
+            'local_evictions': self.local.evictions,
+            'local_expirations': self.local.expirations,
+            'redis_available': self._redis() is not None
+        })
+        return stats
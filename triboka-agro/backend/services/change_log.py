@@ -0,0 +1,289 @@
+"""
+Registro de cambios para la sincronización delta de la app móvil de Triboka
+Cada INSERT/UPDATE/DELETE de lotes, contratos, fijaciones, batches y despachos
+añade a sync_changes una fila por empresa afectada (y otra para la plataforma)
+en la misma transacción; los borrados quedan como tombstones. El cliente pide
+los cambios con id > sync_token y recibe solo las filas modificadas.
+
+Garantía del token: en PostgreSQL/MySQL los ids se asignan al insertar y no
+al confirmar, así que una transacción lenta puede confirmar un id menor que
+otro ya leído. get_delta no avanza el token más allá de entradas escritas hace
+menos de SYNC_SETTLE_SECONDS: ningún cambio se pierde siempre que la
+transacción que lo registra confirme dentro de ese margen. En SQLite las
+escrituras se serializan y el margen es 0.
+"""
+
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, attributes, selectinload
+
+from models_simple import (
+    db, BatchNFT, ContractFixation, Dispatch, ExportContract, ProducerLot, SyncChange
+)
+from services.projections import previous_values, track_previous_values
+
+logger = logging.getLogger(__name__)
+
+# Empresa que recibe todos los cambios (usuarios admin)
+PLATFORM_ID = 0
+
+# Margen para que confirmen las transacciones con ids menores (ver docstring)
+SYNC_SETTLE_SECONDS = float(os.getenv('SYNC_SETTLE_SECONDS', 10))
+
+ENTITY_TYPES = {
+    ProducerLot: 'lot',
+    ExportContract: 'contract',
+    ContractFixation: 'fixation',
+    BatchNFT: 'batch',
+    Dispatch: 'dispatch',
+}
+MODELS = {entity_type: model for model, entity_type in ENTITY_TYPES.items()}
+
+# Clave de cada tipo en la respuesta de /sync/delta
+COLLECTIONS = {'lot': 'lots', 'contract': 'contracts', 'fixation': 'fixations',
+               'batch': 'batches', 'dispatch': 'dispatches'}
+
+# Columnas de empresa que deciden quién ve cada entidad
+SCOPE_COLUMNS = {
+    ProducerLot: ['producer_company_id', 'purchased_by_company_id'],
+    ExportContract: ['exporter_company_id', 'buyer_company_id'],
+    BatchNFT: ['creator_company_id', 'current_owner_company_id'],
+}
+# Fijaciones y despachos las ven las empresas de su contrato
+CONTRACT_COLUMNS = {
+    ContractFixation: 'export_contract_id',
+    Dispatch: 'contract_id',
+}
+
+# Relaciones que usan los to_dict() al serializar la respuesta
+LOAD_OPTIONS = {
+    ProducerLot: [selectinload(ProducerLot.producer_company), selectinload(ProducerLot.export_contract)],
+}
+
+changes_table = SyncChange.__table__
+
+Change = Tuple[str, int, str, List[Dict]]  # (entity_type, entity_id, operation, valores antes/después)
+
+
+# Cargar el valor anterior al asignar para avisar también a la empresa que
+# deja de ver la entidad (recibe un tombstone al leer el delta)
+for _model, _columns in SCOPE_COLUMNS.items():
+    track_previous_values(_model, _columns)
+for _model, _column in CONTRACT_COLUMNS.items():
+    track_previous_values(_model, [_column])
+
+
+def _scope_columns(model) -> List[str]:
+    return SCOPE_COLUMNS.get(model) or [CONTRACT_COLUMNS[model]]
+
+
+def _current_values(obj) -> Dict:
+    return {column: getattr(obj, column) for column in _scope_columns(type(obj))}
+
+
+def _previous_values(obj) -> Dict:
+    return previous_values(obj, _scope_columns(type(obj)))
+
+
+def contract_companies(connection, contract_ids: Iterable[int]) -> Dict[int, Set[int]]:
+    """Empresas exportadora y compradora de cada contrato"""
+    contract_ids = {contract_id for contract_id in contract_ids if contract_id}
+    if not contract_ids:
+        return {}
+    contracts = ExportContract.__table__.c
+    return {contract_id: {company_id for company_id in (exporter, buyer) if company_id}
+            for contract_id, exporter, buyer in connection.execute(
+                select(contracts.id, contracts.exporter_company_id, contracts.buyer_company_id)
+                .where(contracts.id.in_(contract_ids)))}
+
+
+def companies_for(model, values: Dict, contracts: Dict[int, Set[int]]) -> Set[int]:
+    """Empresas que ven una entidad con esos valores de columnas"""
+    if model in CONTRACT_COLUMNS:
+        return set(contracts.get(values.get(CONTRACT_COLUMNS[model]), ()))
+    return {values[column] for column in SCOPE_COLUMNS[model] if values.get(column)}
+
+
+def _contract_children(connection, rescoped: Dict[int, Set[int]]) -> List[Tuple[str, int, Set[int]]]:
+    """Fijaciones y despachos de contratos que cambiaron de empresas (avisar a antiguas y nuevas)"""
+    children = []
+    for model, column in CONTRACT_COLUMNS.items():
+        table = model.__table__
+        for entity_id, contract_id in connection.execute(
+                select(table.c.id, table.c[column]).where(table.c[column].in_(rescoped))):
+            children.append((ENTITY_TYPES[model], entity_id, rescoped[contract_id]))
+    return children
+
+
+def record_changes(connection, changes: List[Change],
+                   scoped: Iterable[Tuple[str, int, Set[int]]] = ()) -> int:
+    """Insertar en sync_changes una fila por cambio y empresa afectada
+
+    `scoped` son upserts con las empresas ya resueltas (entity_type, entity_id, empresas).
+    """
+    contract_ids = set()
+    for entity_type, _, _, values_list in changes:
+        model = MODELS[entity_type]
+        if model in CONTRACT_COLUMNS:
+            contract_ids |= {values.get(CONTRACT_COLUMNS[model]) for values in values_list}
+    contracts = contract_companies(connection, contract_ids)
+
+    now = datetime.utcnow()
+    rows = []
+    for entity_type, entity_id, operation, values_list in changes:
+        model = MODELS[entity_type]
+        companies = {PLATFORM_ID}
+        for values in values_list:
+            companies |= companies_for(model, values, contracts)
+        rows += [{'company_id': company_id, 'entity_type': entity_type, 'entity_id': entity_id,
+                  'operation': operation, 'changed_at': now} for company_id in sorted(companies)]
+    for entity_type, entity_id, companies in scoped:
+        rows += [{'company_id': company_id, 'entity_type': entity_type, 'entity_id': entity_id,
+                  'operation': 'upsert', 'changed_at': now} for company_id in sorted({PLATFORM_ID, *companies})]
+    if rows:
+        connection.execute(changes_table.insert(), rows)
+    return len(rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_sync_changes(session, flush_context):
+    """Registrar los cambios del flush en la misma transacción"""
+    changes = []
+    rescoped_contracts = {}
+
+    for obj in session.new:
+        if type(obj) in ENTITY_TYPES:
+            changes.append((ENTITY_TYPES[type(obj)], obj.id, 'upsert', [_current_values(obj)]))
+    for obj in session.dirty:
+        if type(obj) not in ENTITY_TYPES or not session.is_modified(obj, include_collections=False):
+            continue
+        previous, current = _previous_values(obj), _current_values(obj)
+        changes.append((ENTITY_TYPES[type(obj)], obj.id, 'upsert', [previous, current]))
+        if isinstance(obj, ExportContract) and previous != current:
+            rescoped_contracts[obj.id] = (companies_for(ExportContract, previous, {}) |
+                                          companies_for(ExportContract, current, {}))
+    for obj in session.deleted:
+        if type(obj) in ENTITY_TYPES:
+            entity_id = attributes.instance_state(obj).identity[0]
+            changes.append((ENTITY_TYPES[type(obj)], entity_id, 'delete', [_previous_values(obj)]))
+
+    if not changes:
+        return
+
+    connection = session.connection()
+    children = _contract_children(connection, rescoped_contracts) if rescoped_contracts else []
+    record_changes(connection, changes, children)
+
+
+def record_new_lot_changes(connection, mappings: Iterable[Dict], ids: Dict[str, int]):
+    """Registrar lotes insertados con bulk_insert_mappings (no pasan por after_flush)"""
+    record_changes(connection, [('lot', ids[m['lot_code']], 'upsert', [m]) for m in mappings])
+
+
+def backfill_change_log(connection) -> int:
+    """Registrar como upsert todas las filas existentes (sync_token 0 = descarga completa)"""
+    now = datetime.utcnow()
+    rows = 0
+    for model, entity_type in ENTITY_TYPES.items():
+        table = model.__table__
+        if model in CONTRACT_COLUMNS:
+            contracts = ExportContract.__table__.c
+            base = select(table.c.id, contracts.exporter_company_id, contracts.buyer_company_id).join_from(
+                table, ExportContract.__table__, table.c[CONTRACT_COLUMNS[model]] == contracts.id, isouter=True)
+        else:
+            base = select(table.c.id, *[table.c[column] for column in SCOPE_COLUMNS[model]])
+        batch = []
+        for entity_id, *companies in connection.execute(base):
+            batch += [{'company_id': company_id, 'entity_type': entity_type, 'entity_id': entity_id,
+                       'operation': 'upsert', 'changed_at': now}
+                      for company_id in sorted({PLATFORM_ID, *filter(None, companies)})]
+            if len(batch) >= 5000:
+                connection.execute(changes_table.insert(), batch)
+                rows, batch = rows + len(batch), []
+        if batch:
+            connection.execute(changes_table.insert(), batch)
+            rows += len(batch)
+    return rows
+
+
+def compact_change_log(connection) -> int:
+    """Eliminar entradas superadas por otra más reciente de la misma entidad y empresa
+
+    No cambia el resultado del delta para ningún token: solo importa la última
+    operación de cada entidad con id > token, y esa se conserva.
+    """
+    latest = select(func.max(changes_table.c.id)).group_by(
+        changes_table.c.company_id, changes_table.c.entity_type, changes_table.c.entity_id)
+    return connection.execute(changes_table.delete().where(changes_table.c.id.notin_(latest))).rowcount
+
+
+def token_for_timestamp(company_id: int, last_sync_ms: int) -> int:
+    """Token equivalente a un last_sync en milisegundos (clientes anteriores)"""
+    last_sync = datetime.utcfromtimestamp(last_sync_ms / 1000.0)
+    return db.session.query(func.coalesce(func.max(SyncChange.id), 0)).filter(
+        SyncChange.company_id == company_id, SyncChange.changed_at < last_sync
+    ).scalar()
+
+
+def _settle_seconds() -> float:
+    return 0 if db.engine.dialect.name == 'sqlite' else SYNC_SETTLE_SECONDS
+
+
+def get_delta(company_id: int, since: int = 0, limit: int = 500,
+              settle_seconds: Optional[float] = None) -> Dict:
+    """Cambios visibles para la empresa con id > since
+
+    Las entradas se colapsan a la última operación por entidad; las filas se
+    cargan con una consulta IN por tipo. Una entidad que ya no existe o que la
+    empresa ya no ve se devuelve como tombstone en `deleted`. La respuesta se
+    corta en la primera entrada más reciente que settle_seconds (por defecto
+    SYNC_SETTLE_SECONDS, 0 en SQLite); el cliente la recibe en el siguiente delta.
+    """
+    entries = db.session.query(SyncChange.id, SyncChange.entity_type, SyncChange.entity_id,
+                               SyncChange.operation, SyncChange.changed_at) \
+        .filter(SyncChange.company_id == company_id, SyncChange.id > since) \
+        .order_by(SyncChange.id).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    settle_seconds = _settle_seconds() if settle_seconds is None else settle_seconds
+    if settle_seconds:
+        cutoff = datetime.utcnow() - timedelta(seconds=settle_seconds)
+        for index, entry in enumerate(entries):
+            if entry.changed_at > cutoff:
+                entries, has_more = entries[:index], False
+                break
+
+    latest = {}
+    for _, entity_type, entity_id, operation, _ in entries:
+        latest[(entity_type, entity_id)] = operation
+
+    upserts, deleted = defaultdict(list), defaultdict(list)
+    for (entity_type, entity_id), operation in latest.items():
+        (upserts if operation == 'upsert' else deleted)[entity_type].append(entity_id)
+
+    result = {collection: [] for collection in COLLECTIONS.values()}
+    for entity_type, ids in upserts.items():
+        model = MODELS[entity_type]
+        objects = model.query.options(*LOAD_OPTIONS.get(model, [])).filter(model.id.in_(ids)).all()
+        contracts = {}
+        if model in CONTRACT_COLUMNS and company_id != PLATFORM_ID:
+            contracts = contract_companies(db.session.connection(),
+                                           {getattr(obj, CONTRACT_COLUMNS[model]) for obj in objects})
+        found = set()
+        for obj in objects:
+            if company_id != PLATFORM_ID and company_id not in companies_for(model, _current_values(obj), contracts):
+                continue
+            found.add(obj.id)
+            result[COLLECTIONS[entity_type]].append(obj.to_dict())
+        deleted[entity_type] += [entity_id for entity_id in ids if entity_id not in found]
+
+    result['deleted'] = {COLLECTIONS[entity_type]: sorted(ids) for entity_type, ids in deleted.items() if ids}
+    result['sync_token'] = entries[-1][0] if entries else since
+    result['has_more'] = has_more
+    return result
@@ -0,0 +1,420 @@
+"""
+Contadores incrementales de los dashboards para Triboka
+Mantiene company_dashboard_stats aplicando deltas (valor nuevo - valor anterior)
+en la misma transacción que los cambios de lotes, contratos, fijaciones, batches
+y empresas; un job periódico reconstruye la tabla con GROUP BY para corregir
+cambios que no pasan por el ORM (UPDATE masivos, SQL manual)
+
+Los deltas se escriben con upsert (INSERT ... ON CONFLICT / ON DUPLICATE KEY)
+para que dos primeras escrituras concurrentes de una empresa no choquen por la
+PK. La reconstrucción bloquea la tabla antes de calcular, así ningún delta se
+confirma entre el cálculo y la escritura.
+"""
+
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, event, false, func, select, text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session, attributes
+
+from models_simple import (
+    db, BatchNFT, Company, CompanyDashboardStats, ContractFixation, ExportContract, ProducerLot
+)
+from services.projections import previous_values, track_previous_values
+
+logger = logging.getLogger(__name__)
+
+# Fila con los totales de la plataforma
+PLATFORM_ID = 0
+
+# Clave del lock consultivo de la reconciliación (PostgreSQL)
+RECONCILE_LOCK_KEY = 170017
+
+# Columnas que afectan a los contadores de cada modelo
+TRACKED_COLUMNS = {
+    ProducerLot: ['producer_company_id', 'purchased_by_company_id', 'status', 'weight_kg',
+                  'purchase_price_usd', 'export_contract_id'],
+    ExportContract: ['exporter_company_id', 'buyer_company_id', 'status', 'total_volume_mt', 'fixed_volume_mt'],
+    ContractFixation: ['export_contract_id'],
+    BatchNFT: ['creator_company_id', 'status', 'total_weight_kg'],
+    Company: [],
+}
+
+COUNTER_COLUMNS = [c.name for c in CompanyDashboardStats.__table__.columns
+                   if c.name not in ('company_id', 'updated_at')]
+
+stats_table = CompanyDashboardStats.__table__
+
+Contribution = Tuple[Optional[int], str, object]  # (company_id, columna, cantidad)
+Deltas = Dict[int, Dict[str, object]]
+
+
+# Cargar el valor anterior al asignar (aunque el atributo esté expirado tras un
+# commit) para poder restar la contribución antigua
+for _model, _columns in TRACKED_COLUMNS.items():
+    track_previous_values(_model, _columns)
+
+
+def _amount(value) -> Decimal:
+    return Decimal(str(value)) if value is not None else Decimal(0)
+
+
+def lot_contributions(v: Dict) -> List[Contribution]:
+    """Contribución de un lote (dict de columnas) a los contadores"""
+    weight = _amount(v.get('weight_kg'))
+    counters = [
+        ('lots_total', 1),
+        ('lots_available', int(v.get('status') == 'available')),
+        ('lots_purchased', int(v.get('status') == 'purchased')),
+        ('lots_assigned', int(v.get('export_contract_id') is not None)),
+        ('lots_weight_kg', weight),
+        ('lots_revenue_usd', _amount(v.get('purchase_price_usd'))),
+    ]
+    rows = [(company_id, column, amount)
+            for company_id in (v.get('producer_company_id'), PLATFORM_ID)
+            for column, amount in counters]
+    if v.get('status') == 'purchased':
+        rows += [(v.get('purchased_by_company_id'), 'purchased_lots', 1),
+                 (v.get('purchased_by_company_id'), 'purchased_weight_kg', weight)]
+    return rows
+
+
+def contract_contributions(v: Dict) -> List[Contribution]:
+    """Contribución de un contrato a sus dos empresas y a la plataforma"""
+    active = int(v.get('status') == 'active')
+    total, fixed = _amount(v.get('total_volume_mt')), _amount(v.get('fixed_volume_mt'))
+    rows = []
+    for company_id, prefix in ((v.get('exporter_company_id'), 'exporter'), (v.get('buyer_company_id'), 'buyer')):
+        rows += [(company_id, f'{prefix}_contracts', 1),
+                 (company_id, f'{prefix}_active_contracts', active),
+                 (company_id, f'{prefix}_volume_mt', total),
+                 (company_id, f'{prefix}_fixed_volume_mt', fixed)]
+    return rows + [(PLATFORM_ID, 'contracts_total', 1),
+                   (PLATFORM_ID, 'contracts_active', active),
+                   (PLATFORM_ID, 'contracts_volume_mt', total),
+                   (PLATFORM_ID, 'contracts_fixed_volume_mt', fixed)]
+
+
+def batch_contributions(v: Dict) -> List[Contribution]:
+    """Contribución de un batch a su creador y a los disponibles de la plataforma"""
+    weight = _amount(v.get('total_weight_kg'))
+    available = v.get('status') == 'available'
+    return [(v.get('creator_company_id'), 'batches_total', 1),
+            (v.get('creator_company_id'), 'batches_weight_kg', weight),
+            (PLATFORM_ID, 'batches_available', int(available)),
+            (PLATFORM_ID, 'batches_available_weight_kg', weight if available else Decimal(0))]
+
+
+def company_contributions(v: Dict) -> List[Contribution]:
+    return [(PLATFORM_ID, 'companies_total', 1)]
+
+
+CONTRIBUTIONS = {
+    ProducerLot: lot_contributions,
+    ExportContract: contract_contributions,
+    BatchNFT: batch_contributions,
+    Company: company_contributions,
+}
+
+
+def add_contributions(deltas: Deltas, rows: Iterable[Contribution], sign: int = 1):
+    """Acumular contribuciones en deltas[company_id][columna]"""
+    for company_id, column, amount in rows:
+        if company_id is None or not amount:
+            continue
+        deltas[company_id][column] = deltas[company_id].get(column, 0) + sign * amount
+
+
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert, 'mysql': mysql.insert}
+
+
+def _upsert(connection, row: Dict, columns: Iterable[str], update) -> bool:
+    """INSERT de la fila o, si la empresa ya existe, SET col = update(col, valor insertado)
+
+    Solo se actualizan `columns` (y updated_at). Retorna False si el dialecto
+    no soporta upsert.
+    """
+    dialect = connection.dialect.name
+    insert = UPSERT_INSERTS.get(dialect)
+    if insert is None:
+        return False
+    stmt = insert(stats_table).values(row)
+    new_values = stmt.inserted if dialect == 'mysql' else stmt.excluded
+    values = {column: update(stats_table.c[column], new_values[column]) for column in columns}
+    values['updated_at'] = new_values.updated_at
+    if dialect == 'mysql':
+        stmt = stmt.on_duplicate_key_update(values)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=[stats_table.c.company_id], set_=values)
+    connection.execute(stmt)
+    return True
+
+
+def _stats_row(company_id: int, columns: Dict) -> Dict:
+    return {**{column: 0 for column in COUNTER_COLUMNS}, **columns,
+            'company_id': company_id, 'updated_at': datetime.utcnow()}
+
+
+def apply_deltas(connection, deltas: Deltas):
+    """col = col + delta por empresa con un upsert (la fila se crea si no existe)"""
+    for company_id, columns in deltas.items():
+        columns = {column: amount for column, amount in columns.items() if amount}
+        if not columns:
+            continue
+        if _upsert(connection, _stats_row(company_id, columns), columns, lambda current, delta: current + delta):
+            continue
+        result = connection.execute(
+            stats_table.update()
+            .where(stats_table.c.company_id == company_id)
+            .values({**{column: stats_table.c[column] + amount for column, amount in columns.items()},
+                     'updated_at': datetime.utcnow()})
+        )
+        if result.rowcount == 0:
+            connection.execute(stats_table.insert().values(_stats_row(company_id, columns)))
+
+
+def _current_values(obj) -> Dict:
+    return {column: getattr(obj, column) for column in TRACKED_COLUMNS[type(obj)]}
+
+
+def _previous_values(obj) -> Dict:
+    return previous_values(obj, TRACKED_COLUMNS[type(obj)])
+
+
+def _changed(obj) -> bool:
+    state = attributes.instance_state(obj)
+    return any(state.attrs[column].history.has_changes() for column in TRACKED_COLUMNS[type(obj)])
+
+
+def _fixation_contributions(connection, fixation_changes: List[Tuple[Optional[int], int]]) -> List[Contribution]:
+    """Fijaciones al exportador de su contrato: cambios (export_contract_id, +1/-1)"""
+    contract_ids = {contract_id for contract_id, _ in fixation_changes if contract_id}
+    if not contract_ids:
+        return []
+    exporters = dict(connection.execute(
+        select(ExportContract.__table__.c.id, ExportContract.__table__.c.exporter_company_id)
+        .where(ExportContract.__table__.c.id.in_(contract_ids))
+    ).fetchall())
+    return [(exporters.get(contract_id), 'exporter_fixations', sign)
+            for contract_id, sign in fixation_changes if contract_id]
+
+
+@event.listens_for(Session, 'after_flush')
+def track_dashboard_stats(session, flush_context):
+    """Aplicar los deltas de los objetos del flush en la misma transacción"""
+    deltas = defaultdict(dict)
+    fixation_changes = []
+
+    for obj in session.new:
+        if isinstance(obj, ContractFixation):
+            fixation_changes.append((obj.export_contract_id, 1))
+        elif type(obj) in CONTRIBUTIONS:
+            add_contributions(deltas, CONTRIBUTIONS[type(obj)](_current_values(obj)))
+    for obj in session.dirty:
+        if type(obj) not in TRACKED_COLUMNS or not _changed(obj):
+            continue
+        if isinstance(obj, ContractFixation):
+            fixation_changes += [(_previous_values(obj)['export_contract_id'], -1),
+                                 (obj.export_contract_id, 1)]
+        else:
+            contributions = CONTRIBUTIONS[type(obj)]
+            add_contributions(deltas, contributions(_previous_values(obj)), sign=-1)
+            add_contributions(deltas, contributions(_current_values(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, ContractFixation):
+            fixation_changes.append((_previous_values(obj)['export_contract_id'], -1))
+        elif type(obj) in CONTRIBUTIONS:
+            add_contributions(deltas, CONTRIBUTIONS[type(obj)](_previous_values(obj)), sign=-1)
+
+    if not (deltas or fixation_changes):
+        return
+
+    connection = session.connection()
+    add_contributions(deltas, _fixation_contributions(connection, fixation_changes))
+    apply_deltas(connection, deltas)
+
+
+def record_new_lots(connection, mappings: Iterable[Dict]):
+    """Contar lotes insertados con bulk_insert_mappings (no pasan por after_flush)"""
+    deltas = defaultdict(dict)
+    for mapping in mappings:
+        add_contributions(deltas, lot_contributions(mapping))
+    apply_deltas(connection, deltas)
+
+
+def _sum_if(condition, value=1):
+    return func.coalesce(func.sum(case((condition, value), else_=0)), 0)
+
+
+def compute_dashboard_stats(connection) -> Deltas:
+    """Contadores calculados desde cero con GROUP BY (misma lógica que los deltas)"""
+    stats = defaultdict(dict)
+    lots, contracts, batches = ProducerLot.__table__.c, ExportContract.__table__.c, BatchNFT.__table__.c
+
+    for row in connection.execute(
+        select(lots.producer_company_id, func.count(lots.id),
+               _sum_if(lots.status == 'available'), _sum_if(lots.status == 'purchased'),
+               _sum_if(lots.export_contract_id.isnot(None)),
+               func.coalesce(func.sum(lots.weight_kg), 0), func.coalesce(func.sum(lots.purchase_price_usd), 0))
+        .group_by(lots.producer_company_id)
+    ):
+        for company_id in (row[0], PLATFORM_ID):
+            add_contributions(stats, [(company_id, column, value) for column, value in zip(
+                ['lots_total', 'lots_available', 'lots_purchased', 'lots_assigned', 'lots_weight_kg',
+                 'lots_revenue_usd'], row[1:])])
+
+    for company_id, count, weight in connection.execute(
+        select(lots.purchased_by_company_id, func.count(lots.id), func.coalesce(func.sum(lots.weight_kg), 0))
+        .where(lots.status == 'purchased')
+        .group_by(lots.purchased_by_company_id)
+    ):
+        add_contributions(stats, [(company_id, 'purchased_lots', count), (company_id, 'purchased_weight_kg', weight)])
+
+    for company_column, prefix in ((contracts.exporter_company_id, 'exporter'), (contracts.buyer_company_id, 'buyer')):
+        for row in connection.execute(
+            select(company_column, func.count(contracts.id), _sum_if(contracts.status == 'active'),
+                   func.coalesce(func.sum(contracts.total_volume_mt), 0),
+                   func.coalesce(func.sum(contracts.fixed_volume_mt), 0))
+            .group_by(company_column)
+        ):
+            add_contributions(stats, [(row[0], f'{prefix}_{column}', value) for column, value in zip(
+                ['contracts', 'active_contracts', 'volume_mt', 'fixed_volume_mt'], row[1:])])
+            if prefix == 'exporter':
+                add_contributions(stats, [(PLATFORM_ID, column, value) for column, value in zip(
+                    ['contracts_total', 'contracts_active', 'contracts_volume_mt', 'contracts_fixed_volume_mt'],
+                    row[1:])])
+
+    fixations = ContractFixation.__table__.c
+    add_contributions(stats, [(company_id, 'exporter_fixations', count) for company_id, count in connection.execute(
+        select(contracts.exporter_company_id, func.count(fixations.id))
+        .join_from(ContractFixation.__table__, ExportContract.__table__,
+                   fixations.export_contract_id == contracts.id)
+        .group_by(contracts.exporter_company_id)
+    )])
+
+    for company_id, count, weight, available, available_weight in connection.execute(
+        select(batches.creator_company_id, func.count(batches.id), func.coalesce(func.sum(batches.total_weight_kg), 0),
+               _sum_if(batches.status == 'available'), _sum_if(batches.status == 'available', batches.total_weight_kg))
+        .group_by(batches.creator_company_id)
+    ):
+        add_contributions(stats, [(company_id, 'batches_total', count), (company_id, 'batches_weight_kg', weight),
+                                  (PLATFORM_ID, 'batches_available', available),
+                                  (PLATFORM_ID, 'batches_available_weight_kg', available_weight)])
+
+    add_contributions(stats, [(PLATFORM_ID, 'companies_total', connection.execute(
+        select(func.count()).select_from(Company.__table__)).scalar())])
+    return stats
+
+
+def _lock_stats_table(connection):
+    """Bloquear las escrituras en company_dashboard_stats hasta el fin de la transacción
+
+    Los deltas se aplican en la misma transacción que los cambios de lotes y
+    contratos, así que mientras dure el bloqueo ningún cambio con contadores
+    se confirma y el cálculo ve un estado coherente.
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        # EXCLUSIVE permite lecturas y bloquea INSERT/UPDATE/DELETE
+        connection.execute(text('LOCK TABLE company_dashboard_stats IN EXCLUSIVE MODE'))
+    elif dialect == 'mysql':
+        # Bloqueos de fila y de hueco sobre toda la tabla (también frenan los INSERT)
+        connection.execute(select(stats_table.c.company_id).with_for_update()).fetchall()
+    else:
+        # SQLite: una escritura vacía toma el bloqueo de escritor de la base
+        connection.execute(stats_table.delete().where(false()))
+
+
+def rebuild_dashboard_stats(connection) -> int:
+    """Reemplazar company_dashboard_stats por los valores recalculados
+
+    Bloquea la tabla antes de calcular y escribe con upserts, de modo que los
+    deltas que esperan el bloqueo se aplican después sobre los valores nuevos.
+    """
+    _lock_stats_table(connection)
+    stats = compute_dashboard_stats(connection)
+    connection.execute(stats_table.delete().where(stats_table.c.company_id.notin_(list(stats))))
+    for company_id, columns in stats.items():
+        row = _stats_row(company_id, columns)
+        if not _upsert(connection, row, COUNTER_COLUMNS, lambda current, value: value):
+            connection.execute(stats_table.delete().where(stats_table.c.company_id == company_id))
+            connection.execute(stats_table.insert().values(row))
+    return len(stats)
+
+
+def _try_reconcile_lock(connection) -> bool:
+    """Lock consultivo para que una sola réplica reconstruya a la vez (PostgreSQL)"""
+    if connection.dialect.name != 'postgresql':
+        return True
+    return bool(connection.execute(
+        text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': RECONCILE_LOCK_KEY}).scalar())
+
+
+def get_dashboard_stats(company_id: Optional[int]) -> Dict[str, object]:
+    """Contadores de una empresa (o de la plataforma con PLATFORM_ID) con una lectura por PK"""
+    row = db.session.get(CompanyDashboardStats, company_id) if company_id is not None else None
+    result = {}
+    for column in COUNTER_COLUMNS:
+        value = getattr(row, column) if row is not None else 0
+        result[column] = float(value) if isinstance(value, Decimal) else (value or 0)
+    return result
+
+
+class DashboardStatsReconciler:
+    """Reconstruye company_dashboard_stats cada `interval` segundos en segundo plano"""
+
+    def __init__(self, interval: float = 3600):
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='dashboard-stats', daemon=True)
+        self._thread.start()
+        logger.info(f"📊 Reconciliación de contadores del dashboard cada {self.interval}s")
+
+    def reconcile(self):
+        connection = db.session.connection()
+        if not _try_reconcile_lock(connection):
+            db.session.rollback()
+            logger.info("📊 Otra réplica está reconciliando los contadores del dashboard")
+            return
+        rows = rebuild_dashboard_stats(connection)
+        db.session.commit()
+        logger.info(f"📊 Contadores del dashboard reconciliados ({rows} filas)")
+
+    def _run(self, app):
+        # Reconciliar al arrancar y luego cada intervalo
+        while True:
+            with app.app_context():
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logger.error(f"❌ Error reconciliando contadores del dashboard: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_dashboard_reconciler(app) -> Optional[DashboardStatsReconciler]:
+    """Arrancar la reconciliación periódica salvo con DASHBOARD_STATS_RECONCILE=false"""
+    if app.config.get('TESTING') or os.getenv('DASHBOARD_STATS_RECONCILE', 'true').lower() != 'true':
+        return None
+    reconciler = DashboardStatsReconciler(interval=float(os.getenv('DASHBOARD_STATS_RECONCILE_INTERVAL', 3600)))
+    reconciler.start(app)
+    return reconciler
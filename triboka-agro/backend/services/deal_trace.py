@@ -0,0 +1,361 @@
+"""
+Ensamblado de la trazabilidad de un deal para Triboka
+Reúne los IDs de lotes y batches de todos los enlaces del deal y los carga
+con sus empresas en una consulta por tabla; lo usan el endpoint JSON, el
+filtro y la exportación PDF
+"""
+
+import json
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, selectinload
+
+from models_simple import (
+    BatchNFT, DealMessage, DealTraceLink, ExportContract, ProducerLot
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _to_float(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def _unique(ids) -> List[int]:
+    """IDs únicos en el orden en que aparecen en los enlaces"""
+    seen = []
+    for value in ids:
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            continue
+        if value not in seen:
+            seen.append(value)
+    return seen
+
+
+class DealTraceBuilder:
+    """Construye el timeline completo de un deal con consultas acotadas
+
+    Una consulta por tabla (enlaces, lotes, batches, contratos, fijaciones,
+    mensajes) sin importar cuántos enlaces tenga el deal.
+    """
+
+    def __init__(self, deal, include_blockchain: bool = False):
+        self.deal = deal
+        self.include_blockchain = include_blockchain
+        self.links: List[DealTraceLink] = []
+        self.lots: List[ProducerLot] = []
+        self.batches: List[BatchNFT] = []
+
+    def prefetch(self):
+        """Cargar enlaces, lotes y batches del deal (con sus empresas)"""
+        self.links = DealTraceLink.query.filter_by(deal_id=self.deal.id).order_by(DealTraceLink.id).all()
+
+        lot_ids = _unique(lot_id for link in self.links for lot_id in link.get_lote_ids())
+        batch_ids = _unique(batch_id for link in self.links for batch_id in link.get_batch_ids())
+
+        if lot_ids:
+            lots = ProducerLot.query.options(
+                joinedload(ProducerLot.producer_company),
+                joinedload(ProducerLot.purchased_by_company)
+            ).filter(ProducerLot.id.in_(lot_ids)).all()
+            by_id = {lot.id: lot for lot in lots}
+            self.lots = [by_id[lot_id] for lot_id in lot_ids if lot_id in by_id]
+        if batch_ids:
+            batches = BatchNFT.query.options(
+                joinedload(BatchNFT.creator_company)
+            ).filter(BatchNFT.id.in_(batch_ids)).all()
+            by_id = {batch.id: batch for batch in batches}
+            self.batches = [by_id[batch_id] for batch_id in batch_ids if batch_id in by_id]
+        return self
+
+    def build(self) -> Dict:
+        """Timeline ordenado, resumen y enlaces del deal"""
+        self.prefetch()
+
+        timeline_events = [self._deal_created_event()]
+        for lote in self.lots:
+            timeline_events.extend(self._lot_events(lote))
+        for batch in self.batches:
+            timeline_events.append(self._batch_event(batch))
+        for link in self.links:
+            timeline_events.extend(self._custom_events(link))
+        timeline_events.extend(self._contract_events())
+        timeline_events.extend(self._message_events())
+        if self.include_blockchain:
+            timeline_events.extend(self._blockchain_events())
+
+        # Ordenar timeline por timestamp (más antiguos primero)
+        timeline_events.sort(key=lambda x: x['timestamp'])
+
+        return {
+            'summary': self._summary(timeline_events),
+            'timeline': timeline_events,
+            'trace_links': [{
+                'id': link.id,
+                'lote_ids': link.get_lote_ids(),
+                'batch_ids': link.get_batch_ids(),
+                'events': link.get_events(),
+                'created_at': link.created_at.isoformat()
+            } for link in self.links]
+        }
+
+    def _deal_created_event(self) -> Dict:
+        deal = self.deal
+        return {
+            'id': f'deal_created_{deal.id}',
+            'type': 'deal_created',
+            'title': 'Acuerdo Creado',
+            'description': f'Acuerdo #{deal.id} creado entre productor y exportadora',
+            'timestamp': deal.created_at.isoformat(),
+            'actor': 'Sistema Triboka',
+            'icon': 'handshake',
+            'color': 'primary',
+            'metadata': {
+                'deal_id': deal.id,
+                'producer_company': deal.producer.name if deal.producer else None,
+                'exporter_company': deal.exporter.name if deal.exporter else None,
+                'admin': deal.admin.name if deal.admin else None
+            }
+        }
+
+    def _lot_events(self, lote: ProducerLot) -> List[Dict]:
+        producer_name = lote.producer_company.name if lote.producer_company else 'Productor'
+        events = [{
+            'id': f'lote_created_{lote.id}',
+            'type': 'lote_created',
+            'title': f'Lote {lote.lot_code} Creado',
+            'description': f'Lote registrado por {producer_name}',
+            'timestamp': lote.created_at.isoformat(),
+            'actor': producer_name,
+            'icon': 'seedling',
+            'color': 'success',
+            'metadata': {
+                'lote_id': lote.id,
+                'lote_code': lote.lot_code,
+                'weight_kg': _to_float(lote.weight_kg),
+                'quality_grade': lote.quality_grade,
+                'location': lote.location,
+                'blockchain_lot_id': lote.blockchain_lot_id
+            }
+        }]
+
+        # Evento de cosecha
+        if lote.harvest_date:
+            events.append({
+                'id': f'lote_harvest_{lote.id}',
+                'type': 'harvest',
+                'title': f'Cosecha {lote.lot_code}',
+                'description': f'Cosecha realizada en {lote.farm_name or "finca"}',
+                'timestamp': lote.harvest_date.isoformat(),
+                'actor': producer_name,
+                'icon': 'leaf',
+                'color': 'success',
+                'metadata': {
+                    'lote_id': lote.id,
+                    'farm_name': lote.farm_name,
+                    'location': lote.location
+                }
+            })
+
+        # Evento de compra (si está purchased)
+        if lote.status in ['purchased', 'batched'] and lote.purchase_date:
+            buyer_name = lote.purchased_by_company.name if lote.purchased_by_company else 'Exportadora'
+            events.append({
+                'id': f'lote_purchased_{lote.id}',
+                'type': 'purchase',
+                'title': f'Lote {lote.lot_code} Comprado',
+                'description': f'Adquirido por {buyer_name}',
+                'timestamp': lote.purchase_date.isoformat(),
+                'actor': buyer_name,
+                'icon': 'shopping-cart',
+                'color': 'info',
+                'metadata': {
+                    'lote_id': lote.id,
+                    'buyer': buyer_name,
+                    'purchase_price': _to_float(lote.purchase_price_usd)
+                }
+            })
+        return events
+
+    def _batch_event(self, batch: BatchNFT) -> Dict:
+        creator_name = batch.creator_company.name if batch.creator_company else 'Exportadora'
+        return {
+            'id': f'batch_created_{batch.id}',
+            'type': 'batch_created',
+            'title': f'Batch {batch.batch_code} Creado',
+            'description': f'Batch creado por {creator_name}',
+            'timestamp': batch.created_at.isoformat(),
+            'actor': creator_name,
+            'icon': 'boxes',
+            'color': 'warning',
+            'metadata': {
+                'batch_id': batch.id,
+                'batch_code': batch.batch_code,
+                'total_weight_kg': _to_float(batch.total_weight_kg),
+                'batch_type': batch.batch_type,
+                'location': batch.location,
+                'blockchain_batch_id': batch.blockchain_batch_id
+            }
+        }
+
+    @staticmethod
+    def _custom_events(link: DealTraceLink) -> List[Dict]:
+        """Eventos personalizados del enlace"""
+        return [{
+            'id': f'custom_event_{event.get("id", "unknown")}',
+            'type': event.get('type', 'custom'),
+            'title': event.get('title', 'Evento Personalizado'),
+            'description': event.get('description', ''),
+            'timestamp': event.get('timestamp', datetime.utcnow().isoformat()),
+            'actor': event.get('actor', 'Sistema'),
+            'icon': event.get('icon', 'circle'),
+            'color': event.get('color', 'secondary'),
+            'metadata': event.get('metadata', {})
+        } for event in link.get_events() if isinstance(event, dict)]
+
+    def _contract_events(self) -> List[Dict]:
+        """Contratos entre las empresas del deal y sus fijaciones"""
+        deal = self.deal
+        if not (deal.producer_id and deal.exporter_id):
+            return []
+
+        contracts = ExportContract.query.options(
+            joinedload(ExportContract.exporter_company),
+            joinedload(ExportContract.buyer_company),
+            selectinload(ExportContract.fixations)
+        ).filter(or_(
+            and_(ExportContract.exporter_company_id == deal.producer_id,
+                 ExportContract.buyer_company_id == deal.exporter_id),
+            and_(ExportContract.exporter_company_id == deal.exporter_id,
+                 ExportContract.buyer_company_id == deal.producer_id)
+        )).order_by(ExportContract.id).all()
+
+        events = []
+        for contract in contracts:
+            exporter_name = contract.exporter_company.name if contract.exporter_company else 'Exportadora'
+            buyer_name = contract.buyer_company.name if contract.buyer_company else 'Comprador'
+            events.append({
+                'id': f'contract_created_{contract.id}',
+                'type': 'contract_created',
+                'title': f'Contrato {contract.contract_code} Creado',
+                'description': f'Contrato entre {exporter_name} y {buyer_name}',
+                'timestamp': contract.created_at.isoformat(),
+                'actor': 'Sistema Triboka',
+                'icon': 'file-contract',
+                'color': 'primary',
+                'metadata': {
+                    'contract_id': contract.id,
+                    'contract_code': contract.contract_code,
+                    'total_volume_mt': _to_float(contract.total_volume_mt),
+                    'status': contract.status,
+                    'blockchain_contract_id': contract.blockchain_contract_id
+                }
+            })
+
+            for fixation in sorted(contract.fixations, key=lambda f: f.id):
+                events.append({
+                    'id': f'fixation_created_{fixation.id}',
+                    'type': 'fixation',
+                    'title': 'Fijación de Precio',
+                    'description': f'Precio fijado: ${fixation.spot_price_usd} USD + ${contract.differential_usd} diferencial',
+                    'timestamp': fixation.fixation_date.isoformat(),
+                    'actor': exporter_name,
+                    'icon': 'dollar-sign',
+                    'color': 'success',
+                    'metadata': {
+                        'fixation_id': fixation.id,
+                        'fixed_quantity_mt': _to_float(fixation.fixed_quantity_mt),
+                        'spot_price_usd': _to_float(fixation.spot_price_usd),
+                        'differential_usd': _to_float(contract.differential_usd),
+                        'total_value_usd': _to_float(fixation.total_value_usd)
+                    }
+                })
+        return events
+
+    def _message_events(self) -> List[Dict]:
+        """Mensajes importantes del deal (sistema y archivos)"""
+        messages = DealMessage.query.options(joinedload(DealMessage.author)).filter(
+            DealMessage.deal_id == self.deal.id,
+            DealMessage.message_type.in_(['system', 'file_upload'])
+        ).order_by(DealMessage.created_at.asc()).all()
+
+        events = []
+        for msg in messages:
+            if msg.message_type == 'file_upload':
+                events.append({
+                    'id': f'message_{msg.id}',
+                    'type': 'file_upload',
+                    'title': 'Archivo Compartido',
+                    'description': msg.content,
+                    'timestamp': msg.created_at.isoformat(),
+                    'actor': msg.author.name if msg.author else 'Usuario',
+                    'icon': 'paperclip',
+                    'color': 'info',
+                    'metadata': {
+                        'message_id': msg.id,
+                        'attachments': json.loads(msg.attachments) if msg.attachments else []
+                    }
+                })
+            else:
+                events.append({
+                    'id': f'message_{msg.id}',
+                    'type': 'system_event',
+                    'title': 'Evento del Sistema',
+                    'description': msg.content,
+                    'timestamp': msg.created_at.isoformat(),
+                    'actor': 'Sistema Triboka',
+                    'icon': 'cog',
+                    'color': 'secondary',
+                    'metadata': {
+                        'message_id': msg.id
+                    }
+                })
+        return events
+
+    def _blockchain_events(self) -> List[Dict]:
+        """Lotes tokenizados (a partir de los lotes ya cargados)"""
+        return [{
+            'id': f'blockchain_lote_{lote.id}',
+            'type': 'blockchain_mint',
+            'title': f'NFT Lote {lote.lot_code} Creado',
+            'description': 'Lote tokenizado en blockchain como NFT',
+            'timestamp': lote.created_at.isoformat(),
+            'actor': 'Blockchain Triboka',
+            'icon': 'gem',
+            'color': 'purple',
+            'metadata': {
+                'blockchain_lot_id': lote.blockchain_lot_id,
+                'network': 'Polygon',
+                'contract': 'ProducerLotNFT'
+            }
+        } for lote in self.lots if lote.blockchain_lot_id]
+
+    def _summary(self, timeline_events: List[Dict]) -> Dict:
+        """Resumen de trazabilidad"""
+        def distinct(key):
+            return len({e['metadata'].get(key) for e in timeline_events if e['metadata'].get(key)})
+
+        return {
+            'deal_id': self.deal.id,
+            'total_events': len(timeline_events),
+            'date_range': {
+                'start': timeline_events[0]['timestamp'] if timeline_events else None,
+                'end': timeline_events[-1]['timestamp'] if timeline_events else None
+            },
+            'entities': {
+                'lotes': distinct('lote_id'),
+                'batches': distinct('batch_id'),
+                'contracts': distinct('contract_id'),
+                'blockchain_events': len([e for e in timeline_events if 'blockchain' in e['type']])
+            }
+        }
+
+
+def build_deal_trace(deal, include_blockchain: bool = False) -> Dict:
+    """Trazabilidad completa del deal (sin cache)"""
+    return DealTraceBuilder(deal, include_blockchain=include_blockchain).build()
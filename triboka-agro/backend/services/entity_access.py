@@ -0,0 +1,154 @@
+"""
+Proyección de acceso a entidades de trazabilidad para Triboka
+Mantiene entity_access (empresa -> lote/batch) al crear, comprar o agrupar
+lotes, para que los listados de usuarios no admin filtren con un EXISTS
+indexado en lugar de cargar todos sus IDs en una lista IN
+"""
+
+import logging
+from typing import Iterable, Set, Tuple
+
+from sqlalchemy import and_, event, exists, select
+from sqlalchemy.orm import Session, attributes
+
+from models_simple import BatchLot, BatchNFT, EntityAccess, ProducerLot
+from services.projections import track_previous_values
+
+logger = logging.getLogger(__name__)
+
+# Relaciones que dan acceso según el rol del usuario
+ROLE_RELATIONS = {
+    'producer': ['producer'],
+    'exporter': ['purchaser', 'creator', 'batch'],
+}
+
+# (columna del modelo, tipo de entidad, relación) que se proyectan
+TRACKED_COLUMNS = {
+    ProducerLot: [('producer_company_id', 'lot', 'producer'),
+                  ('purchased_by_company_id', 'lot', 'purchaser')],
+    BatchNFT: [('creator_company_id', 'batch', 'creator')],
+}
+
+AccessRow = Tuple[int, str, str, str]  # (company_id, entity_type, entity_id, relation)
+
+access_table = EntityAccess.__table__
+
+
+# Cargar el valor anterior al asignar (aunque el atributo esté expirado tras un
+# commit) para poder revocar el acceso de la empresa anterior
+for _model, _columns in TRACKED_COLUMNS.items():
+    track_previous_values(_model, [column for column, _, _ in _columns])
+
+
+def grant_access(connection, rows: Iterable[AccessRow]) -> int:
+    """Insertar filas de acceso que aún no existen (idempotente)"""
+    rows = {(company_id, entity_type, str(entity_id), relation)
+            for company_id, entity_type, entity_id, relation in rows if company_id}
+    if not rows:
+        return 0
+
+    existing = set(connection.execute(
+        select(access_table.c.company_id, access_table.c.entity_type,
+               access_table.c.entity_id, access_table.c.relation)
+        .where(access_table.c.entity_id.in_({row[2] for row in rows}))
+        .where(access_table.c.company_id.in_({row[0] for row in rows}))
+    ).fetchall())
+    missing = [row for row in rows if row not in existing]
+    if missing:
+        connection.execute(access_table.insert(), [{
+            'company_id': company_id,
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'relation': relation
+        } for company_id, entity_type, entity_id, relation in missing])
+    return len(missing)
+
+
+def revoke_access(connection, rows: Iterable[AccessRow]):
+    """Eliminar filas de acceso concretas"""
+    for company_id, entity_type, entity_id, relation in set(rows):
+        connection.execute(access_table.delete().where(and_(
+            access_table.c.company_id == company_id,
+            access_table.c.entity_type == entity_type,
+            access_table.c.entity_id == str(entity_id),
+            access_table.c.relation == relation
+        )))
+
+
+def _column_changes(obj) -> Tuple[Set[AccessRow], Set[AccessRow]]:
+    """Filas a otorgar y revocar según el historial de las columnas proyectadas"""
+    grants, revokes = set(), set()
+    state = attributes.instance_state(obj)
+    for column, entity_type, relation in TRACKED_COLUMNS[type(obj)]:
+        history = state.attrs[column].history
+        for company_id in history.added or ():
+            if company_id:
+                grants.add((company_id, entity_type, str(obj.id), relation))
+        for company_id in history.deleted or ():
+            if company_id:
+                revokes.add((company_id, entity_type, str(obj.id), relation))
+    return grants, revokes
+
+
+def _batch_lot_grants(connection, links) -> Set[AccessRow]:
+    """El creador del batch obtiene acceso a los lotes agrupados"""
+    links = [(link.batch_id, link.lot_id) for link in links if link.batch_id and link.lot_id]
+    if not links:
+        return set()
+    creators = dict(connection.execute(
+        select(BatchNFT.__table__.c.id, BatchNFT.__table__.c.creator_company_id)
+        .where(BatchNFT.__table__.c.id.in_({batch_id for batch_id, _ in links}))
+    ).fetchall())
+    return {(creators[batch_id], 'lot', str(lot_id), 'batch')
+            for batch_id, lot_id in links if creators.get(batch_id)}
+
+
+@event.listens_for(Session, 'after_flush')
+def track_entity_access(session, flush_context):
+    """Mantener entity_access en la misma transacción que los cambios de lotes y batches"""
+    grants, revokes = set(), set()
+    new_links, deleted_entities = [], []
+
+    for obj in session.new:
+        if type(obj) in TRACKED_COLUMNS:
+            grants |= _column_changes(obj)[0]
+        elif isinstance(obj, BatchLot):
+            new_links.append(obj)
+    for obj in session.dirty:
+        if type(obj) in TRACKED_COLUMNS:
+            added, removed = _column_changes(obj)
+            grants |= added
+            revokes |= removed
+    for obj in session.deleted:
+        if type(obj) in TRACKED_COLUMNS:
+            deleted_entities.append(('batch' if isinstance(obj, BatchNFT) else 'lot', str(obj.id)))
+
+    if not (grants or revokes or new_links or deleted_entities):
+        return
+
+    connection = session.connection()
+    grants |= _batch_lot_grants(connection, new_links)
+    revoke_access(connection, revokes - grants)
+    grant_access(connection, grants)
+    for entity_type, entity_id in deleted_entities:
+        connection.execute(access_table.delete().where(and_(
+            access_table.c.entity_type == entity_type,
+            access_table.c.entity_id == entity_id
+        )))
+
+
+def accessible_entities_clause(user, entity_type_column, entity_id_column):
+    """Condición EXISTS para filtrar filas por las entidades accesibles del usuario
+
+    Devuelve None si el rol o la empresa del usuario no dan acceso a ninguna entidad.
+    """
+    relations = ROLE_RELATIONS.get(user.role)
+    if not relations or not user.company_id:
+        return None
+    return exists().where(and_(
+        EntityAccess.company_id == user.company_id,
+        EntityAccess.entity_type == entity_type_column,
+        EntityAccess.entity_id == entity_id_column,
+        EntityAccess.relation.in_(relations)
+    ))
+
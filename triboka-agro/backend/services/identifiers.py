@@ -0,0 +1,274 @@
+"""
+Resolución de identificadores externos de Triboka (AgroWeight, apps de campo)
+external_identifiers indexa códigos de lote, NFT IDs y códigos de batch y se
+mantiene en la misma transacción que lotes y batches. Cada proceso tiene un
+mapa en memoria (cargado completo en el primer uso, actualizado con los
+commits locales y recargado cada IDENTIFIER_MAP_TTL segundos); lo que no está
+en el mapa se busca en la tabla indexada con una sola consulta por envío.
+Al cargar las entidades se comprueba que el identificador sigue siendo suyo,
+así un cambio hecho en otro proceso nunca devuelve un lote equivocado.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, event, literal, select
+from sqlalchemy.orm import Session, attributes, selectinload
+
+from models_simple import db, BatchNFT, ExternalIdentifier, ProducerLot
+from services.projections import track_previous_values
+
+logger = logging.getLogger(__name__)
+
+# (columna, tipo de identificador) indexadas por modelo
+IDENTIFIER_COLUMNS = {
+    ProducerLot: (('lot_code', 'lot_code'), ('blockchain_lot_id', 'nft_id')),
+    BatchNFT: (('batch_code', 'batch_code'),),
+}
+KIND_MODELS = {kind: model for model, columns in IDENTIFIER_COLUMNS.items() for _, kind in columns}
+KIND_COLUMNS = {kind: column for columns in IDENTIFIER_COLUMNS.values() for column, kind in columns}
+ALL_KINDS = tuple(KIND_MODELS)
+# Orden de preferencia si un identificador coincide con varios tipos
+LOT_KINDS = ('lot_code', 'nft_id')
+MAX_RESOLVE = 1000
+
+identifiers_table = ExternalIdentifier.__table__
+
+Match = Tuple[str, int]  # (tipo, id de la entidad)
+
+
+# Cargar el valor anterior al cambiar un identificador (aunque esté expirado)
+for _model, _columns in IDENTIFIER_COLUMNS.items():
+    track_previous_values(_model, [column for column, _ in _columns])
+
+
+class IdentifierMap:
+    """Mapa en memoria identificador -> [(tipo, entity_id)] de este proceso"""
+
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._by_identifier: Dict[str, List[Match]] = {}
+        self._by_entity: Dict[Match, str] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        rows = db.session.execute(select(
+            identifiers_table.c.identifier, identifiers_table.c.kind, identifiers_table.c.entity_id
+        )).fetchall()
+        with self._lock:
+            self._by_identifier, self._by_entity = {}, {}
+            self._add_locked(rows)
+            self._loaded_at = time.monotonic()
+        logger.info(f"🏷️ Mapa de identificadores cargado: {len(rows)} identificadores")
+
+    def _add_locked(self, rows: Iterable[Tuple[str, str, int]]):
+        for identifier, kind, entity_id in rows:
+            previous = self._by_entity.pop((kind, entity_id), None)
+            if previous is not None and previous != identifier:
+                self._discard_locked(previous, (kind, entity_id))
+            matches = self._by_identifier.setdefault(identifier, [])
+            if (kind, entity_id) not in matches:
+                matches.append((kind, entity_id))
+            self._by_entity[(kind, entity_id)] = identifier
+
+    def _discard_locked(self, identifier: str, match: Match):
+        matches = self._by_identifier.get(identifier, [])
+        if match in matches:
+            matches.remove(match)
+        if not matches:
+            self._by_identifier.pop(identifier, None)
+
+    def lookup(self, identifiers: Iterable[str]) -> Dict[str, List[Match]]:
+        self._ensure_loaded()
+        with self._lock:
+            return {identifier: list(self._by_identifier[identifier])
+                    for identifier in identifiers if identifier in self._by_identifier}
+
+    def add(self, rows: Iterable[Tuple[str, str, int]]):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._add_locked(rows)
+
+    def remove_entities(self, matches: Iterable[Match]):
+        with self._lock:
+            for match in matches:
+                identifier = self._by_entity.pop(match, None)
+                if identifier is not None:
+                    self._discard_locked(identifier, match)
+
+    def clear(self):
+        with self._lock:
+            self._by_identifier, self._by_entity = {}, {}
+            self._loaded_at = None
+
+    def __len__(self):
+        return len(self._by_identifier)
+
+
+identifier_map = IdentifierMap(ttl=float(os.getenv('IDENTIFIER_MAP_TTL', 600)))
+
+
+# ----------------------------------------------------------------------
+# Mantenimiento del índice
+# ----------------------------------------------------------------------
+
+def index_identifiers(connection, rows: Iterable[Tuple[str, str, int]]) -> List[Tuple[str, str, int]]:
+    """Insertar (identificador, tipo, entity_id); los identificadores vacíos se ignoran"""
+    rows = [(str(identifier), kind, entity_id) for identifier, kind, entity_id in rows if identifier]
+    if rows:
+        connection.execute(identifiers_table.insert(), [
+            {'identifier': identifier, 'kind': kind, 'entity_id': entity_id} for identifier, kind, entity_id in rows
+        ])
+    return rows
+
+
+def unindex_entities(connection, matches: Iterable[Match]):
+    """Eliminar los identificadores de (tipo, entity_id)"""
+    by_kind = defaultdict(set)
+    for kind, entity_id in matches:
+        by_kind[kind].add(entity_id)
+    for kind, entity_ids in by_kind.items():
+        connection.execute(delete(identifiers_table).where(
+            identifiers_table.c.kind == kind, identifiers_table.c.entity_id.in_(entity_ids)))
+
+
+def record_new_lot_identifiers(connection, mappings: Iterable[Dict], ids: Dict[str, int]):
+    """Indexar lotes insertados con bulk_insert_mappings (no pasan por after_flush)"""
+    index_identifiers(connection, [
+        (m.get(column), kind, ids[m['lot_code']])
+        for m in mappings for column, kind in IDENTIFIER_COLUMNS[ProducerLot]
+    ])
+
+
+@event.listens_for(Session, 'after_flush')
+def track_identifier_changes(session, flush_context):
+    """Mantener external_identifiers al crear, modificar o eliminar lotes y batches"""
+    added, removed = [], []
+    for obj in session.new:
+        columns = IDENTIFIER_COLUMNS.get(type(obj))
+        if columns:
+            added += [(getattr(obj, column), kind, obj.id) for column, kind in columns]
+    for obj in session.dirty:
+        columns = IDENTIFIER_COLUMNS.get(type(obj))
+        if not columns:
+            continue
+        for column, kind in columns:
+            if attributes.get_history(obj, column).has_changes():
+                removed.append((kind, obj.id))
+                added.append((getattr(obj, column), kind, obj.id))
+    for obj in session.deleted:
+        columns = IDENTIFIER_COLUMNS.get(type(obj))
+        if columns:
+            removed += [(kind, attributes.instance_state(obj).identity[0]) for _, kind in columns]
+
+    if not added and not removed:
+        return
+    connection = session.connection()
+    if removed:
+        unindex_entities(connection, removed)
+    added = index_identifiers(connection, added)
+    pending = session.info.setdefault('identifier_changes', ([], []))
+    pending[0].extend(added)
+    pending[1].extend(removed)
+
+
+@event.listens_for(Session, 'after_commit')
+def refresh_identifier_map(session):
+    added, removed = session.info.pop('identifier_changes', ([], []))
+    identifier_map.remove_entities(removed)
+    identifier_map.add(added)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_identifier_changes(session):
+    session.info.pop('identifier_changes', None)
+
+
+def backfill_identifiers(connection) -> int:
+    """Indexar todos los lotes y batches existentes (para migraciones)"""
+    rows = 0
+    for model, columns in IDENTIFIER_COLUMNS.items():
+        table = model.__table__
+        for column, kind in columns:
+            rows += len(index_identifiers(connection, connection.execute(
+                select(table.c[column], literal(kind), table.c.id).where(table.c[column].isnot(None))
+            ).fetchall()))
+    return rows
+
+
+# ----------------------------------------------------------------------
+# Resolución
+# ----------------------------------------------------------------------
+
+def resolve_identifiers(identifiers: Iterable[str], kinds: Sequence[str] = ALL_KINDS,
+                        use_map: bool = True) -> Dict[str, List[Match]]:
+    """identificador -> [(tipo, entity_id)] en el orden de `kinds` (sin los no encontrados)"""
+    identifiers = {str(identifier) for identifier in identifiers if identifier}
+    found = identifier_map.lookup(identifiers) if use_map else {}
+    missing = identifiers - set(found)
+    if missing:
+        rows = db.session.execute(select(
+            identifiers_table.c.identifier, identifiers_table.c.kind, identifiers_table.c.entity_id
+        ).where(identifiers_table.c.identifier.in_(missing))).fetchall()
+        for identifier, kind, entity_id in rows:
+            found.setdefault(identifier, []).append((kind, entity_id))
+        identifier_map.add(rows)
+
+    order = {kind: index for index, kind in enumerate(kinds)}
+    return {identifier: sorted((m for m in matches if m[0] in order), key=lambda m: order[m[0]])
+            for identifier, matches in found.items() if any(m[0] in order for m in matches)}
+
+
+def _load_entities(matches: Iterable[Match]) -> Dict[Match, object]:
+    """Cargar con una consulta por modelo las entidades de los matches"""
+    ids_by_model = defaultdict(set)
+    for kind, entity_id in matches:
+        ids_by_model[KIND_MODELS[kind]].add(entity_id)
+    entities = {}
+    for model, ids in ids_by_model.items():
+        query = model.query.filter(model.id.in_(ids))
+        if model is ProducerLot:
+            query = query.options(selectinload(ProducerLot.producer_company), selectinload(ProducerLot.export_contract))
+        entities.update(((model, entity.id), entity) for entity in query)
+    return {(kind, entity_id): entities.get((KIND_MODELS[kind], entity_id)) for kind, entity_id in matches}
+
+
+def load_resolved(identifiers: Iterable[str], kinds: Sequence[str] = ALL_KINDS) -> Dict[str, Tuple[str, object]]:
+    """identificador -> (tipo, entidad) con la primera coincidencia válida según `kinds`
+
+    Si el mapa en memoria estaba desactualizado (el identificador ya no es de
+    esa entidad) se descarta la entrada y se vuelve a resolver contra la tabla.
+    """
+    identifiers = list(dict.fromkeys(str(identifier) for identifier in identifiers if identifier))
+    resolved = {}
+    pending = identifiers
+    for use_map in (True, False):
+        matches = resolve_identifiers(pending, kinds, use_map=use_map)
+        entities = _load_entities({m for candidates in matches.values() for m in candidates})
+        stale = []
+        for identifier, candidates in matches.items():
+            for match in candidates:
+                entity = entities[match]
+                if entity is not None and str(getattr(entity, KIND_COLUMNS[match[0]])) == identifier:
+                    resolved[identifier] = (match[0], entity)
+                    break
+            else:
+                stale.append(identifier)
+                identifier_map.remove_entities(candidates)
+        if not stale or not use_map:
+            break
+        pending = stale
+    return resolved
+
+
+def resolve_lot(identifier: str, kinds: Sequence[str] = LOT_KINDS) -> Optional[ProducerLot]:
+    """Lote por código interno o NFT ID"""
+    resolved = load_resolved([identifier], kinds).get(str(identifier))
+    return resolved[1] if resolved else None
@@ -0,0 +1,293 @@
+"""
+Importación masiva de lotes de productor para Triboka
+Lee CSV o NDJSON fila a fila, valida cada fila, inserta por bloques con
+bulk_insert_mappings y deja el registro en blockchain encolado en el outbox
+"""
+
+import csv
+import json
+import logging
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from models_simple import db, BlockchainTx, Company, ProducerLot
+from services.change_log import record_new_lot_changes
+from services.dashboard_stats import record_new_lots
+from services.entity_access import grant_access
+from services.identifiers import record_new_lot_identifiers
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ['producer_company_id', 'farm_name', 'location',
+                   'product_type', 'weight_kg', 'quality_grade', 'harvest_date']
+
+CHUNK_SIZE = 1000
+# Máximo de errores devueltos en el informe (el total se cuenta siempre)
+MAX_REPORTED_ERRORS = 1000
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+
+def iter_rows(lines: Iterable, fmt: str) -> Iterator[Tuple[int, Dict]]:
+    """Recorrer las filas de un fichero como (número de línea, dict)
+
+    Acepta líneas en bytes o texto; no carga el fichero completo en memoria.
+    """
+    text_lines = (line.decode('utf-8-sig') if isinstance(line, bytes) else line for line in lines)
+
+    if fmt == 'csv':
+        reader = csv.DictReader(text_lines)
+        for row in reader:
+            # line_num es la última línea física leída (la cabecera es la 1)
+            yield reader.line_num, {k.strip(): v for k, v in row.items() if k}
+    elif fmt == 'ndjson':
+        for line_number, line in enumerate(text_lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, {'__error__': f'JSON inválido: {e}'}
+                continue
+            if not isinstance(row, dict):
+                yield line_number, {'__error__': 'Cada línea debe ser un objeto JSON'}
+                continue
+            yield line_number, row
+    else:
+        raise ValueError(f'Formato no soportado: {fmt}')
+
+
+def _parse_certifications(value) -> List[str]:
+    if value in (None, ''):
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value).replace(';', ',').split(',') if v.strip()]
+
+
+class LotImporter:
+    """Valida e inserta lotes por bloques
+
+    `user` limita las empresas permitidas (un productor solo importa para su
+    empresa). Con dry_run solo se valida y no se escribe nada.
+    """
+
+    def __init__(self, user, integration=None, chunk_size: int = CHUNK_SIZE,
+                 dry_run: bool = False, register_on_chain: bool = True):
+        self.user = user
+        self.integration = integration
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.register_on_chain = register_on_chain and not dry_run and self._blockchain_ready()
+
+        # Marca de la importación: dos importaciones en el mismo segundo no colisionan
+        self.batch_stamp = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{uuid.uuid4().hex[:4].upper()}"
+        self._companies: Dict[int, Optional[Company]] = {}
+        self._seen_codes = set()
+        self._sequence = 0
+
+        self.total_rows = 0
+        self.imported = 0
+        self.queued_on_chain = 0
+        self.error_count = 0
+        self.errors: List[Dict] = []
+
+    def _blockchain_ready(self) -> bool:
+        integration = self.integration
+        return bool(integration is not None and integration.is_ready()
+                    and integration.nft_service.contract)
+
+    def _company(self, company_id: int) -> Optional[Company]:
+        if company_id not in self._companies:
+            self._companies[company_id] = db.session.get(Company, company_id)
+        return self._companies[company_id]
+
+    def _add_error(self, line: int, errors: List[str], lot_code: Optional[str] = None):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'lot_code': lot_code, 'errors': errors})
+
+    def validate_row(self, line: int, row: Dict) -> Tuple[Optional[Dict], List[str]]:
+        """Convertir una fila en el mapping de ProducerLot o devolver sus errores"""
+        if '__error__' in row:
+            return None, [row['__error__']]
+
+        errors = [f'Campo requerido: {field}' for field in REQUIRED_FIELDS
+                  if row.get(field) in (None, '')]
+        if errors:
+            return None, errors
+
+        company = None
+        try:
+            company_id = int(row['producer_company_id'])
+        except (TypeError, ValueError):
+            errors.append('producer_company_id debe ser un entero')
+        else:
+            if self.user.role == 'producer' and company_id != self.user.company_id:
+                errors.append('Solo puedes crear lotes para tu empresa')
+            else:
+                company = self._company(company_id)
+                if company is None:
+                    errors.append('Empresa productora no encontrada')
+
+        try:
+            weight = Decimal(str(row['weight_kg']))
+            if not weight.is_finite() or weight <= 0:
+                errors.append('weight_kg debe ser mayor que 0')
+        except InvalidOperation:
+            errors.append('weight_kg no es numérico')
+
+        moisture = None
+        if row.get('moisture_content') not in (None, ''):
+            try:
+                moisture = Decimal(str(row['moisture_content']))
+            except InvalidOperation:
+                errors.append('moisture_content no es numérico')
+
+        try:
+            harvest_date = datetime.fromisoformat(str(row['harvest_date']).replace('Z', '+00:00'))
+        except ValueError:
+            errors.append('harvest_date debe tener formato ISO 8601')
+
+        lot_code = (str(row.get('lot_code') or '').strip()) or None
+        if lot_code and lot_code in self._seen_codes:
+            errors.append(f'lot_code duplicado en el fichero: {lot_code}')
+
+        if errors:
+            return None, errors
+
+        if lot_code is None:
+            self._sequence += 1
+            lot_code = f"LOT-{company.name[:3].upper()}-{self.batch_stamp}-{company.id:03d}-{self._sequence:05d}"
+        self._seen_codes.add(lot_code)
+
+        certifications = _parse_certifications(row.get('certifications'))
+        return {
+            'lot_code': lot_code,
+            'producer_company_id': company.id,
+            'producer_name': row.get('producer_name') or company.name,
+            'farm_name': row['farm_name'],
+            'location': row['location'],
+            'product_type': row['product_type'],
+            'weight_kg': weight,
+            'moisture_content': moisture,
+            'quality_grade': row['quality_grade'],
+            'harvest_date': harvest_date,
+            'certifications': ','.join(certifications),
+            'status': 'available',
+            'created_by_user_id': self.user.id,
+            # Campos auxiliares para el outbox (se retiran antes de insertar)
+            '_line': line,
+            '_certifications': certifications,
+            '_metadata_uri': row.get('metadata_uri') or ''
+        }, []
+
+    def run(self, rows: Iterable[Tuple[int, Dict]]) -> Dict:
+        chunk = []
+        for line, row in rows:
+            self.total_rows += 1
+            mapping, errors = self.validate_row(line, row)
+            if errors:
+                self._add_error(line, errors, row.get('lot_code') or None)
+                continue
+            chunk.append(mapping)
+            if len(chunk) >= self.chunk_size:
+                self._flush_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._flush_chunk(chunk)
+
+        logger.info(f"📦 Importación de lotes: {self.imported}/{self.total_rows} filas, {self.error_count} errores")
+        return self.report()
+
+    def _flush_chunk(self, chunk: List[Dict]):
+        """Insertar un bloque en una transacción; los códigos ya existentes se rechazan"""
+        codes = [m['lot_code'] for m in chunk]
+        existing = {code for (code,) in db.session.query(ProducerLot.lot_code)
+                    .filter(ProducerLot.lot_code.in_(codes))}
+        if existing:
+            for mapping in chunk:
+                if mapping['lot_code'] in existing:
+                    self._add_error(mapping['_line'], [f"lot_code ya existe: {mapping['lot_code']}"], mapping['lot_code'])
+            chunk = [m for m in chunk if m['lot_code'] not in existing]
+            codes = [m['lot_code'] for m in chunk]
+        if not chunk or self.dry_run:
+            self.imported += len(chunk)
+            return
+
+        try:
+            db.session.bulk_insert_mappings(ProducerLot, [
+                {k: v for k, v in m.items() if not k.startswith('_')} for m in chunk
+            ])
+            ids = dict(db.session.query(ProducerLot.lot_code, ProducerLot.id)
+                       .filter(ProducerLot.lot_code.in_(codes)))
+            # bulk_insert_mappings no pasa por after_flush: proyectar el acceso,
+            # sumar los contadores del dashboard, registrar el cambio e
+            # indexar los identificadores aquí
+            grant_access(db.session.connection(), [
+                (m['producer_company_id'], 'lot', ids[m['lot_code']], 'producer') for m in chunk
+            ])
+            record_new_lots(db.session.connection(), chunk)
+            record_new_lot_changes(db.session.connection(), chunk, ids)
+            record_new_lot_identifiers(db.session.connection(), chunk, ids)
+            if self.register_on_chain:
+                self._enqueue_chunk(chunk, ids)
+            db.session.commit()
+            self.imported += len(chunk)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"❌ Error insertando bloque de {len(chunk)} lotes: {e}")
+            for mapping in chunk:
+                self._add_error(mapping['_line'], [f'Error al insertar el bloque: {e}'], mapping['lot_code'])
+
+    def _enqueue_chunk(self, chunk: List[Dict], ids: Dict[str, int]):
+        """Encolar create_lot para el bloque (lo envía el worker del outbox)"""
+        db.session.bulk_insert_mappings(BlockchainTx, [{
+            'kind': 'create_lot',
+            'entity_type': 'lot',
+            'entity_id': ids[m['lot_code']],
+            'args_json': json.dumps({
+                'producer_address': self._companies[m['producer_company_id']].blockchain_address or ZERO_ADDRESS,
+                'producer_name': self._companies[m['producer_company_id']].name,
+                'farm_name': m['farm_name'],
+                'location': m['location'],
+                'product_type': m['product_type'],
+                'weight_kg': int(m['weight_kg']),
+                'quality_grade': m['quality_grade'],
+                'harvest_date': int(m['harvest_date'].timestamp()),
+                'certifications': m['_certifications'],
+                'metadata_uri': m['_metadata_uri']
+            }),
+            'status': 'pending',
+            'attempts': 0
+        } for m in chunk])
+        self.queued_on_chain += len(chunk)
+
+    def report(self) -> Dict:
+        return {
+            'total_rows': self.total_rows,
+            'imported': self.imported,
+            'failed': self.error_count,
+            'queued_on_chain': self.queued_on_chain,
+            'dry_run': self.dry_run,
+            'errors': self.errors,
+            'errors_truncated': self.error_count > len(self.errors)
+        }
+
+
+def import_lots(lines: Iterable, fmt: str, user, integration=None, **options) -> Dict:
+    """Importar lotes desde un fichero CSV o NDJSON y devolver el informe por fila"""
+    return LotImporter(user, integration=integration, **options).run(iter_rows(lines, fmt))
+
+
+def detect_format(filename: Optional[str] = None, content_type: Optional[str] = None) -> Optional[str]:
+    """Deducir el formato por extensión o Content-Type"""
+    name = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if name.endswith('.csv') or 'text/csv' in content_type:
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type or 'jsonlines' in content_type:
+        return 'ndjson'
+    return None
@@ -0,0 +1,74 @@
+"""
+Árboles Merkle para anclaje de eventos de trazabilidad
+Hojas y nodos con prefijo de dominio (0x00 hoja, 0x01 nodo interno) para
+evitar colisiones entre ambos niveles; un nodo sin pareja sube sin rehashear
+"""
+
+import hashlib
+from typing import Dict, List, Tuple
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(event_hash: str) -> str:
+    """Hash de hoja a partir del hash SHA-256 (hex) de un evento"""
+    return hashlib.sha256(LEAF_PREFIX + bytes.fromhex(event_hash)).hexdigest()
+
+
+def node_hash(left: str, right: str) -> str:
+    return hashlib.sha256(NODE_PREFIX + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def build_tree(leaves: List[str]) -> Tuple[str, List[List[Dict]]]:
+    """Construir el árbol sobre hashes de hoja y devolver (raíz, pruebas)
+
+    pruebas[i] es la lista de hermanos desde la hoja i hasta la raíz, cada uno
+    con su posición ('left' o 'right') respecto al nodo acumulado.
+    """
+    if not leaves:
+        raise ValueError('No hay hojas para construir el árbol')
+
+    proofs = [[] for _ in leaves]
+    # positions[i] = índice actual de la hoja i en el nivel que se está procesando
+    positions = list(range(len(leaves)))
+    level = list(leaves)
+
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level), 2):
+            if i + 1 < len(level):
+                next_level.append(node_hash(level[i], level[i + 1]))
+            else:
+                next_level.append(level[i])
+
+        for leaf_index, pos in enumerate(positions):
+            sibling = pos ^ 1
+            if sibling < len(level):
+                proofs[leaf_index].append({
+                    'hash': level[sibling],
+                    'position': 'left' if sibling < pos else 'right'
+                })
+            positions[leaf_index] = pos // 2
+        level = next_level
+
+    return level[0], proofs
+
+
+def compute_root(leaf: str, proof: List[Dict]) -> str:
+    """Recalcular la raíz a partir de una hoja y su prueba de inclusión"""
+    current = leaf
+    for step in proof:
+        if step['position'] == 'left':
+            current = node_hash(step['hash'], current)
+        else:
+            current = node_hash(current, step['hash'])
+    return current
+
+
+def verify_proof(event_hash: str, proof: List[Dict], root: str) -> bool:
+    """Verificar que un evento está incluido en el árbol con la raíz dada"""
+    try:
+        return compute_root(leaf_hash(event_hash), proof) == root
+    except (ValueError, KeyError, TypeError):
+        return False
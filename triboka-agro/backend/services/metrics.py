@@ -0,0 +1,303 @@
+"""
+Registro de métricas de peticiones para PerformanceMonitor
+Histogramas de latencia con buckets fijos acumulados en memoria del proceso
+y enviados a Redis por lotes (un pipeline por intervalo)
+"""
+
+import bisect
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Buckets logarítmicos: 0.1 ms .. ~2 min con un error relativo máximo del 10%
+HISTOGRAM_MIN_SECONDS = 0.0001
+HISTOGRAM_GROWTH = 1.1
+HISTOGRAM_BUCKETS = 150
+BUCKET_BOUNDS = [HISTOGRAM_MIN_SECONDS * HISTOGRAM_GROWTH ** i for i in range(HISTOGRAM_BUCKETS)]
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+# Claves Redis: un hash agregado por endpoint y hora, y una lista de muestras
+ENDPOINTS_KEY = 'metrics:endpoints'
+AGG_KEY = 'metrics:agg:{endpoint}:{hour}'
+SAMPLES_KEY = 'metrics:endpoint:{endpoint}'
+AGG_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+def bucket_index(value: float) -> int:
+    """Índice del primer bucket cuyo límite superior contiene el valor"""
+    return min(bisect.bisect_left(BUCKET_BOUNDS, value), HISTOGRAM_BUCKETS - 1)
+
+
+def percentiles_from_buckets(buckets: Dict[int, int], quantiles: Iterable[float] = DEFAULT_QUANTILES) -> Dict[str, float]:
+    """Calcular percentiles con una sola pasada sobre los buckets (O(buckets))
+
+    El valor devuelto es el límite superior del bucket, por lo que sobreestima
+    como máximo en un 10%.
+    """
+    quantiles = tuple(quantiles)
+    total = sum(buckets.values())
+    result = {f'p{int(q * 100)}': 0.0 for q in quantiles}
+    if total == 0:
+        return result
+
+    targets = sorted((max(1, math.ceil(q * total)), q) for q in quantiles)
+    position = 0
+    cumulative = 0
+    for index in sorted(buckets):
+        cumulative += buckets[index]
+        while position < len(targets) and cumulative >= targets[position][0]:
+            result[f'p{int(targets[position][1] * 100)}'] = BUCKET_BOUNDS[index]
+            position += 1
+        if position == len(targets):
+            break
+    return result
+
+
+def _hour_key(ts: float) -> str:
+    return datetime.utcfromtimestamp(ts).strftime('%Y%m%d%H')
+
+
+class MetricsRecorder:
+    """Agregador de métricas por endpoint con envío periódico a Redis
+
+    Cada petición solo actualiza contadores en memoria bajo un lock. Un hilo en
+    segundo plano calcula cada `flush_interval` segundos los deltas desde el
+    último envío y los escribe en Redis con un único pipeline. Una fracción
+    `sample_rate` de las peticiones se conserva completa para depuración.
+    """
+
+    def __init__(self, redis_getter: Callable, flush_interval: float = 5.0,
+                 sample_rate: float = 0.01, samples_per_endpoint: int = 1000):
+        self._redis_getter = redis_getter
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.samples_per_endpoint = samples_per_endpoint
+        self.endpoints: Dict[str, Dict] = {}
+        self._flushed: Dict[str, Dict[str, float]] = {}
+        self._dirty = set()
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ------------------------------------------------------------------
+    # Camino de la petición
+    # ------------------------------------------------------------------
+
+    def record(self, endpoint_key: str, response_time: float, status_code: int,
+               user_id: Optional[int] = None):
+        """Registrar una petición en los contadores en memoria"""
+        bucket = bucket_index(response_time)
+        status = str(status_code)
+        now = time.time()
+
+        with self._lock:
+            stats = self.endpoints.get(endpoint_key)
+            if stats is None:
+                stats = self.endpoints[endpoint_key] = {
+                    'count': 0,
+                    'total_response_time': 0.0,
+                    'min_response_time': response_time,
+                    'max_response_time': response_time,
+                    'status_codes': {},
+                    'histogram': {},
+                    'last_updated': now
+                }
+            stats['count'] += 1
+            stats['total_response_time'] += response_time
+            if response_time < stats['min_response_time']:
+                stats['min_response_time'] = response_time
+            if response_time > stats['max_response_time']:
+                stats['max_response_time'] = response_time
+            stats['status_codes'][status] = stats['status_codes'].get(status, 0) + 1
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+            stats['last_updated'] = now
+            self._dirty.add(endpoint_key)
+
+            if self.sample_rate and random.random() < self.sample_rate:
+                self._samples[endpoint_key].append((now, response_time, status_code, user_id))
+
+        if self._thread is None:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Error enviando métricas a Redis: {str(e)}")
+
+    # ------------------------------------------------------------------
+    # Envío a Redis
+    # ------------------------------------------------------------------
+
+    def _take_deltas(self):
+        """Calcular deltas desde el último envío y marcarlos como enviados"""
+        with self._lock:
+            deltas = {}
+            for endpoint_key in self._dirty:
+                stats = self.endpoints.get(endpoint_key)
+                if stats is None:
+                    continue
+                current = {'count': stats['count'], 'sum': stats['total_response_time']}
+                current.update((f's:{code}', n) for code, n in stats['status_codes'].items())
+                current.update((f'b:{index}', n) for index, n in stats['histogram'].items())
+
+                previous = self._flushed.get(endpoint_key, {})
+                delta = {field: value - previous.get(field, 0) for field, value in current.items()
+                         if value != previous.get(field, 0)}
+                if delta:
+                    deltas[endpoint_key] = delta
+                self._flushed[endpoint_key] = current
+            self._dirty.clear()
+            samples, self._samples = self._samples, defaultdict(list)
+        return deltas, samples
+
+    def flush(self) -> int:
+        """Enviar los deltas pendientes a Redis en un solo pipeline
+
+        Retorna el número de peticiones enviadas. Sin Redis los deltas se
+        descartan; las métricas en memoria siguen disponibles.
+        """
+        deltas, samples = self._take_deltas()
+        if not deltas:
+            return 0
+
+        client = self._redis_getter()
+        if client is None:
+            return 0
+
+        hour = _hour_key(time.time())
+        pipe = client.pipeline(transaction=False)
+        total_requests = 0
+        status_totals = defaultdict(int)
+
+        for endpoint_key, delta in deltas.items():
+            agg_key = AGG_KEY.format(endpoint=endpoint_key, hour=hour)
+            pipe.sadd(ENDPOINTS_KEY, endpoint_key)
+            for field, amount in delta.items():
+                if field == 'sum':
+                    pipe.hincrbyfloat(agg_key, field, amount)
+                else:
+                    pipe.hincrby(agg_key, field, int(amount))
+                if field.startswith('s:'):
+                    status_totals[field[2:]] += int(amount)
+            pipe.expire(agg_key, AGG_RETENTION_SECONDS)
+            total_requests += int(delta.get('count', 0))
+
+        for status, amount in status_totals.items():
+            pipe.incrby(f"counters:requests:{status}", amount)
+            if status[0] in ('4', '5'):
+                pipe.incrby(f"counters:requests:{status[0]}xx", amount)
+        pipe.incrby("counters:requests:total", total_requests)
+
+        for endpoint_key, entries in samples.items():
+            samples_key = SAMPLES_KEY.format(endpoint=endpoint_key)
+            pipe.lpush(samples_key, *[json.dumps({
+                'timestamp': datetime.utcfromtimestamp(ts).isoformat(),
+                'response_time': response_time,
+                'status_code': status_code,
+                'user_id': user_id
+            }) for ts, response_time, status_code, user_id in entries])
+            pipe.ltrim(samples_key, 0, self.samples_per_endpoint - 1)
+
+        pipe.execute()
+        return total_requests
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+
+    def snapshot(self, endpoint_key: str) -> Optional[Dict]:
+        """Métricas en memoria de este proceso para un endpoint"""
+        with self._lock:
+            stats = self.endpoints.get(endpoint_key)
+            if stats is None:
+                return None
+            count = stats['count']
+            return {
+                'count': count,
+                'avg_response_time': stats['total_response_time'] / count if count else 0,
+                'min_response_time': stats['min_response_time'],
+                'max_response_time': stats['max_response_time'],
+                'status_codes': dict(stats['status_codes']),
+                'percentiles': percentiles_from_buckets(stats['histogram']),
+                'last_updated': datetime.utcfromtimestamp(stats['last_updated']).isoformat()
+            }
+
+    def read_aggregate(self, endpoint_keys: Iterable[str], hours: int = 24) -> Optional[Dict]:
+        """Agregado compartido en Redis de las últimas `hours` horas
+
+        Combina los hashes horarios de todos los endpoints indicados; el coste
+        es O(horas × buckets), independiente del número de peticiones.
+        """
+        client = self._redis_getter()
+        if client is None:
+            return None
+
+        now = datetime.utcnow()
+        hour_keys = [(now - timedelta(hours=h)).strftime('%Y%m%d%H') for h in range(max(hours, 1))]
+        pipe = client.pipeline(transaction=False)
+        for endpoint_key in endpoint_keys:
+            for hour in hour_keys:
+                pipe.hgetall(AGG_KEY.format(endpoint=endpoint_key, hour=hour))
+
+        count = 0
+        total = 0.0
+        buckets = defaultdict(int)
+        status_codes = defaultdict(int)
+        for raw in pipe.execute():
+            for field, value in (raw or {}).items():
+                field = field.decode() if isinstance(field, bytes) else field
+                if field == 'count':
+                    count += int(value)
+                elif field == 'sum':
+                    total += float(value)
+                elif field.startswith('b:'):
+                    buckets[int(field[2:])] += int(value)
+                elif field.startswith('s:'):
+                    status_codes[field[2:]] += int(value)
+
+        if count == 0:
+            return None
+
+        return {
+            'count': count,
+            'avg_response_time': total / count,
+            'status_codes': dict(status_codes),
+            'percentiles': percentiles_from_buckets(buckets),
+            'period_hours': hours
+        }
+
+    def registered_endpoints(self) -> List[str]:
+        """Endpoints con métricas registradas en Redis"""
+        client = self._redis_getter()
+        if client is None:
+            return sorted(self.endpoints)
+        return sorted(client.smembers(ENDPOINTS_KEY))
+
+    def reset(self):
+        """Vaciar las métricas en memoria (no afecta a Redis)"""
+        with self._lock:
+            self.endpoints.clear()
+            self._flushed.clear()
+            self._dirty.clear()
+            self._samples.clear()
+
+    def stop(self):
+        self._stop.set()
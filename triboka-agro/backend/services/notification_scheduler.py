@@ -0,0 +1,320 @@
+"""
+Planificador de alertas del servidor de notificaciones de Triboka
+Cada alerta (contrato por vencer, lote sin asignar) se programa en una cola de
+prioridad por fecha de vencimiento; el hilo duerme hasta la próxima alerta o
+hasta el siguiente refresco, y en cada despertar solo lee las filas vencidas
+(por PK) y las modificadas desde el último refresco (índice en updated_at).
+notification_dedup guarda la última alerta enviada por (category, entity_id).
+
+updated_at se asigna antes del commit: una transacción lenta (p. ej. una
+importación masiva) puede confirmar filas con un updated_at anterior a otras
+ya leídas. Cada refresco relee también los últimos `watermark_overlap`
+segundos antes de la marca, así esas filas se programan igualmente siempre
+que confirmen dentro de ese margen (releer una fila ya programada no cambia nada).
+"""
+
+import heapq
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, int]  # (category, entity_id)
+
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Timestamp de SQLite ('YYYY-MM-DD HH:MM:SS[.ffffff]') a datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+class AlertRule:
+    """Regla de alerta: tabla de origen, cuándo vence y qué notificación genera"""
+
+    category = None
+    table = None
+    columns = []
+    company_column = None
+    cooldown = timedelta(days=1)  # Repetición mientras la condición se mantenga
+    notification_type = 'info'
+    priority = 1
+
+    def select_sql(self, where: str) -> str:
+        return f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE {where}"
+
+    def eligible(self, row: Dict) -> bool:
+        raise NotImplementedError
+
+    def due_at(self, row: Dict) -> Optional[datetime]:
+        raise NotImplementedError
+
+    def build(self, row: Dict, now: datetime) -> Tuple[str, str, Dict]:
+        """(título, mensaje, data) de la notificación"""
+        raise NotImplementedError
+
+
+class ContractExpiryRule(AlertRule):
+    """Contratos activos a 5 días o menos de su delivery_date"""
+
+    category = 'contract_expiry'
+    table = 'export_contracts'
+    columns = ['id', 'contract_code', 'delivery_date', 'status', 'exporter_company_id', 'updated_at']
+    company_column = 'exporter_company_id'
+    notice = timedelta(days=5)
+    cooldown = timedelta(days=1)
+    notification_type = 'warning'
+    priority = 3
+
+    def eligible(self, row):
+        return row['status'] == 'active' and parse_timestamp(row['delivery_date']) is not None
+
+    def due_at(self, row):
+        return parse_timestamp(row['delivery_date']) - self.notice
+
+    def build(self, row, now):
+        days_left = (parse_timestamp(row['delivery_date']) - now).days
+        return (f"Contrato próximo a vencer: {row['contract_code']}",
+                f"El contrato {row['contract_code']} vence en {days_left} días. Revisa el estado de las fijaciones.",
+                {'contract_id': row['id'], 'days_left': days_left})
+
+
+class LotUnassignedRule(AlertRule):
+    """Lotes disponibles 7 días después de su creación"""
+
+    category = 'lot_unassigned'
+    table = 'producer_lots'
+    columns = ['id', 'lot_code', 'created_at', 'status', 'producer_company_id', 'updated_at']
+    company_column = 'producer_company_id'
+    unassigned_after = timedelta(days=7)
+    cooldown = timedelta(days=3)
+    notification_type = 'info'
+    priority = 2
+
+    def eligible(self, row):
+        return row['status'] == 'available' and parse_timestamp(row['created_at']) is not None
+
+    def due_at(self, row):
+        return parse_timestamp(row['created_at']) + self.unassigned_after
+
+    def build(self, row, now):
+        return (f"Lote sin asignar: {row['lot_code']}",
+                f"El lote {row['lot_code']} lleva más de 7 días sin ser asignado a un contrato.",
+                {'lot_id': row['id']})
+
+
+DEFAULT_RULES = [ContractExpiryRule(), LotUnassignedRule()]
+
+
+class NotificationScheduler:
+    """Cola de alertas por fecha de vencimiento con deduplicación por (category, entity_id)
+
+    notify(user_ids, title, message, type, category, data, priority=...) crea la
+    notificación para todos los usuarios de la empresa en un solo lote;
+    connect() abre la conexión SQLite del hilo del planificador.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], notify: Callable,
+                 rules: Optional[List[AlertRule]] = None, refresh_interval: float = 5.0,
+                 clock: Callable[[], datetime] = datetime.utcnow, watermark_overlap: float = 60.0):
+        self.connect = connect
+        self.notify = notify
+        self.rules = {rule.category: rule for rule in (rules or DEFAULT_RULES)}
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.watermark_overlap = timedelta(seconds=watermark_overlap)
+        self._heap: List[Tuple[datetime, str, int]] = []
+        self._scheduled: Dict[Key, datetime] = {}
+        self._fired: Dict[Key, datetime] = {}
+        self._watermarks: Dict[str, str] = {}
+        self._wake = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- Cola de prioridad ---
+
+    def schedule(self, category: str, entity_id: int, due_at: datetime):
+        """Programar (o reprogramar) la revisión de una entidad"""
+        key = (category, int(entity_id))
+        with self._wake:
+            if self._scheduled.get(key) == due_at:
+                return
+            self._scheduled[key] = due_at
+            heapq.heappush(self._heap, (due_at, category, int(entity_id)))
+            # Las entradas reprogramadas quedan obsoletas en el heap: compactar
+            if len(self._heap) > 2 * len(self._scheduled) + 64:
+                self._heap = [(due, c, e) for (c, e), due in self._scheduled.items()]
+                heapq.heapify(self._heap)
+            self._wake.notify()
+
+    def unschedule(self, category: str, entity_id: int):
+        with self._wake:
+            self._scheduled.pop((category, int(entity_id)), None)
+
+    def touch(self, category: str, entity_id: int):
+        """Revisar una entidad cuanto antes (p. ej. tras cambiarla en otro proceso)"""
+        self.schedule(category, entity_id, self.clock())
+
+    def pending(self) -> int:
+        return len(self._scheduled)
+
+    def next_due(self) -> Optional[datetime]:
+        with self._wake:
+            while self._heap and self._scheduled.get(self._heap[0][1:]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now: datetime) -> List[Key]:
+        due = []
+        with self._wake:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, category, entity_id = heapq.heappop(self._heap)
+                key = (category, entity_id)
+                if self._scheduled.get(key) == due_at:
+                    del self._scheduled[key]
+                    due.append(key)
+        return due
+
+    # --- Carga y refresco desde la base de datos ---
+
+    @staticmethod
+    def ensure_schema(conn: sqlite3.Connection):
+        """Tabla de deduplicación e índices para leer solo las filas modificadas"""
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS notification_dedup (
+                category TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                fired_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (category, entity_id)
+            )
+        ''')
+        for table in ('export_contracts', 'producer_lots'):
+            try:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_updated_at ON {table} (updated_at)')
+            except sqlite3.OperationalError as e:
+                logger.warning(f"No se pudo indexar {table}.updated_at: {e}")
+        conn.commit()
+
+    def _plan(self, rule: AlertRule, row: Dict):
+        """Programar la fila según la regla (o sacarla de la cola si ya no aplica)"""
+        if not rule.eligible(row):
+            self.unschedule(rule.category, row['id'])
+            return
+        due = rule.due_at(row)
+        last_fired = self._fired.get((rule.category, row['id']))
+        if last_fired is not None:
+            due = max(due, last_fired + rule.cooldown)
+        self.schedule(rule.category, row['id'], due)
+
+    def _rows(self, conn, rule: AlertRule, where: str, params=()) -> List[Dict]:
+        cursor = conn.execute(rule.select_sql(where), params)
+        return [dict(zip(rule.columns, row)) for row in cursor.fetchall()]
+
+    def _advance_watermark(self, rule: AlertRule, rows: List[Dict]):
+        stamps = [str(row['updated_at']) for row in rows if row['updated_at'] is not None]
+        if stamps:
+            self._watermarks[rule.category] = max([self._watermarks.get(rule.category, ''), *stamps])
+
+    def load(self, conn: sqlite3.Connection):
+        """Carga inicial: deduplicación y todas las filas candidatas (una sola vez)"""
+        self.ensure_schema(conn)
+        for category, entity_id, fired_at in conn.execute(
+                'SELECT category, entity_id, fired_at FROM notification_dedup'):
+            self._fired[(category, entity_id)] = parse_timestamp(fired_at)
+        for rule in self.rules.values():
+            rows = self._rows(conn, rule, '1 = 1')
+            for row in rows:
+                self._plan(rule, row)
+            self._advance_watermark(rule, rows)
+        logger.info(f"🔔 {self.pending()} alertas programadas")
+
+    def _refresh_since(self, rule: AlertRule) -> str:
+        """Marca del último refresco menos el margen de solapamiento"""
+        watermark = parse_timestamp(self._watermarks.get(rule.category))
+        if watermark is None:
+            return self._watermarks.get(rule.category, '')
+        return (watermark - self.watermark_overlap).isoformat(sep=' ')
+
+    def refresh(self, conn: sqlite3.Connection) -> int:
+        """Reprogramar las filas modificadas desde el último refresco (con solapamiento)"""
+        changed = 0
+        for rule in self.rules.values():
+            rows = self._rows(conn, rule, 'updated_at >= ?', (self._refresh_since(rule),))
+            for row in rows:
+                self._plan(rule, row)
+            self._advance_watermark(rule, rows)
+            changed += len(rows)
+        return changed
+
+    # --- Disparo ---
+
+    def run_due(self, conn: sqlite3.Connection, now: Optional[datetime] = None) -> int:
+        """Enviar las alertas vencidas; devuelve cuántas notificaciones se crearon"""
+        now = now or self.clock()
+        sent = 0
+        for category, entity_id in self._pop_due(now):
+            rule = self.rules[category]
+            rows = self._rows(conn, rule, 'id = ?', (entity_id,))
+            if not rows or not rule.eligible(rows[0]):
+                continue
+            row = rows[0]
+            self._plan(rule, row)
+            if self._scheduled.get((category, entity_id), now) > now:
+                continue  # Aún no vence (cambió la fecha o está en cooldown)
+
+            title, message, data = rule.build(row, now)
+            user_ids = [user_id for (user_id,) in conn.execute('SELECT id FROM users WHERE company_id = ?',
+                                                               (row[rule.company_column],)).fetchall()]
+            if user_ids:
+                self.notify(user_ids, title, message, rule.notification_type, category, data,
+                            priority=rule.priority)
+                sent += len(user_ids)
+
+            conn.execute('INSERT OR REPLACE INTO notification_dedup (category, entity_id, fired_at) VALUES (?, ?, ?)',
+                         (category, entity_id, now.isoformat(sep=' ')))
+            conn.commit()
+            self._fired[(category, entity_id)] = now
+            self.schedule(category, entity_id, now + rule.cooldown)
+        return sent
+
+    # --- Hilo ---
+
+    def start(self):
+        with self._wake:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='notification-scheduler', daemon=True)
+        self._thread.start()
+        logger.info(f"🔔 Planificador de alertas activo (refresco cada {self.refresh_interval}s)")
+
+    def _run(self):
+        conn = self.connect()
+        try:
+            self.load(conn)
+            while not self._stop.is_set():
+                try:
+                    self.refresh(conn)
+                    self.run_due(conn)
+                except Exception as e:
+                    logger.error(f"❌ Error generando alertas: {e}")
+
+                # Dormir hasta la próxima alerta, el siguiente refresco o un schedule()
+                next_due = self.next_due()
+                timeout = self.refresh_interval
+                if next_due is not None:
+                    timeout = max(0.0, min(timeout, (next_due - self.clock()).total_seconds()))
+                with self._wake:
+                    self._wake.wait(timeout)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop.set()
+        with self._wake:
+            self._wake.notify()
@@ -0,0 +1,224 @@
+"""
+Aplicación de mutaciones offline de la app móvil de Triboka
+/api/sync/sync/push recibe la cola offline del cliente en un solo lote; cada
+mutación lleva un mutation_id generado en el dispositivo y se aplica en su
+propio savepoint. El resultado se guarda en sync_mutations, de modo que
+reenviar la cola (p. ej. tras perder la respuesta) no duplica nada.
+"""
+
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, List, Optional
+
+from models_simple import db, Company, ExportContract, ProducerLot, SyncMutation
+from services.lot_import import LotImporter
+
+logger = logging.getLogger(__name__)
+
+MAX_MUTATIONS = 500
+
+CONTRACT_REQUIRED_FIELDS = ['buyer_company_id', 'exporter_company_id', 'contract_code',
+                            'product_type', 'product_grade', 'total_volume_mt',
+                            'differential_usd', 'start_date', 'end_date', 'delivery_date']
+CONTRACT_UPDATABLE_FIELDS = ['product_type', 'product_grade', 'total_volume_mt',
+                             'differential_usd', 'start_date', 'end_date', 'delivery_date']
+LOT_UPDATABLE_FIELDS = ['farm_name', 'location', 'product_type', 'weight_kg', 'quality_grade',
+                        'moisture_content', 'harvest_date', 'certifications']
+DATE_FIELDS = {'start_date', 'end_date', 'delivery_date', 'harvest_date'}
+DECIMAL_FIELDS = {'total_volume_mt', 'differential_usd', 'weight_kg', 'moisture_content'}
+
+
+class MutationRejected(Exception):
+    """Mutación inválida o sin permisos (se registra como rejected)"""
+
+
+class MutationConflict(Exception):
+    """La entidad cambió en el servidor desde que el cliente la leyó"""
+
+    def __init__(self, current: Dict):
+        super().__init__('La entidad cambió en el servidor')
+        self.current = current
+
+
+def _parse_value(field: str, value):
+    if value in (None, ''):
+        return None
+    try:
+        if field in DATE_FIELDS:
+            return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if field in DECIMAL_FIELDS:
+            return Decimal(str(value))
+    except (ValueError, InvalidOperation):
+        raise MutationRejected(f'Valor inválido para {field}: {value}')
+    if field == 'certifications' and isinstance(value, list):
+        return ','.join(str(v).strip() for v in value if str(v).strip())
+    return value
+
+
+def _check_version(obj, data: Dict):
+    """Control optimista: expected_updated_at debe coincidir con el del servidor"""
+    expected = data.get('expected_updated_at')
+    if expected and obj.updated_at and obj.updated_at.isoformat() != expected:
+        raise MutationConflict(obj.to_dict())
+
+
+# Tags de cache que invalidan los endpoints REST al modificar cada entidad
+CACHE_TAGS = {'lot': 'lots', 'contract': 'contracts'}
+
+
+def changed_cache_tags(results: List[Dict]) -> List[str]:
+    """Tags a invalidar tras aplicar un lote (solo mutaciones aplicadas ahora)"""
+    return sorted({CACHE_TAGS[r['entity']] for r in results
+                   if r['status'] == 'applied' and not r.get('duplicate') and r.get('entity') in CACHE_TAGS})
+
+
+class OfflineMutationApplier:
+    """Aplica un lote de mutaciones de un usuario (el commit lo hace quien llama)"""
+
+    def __init__(self, user):
+        self.user = user
+        # Un solo importador por lote: códigos de lote únicos entre mutaciones
+        self.lot_importer = LotImporter(user, dry_run=True)
+        self.handlers: Dict[tuple, Callable] = {
+            ('lot', 'create'): self._create_lot,
+            ('lot', 'update'): self._update_lot,
+            ('contract', 'create'): self._create_contract,
+            ('contract', 'update'): self._update_contract,
+        }
+
+    # --- Handlers: devuelven el id de la entidad ---
+
+    def _create_lot(self, entity_id, data: Dict, index: int) -> int:
+        if self.user.role not in ['admin', 'operator', 'producer']:
+            raise MutationRejected('Sin permisos para crear lotes')
+        mapping, errors = self.lot_importer.validate_row(index, data)
+        if errors:
+            raise MutationRejected('; '.join(errors))
+        if ProducerLot.query.filter_by(lot_code=mapping['lot_code']).first():
+            raise MutationRejected(f"lot_code ya existe: {mapping['lot_code']}")
+        lot = ProducerLot(**{k: v for k, v in mapping.items() if not k.startswith('_')})
+        db.session.add(lot)
+        db.session.flush()
+        return lot.id
+
+    def _update_lot(self, entity_id, data: Dict, index: int) -> int:
+        lot = db.session.get(ProducerLot, entity_id) if entity_id else None
+        if lot is None:
+            raise MutationRejected('Lote no encontrado')
+        if self.user.role not in ['admin', 'operator'] and lot.producer_company_id != self.user.company_id:
+            raise MutationRejected('Solo puedes modificar lotes de tu empresa')
+        if lot.status != 'available':
+            raise MutationRejected('Solo se pueden modificar lotes disponibles')
+        _check_version(lot, data)
+        for field in LOT_UPDATABLE_FIELDS:
+            if field in data:
+                setattr(lot, field, _parse_value(field, data[field]))
+        if lot.weight_kg is None or lot.weight_kg <= 0:
+            raise MutationRejected('weight_kg debe ser mayor que 0')
+        db.session.flush()
+        return lot.id
+
+    def _create_contract(self, entity_id, data: Dict, index: int) -> int:
+        if self.user.role not in ['admin', 'operator', 'exporter', 'buyer']:
+            raise MutationRejected('Sin permisos para crear contratos')
+        missing = [field for field in CONTRACT_REQUIRED_FIELDS if field not in data]
+        if missing:
+            raise MutationRejected(f"Campos requeridos: {', '.join(missing)}")
+        if not db.session.get(Company, data['buyer_company_id']) or \
+                not db.session.get(Company, data['exporter_company_id']):
+            raise MutationRejected('Empresa no encontrada')
+        if self.user.role == 'exporter' and data['exporter_company_id'] != self.user.company_id:
+            raise MutationRejected('Solo puedes crear contratos como exportadora')
+        if self.user.role == 'buyer' and data['buyer_company_id'] != self.user.company_id:
+            raise MutationRejected('Solo puedes crear contratos como comprador')
+        if ExportContract.query.filter_by(contract_code=data['contract_code']).first():
+            raise MutationRejected(f"contract_code ya existe: {data['contract_code']}")
+
+        contract = ExportContract(
+            buyer_company_id=data['buyer_company_id'],
+            exporter_company_id=data['exporter_company_id'],
+            contract_code=data['contract_code'],
+            # Borrador como en /api/contracts: editable desde la app hasta
+            # activarlo, momento en que se encola su registro en blockchain
+            status='draft',
+            created_by_user_id=self.user.id,
+            **{field: _parse_value(field, data[field]) for field in CONTRACT_UPDATABLE_FIELDS}
+        )
+        db.session.add(contract)
+        db.session.flush()
+        return contract.id
+
+    def _update_contract(self, entity_id, data: Dict, index: int) -> int:
+        contract = db.session.get(ExportContract, entity_id) if entity_id else None
+        if contract is None:
+            raise MutationRejected('Contrato no encontrado')
+        if self.user.role != 'admin' and contract.created_by_user_id != self.user.id:
+            raise MutationRejected('Solo el creador del contrato o un admin pueden modificarlo')
+        if contract.status != 'draft':
+            raise MutationRejected('Solo se pueden modificar contratos en borrador')
+        _check_version(contract, data)
+        for field in CONTRACT_UPDATABLE_FIELDS:
+            if field in data:
+                setattr(contract, field, _parse_value(field, data[field]))
+        if contract.end_date and contract.start_date and contract.end_date <= contract.start_date:
+            raise MutationRejected('end_date debe ser posterior a start_date')
+        db.session.flush()
+        return contract.id
+
+    # --- Lote ---
+
+    def apply(self, mutations: List[Dict]) -> List[Dict]:
+        """Aplicar las mutaciones en orden; devuelve un resultado por mutación"""
+        mutation_ids = {str(m.get('mutation_id')) for m in mutations if m.get('mutation_id')}
+        done = {record.mutation_id: record for record in SyncMutation.query.filter(
+            SyncMutation.user_id == self.user.id, SyncMutation.mutation_id.in_(mutation_ids))} if mutation_ids else {}
+
+        results = []
+        for index, mutation in enumerate(mutations, start=1):
+            mutation_id = str(mutation.get('mutation_id') or '')[:64]
+            if not mutation_id:
+                results.append({'mutation_id': None, 'status': 'rejected', 'error': 'mutation_id requerido'})
+                continue
+            if mutation_id in done:
+                results.append({**json.loads(done[mutation_id].result_json), 'duplicate': True})
+                continue
+
+            result = self._apply_one(mutation_id, mutation, index)
+            record = SyncMutation(
+                user_id=self.user.id,
+                mutation_id=mutation_id,
+                entity_type=str(mutation.get('entity') or '')[:20],
+                entity_id=result.get('entity_id'),
+                status=result['status'],
+                result_json=json.dumps(result, default=str)
+            )
+            db.session.add(record)
+            done[mutation_id] = record
+            results.append(result)
+        return results
+
+    def _apply_one(self, mutation_id: str, mutation: Dict, index: int) -> Dict:
+        entity, operation = mutation.get('entity'), mutation.get('op')
+        result = {'mutation_id': mutation_id, 'entity': entity, 'op': operation}
+        handler = self.handlers.get((entity, operation))
+        if handler is None:
+            return {**result, 'status': 'rejected', 'error': f'Operación no soportada: {entity}/{operation}'}
+
+        savepoint = db.session.begin_nested()
+        try:
+            entity_id = handler(mutation.get('entity_id'), mutation.get('data') or {}, index)
+            savepoint.commit()
+            return {**result, 'status': 'applied', 'entity_id': entity_id}
+        except MutationConflict as e:
+            savepoint.rollback()
+            return {**result, 'status': 'conflict', 'entity_id': mutation.get('entity_id'),
+                    'error': str(e), 'current': e.current}
+        except MutationRejected as e:
+            savepoint.rollback()
+            return {**result, 'status': 'rejected', 'entity_id': mutation.get('entity_id'), 'error': str(e)}
+
+
+def apply_offline_mutations(user, mutations: List[Dict]) -> List[Dict]:
+    return OfflineMutationApplier(user).apply(mutations)
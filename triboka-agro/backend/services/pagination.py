@@ -0,0 +1,113 @@
+"""
+Paginación por cursor (keyset) para listados grandes
+Evita OFFSET: cada página se obtiene con un rango sobre un índice compuesto,
+en dos fases (valores no NULL y cola de NULLs) para no combinar rangos con OR
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(sort_value, row_id):
+    """Codificar la posición (valor de orden, id) de la última fila en un cursor opaco"""
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    payload = json.dumps([sort_value, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, as_datetime=True):
+    """Decodificar un cursor generado por encode_cursor
+
+    Retorna una tupla (sort_value, row_id). Lanza ValueError si el cursor es inválido.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if as_datetime and sort_value is not None:
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, int(row_id)
+    except Exception:
+        raise ValueError('Cursor de paginación inválido')
+
+
+def order_keyset(query, sort_column, id_column, descending=True):
+    """Ordenar por (sort_column, id_column) con los NULL de sort_column al final"""
+    if descending:
+        return query.order_by(sort_column.desc().nulls_last(), id_column.desc())
+    return query.order_by(sort_column.asc().nulls_last(), id_column.asc())
+
+
+def _null_tail(query, sort_column, id_column, row_id=None, descending=True):
+    """Fase de la cola de NULLs: solo avanza por id"""
+    query = query.filter(sort_column.is_(None))
+    if row_id is not None:
+        query = query.filter(id_column < row_id if descending else id_column > row_id)
+    return query.order_by(id_column.desc() if descending else id_column.asc())
+
+
+def keyset_phases(query, sort_column, id_column, cursor=None, descending=True):
+    """Consultas a recorrer en orden para leer desde el cursor sobre (sort_column, id_column)
+
+    Sin cursor es una sola consulta (NULLs al final). Con cursor, los valores
+    no NULL posteriores y la cola de NULLs son fases separadas, cada una un
+    rango simple sobre el índice en lugar de un OR con IS NULL. Lanza
+    ValueError si el cursor es inválido.
+    """
+    if not cursor:
+        return [order_keyset(query, sort_column, id_column, descending)]
+
+    sort_value, row_id = decode_cursor(cursor)
+    if sort_value is None:
+        # Ya estamos en la cola de NULLs
+        return [_null_tail(query, sort_column, id_column, row_id, descending)]
+
+    position = tuple_(sort_column, id_column)
+    bound = tuple_(sort_value, row_id, types=(sort_column.type, id_column.type))
+    after = query.filter(position < bound if descending else position > bound)
+    return [order_keyset(after, sort_column, id_column, descending),
+            _null_tail(query, sort_column, id_column, descending=descending)]
+
+
+def read_phases(phases, limit):
+    """Leer hasta limit filas recorriendo las fases en orden"""
+    rows = []
+    for phase in phases:
+        if len(rows) >= limit:
+            break
+        rows.extend(phase.limit(limit - len(rows)).all())
+    return rows
+
+
+def iter_phases(phases, limit=None, batch_size=500):
+    """Iterar las filas de las fases en orden (hasta limit filas) sin cargarlas todas"""
+    remaining = limit
+    for phase in phases:
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            phase = phase.limit(remaining)
+        for row in phase.yield_per(batch_size):
+            if remaining is not None:
+                remaining -= 1
+            yield row
+
+
+def fetch_page(phases, limit, sort_attr, id_attr='id'):
+    """Leer una página de las fases del keyset y calcular el siguiente cursor
+
+    Lee limit + 1 filas para saber si existe una página siguiente sin COUNT(*).
+    """
+    rows = read_phases(phases, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, sort_attr), getattr(last, id_attr))
+
+    return rows, next_cursor
@@ -0,0 +1,353 @@
+"""
+Price feed de mercado para Triboka
+Sondea una fuente de precios (Yahoo Finance, CSV o stub) en segundo plano,
+persiste las barras diarias en price_ticks y sirve un snapshot precalculado
+para que los endpoints nunca esperen una llamada HTTP externa
+"""
+
+import csv
+import logging
+import os
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+
+from models_simple import db, PriceTick
+
+logger = logging.getLogger(__name__)
+
+# CC=F cotiza en USD por tonelada corta (2000 lbs); 1 tonelada métrica = 2204.62 lbs
+SHORT_TON_TO_MT = 2204.62 / 2000.0
+DEFAULT_SYMBOL = 'CC=F'
+DEFAULT_SPOT_PRICE = 3250.0
+DEFAULT_VOLATILITY = 15.0
+
+
+# ========================================
+# FUENTES DE PRECIOS
+# ========================================
+
+class PriceSource:
+    """Fuente de barras diarias de precio
+
+    fetch() retorna una lista de dicts con observed_at (datetime) y
+    open/high/low/close en USD por tonelada métrica, en orden cronológico.
+    """
+
+    name = 'base'
+
+    def fetch(self, symbol: str, full: bool = False) -> List[Dict]:
+        raise NotImplementedError
+
+
+class YahooPriceSource(PriceSource):
+    """Futuros de cacao desde Yahoo Finance (requiere yfinance)"""
+
+    name = 'yahoo'
+
+    def fetch(self, symbol: str, full: bool = False) -> List[Dict]:
+        import yfinance as yf
+
+        hist = yf.Ticker(symbol).history(period='1y' if full else '5d')
+        bars = []
+        for index, row in hist.iterrows():
+            bars.append({
+                'observed_at': datetime(index.year, index.month, index.day),
+                'open': float(row['Open']) * SHORT_TON_TO_MT,
+                'high': float(row['High']) * SHORT_TON_TO_MT,
+                'low': float(row['Low']) * SHORT_TON_TO_MT,
+                'close': float(row['Close']) * SHORT_TON_TO_MT
+            })
+        return bars
+
+
+class CsvPriceSource(PriceSource):
+    """Reproducción de un CSV con columnas date,open,high,low,close (USD/MT)
+
+    Con replay_step cada sondeo libera las siguientes N filas, simulando un
+    feed en vivo; sin él se devuelve el archivo completo.
+    """
+
+    name = 'csv'
+
+    def __init__(self, path: str, replay_step: Optional[int] = None):
+        self.path = path
+        self.replay_step = replay_step
+        self._rows = None
+        self._cursor = 0
+
+    def _load(self) -> List[Dict]:
+        if self._rows is None:
+            with open(self.path, newline='') as f:
+                self._rows = [{
+                    'observed_at': datetime.fromisoformat(row['date']),
+                    'open': float(row.get('open') or row['close']),
+                    'high': float(row.get('high') or row['close']),
+                    'low': float(row.get('low') or row['close']),
+                    'close': float(row['close'])
+                } for row in csv.DictReader(f)]
+        return self._rows
+
+    def fetch(self, symbol: str, full: bool = False) -> List[Dict]:
+        rows = self._load()
+        if self.replay_step is None:
+            return rows
+        start = self._cursor
+        self._cursor = min(len(rows), self._cursor + self.replay_step)
+        return rows[start:self._cursor]
+
+
+class StubPriceSource(PriceSource):
+    """Fuente local determinista para tests y entornos sin red"""
+
+    name = 'stub'
+
+    def __init__(self, price: float = DEFAULT_SPOT_PRICE, previous_price: Optional[float] = None):
+        self.price = price
+        self.previous_price = previous_price if previous_price is not None else price
+
+    def fetch(self, symbol: str, full: bool = False) -> List[Dict]:
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return [
+            {'observed_at': today - timedelta(days=1), 'open': self.previous_price, 'high': self.previous_price,
+             'low': self.previous_price, 'close': self.previous_price},
+            {'observed_at': today, 'open': self.previous_price, 'high': max(self.price, self.previous_price),
+             'low': min(self.price, self.previous_price), 'close': self.price}
+        ]
+
+
+def get_price_source(name: Optional[str] = None) -> PriceSource:
+    """Crear la fuente configurada en PRICE_FEED_SOURCE (yahoo por defecto)"""
+    name = (name or os.getenv('PRICE_FEED_SOURCE', 'yahoo')).lower()
+    if name == 'csv':
+        step = os.getenv('PRICE_FEED_CSV_REPLAY_STEP')
+        return CsvPriceSource(os.getenv('PRICE_FEED_CSV_PATH', 'price_ticks.csv'),
+                              replay_step=int(step) if step else None)
+    if name == 'stub':
+        return StubPriceSource()
+    return YahooPriceSource()
+
+
+# ========================================
+# SERVICIO DE PRICE FEED
+# ========================================
+
+class PriceFeedService:
+    """Sondeo periódico de una fuente de precios con snapshot en memoria
+
+    - poll_once() inserta barras nuevas y actualiza la del día en curso.
+    - latest_snapshot() se calcula con agregados SQL y se reutiliza durante
+      snapshot_ttl segundos o hasta el siguiente sondeo con cambios.
+    - El snapshot incluye metadatos de antigüedad para que el cliente sepa
+      si el precio está desactualizado.
+    """
+
+    def __init__(self, source: PriceSource, symbol: str = DEFAULT_SYMBOL,
+                 interval: float = 300, stale_after: Optional[float] = None,
+                 snapshot_ttl: float = 60):
+        self.source = source
+        self.symbol = symbol
+        self.interval = interval
+        self.stale_after = stale_after if stale_after is not None else interval * 3
+        self.snapshot_ttl = snapshot_ttl
+        self.last_poll_at = None
+        self.last_error = None
+        self._backfilled = False
+        self._snapshot = None
+        self._snapshot_built_at = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def poll_once(self) -> int:
+        """Consultar la fuente y guardar las barras (requiere app context)
+
+        Retorna el número de barras insertadas o actualizadas.
+        """
+        try:
+            bars = self.source.fetch(self.symbol, full=not self._backfilled)
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"❌ Error obteniendo precios de {self.source.name}: {str(e)}")
+            return 0
+
+        now = datetime.utcnow()
+        changed = 0
+        if bars:
+            existing = {
+                tick.observed_at: tick for tick in PriceTick.query.filter(
+                    PriceTick.symbol == self.symbol,
+                    PriceTick.source == self.source.name,
+                    PriceTick.observed_at.in_([bar['observed_at'] for bar in bars])
+                )
+            }
+            for bar in bars:
+                tick = existing.get(bar['observed_at'])
+                if tick is None:
+                    tick = PriceTick(symbol=self.symbol, source=self.source.name, observed_at=bar['observed_at'])
+                    db.session.add(tick)
+                    existing[bar['observed_at']] = tick
+                tick.open_usd_mt = round(bar['open'], 2)
+                tick.high_usd_mt = round(bar['high'], 2)
+                tick.low_usd_mt = round(bar['low'], 2)
+                tick.close_usd_mt = round(bar['close'], 2)
+                tick.fetched_at = now
+                changed += 1
+            db.session.commit()
+
+        self._backfilled = True
+        self.last_poll_at = now
+        self.last_error = None
+        if changed:
+            self.invalidate()
+            logger.info(f"✅ Price feed {self.source.name}: {changed} barras de {self.symbol} guardadas")
+        return changed
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def latest_snapshot(self) -> Dict:
+        """Último precio spot, rango anual y volatilidad con metadatos de antigüedad"""
+        with self._lock:
+            if self._snapshot is not None and time.monotonic() - self._snapshot_built_at < self.snapshot_ttl:
+                snapshot = self._snapshot
+            else:
+                snapshot = None
+
+        if snapshot is None:
+            snapshot = self._build_snapshot()
+            with self._lock:
+                self._snapshot = snapshot
+                self._snapshot_built_at = time.monotonic()
+
+        # La antigüedad se recalcula en cada lectura
+        result = dict(snapshot)
+        fetched_at = snapshot['_fetched_at']
+        age = (datetime.utcnow() - fetched_at).total_seconds() if fetched_at else None
+        result.pop('_fetched_at')
+        result['staleness'] = {
+            'as_of': snapshot['_as_of'],
+            'fetched_at': fetched_at.isoformat() if fetched_at else None,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'stale': age is None or age > self.stale_after,
+            'stale_after_seconds': self.stale_after,
+            'last_error': self.last_error
+        }
+        result.pop('_as_of')
+        return result
+
+    def _build_snapshot(self) -> Dict:
+        base = PriceTick.query.filter(PriceTick.symbol == self.symbol, PriceTick.source == self.source.name)
+        latest_two = base.order_by(PriceTick.observed_at.desc()).limit(2).all()
+
+        if not latest_two:
+            return {
+                'spot': self._spot(DEFAULT_SPOT_PRICE, 0.0, 'default'),
+                'market': {
+                    'rangeMin': round(DEFAULT_SPOT_PRICE * 0.85, 2),
+                    'rangeMax': round(DEFAULT_SPOT_PRICE * 1.30, 2),
+                    'volatility': DEFAULT_VOLATILITY
+                },
+                '_as_of': None,
+                '_fetched_at': None
+            }
+
+        latest = latest_two[0]
+        spot_price = float(latest.close_usd_mt)
+        daily_change = 0.0
+        if len(latest_two) > 1 and float(latest_two[1].close_usd_mt) > 0:
+            prev_price = float(latest_two[1].close_usd_mt)
+            daily_change = (spot_price - prev_price) / prev_price * 100
+
+        # Rango de 52 semanas y último fetch con agregados SQL
+        year_start = latest.observed_at - timedelta(days=365)
+        year_low, year_high, fetched_at = db.session.query(
+            func.min(PriceTick.low_usd_mt),
+            func.max(PriceTick.high_usd_mt),
+            func.max(PriceTick.fetched_at)
+        ).filter(
+            PriceTick.symbol == self.symbol,
+            PriceTick.source == self.source.name,
+            PriceTick.observed_at >= year_start
+        ).one()
+
+        # Volatilidad anualizada sobre los cierres diarios (≈252 filas)
+        closes = [float(c) for (c,) in db.session.query(PriceTick.close_usd_mt).filter(
+            PriceTick.symbol == self.symbol,
+            PriceTick.source == self.source.name,
+            PriceTick.observed_at >= year_start
+        ).order_by(PriceTick.observed_at)]
+        returns = [(b - a) / a for a, b in zip(closes, closes[1:]) if a]
+        volatility = statistics.stdev(returns) * 100 * (252 ** 0.5) if len(returns) > 1 else DEFAULT_VOLATILITY
+
+        return {
+            'spot': self._spot(spot_price, daily_change, self.source.name),
+            'market': {
+                'rangeMin': round(float(year_low if year_low is not None else spot_price * 0.85), 2),
+                'rangeMax': round(float(year_high if year_high is not None else spot_price * 1.30), 2),
+                'volatility': round(volatility, 2)
+            },
+            '_as_of': latest.observed_at.isoformat(),
+            '_fetched_at': fetched_at
+        }
+
+    def _spot(self, price: float, change: float, source: str) -> Dict:
+        labels = {'yahoo': f'Yahoo Finance ({self.symbol})', 'default': 'Valor por defecto'}
+        return {
+            'price': round(price, 2),
+            'change': round(change, 2),
+            'currency': 'USD',
+            'unit': 'MT',
+            'source': labels.get(source, source)
+        }
+
+    # ------------------------------------------------------------------
+    # Sondeo en segundo plano
+    # ------------------------------------------------------------------
+
+    def start(self, app):
+        """Iniciar el hilo de sondeo (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='price-feed', daemon=True)
+        self._thread.start()
+        logger.info(f"📈 Price feed iniciado: {self.source.name} {self.symbol} cada {self.interval}s")
+
+    def _run(self, app):
+        while True:
+            with app.app_context():
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    self.last_error = str(e)
+                    logger.error(f"❌ Error en price feed: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+
+# Instancia global configurada por variables de entorno
+price_feed = PriceFeedService(
+    get_price_source(),
+    symbol=os.getenv('PRICE_FEED_SYMBOL', DEFAULT_SYMBOL),
+    interval=float(os.getenv('PRICE_FEED_INTERVAL', 300)),
+    stale_after=float(os.getenv('PRICE_FEED_STALE_SECONDS')) if os.getenv('PRICE_FEED_STALE_SECONDS') else None
+)
+
+
+def start_price_feed(app):
+    """Arrancar el sondeo salvo en testing o con PRICE_FEED_ENABLED=false"""
+    if app.config.get('TESTING') or os.getenv('PRICE_FEED_ENABLED', 'true').lower() != 'true':
+        return
+    price_feed.start(app)
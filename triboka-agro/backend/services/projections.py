@@ -0,0 +1,33 @@
+"""
+Utilidades compartidas por las proyecciones que se mantienen en after_flush
+(identificadores, registro de cambios, snapshots públicos, contadores del
+dashboard y acceso a entidades): cargar el valor anterior de las columnas
+vigiladas al asignarlas y leerlo desde el historial del atributo
+"""
+
+from typing import Dict, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+
+def keep_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+def track_previous_values(model, columns: Iterable[str]):
+    """Cargar el valor anterior al asignar (aunque el atributo esté expirado tras un commit)"""
+    for column in columns:
+        attribute = getattr(model, column)
+        if not event.contains(attribute, 'set', keep_previous_value):
+            event.listen(attribute, 'set', keep_previous_value, active_history=True, retval=True)
+
+
+def previous_values(obj, columns: Iterable[str]) -> Dict:
+    """Valores de las columnas antes de los cambios pendientes del objeto"""
+    state = attributes.instance_state(obj)
+    values = {}
+    for column in columns:
+        history = state.attrs[column].history
+        values[column] = history.deleted[0] if history.deleted else getattr(obj, column)
+    return values
@@ -0,0 +1,154 @@
+"""
+Snapshots de la verificación pública de trazabilidad (escaneo de QR)
+La respuesta de cada entidad se guarda comprimida en public_trace_snapshots.
+Los cambios en sus eventos, timeline, pruebas o anclajes la invalidan
+(version + 1, payload NULL) en la misma transacción, y la siguiente lectura la
+regenera; el resto de escaneos leen una sola fila sin tocar las tablas de eventos.
+"""
+
+import gzip
+import hashlib
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, attributes
+
+from models_simple import db, PublicTraceSnapshot, TraceAnchor, TraceEvent, TraceEventProof, TraceTimeline
+from services.projections import track_previous_values
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_ENTITY_TYPES = ('lot', 'batch', 'contract')
+
+snapshot_table = PublicTraceSnapshot.__table__
+events_table = TraceEvent.__table__
+proofs_table = TraceEventProof.__table__
+
+
+# Cargar el valor anterior al reasignar un evento a otra entidad, para
+# invalidar también el snapshot de la entidad anterior
+track_previous_values(TraceEvent, ('entity_type', 'entity_id'))
+
+
+def invalidate_public_snapshots(connection, entities: Iterable[Tuple[str, str]]):
+    """Marcar como pendientes los snapshots de (entity_type, entity_id)"""
+    by_type = defaultdict(set)
+    for entity_type, entity_id in entities:
+        if entity_type in PUBLIC_ENTITY_TYPES:
+            by_type[entity_type].add(str(entity_id))
+    for entity_type, entity_ids in by_type.items():
+        connection.execute(update(snapshot_table).where(
+            snapshot_table.c.entity_type == entity_type,
+            snapshot_table.c.entity_id.in_(entity_ids)
+        ).values(version=snapshot_table.c.version + 1, etag=None, payload=None))
+
+
+def _event_entities(trace_event: TraceEvent) -> Iterable[Tuple[str, str]]:
+    """Entidad actual del evento y, si se reasignó, la anterior"""
+    yield trace_event.entity_type, trace_event.entity_id
+    old_type = attributes.get_history(trace_event, 'entity_type').deleted
+    old_id = attributes.get_history(trace_event, 'entity_id').deleted
+    if old_type or old_id:
+        yield (old_type[0] if old_type else trace_event.entity_type), (old_id[0] if old_id else trace_event.entity_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_deleted_trace_entities(session, flush_context, instances):
+    # Los objetos eliminados aún pueden cargar sus columnas antes del DELETE
+    deleted = {(obj.entity_type, obj.entity_id) for obj in session.deleted
+               if isinstance(obj, (TraceEvent, TraceTimeline))}
+    if deleted:
+        session.info.setdefault('public_trace_deleted', set()).update(deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_public_trace_changes(session, flush_context):
+    """Invalidar los snapshots de las entidades cuyos datos públicos cambiaron"""
+    entities = session.info.pop('public_trace_deleted', set())
+    anchor_ids = set()
+    proof_event_ids = set()
+
+    for obj in session.new:
+        if isinstance(obj, (TraceEvent, TraceTimeline)):
+            entities.add((obj.entity_type, obj.entity_id))
+        elif isinstance(obj, TraceEventProof):
+            proof_event_ids.add(obj.event_id)
+    for obj in session.dirty:
+        if isinstance(obj, TraceEvent) and session.is_modified(obj):
+            entities.update(_event_entities(obj))
+        elif isinstance(obj, TraceAnchor) and session.is_modified(obj):
+            # Estado o transacción del anclaje: afecta a todos los eventos del árbol
+            anchor_ids.add(obj.id)
+
+    connection = session.connection()
+    if anchor_ids:
+        entities.update(connection.execute(
+            select(events_table.c.entity_type, events_table.c.entity_id).distinct()
+            .join(proofs_table, proofs_table.c.event_id == events_table.c.id)
+            .where(proofs_table.c.anchor_id.in_(anchor_ids))
+        ).fetchall())
+    if proof_event_ids:
+        entities.update(connection.execute(
+            select(events_table.c.entity_type, events_table.c.entity_id)
+            .where(events_table.c.id.in_(proof_event_ids))
+        ).fetchall())
+    if entities:
+        invalidate_public_snapshots(connection, entities)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_deleted_trace_entities(session):
+    session.info.pop('public_trace_deleted', None)
+
+
+def _timeline_exists(entity_type: str, entity_id: str) -> bool:
+    return db.session.query(TraceTimeline.id).filter_by(entity_type=entity_type, entity_id=entity_id).first() is not None
+
+
+def get_public_snapshot(entity_type: str, entity_id: str,
+                        build: Callable[[str, str], Optional[Dict]]) -> Optional[Tuple[str, bytes]]:
+    """(etag, JSON con gzip) de la verificación pública o None si la entidad no existe
+
+    Si el snapshot está pendiente se regenera con `build`. Se guarda solo si
+    nadie lo invalidó mientras tanto (UPDATE condicionado a la versión leída),
+    así un evento registrado durante la regeneración nunca queda fuera.
+    """
+    entity_id = str(entity_id)
+    query = db.session.query(PublicTraceSnapshot.id, PublicTraceSnapshot.version,
+                             PublicTraceSnapshot.etag, PublicTraceSnapshot.payload
+                             ).filter_by(entity_type=entity_type, entity_id=entity_id)
+    row = query.first()
+    if row is not None and row.payload is not None:
+        return row.etag, row.payload
+
+    if row is None:
+        if not _timeline_exists(entity_type, entity_id):
+            return None
+        # Fila vacía antes de leer los eventos: los cambios posteriores ya la invalidan
+        try:
+            db.session.add(PublicTraceSnapshot(entity_type=entity_type, entity_id=entity_id, version=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        row = query.first()
+
+    payload = build(entity_type, entity_id)
+    if payload is None:
+        return None
+
+    raw = current_app.json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha256(raw).hexdigest()[:32]
+    compressed = gzip.compress(raw, compresslevel=6)
+    stored = db.session.execute(update(PublicTraceSnapshot).where(
+        PublicTraceSnapshot.id == row.id,
+        PublicTraceSnapshot.version == row.version
+    ).values(etag=etag, payload=compressed, generated_at=datetime.utcnow())).rowcount
+    db.session.commit()
+    if stored:
+        logger.info(f"🔍 Snapshot público {entity_type} {entity_id}: {len(raw)} → {len(compressed)} bytes")
+    return etag, compressed
@@ -0,0 +1,47 @@
+"""
+Limitador de peticiones token bucket para Triboka
+Cada clave (p. ej. la IP del cliente) tiene un bucket de `burst` fichas que se
+recarga a `rate` fichas por segundo; en memoria del proceso y acotado en claves
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+
+class TokenBucketLimiter:
+    """Token bucket por clave con desalojo LRU de las claves inactivas
+
+    Una clave desalojada vuelve con el bucket lleno, así que max_keys debe
+    cubrir los clientes activos en una ventana de burst / rate segundos.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (fichas, último instante)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def allow(self, key: str) -> Tuple[bool, float]:
+        """Consumir una ficha; retorna (permitido, segundos hasta la próxima ficha)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / self.rate
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+            self.rejected = 0
@@ -0,0 +1,266 @@
+"""
+Trabajos de reportes en segundo plano para Triboka
+Los reportes se renderizan en un pool de procesos y se guardan en disco con
+el hash de sus datos de entrada como nombre: el mismo reporte con los mismos
+datos se sirve directamente del disco (con ETag) sin volver a renderizarlo
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from services.reports import REPORT_RENDERERS
+
+logger = logging.getLogger(__name__)
+
+# Incrementar al cambiar los renderers para no servir artefactos antiguos
+REPORT_FORMAT_VERSION = 1
+
+DEFAULT_ARTIFACT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'instance', 'reports')
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def artifact_key(kind: str, payload: Dict) -> str:
+    """Hash del tipo de reporte y sus datos (JSON canónico)"""
+    canonical = json.dumps({'kind': kind, 'version': REPORT_FORMAT_VERSION, 'payload': payload},
+                           sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def render_artifact(kind: str, payload: Dict, path: str) -> int:
+    """Renderizar un reporte y escribirlo de forma atómica (se ejecuta en el pool)"""
+    renderer = REPORT_RENDERERS[kind][0]
+    data = renderer(payload)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+class ReportJobManager:
+    """Cola de reportes con artefactos direccionados por contenido
+
+    El id del trabajo es el hash de sus datos, así que cualquier proceso del
+    servidor puede responder el estado o servir el artefacto leyendo el disco.
+    El id no es secreto: los metadatos guardan quién pidió el reporte (usuario,
+    empresa, deal) y las rutas lo comprueban con is_allowed antes de servirlo.
+    """
+
+    def __init__(self, artifact_dir: str, max_workers: int = 2, executor=None):
+        self.artifact_dir = artifact_dir
+        self.max_workers = max_workers
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._futures: Dict[str, concurrent.futures.Future] = {}
+        self._listeners = []
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn: los procesos hijos no heredan conexiones de BD ni sockets
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _base_path(self, job_id: str) -> str:
+        return os.path.join(self.artifact_dir, job_id)
+
+    def _load_meta(self, job_id: str) -> Optional[Dict]:
+        if not JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        try:
+            with open(self._base_path(job_id) + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta: Dict):
+        path = self._base_path(meta['id']) + '.json'
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def _grant(self, meta: Dict, owner: Optional[Dict]):
+        """Añadir al solicitante (user_id, company_id, deal_id) a los permisos del trabajo"""
+        access = meta.setdefault('access', {'user_ids': [], 'company_ids': [], 'deal_ids': []})
+        for key in ('user_id', 'company_id', 'deal_id'):
+            value = (owner or {}).get(key)
+            if value is not None and value not in access[f'{key}s']:
+                access[f'{key}s'].append(value)
+
+    def is_allowed(self, job_id: str, user_id=None, company_id=None,
+                   can_access_deal: Optional[Callable[[int], bool]] = None) -> bool:
+        """¿Puede el usuario ver el trabajo? (lo pidió él, su empresa o tiene acceso al deal)"""
+        meta = self._load_meta(job_id)
+        if meta is None:
+            return False
+        access = meta.get('access') or {}
+        if user_id is not None and user_id in access.get('user_ids', []):
+            return True
+        if company_id is not None and company_id in access.get('company_ids', []):
+            return True
+        return can_access_deal is not None and any(can_access_deal(deal_id) for deal_id in access.get('deal_ids', []))
+
+    def artifact_path(self, meta: Dict) -> str:
+        return f"{self._base_path(meta['id'])}.{meta['ext']}"
+
+    def add_listener(self, listener: Callable[[Dict], None]):
+        """Registrar una función llamada con el estado del trabajo al terminar"""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def submit(self, kind: str, payload: Dict, download_name: str, owner: Optional[Dict] = None) -> Dict:
+        """Encolar un reporte; si ya existe el artefacto se devuelve listo
+
+        owner ({'user_id', 'company_id', 'deal_id'}) se añade a los permisos del
+        trabajo, también cuando otro usuario ya había generado el mismo reporte.
+        """
+        if kind not in REPORT_RENDERERS:
+            raise ValueError(f'Tipo de reporte no válido: {kind}')
+        _, ext, mimetype = REPORT_RENDERERS[kind]
+        job_id = artifact_key(kind, payload)
+        meta = {
+            'id': job_id,
+            'kind': kind,
+            'ext': ext,
+            'mimetype': mimetype,
+            'download_name': download_name,
+            'created_at': datetime.utcnow().isoformat()
+        }
+
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        base_path = self._base_path(job_id)
+
+        with self._lock:
+            existing = self._load_meta(job_id)
+            if existing is not None:
+                meta['access'] = existing.get('access')
+            self._grant(meta, owner)
+            if os.path.exists(self.artifact_path(meta)) or job_id in self._futures:
+                self._write_meta(meta)
+                return self.status(job_id)
+            self._write_meta(meta)
+            if os.path.exists(base_path + '.error'):
+                os.remove(base_path + '.error')
+            try:
+                future = self._pool().submit(render_artifact, kind, payload, self.artifact_path(meta))
+            except Exception as e:
+                self._write_error(job_id, e)
+                return self.status(job_id)
+            self._futures[job_id] = future
+
+        future.add_done_callback(lambda f: self._finished(job_id, f))
+        return self.status(job_id)
+
+    def _write_error(self, job_id: str, error: Exception):
+        logger.error(f"❌ Error renderizando reporte {job_id[:12]}: {error}")
+        with open(self._base_path(job_id) + '.error', 'w') as f:
+            f.write(str(error) or error.__class__.__name__)
+
+    def _finished(self, job_id: str, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+        error = future.exception()
+        if error is not None:
+            self._write_error(job_id, error)
+        else:
+            logger.info(f"📄 Reporte listo: {job_id[:12]}")
+
+        job = self.status(job_id)
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                logger.warning(f"Error notificando reporte {job_id[:12]}: {e}")
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """Estado del trabajo: pending, ready o failed (None si no existe)"""
+        meta = self._load_meta(job_id)
+        if meta is None:
+            return None
+
+        job = {
+            'id': job_id,
+            'kind': meta['kind'],
+            'download_name': meta['download_name'],
+            'status': 'pending',
+            'status_url': f'/api/reports/{job_id}',
+            'download_url': f'/api/reports/{job_id}/download'
+        }
+        path = self.artifact_path(meta)
+        future = self._futures.get(job_id)
+        if os.path.exists(path):
+            job['status'] = 'ready'
+            job['size_bytes'] = os.path.getsize(path)
+        elif future is not None and future.done() and future.exception() is not None:
+            # Terminó con error pero el callback aún no escribió el .error
+            job['status'] = 'failed'
+            job['error'] = str(future.exception())
+        elif future is None and os.path.exists(self._base_path(job_id) + '.error'):
+            job['status'] = 'failed'
+            with open(self._base_path(job_id) + '.error') as f:
+                job['error'] = f.read()
+        return job
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict]:
+        """Esperar como máximo timeout segundos a que termine el trabajo"""
+        future = self._futures.get(job_id)
+        if future is not None:
+            concurrent.futures.wait([future], timeout=timeout)
+        return self.status(job_id)
+
+    def send(self, job_id: str):
+        """Respuesta Flask con el artefacto (ETag = id, 304 si el cliente ya lo tiene)"""
+        from flask import send_file
+
+        meta = self._load_meta(job_id)
+        return send_file(
+            self.artifact_path(meta),
+            mimetype=meta['mimetype'],
+            as_attachment=True,
+            download_name=meta['download_name'],
+            etag=job_id,
+            conditional=True,
+            max_age=int(os.getenv('REPORT_CACHE_MAX_AGE', 3600))
+        )
+
+    def respond(self, job: Dict, inline_wait: float = 0):
+        """Servir el reporte si está listo (esperando hasta inline_wait); si no, su estado
+
+        Devuelve 202 con el trabajo mientras está pendiente para que el cliente
+        consulte status_url o espere el evento report_ready del socket.
+        """
+        from flask import jsonify
+
+        if job['status'] == 'pending' and inline_wait:
+            job = self.wait(job['id'], inline_wait)
+        if job['status'] == 'ready':
+            return self.send(job['id'])
+        if job['status'] == 'failed':
+            return jsonify({'error': 'Error generando el reporte', 'job': job}), 500
+        return jsonify({'message': 'Reporte en proceso', 'job': job}), 202
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+report_jobs = ReportJobManager(
+    os.getenv('REPORT_ARTIFACT_DIR', DEFAULT_ARTIFACT_DIR),
+    max_workers=int(os.getenv('REPORT_WORKERS', 2))
+)
+
+# Segundos que las descargas directas esperan al trabajo antes de responder 202
+REPORT_INLINE_WAIT = float(os.getenv('REPORT_INLINE_WAIT', 30))
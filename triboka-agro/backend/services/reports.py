@@ -0,0 +1,205 @@
+"""
+Renderizado de reportes PDF / Excel para Triboka
+Funciones puras (datos -> bytes) sin acceso a Flask ni a la base de datos,
+para poder ejecutarlas en el pool de procesos de services.report_jobs
+"""
+
+import io
+from datetime import datetime
+from typing import Dict
+
+
+def _table_style(header_background, font_size, padding):
+    """Estilo de tablas etiqueta/valor del certificado"""
+    from reportlab.lib import colors
+    from reportlab.platypus import TableStyle
+
+    return TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), header_background),
+        ('TEXTCOLOR', (0, 0), (0, -1), colors.black),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), font_size),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), padding),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ])
+
+
+def render_deal_trace_pdf(payload: Dict) -> bytes:
+    """Certificado de trazabilidad de un deal
+
+    payload: deal_info (filas [etiqueta, valor]), timeline (eventos ordenados)
+    y generated_by.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+    from reportlab.lib.units import inch
+
+    timeline_events = payload['timeline']
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = getSampleStyleSheet()
+
+    # Estilos personalizados
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=16,
+        spaceAfter=30,
+        alignment=1  # Centrado
+    )
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Heading2'],
+        fontSize=14,
+        spaceAfter=20
+    )
+    event_style = ParagraphStyle(
+        'EventStyle',
+        parent=styles['Normal'],
+        fontSize=10,
+        leftIndent=20
+    )
+
+    content = []
+
+    # Título
+    content.append(Paragraph("Certificado de Trazabilidad Triboka Agro", title_style))
+    content.append(Spacer(1, 12))
+
+    # Información del deal
+    content.append(Paragraph("Información del Acuerdo", subtitle_style))
+    deal_table = Table(payload['deal_info'], colWidths=[2*inch, 4*inch])
+    deal_table.setStyle(_table_style(colors.lightgrey, 10, 6))
+    content.append(deal_table)
+    content.append(Spacer(1, 20))
+
+    # Timeline de eventos
+    content.append(Paragraph("Línea de Tiempo de Trazabilidad", subtitle_style))
+    content.append(Spacer(1, 12))
+
+    for event in timeline_events[:50]:  # Limitar a 50 eventos para evitar PDFs muy largos
+        try:
+            event_date = datetime.fromisoformat(event['timestamp'].replace('Z', '+00:00'))
+            date_str = event_date.strftime("%Y-%m-%d %H:%M:%S")
+        except (AttributeError, ValueError):
+            date_str = event['timestamp']
+
+        event_text = f"<b>{date_str}</b> - <b>{event['title']}</b><br/>" \
+                     f"<i>{event['actor']}</i><br/>" \
+                     f"{event['description']}"
+        content.append(Paragraph(event_text, event_style))
+        content.append(Spacer(1, 8))
+
+    # Información adicional
+    content.append(Spacer(1, 20))
+    content.append(Paragraph("Información Adicional", subtitle_style))
+
+    period = 'N/A - N/A'
+    if timeline_events:
+        period = f"{timeline_events[0]['timestamp'][:10]} - {timeline_events[-1]['timestamp'][:10]}"
+    additional_info = [
+        ["Total de Eventos:", str(len(timeline_events))],
+        ["Período de Trazabilidad:", period],
+        ["Generado por:", payload.get('generated_by') or 'N/A'],
+        ["Fecha de Generación:", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")],
+        ["Sistema:", "Triboka Agro - Plataforma de Trazabilidad Blockchain"]
+    ]
+    additional_table = Table(additional_info, colWidths=[2.5*inch, 3.5*inch])
+    additional_table.setStyle(_table_style(colors.lightgrey, 9, 4))
+    content.append(additional_table)
+
+    # Pie de página
+    content.append(Spacer(1, 30))
+    footer_text = """
+    <para alignment="center" fontSize="8">
+    Este certificado de trazabilidad es generado por el sistema Triboka Agro y certifica la autenticidad
+    de la cadena de suministro desde la finca hasta la exportación. La información contenida en este
+    documento está respaldada por registros blockchain inmutables.
+    </para>
+    """
+    content.append(Paragraph(footer_text, ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, alignment=1)))
+
+    doc.build(content)
+    return buffer.getvalue()
+
+
+def render_esg_pdf(payload: Dict) -> bytes:
+    """Reporte ESG (payload: report_type y métricas esg cuando report_type == 'esg')"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
+    report_type = payload['report_type']
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=18,
+        textColor=colors.HexColor('#2E8B57'),
+        alignment=1,  # Centrado
+        spaceAfter=30
+    )
+
+    story = []
+    if report_type == 'esg':
+        esg_data = payload['esg']
+        story.append(Paragraph("Reporte ESG Completo - Triboka Agro", title_style))
+        story.append(Spacer(1, 12))
+
+        # Métricas principales
+        story.append(Paragraph("Métricas Principales", styles['Heading2']))
+        metrics_data = [
+            ['Métrica', 'Valor', 'Tendencia'],
+            ['Puntaje ESG General', f"{esg_data['overall']['esg_score']}", '↗'],
+            ['Huella de Carbono', f"{esg_data['environmental']['carbon_footprint']['total_co2_tons']} tCO₂", '↘'],
+            ['Eficiencia del Agua', f"{esg_data['environmental']['water_usage']['efficiency_score']}%", '→'],
+            ['Biodiversidad', f"{esg_data['environmental']['biodiversity']['species_preserved']} especies", '↗'],
+            ['Transparencia', f"{esg_data['governance']['transparency']['blockchain_traced_pct']}%", '↗']
+        ]
+
+        table = Table(metrics_data)
+        table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2E8B57')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 14),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ]))
+        story.append(table)
+    else:
+        story.append(Paragraph(f"Reporte {report_type.title()}", title_style))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def render_excel(payload: Dict) -> bytes:
+    """Hoja Excel a partir de columnas y filas (payload: sheet_name, columns, rows)"""
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    df = pd.DataFrame(payload['rows'], columns=payload['columns'])
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=payload['sheet_name'], index=False)
+    return buffer.getvalue()
+
+
+PDF_MIMETYPE = 'application/pdf'
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Tipo de reporte -> (renderer, extensión, mimetype)
+REPORT_RENDERERS = {
+    'deal_trace_pdf': (render_deal_trace_pdf, 'pdf', PDF_MIMETYPE),
+    'esg_pdf': (render_esg_pdf, 'pdf', PDF_MIMETYPE),
+    'excel': (render_excel, 'xlsx', XLSX_MIMETYPE),
+}
@@ -0,0 +1,108 @@
+"""
+Pool de conexiones SQLite para procesos que comparten triboka_production.db
+Las conexiones se abren una vez en modo WAL (lectores y un escritor no se
+bloquean entre sí) con busy_timeout, y se reutilizan para aprovechar la cache
+de sentencias preparadas de sqlite3. Las escrituras toman el lock con
+BEGIN IMMEDIATE y se reintentan si la base sigue bloqueada.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+def is_locked_error(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and (
+        'locked' in str(error) or 'busy' in str(error))
+
+
+class SQLitePool:
+    """Pool de tamaño fijo de conexiones SQLite configuradas (WAL + busy_timeout)"""
+
+    def __init__(self, db_path: str, size: int = 5, busy_timeout: float = 5.0,
+                 write_retries: int = 3, cached_statements: int = 256):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.write_retries = write_retries
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def new_connection(self) -> sqlite3.Connection:
+        """Conexión configurada fuera del pool (p. ej. para un hilo de larga duración)"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self.new_connection()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get(timeout=self.busy_timeout)
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Conexión del pool en modo autocommit (lecturas y escrituras de una sentencia)"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Transacción de escritura: BEGIN IMMEDIATE, COMMIT al salir y ROLLBACK si falla
+
+        Tomar el lock de escritura al empezar evita el SQLITE_BUSY de promocionar
+        una transacción de lectura, que busy_timeout no puede resolver.
+        """
+        with self.connection() as conn:
+            for attempt in range(self.write_retries + 1):
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    break
+                except sqlite3.OperationalError as e:
+                    if not is_locked_error(e) or attempt == self.write_retries:
+                        raise
+                    logger.warning(f"Base de datos bloqueada, reintento {attempt + 1}/{self.write_retries}")
+                    time.sleep(0.05 * 2 ** attempt)
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
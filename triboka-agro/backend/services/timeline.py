@@ -0,0 +1,169 @@
+"""
+Timeline append-only de trazabilidad para Triboka
+Cada evento agrega una fila a timeline_entries (O(1)); el timeline completo
+de una entidad se lee con una sola consulta ordenada por índice
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from models_simple import db, TimelineEntry, TraceEvent, TraceTimeline, User
+from services.cache import LocalLRUCache
+from services.pagination import encode_cursor, keyset_phases, read_phases
+
+logger = logging.getLogger(__name__)
+
+# Nombres de usuario para mostrar como actor (cambian poco)
+USER_NAME_TTL = 300
+_user_names = LocalLRUCache(max_entries=4096)
+
+
+def resolve_user_names(user_ids: Iterable[Optional[int]]) -> Dict[int, str]:
+    """Resolver nombres de varios usuarios con una consulta IN (más cache LRU)"""
+    names = {}
+    missing = []
+    for user_id in {uid for uid in user_ids if uid}:
+        name = _user_names.get(str(user_id))
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+
+    if missing:
+        for user_id, name in db.session.query(User.id, User.name).filter(User.id.in_(missing)):
+            names[user_id] = name
+            _user_names.set(str(user_id), name, USER_NAME_TTL)
+    return names
+
+
+def actor_names(events: List[TraceEvent]) -> Dict[int, str]:
+    """Nombre del actor de cada evento (por id de evento)
+
+    Usa actor_name cacheado en el evento y resuelve el resto en un solo IN.
+    """
+    names = resolve_user_names(e.actor_id for e in events if not e.actor_name)
+    return {e.id: e.actor_name or names.get(e.actor_id) or 'Sistema' for e in events}
+
+
+def entry_mapping(trace_event: TraceEvent, title: Optional[str] = None,
+                  description: Optional[str] = None, actor_name: Optional[str] = None,
+                  **extra) -> Dict:
+    """Mapping de TimelineEntry para un TraceEvent (también usado en bulk inserts)"""
+    occurred_at = trace_event.event_timestamp or trace_event.created_at
+    if occurred_at.tzinfo is not None:
+        occurred_at = occurred_at.astimezone(timezone.utc).replace(tzinfo=None)
+    data = {
+        'measurements': json.loads(trace_event.measurements) if trace_event.measurements else {},
+        'location': trace_event.location,
+        **extra
+    }
+    return {
+        'entity_type': trace_event.entity_type,
+        'entity_id': str(trace_event.entity_id),
+        'entry_key': f'event_{trace_event.id}',
+        'entry_type': 'traceability_event',
+        'event_id': trace_event.id,
+        'event_type': trace_event.event_type,
+        'title': title or trace_event.title,
+        'description': description if description is not None else trace_event.description,
+        'occurred_at': occurred_at,
+        'actor_name': actor_name or trace_event.actor_name,
+        'data_json': json.dumps(data),
+        'blockchain_tx_hash': trace_event.blockchain_tx_hash
+    }
+
+
+def append_event(trace_event: TraceEvent, **kwargs) -> TimelineEntry:
+    """Agregar un evento al timeline de su entidad (requiere trace_event.id)
+
+    No hace commit: la entrada se guarda en la misma transacción que el evento.
+    """
+    entry = TimelineEntry(**entry_mapping(trace_event, **kwargs))
+    db.session.add(entry)
+    _touch_timeline(entry.entity_type, entry.entity_id, entry.occurred_at)
+    return entry
+
+
+def _touch_timeline(entity_type: str, entity_id: str, occurred_at):
+    """Mantener las estadísticas de TraceTimeline sin releer las entradas"""
+    bump_timelines(entity_type, {entity_id: (1, occurred_at)})
+
+
+def bump_timelines(entity_type: str, stats: Dict[str, Tuple[int, datetime]]):
+    """Sumar eventos a los TraceTimeline de varias entidades con una sola lectura
+
+    stats: {entity_id: (eventos nuevos, primer occurred_at)}.
+    """
+    timelines = {timeline.entity_id: timeline for timeline in TraceTimeline.query.filter(
+        TraceTimeline.entity_type == entity_type, TraceTimeline.entity_id.in_(list(stats)))}
+    for entity_id, (count, occurred_at) in stats.items():
+        timeline = timelines.get(entity_id)
+        if timeline is None:
+            db.session.add(TraceTimeline(
+                entity_type=entity_type,
+                entity_id=entity_id,
+                title=f'Trazabilidad {entity_type} {entity_id}',
+                total_events=count,
+                started_at=occurred_at
+            ))
+            continue
+        timeline.total_events = func.coalesce(TraceTimeline.total_events, 0) + count
+        if timeline.started_at is None or occurred_at < timeline.started_at:
+            timeline.started_at = occurred_at
+
+
+def _timeline_query(entity_type: str, entity_id: str):
+    return db.session.query(
+        TimelineEntry, TraceEvent.blockchain_tx_hash, TraceEvent.actor_id
+    ).outerjoin(
+        TraceEvent, TraceEvent.id == TimelineEntry.event_id
+    ).filter(
+        TimelineEntry.entity_type == entity_type,
+        TimelineEntry.entity_id == str(entity_id)
+    )
+
+
+def _serialize_timeline(rows) -> List[Dict]:
+    # Entradas sin nombre de actor: resolver todos los usuarios en una consulta
+    names = resolve_user_names(actor_id for entry, _, actor_id in rows if not entry.actor_name)
+    result = []
+    for entry, tx_hash, actor_id in rows:
+        item = entry.to_dict(blockchain_tx_hash=tx_hash)
+        if not entry.actor_name and actor_id in names:
+            item['actor'] = names[actor_id]
+        result.append(item)
+    return result
+
+
+def load_timeline(entity_type: str, entity_id: str) -> List[Dict]:
+    """Timeline completo de una entidad en orden cronológico (una consulta)
+
+    El hash de blockchain se toma del evento para reflejar anclajes posteriores.
+    """
+    rows = _timeline_query(entity_type, entity_id).order_by(
+        TimelineEntry.occurred_at.asc(), TimelineEntry.id.asc()
+    ).all()
+    return _serialize_timeline(rows)
+
+
+def load_timeline_page(entity_type: str, entity_id: str, limit: int,
+                       cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Página del timeline por cursor (occurred_at, id) en orden cronológico
+
+    Lanza ValueError si el cursor es inválido.
+    """
+    phases = keyset_phases(_timeline_query(entity_type, entity_id), TimelineEntry.occurred_at,
+                           TimelineEntry.id, cursor=cursor, descending=False)
+    rows = read_phases(phases, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1][0]
+        next_cursor = encode_cursor(last.occurred_at, last.id)
+    return _serialize_timeline(rows), next_cursor
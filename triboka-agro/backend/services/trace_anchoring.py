@@ -0,0 +1,214 @@
+"""
+Anclaje Merkle de eventos de trazabilidad para Triboka
+Agrupa periódicamente los eventos sin anclar en un árbol Merkle, guarda la
+prueba de inclusión de cada evento y encola una sola transacción con la raíz
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy.orm import joinedload
+
+from models_simple import db, TraceEvent, TraceAnchor, TraceEventProof, TraceTimeline
+from services.merkle import build_tree, leaf_hash, verify_proof
+from services.public_trace import invalidate_public_snapshots
+from services.tx_outbox import enqueue_transaction
+
+logger = logging.getLogger(__name__)
+
+# Máximo de eventos por árbol (la prueba crece en log2(n))
+MAX_LEAVES = 4096
+
+
+def anchor_pending_events(integration=None, max_leaves: int = MAX_LEAVES) -> Optional[TraceAnchor]:
+    """Anclar los eventos activos que aún no tienen prueba de inclusión
+
+    Crea el TraceAnchor, las pruebas de cada evento y, si DocumentRegistry
+    está disponible, la transacción en el outbox. Sin blockchain el anclaje
+    queda como 'offchain' (las pruebas siguen siendo verificables). Los
+    eventos de un anclaje cuya transacción falló vuelven a estar pendientes.
+    """
+    events = TraceEvent.query.outerjoin(
+        TraceEventProof, TraceEventProof.event_id == TraceEvent.id
+    ).filter(
+        TraceEventProof.id.is_(None),
+        TraceEvent.status == 'active'
+    ).order_by(TraceEvent.id).limit(max_leaves).all()
+
+    if not events:
+        return None
+
+    event_hashes = [event.get_event_hash() for event in events]
+    root, proofs = build_tree([leaf_hash(h) for h in event_hashes])
+
+    # Un anclaje fallido libera sus eventos; si se vuelven a agrupar igual la
+    # raíz coincide y se reutiliza la fila (merkle_root es única)
+    anchor = TraceAnchor.query.filter_by(merkle_root=root, status='failed').first()
+    if anchor is None:
+        anchor = TraceAnchor(merkle_root=root)
+        db.session.add(anchor)
+    anchor.leaf_count = len(events)
+    anchor.first_event_id = events[0].id
+    anchor.last_event_id = events[-1].id
+    anchor.status = 'pending'
+    anchor.outbox_tx_id = None
+    db.session.flush()
+
+    db.session.bulk_insert_mappings(TraceEventProof, [{
+        'event_id': event.id,
+        'anchor_id': anchor.id,
+        'event_hash': event_hash,
+        'leaf_index': index,
+        'proof_json': json.dumps(proof, separators=(',', ':'))
+    } for index, (event, event_hash, proof) in enumerate(zip(events, event_hashes, proofs))])
+    invalidate_public_snapshots(db.session.connection(), {(event.entity_type, event.entity_id) for event in events})
+
+    registry = getattr(integration, 'document_registry', None) if integration else None
+    if integration is not None and integration.is_ready() and registry is not None and registry.contract:
+        tx = enqueue_transaction('anchor_trace_root', anchor.id, {
+            'anchor_id': anchor.id,
+            'merkle_root': root,
+            'leaf_count': anchor.leaf_count,
+            'metadata': json.dumps({'first_event_id': anchor.first_event_id, 'last_event_id': anchor.last_event_id})
+        })
+        db.session.flush()
+        anchor.outbox_tx_id = tx.id
+    else:
+        anchor.status = 'offchain'
+
+    db.session.commit()
+    logger.info(f"🌳 Anclaje #{anchor.id}: {anchor.leaf_count} eventos, raíz {root[:16]}… ({anchor.status})")
+    return anchor
+
+
+def verify_event_proof(event: TraceEvent, proof_row: Optional[TraceEventProof]) -> Dict:
+    """Verificar localmente la inclusión de un evento (sin llamadas a la blockchain)
+
+    Recalcula el hash actual del evento y la raíz a partir de su prueba; si el
+    evento se modificó después de anclarse la verificación falla.
+    """
+    if proof_row is None:
+        return {'anchored': False, 'valid': None, 'status': 'pending_anchor'}
+
+    anchor = proof_row.anchor
+    current_hash = event.get_event_hash()
+    valid = current_hash == proof_row.event_hash and verify_proof(current_hash, proof_row.proof, anchor.merkle_root)
+
+    return {
+        'anchored': True,
+        'valid': valid,
+        'status': ('anchored' if anchor.status == 'confirmed' else anchor.status) if valid else 'modified_after_anchor',
+        'event_hash': current_hash,
+        'merkle_root': anchor.merkle_root,
+        'leaf_index': proof_row.leaf_index,
+        'proof': proof_row.proof,
+        'anchor_id': anchor.id,
+        'blockchain_tx_hash': anchor.blockchain_tx_hash,
+        'blockchain_block_number': anchor.blockchain_block_number
+    }
+
+
+def load_proofs(event_ids: Iterable[int]) -> Dict[int, TraceEventProof]:
+    """Cargar en una consulta las pruebas (con su anclaje) de varios eventos"""
+    event_ids = list(event_ids)
+    if not event_ids:
+        return {}
+    rows = TraceEventProof.query.options(
+        joinedload(TraceEventProof.anchor)
+    ).filter(TraceEventProof.event_id.in_(event_ids)).all()
+    return {row.event_id: row for row in rows}
+
+
+def summarize_verification(results: List[Dict]) -> str:
+    """Estado global de verificación de un conjunto de eventos"""
+    if not results:
+        return 'no_data'
+    if any(r['valid'] is False for r in results):
+        return 'tampered'
+    if all(r['anchored'] for r in results):
+        return 'verified'
+    return 'partially_anchored'
+
+
+def build_public_verification(entity_type: str, entity_id: str) -> Optional[Dict]:
+    """Respuesta de la verificación pública de una entidad (None si no tiene timeline)
+
+    Solo eventos públicos, cada uno con la verificación local de su prueba Merkle.
+    """
+    timeline = TraceTimeline.query.filter_by(entity_type=entity_type, entity_id=str(entity_id)).first()
+    if not timeline:
+        return None
+
+    events = TraceEvent.query.filter_by(
+        entity_type=entity_type,
+        entity_id=str(entity_id),
+        is_public=True
+    ).order_by(TraceEvent.event_timestamp.asc()).all()
+
+    proofs = load_proofs(event.id for event in events)
+    event_list = []
+    results = []
+    for event in events:
+        result = verify_event_proof(event, proofs.get(event.id))
+        results.append(result)
+        event_data = event.to_dict(include_private=False)
+        event_data['verification'] = result
+        event_list.append(event_data)
+
+    return {
+        'entity_type': entity_type,
+        'entity_id': entity_id,
+        'total_events': len(events),
+        'blockchain_events': sum(1 for e in events if e.blockchain_tx_hash),
+        'anchored_events': sum(1 for r in results if r['anchored']),
+        'last_update': events[-1].event_timestamp.isoformat() if events and events[-1].event_timestamp else None,
+        'verification_status': summarize_verification(results),
+        'events': event_list
+    }
+
+
+class TraceAnchorScheduler:
+    """Ejecuta anchor_pending_events cada `interval` segundos en segundo plano"""
+
+    def __init__(self, integration, interval: float = 600):
+        self.integration = integration
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='trace-anchor', daemon=True)
+        self._thread.start()
+        logger.info(f"🌳 Anclaje Merkle de eventos cada {self.interval}s")
+
+    def _run(self, app):
+        while not self._stop.wait(self.interval):
+            with app.app_context():
+                try:
+                    # Vaciar todo el backlog en árboles de hasta MAX_LEAVES eventos
+                    while anchor_pending_events(self.integration) is not None:
+                        pass
+                except Exception as e:
+                    logger.error(f"❌ Error anclando eventos de trazabilidad: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_trace_anchoring(app, integration) -> Optional[TraceAnchorScheduler]:
+    """Arrancar el anclaje periódico salvo con TRACE_ANCHOR_ENABLED=false"""
+    if app.config.get('TESTING') or os.getenv('TRACE_ANCHOR_ENABLED', 'true').lower() != 'true':
+        return None
+    scheduler = TraceAnchorScheduler(integration, interval=float(os.getenv('TRACE_ANCHOR_INTERVAL', 600)))
+    scheduler.start(app)
+    return scheduler
@@ -0,0 +1,418 @@
+"""
+Outbox de transacciones blockchain para Triboka
+Las rutas encolan la transacción junto con la entidad (misma transacción de BD)
+y responden de inmediato; el worker envía en orden con nonces locales y
+consulta los recibos por lotes
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import update
+
+from models_simple import (
+    db, BlockchainTx, ExportContract, ContractFixation, ProducerLot,
+    TraceAnchor, TraceEvent, TraceEventProof
+)
+from services.public_trace import invalidate_public_snapshots
+
+logger = logging.getLogger(__name__)
+
+
+def _mark_anchor_confirmed(tx, anchor):
+    """Propagar hash y bloque del anclaje a todos los eventos del árbol"""
+    anchor.status = 'confirmed'
+    anchor.anchored_at = tx.confirmed_at
+    event_ids = db.session.query(TraceEventProof.event_id).filter(TraceEventProof.anchor_id == anchor.id)
+    TraceEvent.query.filter(TraceEvent.id.in_(event_ids)).update({
+        TraceEvent.blockchain_tx_hash: tx.tx_hash,
+        TraceEvent.blockchain_block_number: tx.block_number,
+        TraceEvent.blockchain_timestamp: tx.confirmed_at
+    }, synchronize_session=False)
+
+
+def _mark_anchor_failed(tx, anchor):
+    """Liberar los eventos del árbol para que el siguiente ciclo los vuelva a anclar"""
+    anchor.status = 'failed'
+    proofs = TraceEventProof.query.filter(TraceEventProof.anchor_id == anchor.id)
+    entities = db.session.query(TraceEvent.entity_type, TraceEvent.entity_id).filter(
+        TraceEvent.id.in_(proofs.with_entities(TraceEventProof.event_id))
+    ).distinct().all()
+    released = proofs.delete(synchronize_session=False)
+    invalidate_public_snapshots(db.session.connection(), entities)
+    logger.warning(f"⚠️ Anclaje #{anchor.id} fallido: {released} eventos vuelven a quedar pendientes")
+
+
+class TxDependencyFailed(Exception):
+    """La transacción depende de otra que falló o nunca se encoló"""
+
+
+def _resolve_fixation_args(args: Dict) -> Optional[Dict]:
+    """Completar contract_id con el ID on-chain del contrato padre
+
+    Retorna None mientras su create_contract no se confirme (la fijación
+    queda pendiente) y lanza TxDependencyFailed si ya no se va a confirmar.
+    """
+    args = dict(args)
+    export_contract_id = args.pop('export_contract_id', None)
+    if args.get('contract_id'):
+        return args
+
+    contract = db.session.get(ExportContract, export_contract_id) if export_contract_id else None
+    if contract is None:
+        raise TxDependencyFailed(f'Contrato {export_contract_id} no encontrado')
+    if contract.blockchain_contract_id:
+        args['contract_id'] = contract.blockchain_contract_id
+        return args
+
+    parent = BlockchainTx.query.filter_by(
+        kind='create_contract', entity_id=contract.id
+    ).order_by(BlockchainTx.id.desc()).first()
+    if parent is None or parent.status == 'failed':
+        raise TxDependencyFailed(f'El contrato {contract.id} no tiene una creación en blockchain válida')
+    return None
+
+
+# Tipos de transacción: servicio de BlockchainIntegration, método que prepara la
+# llamada, método que extrae el ID del recibo, columna de la entidad a actualizar
+# y callbacks opcionales para completar los argumentos al enviar y al
+# confirmarse / fallar
+TX_KINDS = {
+    'create_contract': {
+        'service': 'agro_contract',
+        'build': 'create_contract_call',
+        'extract': 'extract_contract_id',
+        'entity_type': 'contract',
+        'model': ExportContract,
+        'field': 'blockchain_contract_id'
+    },
+    'register_fixation': {
+        'service': 'agro_contract',
+        'build': 'register_fixation_call',
+        'extract': 'extract_fixation_id',
+        'entity_type': 'fixation',
+        'model': ContractFixation,
+        'field': 'blockchain_fixation_id',
+        'resolve_args': _resolve_fixation_args
+    },
+    'create_lot': {
+        'service': 'nft_service',
+        'build': 'create_lot_call',
+        'extract': 'extract_lot_id',
+        'entity_type': 'lot',
+        'model': ProducerLot,
+        'field': 'blockchain_lot_id'
+    },
+    'anchor_trace_root': {
+        'service': 'document_registry',
+        'build': 'anchor_root_call',
+        'extract': 'extract_document_id',
+        'entity_type': 'trace_anchor',
+        'model': TraceAnchor,
+        'field': 'document_id',
+        'on_confirm': _mark_anchor_confirmed,
+        'on_fail': _mark_anchor_failed
+    }
+}
+
+
+def enqueue_transaction(kind: str, entity_id: int, args: Dict) -> BlockchainTx:
+    """Encolar una transacción en la sesión actual (el commit lo hace quien llama)"""
+    spec = TX_KINDS[kind]
+    tx = BlockchainTx(
+        kind=kind,
+        entity_type=spec['entity_type'],
+        entity_id=entity_id,
+        args_json=json.dumps(args),
+        status='pending',
+        attempts=0
+    )
+    db.session.add(tx)
+    return tx
+
+
+ZERO_ADDRESS = '0x' + '0' * 40
+
+
+def contract_creation_args(contract: ExportContract) -> Dict:
+    """Argumentos de create_contract a partir del contrato guardado"""
+    return {
+        'buyer_address': (contract.buyer_company.blockchain_address if contract.buyer_company else None) or ZERO_ADDRESS,
+        'exporter_address': (contract.exporter_company.blockchain_address if contract.exporter_company else None) or ZERO_ADDRESS,
+        'contract_code': contract.contract_code,
+        'product_type': contract.product_type,
+        'product_grade': contract.product_grade,
+        'total_volume_mt': int(contract.total_volume_mt * 1000),  # Convertir a kg
+        'differential_usd': int(contract.differential_usd * 100),  # Convertir a centavos
+        'start_date': int(contract.start_date.timestamp()),
+        'end_date': int(contract.end_date.timestamp()),
+        'delivery_date': int(contract.delivery_date.timestamp())
+    }
+
+
+def enqueue_contract_creation(contract: ExportContract) -> Optional[BlockchainTx]:
+    """Encolar create_contract salvo que el contrato ya esté o vaya a estar en blockchain"""
+    if contract.blockchain_contract_id or BlockchainTx.query.filter(
+        BlockchainTx.kind == 'create_contract',
+        BlockchainTx.entity_id == contract.id,
+        BlockchainTx.status != 'failed'
+    ).first():
+        return None
+    return enqueue_transaction('create_contract', contract.id, contract_creation_args(contract))
+
+
+class TxOutboxWorker:
+    """Envía transacciones pendientes y aplica sus recibos
+
+    Cada transacción se reclama (pending -> sending con un UPDATE condicionado)
+    antes de enviarla, así dos workers nunca envían la misma. Los nonces se
+    asignan localmente por el NonceManager de BlockchainService: con varios
+    workers un nonce repetido hace fallar el envío, que se reintenta tras
+    resincronizar con el nodo.
+
+    La transacción se firma y se guarda (raw_tx, nonce, tx_hash) antes de
+    difundirla. Si el worker cae o el envío falla después, el reintento no la
+    reconstruye: si el nodo ya conoce el hash se da por enviada y si no se
+    reenvía la misma transacción firmada, así nunca se duplica on-chain.
+    """
+
+    def __init__(self, integration, batch_size: int = 20, poll_interval: float = 2.0,
+                 max_attempts: int = 5, claim_timeout: float = 300):
+        self.integration = integration
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def submit_pending(self) -> int:
+        """Enviar transacciones pendientes en orden de encolado
+
+        Si un envío falla se detiene el lote para no adelantar transacciones
+        posteriores; tras max_attempts la transacción se marca como fallida.
+        Las que esperan a otra transacción (p. ej. una fijación a su contrato)
+        siguen pendientes sin detener el lote.
+        """
+        blockchain = self.integration.blockchain
+        self._release_stale_claims()
+        pending = BlockchainTx.query.filter_by(status='pending').order_by(BlockchainTx.id).limit(self.batch_size).all()
+
+        sent = 0
+        for tx in pending:
+            spec = TX_KINDS[tx.kind]
+            service = getattr(self.integration, spec['service'])
+            args = tx.args
+            if spec.get('resolve_args'):
+                try:
+                    args = spec['resolve_args'](args)
+                except TxDependencyFailed as e:
+                    tx.status = 'failed'
+                    tx.last_error = str(e)
+                    self._run_hook(tx, 'on_fail')
+                    logger.error(f"❌ Transacción {tx.kind} #{tx.id} descartada: {e}")
+                    db.session.commit()
+                    continue
+                if args is None:
+                    continue
+
+            if not self._claim(tx):
+                continue
+            try:
+                if tx.raw_tx is None:
+                    transaction = getattr(service, spec['build'])(**args).build_transaction({
+                        'from': blockchain.account.address
+                    })
+                    tx.tx_hash, tx.raw_tx = blockchain.sign_transaction(transaction)
+                    tx.nonce = transaction.get('nonce')
+                    self._persist_signed(blockchain)
+                    blockchain.broadcast_raw_transaction(tx.raw_tx)
+                elif not blockchain.is_known_transaction(tx.tx_hash):
+                    blockchain.broadcast_raw_transaction(tx.raw_tx)
+                tx.status = 'submitted'
+                tx.submitted_at = datetime.utcnow()
+                tx.last_error = None
+                sent += 1
+            except Exception as e:
+                tx.attempts += 1
+                tx.last_error = str(e)
+                if tx.attempts >= self.max_attempts:
+                    tx.status = 'failed'
+                    if tx.raw_tx is not None:
+                        # Su nonce no se usará: resincronizar con el nodo
+                        blockchain.nonces.reset()
+                    self._run_hook(tx, 'on_fail')
+                    logger.error(f"❌ Transacción {tx.kind} #{tx.id} descartada tras {tx.attempts} intentos: {e}")
+                    db.session.commit()
+                    continue
+                tx.status = 'pending'
+                logger.warning(f"⚠️ Error enviando {tx.kind} #{tx.id} (intento {tx.attempts}): {e}")
+                db.session.commit()
+                break
+            # Persistir el hash antes de enviar la siguiente
+            db.session.commit()
+
+        return sent
+
+    def _persist_signed(self, blockchain):
+        """Confirmar la transacción firmada antes de difundirla"""
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # No se difundió: su nonce queda libre
+            blockchain.nonces.reset()
+            raise
+
+    def _claim(self, tx: BlockchainTx) -> bool:
+        """Reclamar la transacción para este worker; False si otro ya la tomó"""
+        claimed = db.session.execute(update(BlockchainTx).where(
+            BlockchainTx.id == tx.id,
+            BlockchainTx.status == 'pending'
+        ).values(status='sending', submitted_at=datetime.utcnow())).rowcount
+        db.session.commit()
+        return bool(claimed)
+
+    def _release_stale_claims(self):
+        """Devolver a pending las reclamadas por un worker que se detuvo
+
+        Las que ya tienen raw_tx se reenvían tal cual (o se marcan enviadas si
+        el nodo ya las conoce) en el siguiente submit_pending.
+        """
+        released = db.session.execute(update(BlockchainTx).where(
+            BlockchainTx.status == 'sending',
+            BlockchainTx.submitted_at < datetime.utcnow() - timedelta(seconds=self.claim_timeout)
+        ).values(status='pending')).rowcount
+        db.session.commit()
+        if released:
+            logger.warning(f"⚠️ {released} transacciones reclamadas sin enviar vuelven a pendientes")
+
+    def poll_receipts(self) -> int:
+        """Consultar en un lote los recibos de las transacciones enviadas"""
+        submitted = BlockchainTx.query.filter_by(status='submitted').order_by(BlockchainTx.id).limit(self.batch_size * 5).all()
+        if not submitted:
+            return 0
+
+        receipts = self.integration.blockchain.get_receipts([tx.tx_hash for tx in submitted])
+
+        processed = 0
+        for tx in submitted:
+            receipt = receipts.get(tx.tx_hash)
+            if receipt is None:
+                continue
+
+            tx.block_number = receipt.get('blockNumber')
+            tx.gas_used = receipt.get('gasUsed')
+            tx.confirmed_at = datetime.utcnow()
+            if receipt.get('status') == 1:
+                tx.status = 'confirmed'
+                self._apply_receipt(tx, receipt)
+            else:
+                tx.status = 'failed'
+                tx.last_error = 'Transacción revertida'
+                self._run_hook(tx, 'on_fail')
+                logger.error(f"❌ Transacción {tx.kind} #{tx.id} revertida: {tx.tx_hash}")
+            processed += 1
+
+        db.session.commit()
+        return processed
+
+    def _apply_receipt(self, tx: BlockchainTx, receipt: Dict):
+        """Copiar ID on-chain, hash y bloque a la entidad de origen"""
+        spec = TX_KINDS[tx.kind]
+        service = getattr(self.integration, spec['service'])
+        try:
+            result = getattr(service, spec['extract'])(receipt)
+        except Exception as e:
+            logger.warning(f"No se pudo extraer el evento de {tx.kind} #{tx.id}: {e}")
+            result = None
+        tx.result_id = str(result) if result is not None else None
+
+        entity = db.session.get(spec['model'], tx.entity_id)
+        if entity is None:
+            return
+        if tx.result_id:
+            setattr(entity, spec['field'], tx.result_id)
+        if hasattr(entity, 'blockchain_tx_hash'):
+            entity.blockchain_tx_hash = tx.tx_hash
+        if hasattr(entity, 'blockchain_block_number'):
+            entity.blockchain_block_number = tx.block_number
+        if spec.get('on_confirm'):
+            spec['on_confirm'](tx, entity)
+        logger.info(f"✅ {tx.kind} #{tx.entity_id} confirmado en bloque {tx.block_number}")
+
+    def _run_hook(self, tx: BlockchainTx, hook: str):
+        spec = TX_KINDS[tx.kind]
+        if not spec.get(hook):
+            return
+        entity = db.session.get(spec['model'], tx.entity_id)
+        if entity is not None:
+            spec[hook](tx, entity)
+
+    def run_once(self) -> Dict:
+        return {'submitted': self.submit_pending(), 'confirmed': self.poll_receipts()}
+
+    def start(self, app):
+        """Iniciar el worker en segundo plano (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='tx-outbox', daemon=True)
+        self._thread.start()
+        logger.info("⛓️ Worker de outbox blockchain iniciado")
+
+    def _run(self, app):
+        while not self._stop.is_set():
+            with app.app_context():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"❌ Error en worker de outbox blockchain: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            self._stop.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+_worker: Optional[TxOutboxWorker] = None
+
+
+def start_tx_outbox_worker(app, integration) -> Optional[TxOutboxWorker]:
+    """Arrancar el worker salvo en modo simulación o con BLOCKCHAIN_OUTBOX_WORKER=false"""
+    global _worker
+    if getattr(integration.blockchain, 'simulation_mode', False) or integration.blockchain.w3 is None:
+        return None
+    if os.getenv('BLOCKCHAIN_OUTBOX_WORKER', 'true').lower() != 'true':
+        return None
+    if _worker is None:
+        _worker = TxOutboxWorker(
+            integration,
+            batch_size=int(os.getenv('BLOCKCHAIN_OUTBOX_BATCH', 20)),
+            poll_interval=float(os.getenv('BLOCKCHAIN_OUTBOX_INTERVAL', 2))
+        )
+    _worker.start(app)
+    return _worker
+
+
+if __name__ == '__main__':
+    # Ejecutar el worker como proceso independiente:
+    #   BLOCKCHAIN_OUTBOX_WORKER=false gunicorn ...  (API)
+    #   python -m services.tx_outbox                 (worker)
+    import time
+    from app_web3 import app, blockchain
+
+    os.environ['BLOCKCHAIN_OUTBOX_WORKER'] = 'true'
+    worker = start_tx_outbox_worker(app, blockchain)
+    if worker is None:
+        print("⚠️ Blockchain no disponible (modo simulación), el worker no se inicia")
+    else:
+        while True:
+            time.sleep(60)
@@ -0,0 +1,227 @@
+"""
+Ingesta de eventos de básculas (AgroWeight Cloud) para Triboka
+Recibe lotes de lecturas (array JSON o NDJSON) con un id_evento por lectura:
+valida todos los lotes del bloque con una consulta, inserta eventos y entradas
+de timeline con INSERT multi-fila, actualiza el TraceTimeline una vez por
+lote y hace un solo commit por bloque. Reenviar un id_evento ya registrado
+devuelve el evento existente (idempotencia por empresa).
+"""
+
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from models_simple import db, IngestedEventKey, ProducerLot, TimelineEntry, TraceEvent
+from services.public_trace import invalidate_public_snapshots
+from services.timeline import bump_timelines, entry_mapping
+
+logger = logging.getLogger(__name__)
+
+MAX_EVENTS = 10000
+CHUNK_SIZE = 1000
+# Máximo de errores devueltos en el informe (el total se cuenta siempre)
+MAX_REPORTED_ERRORS = 1000
+
+# Campos de la lectura que se guardan como mediciones del evento
+MEASUREMENT_FIELDS = {'peso_kg': 'weight_kg', 'humedad': 'moisture_content', 'temperatura': 'temperature_c'}
+
+
+def _parse_timestamp(value) -> datetime:
+    timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+class WeighingEventIngestor:
+    """Valida y registra eventos de báscula por bloques
+
+    Con require_key cada lectura debe traer id_evento (clave de idempotencia).
+    """
+
+    def __init__(self, company, chunk_size: int = CHUNK_SIZE, require_key: bool = True):
+        self.company_id = company.id
+        self.company_name = company.name
+        self.chunk_size = chunk_size
+        self.require_key = require_key
+        self._seen_keys = set()
+
+        self.received = 0
+        self.registered = 0
+        self.duplicates = 0
+        self.error_count = 0
+        self.errors: List[Dict] = []
+        self.events: List[Dict] = []
+
+    def _add_error(self, line: int, errors: List[str], event_key: Optional[str] = None):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'id_evento': event_key, 'errors': errors})
+
+    def validate_event(self, line: int, row: Dict) -> Tuple[Optional[Dict], List[str]]:
+        """Convertir una lectura en el mapping de TraceEvent o devolver sus errores"""
+        if '__error__' in row:
+            return None, [row['__error__']]
+
+        errors = []
+        event_key = str(row.get('id_evento') or '').strip() or None
+        if event_key is None and self.require_key:
+            errors.append('Campo requerido: id_evento')
+        elif event_key is not None and len(event_key) > 100:
+            errors.append('id_evento admite hasta 100 caracteres')
+        elif event_key is not None and event_key in self._seen_keys:
+            errors.append(f'id_evento repetido en el envío: {event_key}')
+
+        event_type = str(row.get('tipo') or '').strip()
+        if not event_type:
+            errors.append('Campo requerido: tipo')
+
+        try:
+            lot_id = int(row.get('lote_id'))
+        except (TypeError, ValueError):
+            errors.append('lote_id debe ser un entero')
+
+        measurements = dict(row['mediciones']) if isinstance(row.get('mediciones'), dict) else {}
+        for field, key in MEASUREMENT_FIELDS.items():
+            if row.get(field) in (None, ''):
+                continue
+            try:
+                measurements[key] = float(Decimal(str(row[field])))
+            except InvalidOperation:
+                errors.append(f'{field} no es numérico')
+
+        occurred_at = datetime.utcnow()
+        if row.get('timestamp'):
+            try:
+                occurred_at = _parse_timestamp(row['timestamp'])
+            except ValueError:
+                errors.append('timestamp debe tener formato ISO 8601')
+
+        if errors:
+            return None, errors
+
+        if event_key is not None:
+            self._seen_keys.add(event_key)
+        return {
+            'event_type': event_type[:100],
+            'entity_type': 'lot',
+            'entity_id': str(lot_id),
+            'title': f'Evento: {event_type}'[:255],
+            'description': row.get('descripcion') or f'Evento {event_type} registrado desde AgroWeight Cloud',
+            'location': row.get('ubicacion'),
+            'actor_name': self.company_name,
+            'event_data': json.dumps(row, default=str),
+            'measurements': json.dumps(measurements) if measurements else None,
+            'event_timestamp': occurred_at,
+            # Campos auxiliares (se retiran antes de insertar)
+            '_line': line,
+            '_key': event_key,
+            '_lot_id': lot_id
+        }, []
+
+    def run(self, rows: Iterable[Tuple[int, Dict]]) -> Dict:
+        chunk = []
+        for line, row in rows:
+            self.received += 1
+            if self.received > MAX_EVENTS:
+                self._add_error(line, [f'Máximo {MAX_EVENTS} eventos por envío'])
+                break
+            mapping, errors = self.validate_event(line, row)
+            if errors:
+                self._add_error(line, errors, row.get('id_evento'))
+                continue
+            chunk.append(mapping)
+            if len(chunk) >= self.chunk_size:
+                self._flush_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._flush_chunk(chunk)
+
+        logger.info(f"⚖️ Ingesta de básculas: {self.registered} registrados, {self.duplicates} duplicados, "
+                    f"{self.error_count} errores (empresa {self.company_id})")
+        return self.report()
+
+    def _flush_chunk(self, chunk: List[Dict], retry: bool = True):
+        """Registrar un bloque en una transacción (duplicados y lotes inexistentes se descartan)"""
+        keys = [m['_key'] for m in chunk if m['_key']]
+        existing = dict(db.session.query(IngestedEventKey.event_key, IngestedEventKey.trace_event_id).filter(
+            IngestedEventKey.company_id == self.company_id, IngestedEventKey.event_key.in_(keys)
+        )) if keys else {}
+        lot_ids = {lot_id for (lot_id,) in db.session.query(ProducerLot.id).filter(
+            ProducerLot.id.in_({m['_lot_id'] for m in chunk}))}
+
+        new = []
+        for mapping in chunk:
+            if mapping['_key'] in existing:
+                self.duplicates += 1
+                self.events.append({'id_evento': mapping['_key'], 'evento_id': existing[mapping['_key']],
+                                    'lote_id': mapping['_lot_id'], 'estado': 'duplicado'})
+            elif mapping['_lot_id'] not in lot_ids:
+                self._add_error(mapping['_line'], [f"Lote no encontrado: {mapping['_lot_id']}"], mapping['_key'])
+            else:
+                new.append(mapping)
+        if not new:
+            return
+
+        try:
+            created_at = datetime.utcnow()
+            rows = [dict({k: v for k, v in m.items() if not k.startswith('_')}, created_at=created_at) for m in new]
+            # INSERT multi-fila con RETURNING. El orden devuelto no está garantizado, así que
+            # los ids se asignan por event_data (la lectura original, única por id_evento);
+            # filas con el mismo event_data son idénticas y cualquier asignación vale.
+            returned = defaultdict(list)
+            for event_id, event_data in db.session.execute(
+                    insert(TraceEvent).returning(TraceEvent.id, TraceEvent.event_data), rows):
+                returned[event_data].append(event_id)
+            events = [TraceEvent(id=returned[row['event_data']].pop(), **row) for row in rows]
+
+            db.session.bulk_insert_mappings(TimelineEntry, [entry_mapping(event) for event in events])
+            stats = {}
+            for event in events:
+                count, started = stats.get(event.entity_id, (0, event.event_timestamp))
+                stats[event.entity_id] = (count + 1, min(started, event.event_timestamp))
+            bump_timelines('lot', stats)
+            # INSERT directo: el listener de after_flush no ve estos eventos
+            invalidate_public_snapshots(db.session.connection(), (('lot', lot_id) for lot_id in stats))
+
+            db.session.bulk_insert_mappings(IngestedEventKey, [{
+                'company_id': self.company_id,
+                'event_key': m['_key'],
+                'trace_event_id': event.id,
+                'lot_id': m['_lot_id']
+            } for m, event in zip(new, events) if m['_key']])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if not retry:
+                raise
+            # Otro envío registró las mismas claves a la vez: ahora son duplicados
+            self._flush_chunk(new, retry=False)
+            return
+
+        self.registered += len(new)
+        self.events += [{'id_evento': m['_key'], 'evento_id': event.id, 'lote_id': m['_lot_id'],
+                         'estado': 'registrado', 'timestamp': event.event_timestamp.isoformat()}
+                        for m, event in zip(new, events)]
+
+    def report(self) -> Dict:
+        return {
+            'success': self.error_count == 0,
+            'recibidos': self.received,
+            'registrados': self.registered,
+            'duplicados': self.duplicates,
+            'rechazados': self.error_count,
+            'errores': self.errors,
+            'eventos': self.events
+        }
+
+
+def ingest_weighing_events(rows: Iterable[Tuple[int, Dict]], company, **options) -> Dict:
+    """Registrar lecturas de báscula (como (línea, dict)) y devolver el informe"""
+    return WeighingEventIngestor(company, **options).run(rows)
@@ -10,6 +10,7 @@ from flask import Flask
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 import sys
+from sqlalchemy import event
 
 # Agregar el directorio padre al path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -63,6 +64,35 @@ def test_user(db_session):
     db_session.session.commit()
     return user
 
+@pytest.fixture
+def capture_queries(db_session):
+    """Capturar las sentencias SQL ejecutadas desde la llamada hasta el fin del test
+
+    capture_queries() devuelve la lista de todas las sentencias;
+    capture_queries('FROM companies', ...) solo las que contienen algún fragmento.
+    """
+    listeners = []
+
+    def capture(*fragments):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if not fragments or any(fragment in statement for fragment in fragments):
+                statements.append(statement)
+
+        event.listen(db_session.engine, 'before_cursor_execute', before_cursor_execute)
+        listeners.append(before_cursor_execute)
+        return statements
+
+    yield capture
+    for listener in listeners:
+        event.remove(db_session.engine, 'before_cursor_execute', listener)
+
+@pytest.fixture
+def count_queries(capture_queries):
+    """Todas las sentencias SQL ejecutadas durante el test"""
+    return capture_queries()
+
 @pytest.fixture
 def test_company(db_session):
     """Empresa de prueba"""
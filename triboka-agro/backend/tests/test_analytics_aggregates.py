@@ -0,0 +1,126 @@
+# tests/test_analytics_aggregates.py
+"""
+Tests para los agregados SQL del motor de analytics
+"""
+
+import json
+from datetime import date, datetime
+
+import numpy as np
+import pytest
+
+from models_simple import Company, ContractFixation, ExportContract, ProducerLot, TraceEvent
+from routes.analytics import AnalyticsEngine
+
+START, END = date(2025, 3, 1), date(2025, 3, 31)
+DAY = datetime(2025, 3, 10, 12)
+
+supply_chain = AnalyticsEngine.get_supply_chain_metrics.__wrapped__
+financial = AnalyticsEngine.get_financial_analytics.__wrapped__
+quality = AnalyticsEngine.get_quality_analytics.__wrapped__
+
+
+def seed(db_session, scale=1, tag=''):
+    buyer = Company(name='Chocolates Europa', company_type='buyer')
+    db_session.session.add(buyer)
+    db_session.session.flush()
+    for i in range(scale):
+        contract = ExportContract(contract_code=f'{tag}C-{i}', buyer_company_id=buyer.id, product_type='Cacao CCN51',
+                                  total_volume_mt=20, differential_usd=100 + i % 2 * 50, status='active',
+                                  created_at=DAY)
+        blend = ExportContract(contract_code=f'{tag}CB-{i}', buyer_company_id=buyer.id, product_type=None,
+                               total_volume_mt=5, differential_usd=0, status='draft', created_at=DAY)
+        db_session.session.add_all([contract, blend])
+        db_session.session.flush()
+        db_session.session.add_all([
+            ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=10, spot_price_usd=3000,
+                             total_value_usd=30000, fixation_date=DAY, created_at=DAY),
+            ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=5, spot_price_usd=3400,
+                             total_value_usd=17000, fixation_date=datetime(2025, 3, 20), created_at=DAY),
+            ContractFixation(export_contract_id=blend.id, fixed_quantity_mt=1, spot_price_usd=2900,
+                             total_value_usd=2900, fixation_date=DAY, created_at=DAY),
+            ProducerLot(lot_code=f'{tag}L-{i}', weight_kg=1500, quality_grade='A', moisture_content=7,
+                        created_at=DAY),
+            ProducerLot(lot_code=f'{tag}LB-{i}', weight_kg=500, quality_grade='B', moisture_content=None,
+                        created_at=DAY),
+            TraceEvent(event_type='CALIDAD', entity_type='batch', entity_id=str(i), title='Control',
+                       measurements=json.dumps({'defect_rate': 4 + i % 3}), event_timestamp=DAY),
+            TraceEvent(event_type='SHIPMENT', entity_type='batch', entity_id=str(i), title='Embarque',
+                       event_timestamp=DAY),
+            TraceEvent(event_type='DRYING', entity_type='lot', entity_id=str(i), title='Secado',
+                       event_timestamp=datetime(2025, 3, 11)),
+        ])
+    db_session.session.commit()
+
+
+@pytest.fixture
+def engine():
+    return AnalyticsEngine()
+
+
+class TestSupplyChainMetrics:
+    """Tests para las métricas de cadena de suministro"""
+
+    def test_metrics(self, db_session, engine):
+        seed(db_session)
+
+        metrics = supply_chain(engine, START, END)
+
+        assert metrics['contracts']['total'] == 2
+        assert metrics['contracts']['by_status'] == {'active': 1, 'draft': 1}
+        assert metrics['contracts']['total_volume_mt'] == 25.0
+        assert metrics['contracts']['avg_differential'] == 100.0
+        assert metrics['fixations']['total_value_usd'] == 49900.0
+        assert metrics['lots']['total_volume_mt'] == 2.0
+        assert metrics['lots']['avg_humidity'] == 7.0
+        assert metrics['traceability']['events_per_day'] == {'2025-03-10': 2, '2025-03-11': 1}
+        assert metrics['traceability']['supply_chain_stages']['export'] == {'events': 1, 'unique_batches': 1}
+        assert metrics['traceability']['supply_chain_stages']['processing'] == {'events': 1, 'unique_batches': 0}
+
+    def test_query_count_independent_of_rows(self, db_session, engine, count_queries):
+        seed(db_session)
+        count_queries.clear()
+        supply_chain(engine, START, END)
+        financial(engine, START, END)
+        few = len(count_queries)
+
+        seed(db_session, scale=20, tag='x')
+        count_queries.clear()
+        supply_chain(engine, START, END)
+        financial(engine, START, END)
+
+        assert len(count_queries) == few
+
+
+class TestFinancialAnalytics:
+    """Tests para el análisis financiero"""
+
+    def test_revenue_and_prices(self, db_session, engine):
+        seed(db_session)
+
+        analytics = financial(engine, START, END)
+
+        assert analytics['revenue']['total_usd'] == 49900.0
+        assert analytics['revenue']['by_month'] == {'2025-03': 49900.0}
+        assert analytics['revenue']['by_product_type'] == {'Cacao CCN51': 47000.0, 'Unknown': 2900.0}
+        prices = np.array([3000, 3400, 2900])
+        assert analytics['price_trends']['avg_price'] == pytest.approx(prices.mean())
+        assert analytics['price_trends']['price_volatility'] == pytest.approx(prices.std(ddof=1))
+        assert analytics['price_trends']['by_product']['count'] == {'Cacao CCN51': 2, 'Unknown': 1}
+        assert analytics['market_insights']['top_buyers'] == [{'buyer': 'Chocolates Europa', 'revenue_usd': 49900.0}]
+        assert analytics['market_insights']['price_distribution']['quartiles']['50'] == 3000.0
+
+    def test_empty_window(self, db_session, engine):
+        analytics = financial(engine, START, END)
+        assert analytics['revenue'] == {}
+        assert analytics['price_trends'] == {}
+
+
+def test_quality_analytics(db_session, engine):
+    seed(db_session, scale=3)
+
+    analytics = quality(engine, START, END)
+
+    assert analytics['quality_distribution'] == {'A': 3, 'B': 3}
+    assert analytics['defect_rates']['avg_defect_rate'] == 5.0
+    assert analytics['defect_rates']['acceptable_rate'] == pytest.approx(200 / 3)
@@ -0,0 +1,107 @@
+# tests/test_api_keys.py
+"""
+Tests para las API keys hasheadas, su cache por proceso y los contadores por clave
+"""
+
+import pytest
+from flask import g, jsonify
+
+from models_simple import Company
+from services.api_keys import (
+    api_key_cache, api_key_usage, authenticate_api_key, hash_api_key, key_prefix, require_api_key, set_api_key
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    api_key_cache.clear()
+    api_key_usage.reset()
+    yield
+    api_key_cache.clear()
+    api_key_usage.reset()
+
+
+@pytest.fixture
+def company_key(db_session, test_company):
+    api_key = set_api_key(test_company)
+    db_session.session.commit()
+    return api_key
+
+
+@pytest.fixture
+def company_queries(capture_queries):
+    return capture_queries('FROM companies')
+
+
+@require_api_key
+def whoami():
+    return jsonify({'company_id': g.company.id, 'name': g.company.name})
+
+
+def call(app, api_key):
+    with app.test_request_context(headers={'Authorization': f'Bearer {api_key}'}):
+        return whoami()
+
+
+class TestApiKeys:
+    """Tests para el almacenamiento y la validación de claves"""
+
+    def test_key_is_stored_hashed(self, db_session, test_company, company_key):
+        company = db_session.session.get(Company, test_company.id)
+
+        assert company.api_key is None
+        assert company.api_key_prefix == key_prefix(company_key)
+        assert company.api_key_hash == hash_api_key(company_key)
+        assert company_key not in (company.api_key_prefix, company.api_key_hash)
+
+    def test_validated_key_skips_database(self, db_session, test_company, company_key, company_queries):
+        assert authenticate_api_key(company_key).id == test_company.id
+        db_session.session.remove()
+        company_queries.clear()
+
+        company = authenticate_api_key(company_key)
+
+        assert company.name == 'Test Company'
+        assert company_queries == []
+        assert api_key_cache.stats()['hits'] == 1
+
+    def test_wrong_key_with_same_prefix_is_rejected(self, db_session, company_key):
+        assert authenticate_api_key(company_key[:-1] + ('a' if company_key[-1] != 'a' else 'b')) is None
+
+    def test_rotation_invalidates_cached_key(self, db_session, test_company, company_key):
+        authenticate_api_key(company_key)
+
+        new_key = set_api_key(test_company)
+        db_session.session.commit()
+
+        assert authenticate_api_key(company_key) is None
+        assert authenticate_api_key(new_key).id == test_company.id
+
+    def test_lookup_started_before_rotation_is_not_cached(self, db_session, test_company, company_key):
+        generation = api_key_cache.generation
+        api_key_cache.invalidate_company(test_company.id)
+
+        api_key_cache.set(hash_api_key(company_key), test_company, generation)
+
+        assert api_key_cache.get(hash_api_key(company_key)) is None
+
+
+class TestRequireApiKey:
+    """Tests para el decorador compartido y los contadores por clave"""
+
+    def test_decorator_sets_company_and_counts_usage(self, app, db_session, test_company, company_key):
+        for _ in range(3):
+            response = call(app, company_key)
+
+        assert response.status_code == 200
+        assert response.get_json() == {'company_id': test_company.id, 'name': 'Test Company'}
+        usage = api_key_usage.snapshot()[key_prefix(company_key)]
+        assert (usage['company_id'], usage['count'], usage['errors']) == (test_company.id, 3, 0)
+        assert usage['requests_last_minute'] == 3
+
+    def test_invalid_key_is_rejected(self, app, db_session, company_key):
+        response, status_code = call(app, 'tbk_no-existe')
+
+        assert status_code == 401
+        assert response.get_json()['error'] == 'API key inválida'
+        assert api_key_usage.snapshot() == {}
@@ -0,0 +1,103 @@
+# tests/test_batch_lots.py
+"""
+Tests para el índice lote -> batch (batch_lots)
+"""
+
+import json
+import pytest
+
+from flask_jwt_extended import create_access_token
+
+from models_simple import Company, ProducerLot, BatchNFT, BatchLot, User
+from app_web3 import _link_batch_lots, crear_batch_nft, get_batch_detail, get_batches
+from services.api_keys import set_api_key
+from migrate_batch_lots import resolve_lot_ids
+
+
+class TestBatchLotIndex:
+    """Tests para la sincronización y el backfill de batch_lots"""
+
+    @pytest.fixture
+    def lots(self, db_session, test_company):
+        created = [
+            ProducerLot(lot_code=f'LOT-BL-{i}', producer_company_id=test_company.id,
+                        weight_kg=500 * (i + 1), status='purchased')
+            for i in range(3)
+        ]
+        db_session.session.add_all(created)
+        db_session.session.commit()
+        return created
+
+    def test_link_batch_lots(self, db_session, test_company, lots):
+        """Crear un batch registra un vínculo por lote con su peso"""
+        batch = BatchNFT(batch_code='BATCH-BL-1', source_lot_ids=json.dumps([l.id for l in lots[:2]]),
+                         total_weight_kg=1500, creator_company_id=test_company.id)
+        db_session.session.add(batch)
+        db_session.session.flush()
+        _link_batch_lots(batch, lots[:2])
+        db_session.session.commit()
+
+        links = BatchLot.query.filter_by(lot_id=lots[1].id).all()
+        assert len(links) == 1
+        assert links[0].batch_id == batch.id
+        assert float(links[0].weight_kg) == 1000.0
+        assert BatchLot.query.filter_by(lot_id=lots[2].id).count() == 0
+
+    def test_resolve_ids_and_codes(self, lots):
+        """El backfill resuelve IDs numéricos y códigos de lote conservando el orden"""
+        resolved = resolve_lot_ids([lots[2].id, 'LOT-BL-0', str(lots[1].id), 'NO-EXISTE'])
+
+        assert [lot.id if lot else None for lot in resolved] == [lots[2].id, lots[0].id, lots[1].id, None]
+
+    def test_repeated_lot_counted_once(self, app, db_session, test_company, lots):
+        """Un lote enviado dos veces a /api/batch-nft se vincula y se pesa una sola vez"""
+        api_key = set_api_key(test_company)
+        db_session.session.commit()
+        body = {'batch_code': 'BATCH-BL-DUP', 'lotes': [{'id': lots[0].id}, {'id': str(lots[0].id)}, {'id': lots[1].id}]}
+
+        with app.app_context(), app.test_request_context(json=body, headers={'Authorization': f'Bearer {api_key}'}):
+            response = app.make_response(crear_batch_nft())
+
+        assert response.status_code == 200, response.get_json()
+        batch = BatchNFT.query.filter_by(batch_code='BATCH-BL-DUP').one()
+        assert float(batch.total_weight_kg) == 1500.0
+        assert json.loads(batch.source_lot_ids) == [lots[0].id, lots[1].id]
+        assert BatchLot.query.filter_by(batch_id=batch.id).count() == 2
+
+
+class TestProducerBatchAccess:
+    """Tests para los batches visibles por un productor (vía batch_lots)"""
+
+    def call_as(self, app, user, view, *args):
+        token = create_access_token(identity=str(user.id))
+        with app.app_context(), app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+            return app.make_response(view(*args))
+
+    def test_producer_sees_batches_with_own_lots(self, app, db_session, test_company, capture_queries):
+        other = Company(name='Otra Finca', company_type='producer')
+        db_session.session.add(other)
+        db_session.session.flush()
+        own = ProducerLot(lot_code='LOT-OWN', producer_company_id=test_company.id, weight_kg=100)
+        foreign = ProducerLot(lot_code='LOT-FOREIGN', producer_company_id=other.id, weight_kg=100)
+        db_session.session.add_all([own, foreign])
+        db_session.session.flush()
+        batches = []
+        for code, lots in (('B-OWN', [own, foreign]), ('B-FOREIGN', [foreign])):
+            batch = BatchNFT(batch_code=code, source_lot_ids=json.dumps([l.id for l in lots]),
+                             total_weight_kg=100 * len(lots), creator_company_id=other.id)
+            db_session.session.add(batch)
+            db_session.session.flush()
+            _link_batch_lots(batch, lots)
+            batches.append(batch)
+        producer = User(email='prod@x.com', name='P', password_hash='x', role='producer', company_id=test_company.id)
+        db_session.session.add(producer)
+        db_session.session.commit()
+
+        statements = capture_queries('FROM batch_nfts')
+        listed = self.call_as(app, producer, get_batches).get_json()
+
+        assert [b['batch_code'] for b in listed] == ['B-OWN']
+        assert len(statements) == 1
+        # Solo se verifica el control de acceso del detalle
+        assert self.call_as(app, producer, get_batch_detail, batches[0].id).status_code != 403
+        assert self.call_as(app, producer, get_batch_detail, batches[1].id).status_code == 403
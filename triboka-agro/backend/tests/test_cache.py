@@ -0,0 +1,233 @@
+# tests/test_cache.py
+"""
+Tests para el cache de dos niveles (LRU local + Redis)
+"""
+
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+
+from services.cache import LocalLRUCache, TwoTierCache, scan_delete
+
+
+class TestLocalLRUCache:
+    """Tests para el nivel en memoria"""
+
+    def test_eviction_when_full(self):
+        """Al superar el límite se desaloja la entrada menos usada"""
+        cache = LocalLRUCache(max_entries=2)
+        cache.set('a', '1', ttl=60)
+        cache.set('b', '2', ttl=60)
+        cache.get('a')  # 'a' pasa a ser la más reciente
+        cache.set('c', '3', ttl=60)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == '1'
+        assert cache.evictions == 1
+
+    def test_ttl_expiration(self):
+        """Las entradas expiradas no se devuelven"""
+        cache = LocalLRUCache()
+        cache.set('a', '1', ttl=0.05)
+        time.sleep(0.06)
+
+        assert cache.get('a') is None
+        assert cache.expirations == 1
+
+
+class TestTwoTierCache:
+    """Tests para el cache combinado"""
+
+    @pytest.fixture
+    def cache(self):
+        return TwoTierCache(lambda: None)
+
+    def test_works_without_redis(self, cache):
+        """Sin Redis el cache sigue sirviendo desde memoria"""
+        cache.set('k', {'total': 3}, ttl=60)
+
+        assert cache.get('k') == {'total': 3}
+        assert cache.get_stats()['local_hits'] == 1
+
+    def test_local_ttl_capped_without_redis(self):
+        """Sin Redis las entradas locales expiran a local_ttl_cap (los demás workers no ven la invalidación)"""
+        cache = TwoTierCache(lambda: None, local_ttl_cap=0.05)
+        cache.set('k', [1], ttl=300)
+        time.sleep(0.06)
+
+        assert cache.get('k') is None
+
+    def test_returns_independent_copies(self, cache):
+        """Modificar un valor leído no altera el cache"""
+        cache.set('k', {'items': [1]}, ttl=60)
+        cache.get('k')['items'].append(2)
+
+        assert cache.get('k') == {'items': [1]}
+
+    def test_invalidate_tags(self, cache):
+        """Invalidar un tag elimina solo sus entradas"""
+        cache.set('lots:a', 1, ttl=60, tags=['lots'])
+        cache.set('companies:a', 2, ttl=60, tags=['companies'])
+
+        cache.invalidate_tags('lots')
+
+        assert cache.get('lots:a') is None
+        assert cache.get('companies:a') == 2
+
+    def test_single_flight(self, cache):
+        """Llamadas concurrentes por la misma clave calculan una sola vez"""
+        calls = []
+        started = threading.Event()
+
+        def slow_compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return {'value': 42}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', slow_compute)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert results == [{'value': 42}] * 5
+
+    def test_redis_failure_falls_back_to_memory(self):
+        """Un error de Redis no rompe el cache y suspende los reintentos"""
+        redis_client = MagicMock()
+        redis_client.get.side_effect = ConnectionError('down')
+        redis_client.pipeline.side_effect = ConnectionError('down')
+        cache = TwoTierCache(lambda: redis_client, redis_retry_seconds=60)
+
+        cache.set('k', [1, 2], ttl=60)
+
+        assert cache.get('k') == [1, 2]
+        assert cache.get('otra') is None
+        assert cache.get_stats()['redis_errors'] == 1
+        assert cache.get_stats()['redis_available'] is False
+
+    def test_redis_hit_populates_local(self):
+        """Un acierto en Redis se copia al nivel local"""
+        redis_client = MagicMock()
+        redis_client.get.return_value = '{"a": 1}'
+        cache = TwoTierCache(lambda: redis_client)
+
+        assert cache.get('k') == {'a': 1}
+        assert cache.get('k') == {'a': 1}
+        assert redis_client.get.call_count == 1
+        assert cache.get_stats()['redis_hits'] == 1
+
+
+class FakeRedis:
+    """Redis en memoria con las operaciones que usa TwoTierCache"""
+
+    def __init__(self):
+        self.values, self.sets = {}, {}
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        return []
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def expire(self, key, ttl):
+        pass
+
+    def sscan_iter(self, key, count=None):
+        return iter(list(self.sets.get(key, ())))
+
+    def unlink(self, *keys):
+        return sum(1 for key in keys if self.values.pop(key, None) is not None or self.sets.pop(key, None) is not None)
+
+    def srem(self, key, *members):
+        self.sets.get(key, set()).difference_update(members)
+
+
+class TestSharedTier:
+    """Tests para la promoción de entradas de Redis al nivel local"""
+
+    def test_promoted_entry_keeps_tags(self):
+        """Una copia traída de Redis se invalida con sus tags en el mismo worker"""
+        redis_client = FakeRedis()
+        writer, reader = TwoTierCache(lambda: redis_client), TwoTierCache(lambda: redis_client)
+        writer.set('lots:a', [1], ttl=60, tags=['lots'])
+
+        assert reader.get('lots:a') == [1]
+        assert reader.local.count_tag('lots') == 1
+
+        reader.invalidate_tags('lots')
+
+        assert reader.get('lots:a') is None
+
+    def test_untagged_legacy_value(self):
+        """Valores guardados sin cabecera de tags se siguen leyendo"""
+        redis_client = FakeRedis()
+        redis_client.values['k'] = '{"a": 1}'
+
+        assert TwoTierCache(lambda: redis_client).get('k') == {'a': 1}
+
+
+class TestCacheKeyRegistry:
+    """Tests para el registro de claves por namespace y los borrados con SCAN"""
+
+    def test_scan_delete_in_batches(self):
+        """scan_delete borra por lotes sin usar KEYS"""
+        redis_client = MagicMock()
+        redis_client.scan_iter.return_value = iter([f'lots:{i}' for i in range(5)])
+        redis_client.unlink.side_effect = lambda *keys: len(keys)
+
+        deleted = scan_delete(redis_client, 'lots:*', batch_size=2)
+
+        assert deleted == 5
+        assert redis_client.unlink.call_count == 3
+        redis_client.keys.assert_not_called()
+
+    def test_set_registers_namespace(self):
+        """Escribir una clave la registra en el set de su namespace"""
+        redis_client = MagicMock()
+        pipe = redis_client.pipeline.return_value
+        cache = TwoTierCache(lambda: redis_client)
+
+        cache.set('lots:a', 1, ttl=60, tags=['lots'])
+
+        pipe.sadd.assert_any_call('cache:tags:lots', 'lots:a')
+        pipe.sadd.assert_any_call('cache:namespaces', 'lots')
+
+    def test_namespace_sizes_without_redis(self):
+        """Sin Redis los conteos salen del nivel local"""
+        cache = TwoTierCache(lambda: None)
+        cache.set('lots:a', 1, ttl=60, tags=['lots'])
+        cache.set('lots:b', 2, ttl=60, tags=['lots'])
+
+        assert cache.namespaces() == ['lots']
+        assert cache.namespace_sizes() == {'lots': 2}
+
+    def test_invalidate_uses_registry(self):
+        """La invalidación recorre el set del namespace con SSCAN"""
+        redis_client = MagicMock()
+        redis_client.sscan_iter.return_value = iter(['lots:a', 'lots:b'])
+        redis_client.unlink.side_effect = lambda *keys: len(keys)
+        cache = TwoTierCache(lambda: redis_client)
+
+        removed = cache.invalidate_tags('lots')
+
+        assert removed == 2
+        redis_client.sscan_iter.assert_called_once()
+        redis_client.flushdb.assert_not_called()
+        redis_client.srem.assert_called_once_with('cache:namespaces', 'lots')
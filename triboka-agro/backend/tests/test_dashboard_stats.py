@@ -0,0 +1,168 @@
+# tests/test_dashboard_stats.py
+"""
+Tests para los contadores incrementales del dashboard
+"""
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import mysql, postgresql
+
+from models_simple import BatchNFT, Company, CompanyDashboardStats, ContractFixation, ExportContract, ProducerLot
+from services.dashboard_stats import (
+    PLATFORM_ID, apply_deltas, compute_dashboard_stats, get_dashboard_stats, rebuild_dashboard_stats, record_new_lots
+)
+
+
+@pytest.fixture
+def companies(db_session):
+    producer = Company(name='Finca Norte', company_type='producer')
+    exporter = Company(name='Exportadora Sur', company_type='exporter')
+    buyer = Company(name='Chocolates Europa', company_type='buyer')
+    db_session.session.add_all([producer, exporter, buyer])
+    db_session.session.commit()
+    return producer, exporter, buyer
+
+
+def stored_stats(db_session):
+    """Contadores incrementales de todas las filas (sin ceros)"""
+    rows = {}
+    for company_id in compute_dashboard_stats(db_session.session.connection()).keys() | {PLATFORM_ID}:
+        rows[company_id] = {k: v for k, v in get_dashboard_stats(company_id).items() if v}
+    return rows
+
+
+def recomputed_stats(db_session):
+    return {company_id: {k: float(v) if not isinstance(v, int) else v for k, v in columns.items() if v}
+            for company_id, columns in compute_dashboard_stats(db_session.session.connection()).items()}
+
+
+class TestIncrementalCounters:
+    """Tests para los deltas aplicados en after_flush"""
+
+    def test_lot_lifecycle(self, db_session, companies):
+        producer, exporter, _ = companies
+        lot = ProducerLot(lot_code='L-1', producer_company_id=producer.id, weight_kg=1000,
+                          harvest_date=datetime(2025, 1, 1))
+        db_session.session.add(lot)
+        db_session.session.commit()
+
+        stats = get_dashboard_stats(producer.id)
+        assert (stats['lots_total'], stats['lots_available'], stats['lots_weight_kg']) == (1, 1, 1000.0)
+
+        lot.status = 'purchased'
+        lot.purchased_by_company_id = exporter.id
+        lot.purchase_price_usd = 2500
+        db_session.session.commit()
+
+        stats = get_dashboard_stats(producer.id)
+        assert (stats['lots_available'], stats['lots_purchased'], stats['lots_revenue_usd']) == (0, 1, 2500.0)
+        assert get_dashboard_stats(exporter.id)['purchased_lots'] == 1
+        assert get_dashboard_stats(PLATFORM_ID)['lots_available'] == 0
+
+        db_session.session.delete(lot)
+        db_session.session.commit()
+
+        assert get_dashboard_stats(producer.id)['lots_total'] == 0
+        assert get_dashboard_stats(exporter.id)['purchased_weight_kg'] == 0
+
+    def test_matches_reconciliation(self, db_session, companies):
+        producer, exporter, buyer = companies
+        contract = ExportContract(contract_code='C-1', exporter_company_id=exporter.id,
+                                  buyer_company_id=buyer.id, total_volume_mt=25, status='active')
+        lots = [ProducerLot(lot_code=f'L-{i}', producer_company_id=producer.id, weight_kg=500 + i,
+                            harvest_date=datetime(2025, 1, 1)) for i in range(5)]
+        db_session.session.add_all([contract, *lots])
+        db_session.session.flush()
+        db_session.session.add(ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=5))
+        db_session.session.add(BatchNFT(batch_code='B-1', creator_company_id=exporter.id,
+                                        total_weight_kg=1001, status='available'))
+        db_session.session.commit()
+
+        lots[0].export_contract_id = contract.id
+        lots[0].status = 'purchased'
+        lots[0].purchased_by_company_id = exporter.id
+        lots[1].weight_kg = 700
+        contract.fixed_volume_mt = 5
+        contract.status = 'completed'
+        db_session.session.commit()
+
+        expected = recomputed_stats(db_session)
+        assert stored_stats(db_session) == expected
+        assert expected[exporter.id]['exporter_fixations'] == 1
+        assert expected[PLATFORM_ID]['companies_total'] == 3
+
+    def test_bulk_inserted_lots(self, db_session, companies):
+        producer = companies[0]
+        mappings = [{'lot_code': f'I-{i}', 'producer_company_id': producer.id, 'weight_kg': 100,
+                     'status': 'available'} for i in range(3)]
+        db_session.session.bulk_insert_mappings(ProducerLot, mappings)
+        record_new_lots(db_session.session.connection(), mappings)
+        db_session.session.commit()
+
+        assert get_dashboard_stats(producer.id)['lots_available'] == 3
+        assert stored_stats(db_session) == recomputed_stats(db_session)
+
+    def test_reconciliation_fixes_drift(self, db_session, companies):
+        producer = companies[0]
+        db_session.session.add(ProducerLot(lot_code='L-1', producer_company_id=producer.id, weight_kg=10))
+        db_session.session.commit()
+        # UPDATE masivo: no pasa por after_flush
+        ProducerLot.query.update({'status': 'batched'})
+        db_session.session.commit()
+        assert get_dashboard_stats(producer.id)['lots_available'] == 1
+
+        rebuild_dashboard_stats(db_session.session.connection())
+        db_session.session.commit()
+
+        assert get_dashboard_stats(producer.id)['lots_available'] == 0
+        assert get_dashboard_stats(producer.id)['lots_total'] == 1
+
+    def test_reconciliation_drops_stale_rows(self, db_session, companies):
+        producer = companies[0]
+        db_session.session.add(CompanyDashboardStats(company_id=9999, lots_total=4))
+        db_session.session.add(ProducerLot(lot_code='L-1', producer_company_id=producer.id, weight_kg=10))
+        db_session.session.commit()
+
+        rebuild_dashboard_stats(db_session.session.connection())
+        db_session.session.commit()
+
+        assert db_session.session.get(CompanyDashboardStats, 9999) is None
+        assert stored_stats(db_session) == recomputed_stats(db_session)
+
+
+class TestUpsert:
+    """Tests para la escritura concurrente de los contadores"""
+
+    def test_first_write_is_an_upsert(self, db_session, companies, capture_queries):
+        statements = capture_queries('company_dashboard_stats')
+        db_session.session.add(ProducerLot(lot_code='L-1', producer_company_id=companies[0].id, weight_kg=10))
+        db_session.session.commit()
+
+        writes = [s for s in statements if not s.lstrip().upper().startswith('SELECT')]
+        assert writes and all('ON CONFLICT (company_id) DO UPDATE' in s for s in writes)
+        assert get_dashboard_stats(companies[0].id)['lots_total'] == 1
+
+    @pytest.mark.parametrize('dialect, clause', [
+        (postgresql.dialect(), 'ON CONFLICT (company_id) DO UPDATE SET lots_total = (company_dashboard_stats.lots_total + excluded.lots_total)'),
+        (mysql.dialect(), 'ON DUPLICATE KEY UPDATE lots_total = (company_dashboard_stats.lots_total + VALUES(lots_total))'),
+    ])
+    def test_upsert_per_dialect(self, dialect, clause):
+        executed = []
+        connection = SimpleNamespace(dialect=dialect, execute=executed.append)
+
+        apply_deltas(connection, {7: {'lots_total': 1}})
+
+        assert clause in str(executed[0].compile(dialect=dialect))
+
+
+def test_dashboard_read_is_single_query(db_session, companies, capture_queries):
+    company_id = companies[0].id
+    db_session.session.expire_all()
+    statements = capture_queries()
+    stats = get_dashboard_stats(company_id)
+
+    assert stats['lots_total'] == 0
+    assert len(statements) == 1
+    assert get_dashboard_stats(None)['lots_total'] == 0
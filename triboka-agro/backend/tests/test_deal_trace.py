@@ -0,0 +1,119 @@
+# tests/test_deal_trace.py
+"""
+Tests para el ensamblado y cache de la trazabilidad de deals
+"""
+
+import json
+from datetime import datetime
+
+import pytest
+
+from models_simple import (
+    BatchNFT, Company, ContractFixation, Deal, DealMessage, DealTraceLink, ExportContract, ProducerLot
+)
+from routes.performance import cache_layer, invalidate_cache_tags
+from services.deal_trace import build_deal_trace
+from app_web3 import get_deal_trace_cached
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache_layer.clear_local()
+    yield
+    cache_layer.clear_local()
+
+
+@pytest.fixture
+def deal(db_session, test_user):
+    producer = Company(name='Finca Norte', company_type='producer')
+    exporter = Company(name='Exportadora Sur', company_type='exporter')
+    db_session.session.add_all([producer, exporter])
+    db_session.session.flush()
+    deal = Deal(deal_code='D-1', admin_id=test_user.id, producer_id=producer.id, exporter_id=exporter.id)
+    db_session.session.add(deal)
+    db_session.session.commit()
+    return deal
+
+
+def add_links(db_session, deal, count, start=0):
+    for i in range(start, start + count):
+        lot = ProducerLot(lot_code=f'LOT-{i}', producer_company_id=deal.producer_id, weight_kg=1000,
+                          harvest_date=datetime(2025, 1, 1 + i % 28), status='purchased',
+                          purchase_date=datetime(2025, 2, 1), purchased_by_company_id=deal.exporter_id)
+        batch = BatchNFT(batch_code=f'B-{i}', creator_company_id=deal.exporter_id, total_weight_kg=1000)
+        db_session.session.add_all([lot, batch])
+        db_session.session.flush()
+        db_session.session.add(DealTraceLink(deal_id=deal.id, lote_ids=json.dumps([lot.id]),
+                                             batch_ids=json.dumps([batch.id]), events='[]'))
+    db_session.session.commit()
+
+
+class TestDealTraceBuilder:
+    """Tests para el builder compartido por JSON, filtro y PDF"""
+
+    def test_timeline_contents(self, db_session, deal):
+        add_links(db_session, deal, 1)
+        link = DealTraceLink.query.one()
+        link.events = json.dumps([{'id': 'x', 'title': 'Inspección', 'timestamp': '2025-03-01T00:00:00'}])
+        contract = ExportContract(contract_code='C-1', exporter_company_id=deal.exporter_id,
+                                  buyer_company_id=deal.producer_id, total_volume_mt=10)
+        db_session.session.add(contract)
+        db_session.session.flush()
+        db_session.session.add(ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=5,
+                                                spot_price_usd=3000, total_value_usd=15000))
+        db_session.session.add(DealMessage(deal_id=deal.id, author_id=deal.admin_id, content='Archivo',
+                                           message_type='file_upload'))
+        db_session.session.commit()
+
+        trace = build_deal_trace(deal)
+
+        types = [e['type'] for e in trace['timeline']]
+        assert sorted(types) == sorted(['deal_created', 'lote_created', 'harvest', 'purchase', 'batch_created',
+                                        'custom', 'contract_created', 'fixation', 'file_upload'])
+        assert [e['timestamp'] for e in trace['timeline']] == sorted(e['timestamp'] for e in trace['timeline'])
+        assert trace['summary']['entities'] == {'lotes': 1, 'batches': 1, 'contracts': 1, 'blockchain_events': 0}
+        purchase = next(e for e in trace['timeline'] if e['type'] == 'purchase')
+        assert purchase['actor'] == 'Exportadora Sur'
+
+    def test_query_count_independent_of_links(self, db_session, deal, count_queries):
+        add_links(db_session, deal, 2)
+        db_session.session.expire_all()
+        count_queries.clear()
+        build_deal_trace(deal)
+        few = len(count_queries)
+
+        add_links(db_session, deal, 20, start=2)
+        db_session.session.expire_all()
+        count_queries.clear()
+        trace = build_deal_trace(deal)
+
+        assert trace['summary']['entities']['lotes'] == 22
+        assert len(count_queries) == few
+
+    def test_lot_shared_by_links_listed_once(self, db_session, deal):
+        add_links(db_session, deal, 1)
+        lot = ProducerLot.query.one()
+        db_session.session.add(DealTraceLink(deal_id=deal.id, lote_ids=json.dumps([lot.id, 'x']), events='[]'))
+        db_session.session.commit()
+
+        trace = build_deal_trace(deal)
+
+        assert len([e for e in trace['timeline'] if e['type'] == 'lote_created']) == 1
+        assert len(trace['trace_links']) == 2
+
+
+class TestDealTraceCache:
+    """Tests para el cache por deal"""
+
+    def test_cached_until_invalidated(self, db_session, deal, count_queries):
+        add_links(db_session, deal, 1)
+        get_deal_trace_cached(deal)
+        count_queries.clear()
+
+        assert get_deal_trace_cached(deal)['summary']['entities']['lotes'] == 1
+        assert count_queries == []
+
+        add_links(db_session, deal, 1, start=1)
+        invalidate_cache_tags(f'deal_trace:{deal.id}')
+
+        assert get_deal_trace_cached(deal)['summary']['entities']['lotes'] == 2
@@ -0,0 +1,134 @@
+# tests/test_entity_access.py
+"""
+Tests para la proyección entity_access y el filtrado de eventos por EXISTS
+"""
+
+import io
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from models_simple import BatchLot, BatchNFT, Company, EntityAccess, ProducerLot, TraceEvent, User
+from services.lot_import import import_lots
+from migrate_entity_access import rebuild_entity_access
+
+
+def access_rows():
+    return {(a.company_id, a.entity_type, a.entity_id, a.relation) for a in EntityAccess.query.all()}
+
+
+@pytest.fixture
+def companies(db_session):
+    producer = Company(name='Finca Norte', company_type='producer')
+    exporter = Company(name='Exportadora Sur', company_type='exporter')
+    db_session.session.add_all([producer, exporter])
+    db_session.session.commit()
+    return producer, exporter
+
+
+@pytest.fixture
+def lot(db_session, companies):
+    lot = ProducerLot(lot_code='LOT-1', producer_company_id=companies[0].id)
+    db_session.session.add(lot)
+    db_session.session.commit()
+    return lot
+
+
+class TestEntityAccessProjection:
+    """Tests para el mantenimiento de entity_access en after_flush"""
+
+    def test_lot_creation_grants_producer(self, lot, companies):
+        assert access_rows() == {(companies[0].id, 'lot', str(lot.id), 'producer')}
+
+    def test_purchase_grants_buyer_and_revokes_previous(self, db_session, lot, companies):
+        other = Company(name='Otra', company_type='exporter')
+        db_session.session.add(other)
+        db_session.session.commit()
+
+        lot.purchased_by_company_id = other.id
+        db_session.session.commit()
+        lot.purchased_by_company_id = companies[1].id
+        db_session.session.commit()
+
+        assert access_rows() == {
+            (companies[0].id, 'lot', str(lot.id), 'producer'),
+            (companies[1].id, 'lot', str(lot.id), 'purchaser')
+        }
+
+    def test_batch_grants_creator_and_source_lots(self, db_session, lot, companies):
+        batch = BatchNFT(batch_code='B-1', creator_company_id=companies[1].id)
+        db_session.session.add(batch)
+        db_session.session.flush()
+        db_session.session.add(BatchLot(batch_id=batch.id, lot_id=lot.id))
+        db_session.session.commit()
+
+        assert (companies[1].id, 'batch', str(batch.id), 'creator') in access_rows()
+        assert (companies[1].id, 'lot', str(lot.id), 'batch') in access_rows()
+
+    def test_delete_revokes_entity(self, db_session, lot):
+        db_session.session.delete(lot)
+        db_session.session.commit()
+        assert access_rows() == set()
+
+    def test_bulk_import_grants_producer(self, db_session, test_user, companies):
+        data = ('producer_company_id,farm_name,location,product_type,weight_kg,quality_grade,harvest_date\n'
+                f'{companies[0].id},Finca,Los Ríos,cacao,1000,A,2025-03-01\n')
+        import_lots(io.BytesIO(data.encode()), 'csv', test_user)
+
+        lot = ProducerLot.query.one()
+        assert access_rows() == {(companies[0].id, 'lot', str(lot.id), 'producer')}
+
+    def test_rebuild_matches_listener(self, db_session, lot, companies):
+        lot.purchased_by_company_id = companies[1].id
+        batch = BatchNFT(batch_code='B-1', creator_company_id=companies[1].id)
+        db_session.session.add(batch)
+        db_session.session.flush()
+        db_session.session.add(BatchLot(batch_id=batch.id, lot_id=lot.id))
+        db_session.session.commit()
+        expected = access_rows()
+
+        rebuild_entity_access()
+
+        assert access_rows() == expected
+
+
+class TestTraceEventsFiltering:
+    """Tests para el listado de eventos de usuarios no admin"""
+
+    @staticmethod
+    def get_events(client, user):
+        token = create_access_token(identity=str(user.id))
+        response = client.get('/api/traceability/events', headers={'Authorization': f'Bearer {token}'})
+        assert response.status_code == 200
+        return response.get_json()
+
+    def test_producer_sees_only_own_lot_events(self, client, db_session, lot, companies):
+        other_lot = ProducerLot(lot_code='LOT-2', producer_company_id=companies[1].id)
+        db_session.session.add(other_lot)
+        db_session.session.flush()
+        for target in (lot, other_lot):
+            db_session.session.add(TraceEvent(event_type='DRYING', entity_type='lot', entity_id=str(target.id), title='Secado'))
+        # Mismo id pero otro tipo de entidad: no debe filtrarse como lote
+        db_session.session.add(TraceEvent(event_type='STORAGE', entity_type='batch', entity_id=str(lot.id), title='Almacenamiento'))
+        producer = User(email='p@example.com', name='P', password_hash='x', role='producer',
+                        company_id=companies[0].id)
+        db_session.session.add(producer)
+        db_session.session.commit()
+
+        body = self.get_events(client, producer)
+
+        assert [(e['entity_type'], e['entity_id']) for e in body['events']] == [('lot', str(lot.id))]
+
+    def test_exporter_sees_batch_events(self, client, db_session, lot, companies):
+        batch = BatchNFT(batch_code='B-1', creator_company_id=companies[1].id)
+        db_session.session.add(batch)
+        db_session.session.flush()
+        db_session.session.add(TraceEvent(event_type='STORAGE', entity_type='batch', entity_id=str(batch.id), title='Almacenamiento'))
+        exporter = User(email='e@example.com', name='E', password_hash='x', role='exporter',
+                        company_id=companies[1].id)
+        db_session.session.add(exporter)
+        db_session.session.commit()
+
+        body = self.get_events(client, exporter)
+
+        assert [e['entity_id'] for e in body['events']] == [str(batch.id)]
@@ -0,0 +1,94 @@
+# tests/test_esg_analytics.py
+"""
+Tests para los agregados ESG en SQL y los gráficos memoizados del blueprint ESG
+"""
+
+import sqlite3
+
+import pytest
+from flask import Flask
+
+import analytics
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    analytics._chart_cache.clear()
+    analytics._esg_cache.clear()
+    yield
+    analytics._chart_cache.clear()
+    analytics._esg_cache.clear()
+
+
+@pytest.fixture
+def esg_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'esg.db')
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE export_contracts (id INTEGER PRIMARY KEY, total_volume_mt NUMERIC);
+        CREATE TABLE producer_lots (id INTEGER PRIMARY KEY, certifications TEXT);
+        INSERT INTO export_contracts (total_volume_mt) VALUES (100), (50.5), (NULL);
+        INSERT INTO producer_lots (certifications) VALUES ('Organic,Fairtrade'), ('Fairtrade'), (NULL), ('organic');
+    ''')
+    conn.commit()
+    conn.close()
+
+    def connect():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    monkeypatch.setattr(analytics, 'get_db_connection', connect)
+
+
+class TestEsgMetrics:
+    """Tests para los agregados ESG"""
+
+    def test_aggregates_computed_in_sql(self, esg_db):
+        assert analytics.esg_aggregates() == {'total_volume': 150.5, 'total_lots': 4, 'organic_lots': 1}
+
+    def test_metrics_from_aggregates(self, esg_db):
+        metrics = analytics.generate_esg_metrics()
+        assert metrics['environmental']['carbon_footprint']['total_co2_tons'] == round(150.5 * 0.85, 2)
+        assert metrics['governance']['certifications']['organic_pct'] == 25.0
+
+    def test_aggregates_cached(self, esg_db, monkeypatch):
+        analytics.esg_aggregates()
+        monkeypatch.setattr(analytics, 'get_db_connection', lambda: pytest.fail('consulta repetida'))
+        assert analytics.esg_aggregates()['total_lots'] == 4
+
+
+class TestCharts:
+    """Tests para la memoización de gráficos y las series crudas"""
+
+    def test_chart_rendered_once_per_data(self, monkeypatch):
+        renders = []
+        monkeypatch.setattr(analytics, '_render_chart', lambda *args: renders.append(args) or 'png')
+
+        analytics.render_page_charts('dashboard')
+        analytics.render_page_charts('dashboard')
+        analytics.create_chart('bar', [1, 2], 'Otro', ['a', 'b'])
+
+        assert len(renders) == 5
+
+    def test_render_chart_png(self):
+        image = analytics.create_chart('pie', [42, 3, 0], 'Auditorías', ['A', 'B', 'C'])
+        assert image.startswith('iVBOR')  # PNG en base64
+
+    def test_series_endpoint(self):
+        app = Flask(__name__)
+        app.secret_key = 'test'
+        app.register_blueprint(analytics.analytics_bp)
+        client = app.test_client()
+
+        assert client.get('/analytics/api/series/governance').status_code == 401
+
+        with client.session_transaction() as sess:
+            sess['user'] = {'id': 1}
+        response = client.get('/analytics/api/series/governance')
+        assert response.status_code == 200
+        assert response.get_json()['audit_results'] == {
+            'type': 'pie', 'title': 'Resultados de Auditorías',
+            'labels': ['Aprobadas', 'Condicionales', 'Rechazadas'], 'data': [42, 3, 0]
+        }
+        assert client.get('/analytics/api/series/otra').status_code == 404
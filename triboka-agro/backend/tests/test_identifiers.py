@@ -0,0 +1,143 @@
+# tests/test_identifiers.py
+"""
+Tests para el índice de identificadores externos y la resolución por lotes (AgroWeight)
+"""
+
+import json
+
+import pytest
+
+from app_web3 import resolver_lotes
+from models_simple import BatchNFT, ExternalIdentifier, ProducerLot
+from services.api_keys import api_key_cache, set_api_key
+from services.identifiers import backfill_identifiers, identifier_map, load_resolved, resolve_lot
+from services.lot_import import import_lots
+from tests.test_lot_import import csv_file
+
+
+@pytest.fixture(autouse=True)
+def clean_map():
+    identifier_map.clear()
+    api_key_cache.clear()
+    yield
+    identifier_map.clear()
+
+
+@pytest.fixture
+def lots(db_session, test_company):
+    created = [
+        ProducerLot(lot_code=f'LOT-ID-{i}', producer_company_id=test_company.id, weight_kg=100 * (i + 1))
+        for i in range(3)
+    ]
+    created[0].blockchain_lot_id = 'NFT-0'
+    db_session.session.add_all(created)
+    db_session.session.add(BatchNFT(batch_code='BATCH-ID-1', total_weight_kg=300, creator_company_id=test_company.id))
+    db_session.session.commit()
+    return created
+
+
+@pytest.fixture
+def lot_queries(capture_queries):
+    return capture_queries('external_identifiers', 'FROM producer_lots')
+
+
+def resolve(app, api_key, payload):
+    with app.test_request_context(method='POST', json=payload, headers={'Authorization': f'Bearer {api_key}'}):
+        return app.make_response(resolver_lotes())
+
+
+class TestIdentifierIndex:
+    """Tests para el mantenimiento del índice y del mapa en memoria"""
+
+    def test_new_entities_are_indexed(self, db_session, lots):
+        rows = {(r.identifier, r.kind) for r in ExternalIdentifier.query}
+
+        assert rows == {('LOT-ID-0', 'lot_code'), ('NFT-0', 'nft_id'), ('LOT-ID-1', 'lot_code'),
+                        ('LOT-ID-2', 'lot_code'), ('BATCH-ID-1', 'batch_code')}
+
+    def test_lookup_by_code_or_nft_id(self, db_session, lots):
+        assert resolve_lot('LOT-ID-1').id == lots[1].id
+        assert resolve_lot('NFT-0').id == lots[0].id
+        assert resolve_lot('BATCH-ID-1') is None
+        assert resolve_lot('NO-EXISTE') is None
+
+    def test_nft_assignment_updates_map(self, db_session, lots):
+        assert resolve_lot('NFT-1') is None
+        lots[1].blockchain_lot_id = 'NFT-1'
+        db_session.session.commit()
+
+        assert resolve_lot('NFT-1').id == lots[1].id
+        assert identifier_map.lookup(['NFT-1']) == {'NFT-1': [('nft_id', lots[1].id)]}
+
+    def test_deleted_lot_is_unindexed(self, db_session, lots):
+        resolve_lot('LOT-ID-2')
+        db_session.session.delete(lots[2])
+        db_session.session.commit()
+
+        assert resolve_lot('LOT-ID-2') is None
+        assert ExternalIdentifier.query.filter_by(identifier='LOT-ID-2').count() == 0
+
+    def test_stale_map_entry_is_rechecked(self, db_session, lots):
+        """Un cambio hecho por otro proceso no devuelve el lote equivocado"""
+        resolve_lot('LOT-ID-0')
+        identifier_map.remove_entities([('lot_code', lots[0].id)])
+        identifier_map.add([('LOT-ID-0', 'lot_code', lots[1].id), ('LOT-ID-1', 'lot_code', lots[0].id)])
+        assert identifier_map.lookup(['LOT-ID-0']) == {'LOT-ID-0': [('lot_code', lots[1].id)]}
+
+        assert resolve_lot('LOT-ID-0').id == lots[0].id
+        assert resolve_lot('LOT-ID-1').id == lots[1].id
+
+    def test_warm_map_skips_index_table(self, db_session, lots, lot_queries):
+        resolve_lot('LOT-ID-0')
+        lot_queries.clear()
+
+        resolved = load_resolved(['LOT-ID-0', 'LOT-ID-1', 'NFT-0'])
+
+        assert {k: v[1].id for k, v in resolved.items()} == {
+            'LOT-ID-0': lots[0].id, 'LOT-ID-1': lots[1].id, 'NFT-0': lots[0].id}
+        assert not any('external_identifiers' in s for s in lot_queries)
+        assert sum('FROM producer_lots' in s for s in lot_queries) == 1
+
+    def test_backfill_rebuilds_index(self, db_session, lots):
+        indexed = ExternalIdentifier.query.count()
+        connection = db_session.session.connection()
+        connection.execute(ExternalIdentifier.__table__.delete())
+
+        assert backfill_identifiers(connection) == indexed
+        db_session.session.commit()
+        assert resolve_lot('NFT-0').id == lots[0].id
+
+    def test_bulk_import_is_indexed(self, db_session, test_user, test_company):
+        import_lots(csv_file(test_company.id, 5), 'csv', test_user)
+        lot = ProducerLot.query.order_by(ProducerLot.id.desc()).first()
+
+        assert resolve_lot(lot.lot_code).id == lot.id
+
+
+class TestResolverEndpoint:
+    """Tests para POST /api/lotes/resolver"""
+
+    @pytest.fixture
+    def api_key(self, db_session, test_company):
+        key = set_api_key(test_company)
+        db_session.session.commit()
+        return key
+
+    def test_batch_resolve(self, app, lots, api_key):
+        response = resolve(app, api_key, {'ids': ['LOT-ID-1', 'NFT-0', 'BATCH-ID-1', 'NO-EXISTE', 'LOT-ID-1']})
+        data = json.loads(response.get_data())
+
+        assert response.status_code == 200
+        assert data['resultados']['LOT-ID-1']['lote']['id'] == lots[1].id
+        assert data['resultados']['NFT-0']['tipo'] == 'nft_id'
+        assert data['resultados']['NFT-0']['lote']['blockchain_lot_id'] == 'NFT-0'
+        assert data['resultados']['BATCH-ID-1']['batch']['batch_code'] == 'BATCH-ID-1'
+        assert data['no_encontrados'] == ['NO-EXISTE']
+
+    def test_kind_filter_and_limits(self, app, lots, api_key):
+        only_lots = json.loads(resolve(app, api_key, {'ids': ['BATCH-ID-1'], 'tipos': ['lot_code']}).get_data())
+
+        assert only_lots['no_encontrados'] == ['BATCH-ID-1']
+        assert resolve(app, api_key, {'ids': ['X'] * 1001}).status_code == 413
+        assert resolve(app, api_key, {'ids': []}).status_code == 400
+        assert resolve(app, api_key, {'ids': ['X'], 'tipos': ['otro']}).status_code == 400
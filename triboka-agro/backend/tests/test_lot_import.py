@@ -0,0 +1,120 @@
+# tests/test_lot_import.py
+"""
+Tests para la importación masiva de lotes (CSV / NDJSON)
+"""
+
+import io
+import json
+import pytest
+from types import SimpleNamespace
+
+from models_simple import BlockchainTx, ProducerLot
+from services.lot_import import import_lots, iter_rows, detect_format
+
+HEADER = 'producer_company_id,farm_name,location,product_type,weight_kg,quality_grade,harvest_date,certifications\n'
+
+
+def csv_file(company_id, rows):
+    lines = [HEADER] + [
+        f'{company_id},Finca {i},Los Ríos,cacao,{1000 + i},A,2025-03-0{1 + i % 9},Organic;Fairtrade\n'
+        for i in range(rows)
+    ]
+    return io.BytesIO(''.join(lines).encode())
+
+
+class ReadyIntegration:
+    nft_service = SimpleNamespace(contract=object())
+
+    def is_ready(self):
+        return True
+
+
+class TestLotImport:
+    """Tests para validación por fila e inserción por bloques"""
+
+    def test_csv_imported_in_chunks(self, db_session, test_user, test_company):
+        """Todas las filas válidas se insertan aunque ocupen varios bloques"""
+        report = import_lots(csv_file(test_company.id, 25), 'csv', test_user, chunk_size=10)
+
+        assert report['imported'] == 25
+        assert report['failed'] == 0
+        assert ProducerLot.query.count() == 25
+        lot = ProducerLot.query.filter_by(farm_name='Finca 3').one()
+        assert lot.certifications == 'Organic,Fairtrade'
+        assert lot.created_by_user_id == test_user.id
+
+    def test_invalid_rows_reported_by_line(self, db_session, test_user, test_company):
+        """Las filas inválidas se reportan con su línea sin bloquear el resto"""
+        rows = [
+            {'producer_company_id': test_company.id, 'farm_name': 'A', 'location': 'L', 'product_type': 'cacao',
+             'weight_kg': 500, 'quality_grade': 'A', 'harvest_date': '2025-03-01', 'lot_code': 'COOP-1'},
+            {'producer_company_id': test_company.id, 'farm_name': 'B', 'location': 'L', 'product_type': 'cacao',
+             'weight_kg': 'mucho', 'quality_grade': 'A', 'harvest_date': 'ayer'},
+            {'producer_company_id': 9999, 'farm_name': 'C', 'location': 'L', 'product_type': 'cacao',
+             'weight_kg': 500, 'quality_grade': 'A', 'harvest_date': '2025-03-01'},
+            {'producer_company_id': test_company.id, 'farm_name': 'D', 'location': 'L', 'product_type': 'cacao',
+             'weight_kg': 500, 'quality_grade': 'A', 'harvest_date': '2025-03-01', 'lot_code': 'COOP-1'},
+        ]
+        lines = [json.dumps(r) + '\n' for r in rows] + ['{no es json\n']
+
+        report = import_lots(lines, 'ndjson', test_user)
+
+        assert report['imported'] == 1
+        assert report['failed'] == 4
+        errors = {e['line']: e['errors'] for e in report['errors']}
+        assert set(errors) == {2, 3, 4, 5}
+        assert len(errors[2]) == 2
+        assert errors[3] == ['Empresa productora no encontrada']
+        assert 'duplicado' in errors[4][0]
+
+    def test_existing_lot_code_rejected(self, db_session, test_user, test_company):
+        """Un código ya presente en la base de datos se rechaza al insertar el bloque"""
+        db_session.session.add(ProducerLot(lot_code='COOP-9', producer_company_id=test_company.id, weight_kg=1))
+        db_session.session.commit()
+        data = HEADER.rstrip('\n') + ',lot_code\n' + \
+            f'{test_company.id},Finca,L,cacao,100,A,2025-03-01,,COOP-9\n' + \
+            f'{test_company.id},Finca,L,cacao,100,A,2025-03-01,,COOP-10\n'
+
+        report = import_lots(io.BytesIO(data.encode()), 'csv', test_user)
+
+        assert report['imported'] == 1
+        assert report['errors'][0]['lot_code'] == 'COOP-9'
+
+    def test_dry_run_writes_nothing(self, db_session, test_user, test_company):
+        report = import_lots(csv_file(test_company.id, 5), 'csv', test_user, dry_run=True)
+
+        assert report['imported'] == 5
+        assert ProducerLot.query.count() == 0
+
+    def test_blockchain_registration_queued(self, db_session, test_user, test_company):
+        """Con blockchain disponible cada lote deja un create_lot en el outbox"""
+        report = import_lots(csv_file(test_company.id, 4), 'csv', test_user,
+                             integration=ReadyIntegration())
+
+        assert report['queued_on_chain'] == 4
+        txs = BlockchainTx.query.filter_by(kind='create_lot').all()
+        assert sorted(tx.entity_id for tx in txs) == sorted(lot.id for lot in ProducerLot.query)
+        assert txs[0].args['certifications'] == ['Organic', 'Fairtrade']
+
+    def test_producer_limited_to_own_company(self, db_session, test_company):
+        producer = SimpleNamespace(id=1, role='producer', company_id=test_company.id + 1)
+
+        report = import_lots(csv_file(test_company.id, 2), 'csv', producer)
+
+        assert report['imported'] == 0
+        assert report['errors'][0]['errors'] == ['Solo puedes crear lotes para tu empresa']
+
+
+@pytest.mark.parametrize('filename,content_type,expected', [
+    ('cosecha.csv', None, 'csv'),
+    ('cosecha.jsonl', None, 'ndjson'),
+    (None, 'application/x-ndjson', 'ndjson'),
+    ('cosecha.xlsx', None, None),
+])
+def test_detect_format(filename, content_type, expected):
+    assert detect_format(filename, content_type) == expected
+
+
+def test_csv_line_numbers_include_header():
+    rows = list(iter_rows([b'a,b\n', b'1,2\n', b'3,4\n'], 'csv'))
+    assert rows == [(2, {'a': '1', 'b': '2'}), (3, {'a': '3', 'b': '4'})]
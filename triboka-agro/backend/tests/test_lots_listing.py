@@ -0,0 +1,168 @@
+# tests/test_lots_listing.py
+"""
+Tests para el listado paginado de lotes (/api/lots)
+"""
+
+import json
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from flask_jwt_extended import create_access_token
+
+from models_simple import ProducerLot
+from services.pagination import encode_cursor, decode_cursor, fetch_page, keyset_phases
+from app_web3 import _build_lots_query, _serialize_lot_listing, get_lots
+
+
+class TestCursorEncoding:
+    """Tests para codificación de cursores"""
+
+    def test_roundtrip_datetime(self):
+        """Un cursor codificado se decodifica al mismo valor"""
+        harvest = datetime(2025, 3, 1, 12, 30)
+        sort_value, row_id = decode_cursor(encode_cursor(harvest, 42))
+
+        assert sort_value == harvest
+        assert row_id == 42
+
+    def test_roundtrip_null(self):
+        """Cursores sobre valores NULL conservan el None"""
+        assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+
+    def test_invalid_cursor(self):
+        """Un cursor corrupto lanza ValueError"""
+        with pytest.raises(ValueError):
+            decode_cursor('no-es-un-cursor')
+
+
+class TestLotsKeysetPagination:
+    """Tests para la paginación keyset sobre (harvest_date, id)"""
+
+    @pytest.fixture
+    def lots(self, db_session, test_company):
+        base = datetime(2025, 1, 1)
+        created = []
+        for i in range(7):
+            lot = ProducerLot(
+                lot_code=f'LOT-PAG-{i}',
+                producer_company_id=test_company.id,
+                weight_kg=1000 + i,
+                # Dos lotes sin fecha de cosecha y dos con la misma fecha
+                harvest_date=None if i >= 5 else base + timedelta(days=min(i, 3)),
+                status='available'
+            )
+            db_session.session.add(lot)
+            created.append(lot)
+        db_session.session.commit()
+        return created
+
+    def test_pages_cover_all_lots_once(self, lots):
+        """Recorrer todas las páginas devuelve cada lote exactamente una vez"""
+        admin = MagicMock(role='admin', company_id=None)
+        seen = []
+        cursor = None
+
+        while True:
+            phases = keyset_phases(_build_lots_query(admin, {}), ProducerLot.harvest_date, ProducerLot.id, cursor=cursor)
+            page, cursor = fetch_page(phases, 2, 'harvest_date')
+            seen.extend(lot.id for lot in page)
+            if cursor is None:
+                break
+
+        assert sorted(seen) == sorted(lot.id for lot in lots)
+        assert len(seen) == len(set(seen))
+
+    def test_order_is_newest_first_nulls_last(self, lots):
+        """Orden por cosecha descendente, lotes sin fecha al final"""
+        admin = MagicMock(role='admin', company_id=None)
+        phases = keyset_phases(_build_lots_query(admin, {}), ProducerLot.harvest_date, ProducerLot.id)
+        ordered = phases[0].all()
+
+        dates = [lot.harvest_date for lot in ordered if lot.harvest_date]
+        assert dates == sorted(dates, reverse=True)
+        assert all(lot.harvest_date is None for lot in ordered[-2:])
+
+    def test_null_tail_is_a_separate_phase(self, lots, capture_queries):
+        """Tras el último lote con fecha, la cola de NULLs se lee en su propia consulta, sin OR"""
+        admin = MagicMock(role='admin', company_id=None)
+        last_dated = encode_cursor(lots[1].harvest_date, lots[1].id)
+        expected = [lots[0].id, lots[6].id, lots[5].id]
+        statements = capture_queries('FROM producer_lots')
+
+        phases = keyset_phases(_build_lots_query(admin, {}), ProducerLot.harvest_date, ProducerLot.id, cursor=last_dated)
+        page, cursor = fetch_page(phases, 2, 'harvest_date')
+
+        assert [lot.id for lot in page] == expected[:2]
+        assert decode_cursor(cursor) == (None, expected[1])
+        ranged, tail = statements
+        assert 'IS NULL' not in ranged and ' OR ' not in ranged
+        assert 'harvest_date IS NULL' in tail and ' OR ' not in tail
+
+        tail_phases = keyset_phases(_build_lots_query(admin, {}), ProducerLot.harvest_date, ProducerLot.id, cursor=cursor)
+        assert len(tail_phases) == 1
+        assert [lot.id for lot in fetch_page(tail_phases, 2, 'harvest_date')[0]] == expected[2:]
+
+    def test_producer_only_sees_own_lots(self, lots):
+        """El filtro por rol se mantiene en el modo paginado"""
+        producer = MagicMock(role='producer', company_id=-1)
+        assert _build_lots_query(producer, {}).count() == 0
+
+    def test_serialize_listing(self, lots, test_company):
+        """La serialización incluye datos de la empresa precargada"""
+        data = _serialize_lot_listing(lots[0])
+
+        assert data['lot_code'] == 'LOT-PAG-0'
+        assert data['producer_company'] == test_company.name
+        assert data['weight_mt'] == pytest.approx(1.0)
+
+
+class TestLotsEndpoint:
+    """Tests para los parámetros limit/cursor/format de GET /api/lots"""
+
+    @pytest.fixture
+    def lots(self, db_session, test_company):
+        created = [
+            ProducerLot(lot_code=f'LOT-ND-{i}', producer_company_id=test_company.id, weight_kg=1000,
+                        harvest_date=datetime(2025, 1, 1) + timedelta(days=i), status='available')
+            for i in range(5)
+        ]
+        db_session.session.add_all(created)
+        db_session.session.commit()
+        return created
+
+    def get(self, app, user, query):
+        token = create_access_token(identity=str(user.id))
+        with app.app_context(), app.test_request_context(f'/api/lots?{query}', headers={'Authorization': f'Bearer {token}'}):
+            response = app.make_response(get_lots())
+            return response.status_code, response.get_data(as_text=True)
+
+    def test_ndjson_pages_with_limit(self, app, test_user, lots):
+        """En ndjson el limit se respeta y la última línea trae el siguiente cursor"""
+        seen, cursor = [], ''
+        while True:
+            status, body = self.get(app, test_user, f'format=ndjson&limit=2&cursor={cursor}')
+            lines = [json.loads(line) for line in body.splitlines()]
+            trailer = lines.pop()
+            assert status == 200
+            assert len(lines) <= 2
+            seen.extend(lot['lot_code'] for lot in lines)
+            if not trailer['has_more']:
+                assert trailer['next_cursor'] is None
+                break
+            cursor = trailer['next_cursor']
+
+        assert seen == [f'LOT-ND-{i}' for i in reversed(range(5))]
+
+    def test_ndjson_without_limit_streams_everything(self, app, test_user, lots):
+        status, body = self.get(app, test_user, 'format=ndjson')
+
+        assert status == 200
+        assert len(body.splitlines()) == 5
+
+    @pytest.mark.parametrize('limit', ['abc', '0', '-3', '1.5'])
+    def test_invalid_limit_rejected(self, app, test_user, lots, limit):
+        for query in (f'limit={limit}', f'format=ndjson&limit={limit}'):
+            status, body = self.get(app, test_user, query)
+
+            assert status == 400
+            assert 'limit' in json.loads(body)['error']
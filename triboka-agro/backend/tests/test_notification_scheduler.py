@@ -0,0 +1,160 @@
+# tests/test_notification_scheduler.py
+"""
+Tests para el planificador de alertas del servidor de notificaciones
+"""
+
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from services.notification_scheduler import NotificationScheduler
+
+NOW = datetime(2025, 3, 10, 12, 0, 0)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'notifications.db')
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE users (id INTEGER PRIMARY KEY, company_id INTEGER);
+        CREATE TABLE export_contracts (id INTEGER PRIMARY KEY, contract_code TEXT, delivery_date TIMESTAMP,
+                                       status TEXT, exporter_company_id INTEGER, updated_at TIMESTAMP);
+        CREATE TABLE producer_lots (id INTEGER PRIMARY KEY, lot_code TEXT, created_at TIMESTAMP,
+                                    status TEXT, producer_company_id INTEGER, updated_at TIMESTAMP);
+        INSERT INTO users (id, company_id) VALUES (1, 10), (2, 10), (3, 20);
+    ''')
+    yield conn
+    conn.close()
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock(NOW)
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def scheduler(conn, clock, sent):
+    def notify(user_ids, title, message, notification_type, category, data, priority=1):
+        sent.extend((user_id, category, data) for user_id in user_ids)
+
+    return NotificationScheduler(lambda: conn, notify, clock=clock)
+
+
+def ts(value: datetime) -> str:
+    return value.isoformat(sep=' ')
+
+
+def add_contract(conn, contract_id, delivery, status='active', updated=NOW):
+    conn.execute('INSERT INTO export_contracts VALUES (?, ?, ?, ?, 20, ?)',
+                 (contract_id, f'C-{contract_id}', ts(delivery), status, ts(updated)))
+    conn.commit()
+
+
+def add_lot(conn, lot_id, created, status='available', updated=None):
+    conn.execute('INSERT INTO producer_lots VALUES (?, ?, ?, ?, 10, ?)',
+                 (lot_id, f'L-{lot_id}', ts(created), status, ts(updated or created)))
+    conn.commit()
+
+
+class TestNotificationScheduler:
+    """Tests para la cola de alertas por vencimiento"""
+
+    def test_fires_only_when_due(self, conn, scheduler, clock, sent):
+        add_lot(conn, 1, NOW - timedelta(days=8))
+        add_lot(conn, 2, NOW - timedelta(days=6))
+        add_contract(conn, 1, NOW + timedelta(days=3))
+        scheduler.load(conn)
+
+        assert scheduler.run_due(conn) == 3
+        assert sorted(sent) == [(1, 'lot_unassigned', {'lot_id': 1}), (2, 'lot_unassigned', {'lot_id': 1}),
+                                (3, 'contract_expiry', {'contract_id': 1, 'days_left': 3})]
+
+        sent.clear()
+        clock.now = NOW + timedelta(days=1, seconds=1)
+        scheduler.run_due(conn)
+        assert [data for _, category, data in sent if category == 'lot_unassigned'] == [{'lot_id': 2}] * 2
+
+    def test_deduplicated_until_cooldown(self, conn, scheduler, clock, sent):
+        add_contract(conn, 1, NOW + timedelta(days=2))
+        scheduler.load(conn)
+        scheduler.run_due(conn)
+        scheduler.run_due(conn)
+        assert len(sent) == 1
+
+        # Un planificador nuevo (reinicio del servidor) respeta notification_dedup
+        restarted = NotificationScheduler(lambda: conn, lambda *args, **kwargs: sent.append(args), clock=clock)
+        restarted.load(conn)
+        assert restarted.run_due(conn) == 0
+
+        clock.now = NOW + timedelta(days=1)
+        assert restarted.run_due(conn) == 1
+
+    def test_changed_rows_rescheduled(self, conn, scheduler, clock, sent):
+        add_lot(conn, 1, NOW - timedelta(days=6))
+        scheduler.load(conn)
+        assert scheduler.next_due() == NOW + timedelta(days=1)
+
+        # El lote se vende antes de vencer: la alerta se cancela
+        conn.execute("UPDATE producer_lots SET status = 'purchased', updated_at = ? WHERE id = 1",
+                     (ts(NOW + timedelta(minutes=1)),))
+        add_contract(conn, 7, NOW + timedelta(days=1), updated=NOW + timedelta(minutes=1))
+        assert scheduler.refresh(conn) == 2
+
+        clock.now = NOW + timedelta(days=2)
+        scheduler.run_due(conn)
+        assert [category for _, category, _ in sent] == ['contract_expiry']
+        assert scheduler.next_due() == clock.now + timedelta(days=1)
+
+    def test_late_commit_with_earlier_stamp_scheduled(self, conn, scheduler):
+        add_lot(conn, 1, NOW - timedelta(days=6), updated=NOW)
+        scheduler.load(conn)
+
+        # Una importación lenta confirma después un lote con updated_at anterior a la marca
+        add_lot(conn, 2, NOW - timedelta(days=8), updated=NOW - timedelta(seconds=20))
+        scheduler.refresh(conn)
+
+        assert scheduler.next_due() == NOW - timedelta(days=1)
+        assert scheduler.pending() == 2
+
+    def test_ineligible_rows_not_queued(self, conn, scheduler):
+        add_contract(conn, 1, NOW + timedelta(days=1), status='completed')
+        add_lot(conn, 1, NOW - timedelta(days=30), status='batched')
+        scheduler.load(conn)
+        assert scheduler.pending() == 0
+
+    def test_background_thread_fires_within_seconds(self, conn, db_path, clock, sent):
+        def notify(user_ids, title, message, notification_type, category, data, priority=1):
+            sent.extend(category for _ in user_ids)
+
+        scheduler = NotificationScheduler(lambda: sqlite3.connect(db_path), notify, refresh_interval=0.05, clock=clock)
+        scheduler.start()
+        try:
+            add_lot(conn, 1, NOW - timedelta(days=7, seconds=-1), updated=NOW)
+            clock.now = NOW + timedelta(seconds=2)
+            deadline = time.time() + 5
+            while len(sent) < 2 and time.time() < deadline:
+                time.sleep(0.02)
+        finally:
+            scheduler.stop()
+
+        assert sent == ['lot_unassigned', 'lot_unassigned']
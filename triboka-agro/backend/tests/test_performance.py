@@ -7,7 +7,9 @@ import pytest
 import json
 import time
 from unittest.mock import patch, MagicMock
-from routes.performance import PerformanceMonitor, cached, redis_manager
+from flask_jwt_extended import create_access_token
+from routes.performance import PerformanceMonitor, cache_layer, cached, redis_manager
+from services.metrics import MetricsRecorder, bucket_index, percentiles_from_buckets
 
 
 class TestPerformanceMonitor:
@@ -67,6 +69,71 @@ class TestPerformanceMonitor:
         monitor.reset_metrics()
         assert len(monitor.metrics) == 0
 
+    def test_percentiles_from_histogram(self, monitor):
+        """Los percentiles salen del histograma con error relativo acotado"""
+        for i in range(1, 101):
+            monitor.record_request('test_endpoint', 'GET', i / 1000, 200)
+
+        percentiles = monitor.get_endpoint_metrics('test_endpoint', 'GET')['percentiles']
+
+        assert percentiles['p50'] == pytest.approx(0.050, rel=0.1)
+        assert percentiles['p95'] == pytest.approx(0.095, rel=0.1)
+        assert percentiles['p99'] == pytest.approx(0.099, rel=0.1)
+
+
+class TestMetricsRecorder:
+    """Tests para el envío de métricas a Redis por lotes"""
+
+    def test_record_does_not_touch_redis(self):
+        """Registrar una petición no escribe en Redis"""
+        redis_client = MagicMock()
+        recorder = MetricsRecorder(lambda: redis_client, flush_interval=3600, sample_rate=0)
+
+        recorder.record('lots:GET', 0.1, 200)
+
+        redis_client.pipeline.assert_not_called()
+        redis_client.lpush.assert_not_called()
+
+    def test_flush_sends_deltas_in_one_pipeline(self):
+        """El flush envía solo lo acumulado desde el último envío"""
+        redis_client = MagicMock()
+        pipe = redis_client.pipeline.return_value
+        recorder = MetricsRecorder(lambda: redis_client, flush_interval=3600, sample_rate=0)
+
+        recorder.record('lots:GET', 0.1, 200)
+        recorder.record('lots:GET', 0.2, 500)
+        assert recorder.flush() == 2
+
+        recorder.record('lots:GET', 0.1, 200)
+        assert recorder.flush() == 1
+
+        assert redis_client.pipeline.call_count == 2
+        assert pipe.execute.call_count == 2
+        pipe.incrby.assert_any_call('counters:requests:5xx', 1)
+        assert recorder.flush() == 0
+
+    def test_read_aggregate_merges_hours(self):
+        """El agregado combina los hashes horarios de Redis"""
+        redis_client = MagicMock()
+        bucket = bucket_index(0.1)
+        redis_client.pipeline.return_value.execute.return_value = [
+            {'count': '2', 'sum': '0.2', f'b:{bucket}': '2', 's:200': '2'},
+            {},
+            {'count': '1', 'sum': '0.1', f'b:{bucket}': '1', 's:404': '1'}
+        ]
+        recorder = MetricsRecorder(lambda: redis_client, flush_interval=3600)
+
+        aggregate = recorder.read_aggregate(['lots:GET'], hours=3)
+
+        assert aggregate['count'] == 3
+        assert aggregate['avg_response_time'] == pytest.approx(0.1)
+        assert aggregate['status_codes'] == {'200': 2, '404': 1}
+        assert aggregate['percentiles']['p99'] == pytest.approx(0.1, rel=0.1)
+
+    def test_percentiles_empty(self):
+        """Sin datos los percentiles son cero"""
+        assert percentiles_from_buckets({}) == {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+
 
 class TestCaching:
     """Tests para funcionalidad de caching"""
@@ -160,6 +227,35 @@ class TestPerformanceAPI:
         if response.status_code == 200:
             mock_redis.flushdb.assert_called_once()
 
+    def test_clear_cache_rejects_invalid_namespaces(self, app, client, test_user):
+        """namespaces debe ser una lista de strings"""
+        with app.app_context():
+            auth_headers = {'Authorization': f'Bearer {create_access_token(identity=str(test_user.id))}'}
+        invalid = ({'namespaces': 'lots'}, {'namespaces': ['lots', 3]}, {'namespace': {'lots': 1}},
+                   {'namespaces': []}, {'namespaces': {}}, {'namespaces': ''}, {'namespaces': 0},
+                   {'namespaces': None}, {'namespace': ''}, ['lots'])
+        for body in invalid:
+            response = client.post('/api/performance/cache/clear', json=body, headers=auth_headers)
+
+            assert response.status_code == 400, body
+            assert 'error' in response.get_json()
+
+    def test_clear_cache_only_requested_namespace(self, app, client, test_user):
+        """Con namespaces solo se limpian esos; sin ellos, todos"""
+        with app.app_context():
+            auth_headers = {'Authorization': f'Bearer {create_access_token(identity=str(test_user.id))}'}
+        cache_layer.set('lots:x', 1, ttl=60, tags=['lots'])
+        cache_layer.set('companies:x', 2, ttl=60, tags=['companies'])
+
+        response = client.post('/api/performance/cache/clear', json={'namespaces': ['lots']}, headers=auth_headers)
+
+        assert response.status_code == 200
+        assert cache_layer.get('lots:x') is None
+        assert cache_layer.get('companies:x') == 2
+
+        client.post('/api/performance/cache/clear', json={}, headers=auth_headers)
+        assert cache_layer.get('companies:x') is None
+
     def test_optimize_query_missing_params(self, client, auth_headers):
         """Optimizar consulta sin parámetros debe fallar"""
         response = client.post('/api/performance/optimize/query',
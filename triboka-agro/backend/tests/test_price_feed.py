@@ -0,0 +1,75 @@
+# tests/test_price_feed.py
+"""
+Tests para el price feed de mercado (price_ticks + snapshot)
+"""
+
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from models_simple import PriceTick
+from services.price_feed import PriceFeedService, StubPriceSource, CsvPriceSource
+
+
+class TestPriceFeedService:
+    """Tests para el sondeo y el snapshot de precios"""
+
+    def test_poll_is_idempotent(self, db_session):
+        """Sondear dos veces actualiza las barras en lugar de duplicarlas"""
+        feed = PriceFeedService(StubPriceSource(price=6000.0, previous_price=5800.0))
+
+        feed.poll_once()
+        feed.source.price = 6100.0
+        feed.poll_once()
+
+        ticks = PriceTick.query.order_by(PriceTick.observed_at).all()
+        assert len(ticks) == 2
+        assert float(ticks[-1].close_usd_mt) == 6100.0
+
+    def test_snapshot_from_ticks(self, db_session):
+        """El snapshot usa el último cierre, el cambio diario y el rango anual"""
+        feed = PriceFeedService(StubPriceSource(price=6000.0, previous_price=5000.0))
+        feed.poll_once()
+
+        snapshot = feed.latest_snapshot()
+
+        assert snapshot['spot']['price'] == 6000.0
+        assert snapshot['spot']['change'] == pytest.approx(20.0)
+        assert snapshot['market']['rangeMin'] == 5000.0
+        assert snapshot['market']['rangeMax'] == 6000.0
+        assert snapshot['staleness']['stale'] is False
+
+    def test_snapshot_without_ticks_is_stale(self, db_session):
+        """Sin datos se devuelven valores por defecto marcados como desactualizados"""
+        feed = PriceFeedService(StubPriceSource())
+
+        snapshot = feed.latest_snapshot()
+
+        assert snapshot['spot']['source'] == 'Valor por defecto'
+        assert snapshot['staleness']['stale'] is True
+        assert snapshot['staleness']['as_of'] is None
+
+    def test_source_error_keeps_previous_data(self, db_session):
+        """Un fallo de la fuente no borra el histórico y queda registrado"""
+        feed = PriceFeedService(StubPriceSource(price=6000.0))
+        feed.poll_once()
+        feed.source.fetch = MagicMock(side_effect=ConnectionError('sin red'))
+
+        assert feed.poll_once() == 0
+        snapshot = feed.latest_snapshot()
+        assert snapshot['spot']['price'] == 6000.0
+        assert snapshot['staleness']['last_error'] == 'sin red'
+
+    def test_csv_replay(self, db_session, tmp_path):
+        """La fuente CSV libera filas progresivamente en modo replay"""
+        path = tmp_path / 'prices.csv'
+        start = datetime(2025, 1, 1)
+        rows = ['date,open,high,low,close'] + [
+            f"{(start + timedelta(days=i)).date()},{5000 + i},{5010 + i},{4990 + i},{5000 + i}" for i in range(5)
+        ]
+        path.write_text('\n'.join(rows))
+        feed = PriceFeedService(CsvPriceSource(str(path), replay_step=2))
+
+        assert feed.poll_once() == 2
+        assert feed.poll_once() == 2
+        assert feed.latest_snapshot()['spot']['price'] == 5003.0
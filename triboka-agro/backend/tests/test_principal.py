@@ -0,0 +1,116 @@
+# tests/test_principal.py
+"""
+Tests para el contexto de autorización por petición (principal + acceso a deals)
+"""
+
+import pytest
+from flask import g
+
+from models_simple import Deal, User
+from middleware import principal as principal_module
+from middleware.principal import load_principal, invalidate_principal, deal_access_required
+
+
+@pytest.fixture(autouse=True)
+def clear_identity_cache():
+    principal_module._identity_cache.clear()
+    yield
+    principal_module._identity_cache.clear()
+
+
+@pytest.fixture
+def deal(db_session, test_user, test_company):
+    deal = Deal(deal_code='D-2025-001', admin_id=test_user.id, exporter_id=test_company.id)
+    db_session.session.add(deal)
+    db_session.session.commit()
+    return deal
+
+
+def make_user(db_session, role, company_id=None, email='otro@example.com'):
+    user = User(email=email, name='Otro', password_hash='x', role=role, company_id=company_id)
+    db_session.session.add(user)
+    db_session.session.commit()
+    return user
+
+
+class TestPrincipal:
+    """Tests para roles en el deal y cache de identidades"""
+
+    def test_deal_roles(self, db_session, deal, test_company):
+        exporter = make_user(db_session, 'exporter', company_id=test_company.id, email='exp@example.com')
+        operator = make_user(db_session, 'operator', email='op@example.com')
+        stranger = make_user(db_session, 'producer', email='prod@example.com')
+
+        assert load_principal(deal.admin_id).deal_role(deal) == 'admin'
+        assert load_principal(exporter.id).deal_role(deal) == 'exporter'
+        assert load_principal(operator.id).deal_role(deal) == 'admin'
+        assert load_principal(stranger.id).deal_role(deal) is None
+
+    def test_user_without_company_not_matched_to_deal_without_producer(self, db_session, deal):
+        """company_id None no coincide con producer_id None"""
+        user = make_user(db_session, 'producer')
+        assert not load_principal(user.id).can_access_deal(deal)
+
+    def test_identity_cached_between_requests(self, db_session, test_user, count_queries):
+        load_principal(test_user.id, cache_key='jti:abc')
+        db_session.session.expunge_all()
+        count_queries.clear()
+
+        principal = load_principal(test_user.id, cache_key='jti:abc')
+
+        assert principal.name == 'Test User'
+        assert count_queries == []
+
+    def test_invalidate_after_role_change(self, db_session, test_user):
+        load_principal(test_user.id, cache_key='jti:abc')
+        test_user.role = 'viewer'
+        db_session.session.commit()
+        invalidate_principal(test_user.id)
+
+        assert load_principal(test_user.id, cache_key='jti:abc').role == 'viewer'
+
+    def test_deal_access_memoized_per_request(self, db_session, deal, count_queries):
+        principal = load_principal(deal.admin_id)
+        db_session.session.expunge_all()
+        count_queries.clear()
+
+        assert principal.can_access_deal(deal.id)
+        assert principal.can_access_deal(deal.id)
+        assert len(count_queries) == 1
+
+
+class TestDealAccessRequired:
+    """Tests para el decorador de acceso a deals"""
+
+    @staticmethod
+    def call(app, principal, deal_id):
+        @deal_access_required('Sin permisos')
+        def view(deal_id):
+            return {'deal': g.deal.id, 'role': g.deal_role}
+
+        with app.test_request_context():
+            g.principal = principal
+            result = view(deal_id=deal_id)
+        if isinstance(result, tuple):
+            return result[0].get_json(), result[1]
+        return result, 200
+
+    def test_allowed(self, app, deal):
+        body, status = self.call(app, load_principal(deal.admin_id), deal.id)
+        assert status == 200
+        assert body == {'deal': deal.id, 'role': 'admin'}
+
+    def test_forbidden(self, app, db_session, deal):
+        stranger = make_user(db_session, 'producer')
+        body, status = self.call(app, load_principal(stranger.id), deal.id)
+        assert status == 403
+        assert body == {'error': 'Sin permisos'}
+
+    def test_missing_deal(self, app, deal):
+        body, status = self.call(app, load_principal(deal.admin_id), 999)
+        assert status == 404
+        assert body == {'error': 'Deal no encontrado'}
+
+    def test_missing_user(self, app, deal):
+        body, status = self.call(app, None, deal.id)
+        assert status == 404
@@ -0,0 +1,35 @@
+# tests/test_projections.py
+"""
+Tests para las utilidades compartidas de las proyecciones (valor anterior de columnas vigiladas)
+"""
+
+from sqlalchemy import event
+
+from models_simple import Company, ProducerLot
+from services.projections import keep_previous_value, previous_values, track_previous_values
+
+
+class TestPreviousValues:
+    """Tests para track_previous_values y previous_values"""
+
+    def test_listener_registered_once(self):
+        # producer_company_id lo vigilan el registro de cambios, el dashboard y entity_access
+        track_previous_values(ProducerLot, ['producer_company_id'])
+
+        attribute = ProducerLot.producer_company_id
+        assert event.contains(attribute, 'set', keep_previous_value)
+        assert len(attribute.dispatch.set) == 1
+
+    def test_previous_value_of_expired_attribute(self, db_session):
+        first, second = Company(name='Finca A', company_type='producer'), Company(name='Finca B', company_type='producer')
+        db_session.session.add_all([first, second])
+        db_session.session.flush()
+        lot = ProducerLot(lot_code='L-1', producer_company_id=first.id, weight_kg=100)
+        db_session.session.add(lot)
+        db_session.session.commit()
+
+        lot.producer_company_id = second.id
+
+        assert previous_values(lot, ['producer_company_id', 'lot_code']) == {
+            'producer_company_id': first.id, 'lot_code': 'L-1'
+        }
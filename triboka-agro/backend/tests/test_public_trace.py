@@ -0,0 +1,142 @@
+# tests/test_public_trace.py
+"""
+Tests para los snapshots de la verificación pública (QR) y el limitador por IP
+"""
+
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+import app_web3
+from app_web3 import verify_trace_public
+from models_simple import PublicTraceSnapshot, TraceEvent, TraceTimeline
+from services.public_trace import get_public_snapshot
+from services.rate_limit import TokenBucketLimiter
+from services.trace_anchoring import anchor_pending_events, build_public_verification
+
+
+@pytest.fixture(autouse=True)
+def reset_limiter():
+    app_web3.public_trace_limiter.reset()
+
+
+@pytest.fixture
+def lot_trace(db_session):
+    db_session.session.add_all([
+        TraceTimeline(entity_type='lot', entity_id='7', title='Lote 7'),
+        TraceEvent(event_type='COSECHA', entity_type='lot', entity_id='7', title='Cosecha',
+                   event_timestamp=datetime(2025, 1, 1)),
+        TraceEvent(event_type='NOTA', entity_type='lot', entity_id='7', title='Privada', is_public=False,
+                   event_timestamp=datetime(2025, 1, 2)),
+    ])
+    db_session.session.commit()
+
+
+@pytest.fixture
+def event_queries(capture_queries):
+    return capture_queries('trace_events')
+
+
+def scan(app, headers=None, entity_id='7'):
+    with app.test_request_context(headers=headers or {}):
+        return app.make_response(verify_trace_public('lot', entity_id))
+
+
+def body(response):
+    data = response.get_data()
+    if response.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+class TestPublicTraceSnapshots:
+    """Tests para la materialización, invalidación y los GET condicionales"""
+
+    def test_repeated_scans_skip_event_tables(self, app, lot_trace, event_queries):
+        first = scan(app)
+        event_queries.clear()
+        second = scan(app)
+
+        assert first.status_code == second.status_code == 200
+        assert body(second) == body(first)
+        assert [e['title'] for e in body(second)['events']] == ['Cosecha']
+        assert event_queries == []
+        assert second.headers['Cache-Control'].startswith('public, max-age=')
+
+    def test_matching_etag_returns_304(self, app, lot_trace):
+        etag = scan(app).headers['ETag']
+
+        response = scan(app, {'If-None-Match': etag})
+
+        assert response.status_code == 304 and response.get_data() == b''
+        assert response.headers['ETag'] == etag
+
+    def test_gzip_representation(self, app, lot_trace):
+        plain = scan(app)
+        compressed = scan(app, {'Accept-Encoding': 'gzip'})
+
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert compressed.headers['ETag'] != plain.headers['ETag']
+        assert body(compressed) == body(plain)
+        assert scan(app, {'If-None-Match': compressed.headers['ETag']}).status_code == 304
+
+    def test_new_event_invalidates_snapshot(self, app, db_session, lot_trace):
+        etag = scan(app).headers['ETag']
+
+        db_session.session.add(TraceEvent(event_type='SECADO', entity_type='lot', entity_id='7', title='Secado',
+                                          event_timestamp=datetime(2025, 1, 3)))
+        db_session.session.commit()
+        response = scan(app, {'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert body(response)['total_events'] == 2
+
+    def test_event_recorded_during_rebuild_is_not_lost(self, app, db_session, lot_trace):
+        def build_with_concurrent_write(entity_type, entity_id):
+            payload = build_public_verification(entity_type, entity_id)
+            db_session.session.add(TraceEvent(event_type='SECADO', entity_type='lot', entity_id='7',
+                                              title='Secado', event_timestamp=datetime(2025, 1, 3)))
+            db_session.session.commit()
+            return payload
+
+        with app.test_request_context():
+            stale = get_public_snapshot('lot', '7', build_with_concurrent_write)
+
+        assert PublicTraceSnapshot.query.one().payload is None
+        assert json.loads(gzip.decompress(stale[1]))['total_events'] == 1
+        assert body(scan(app))['total_events'] == 2
+
+    def test_anchoring_invalidates_snapshot(self, app, lot_trace):
+        assert body(scan(app))['verification_status'] == 'partially_anchored'
+
+        anchor_pending_events()
+
+        assert body(scan(app))['verification_status'] == 'verified'
+
+    def test_unknown_entity_is_not_materialized(self, app, db_session):
+        assert scan(app, entity_id='999').status_code == 404
+        assert PublicTraceSnapshot.query.count() == 0
+
+
+class TestTokenBucket:
+    """Tests para el limitador por IP"""
+
+    def test_bucket_refills_over_time(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr('services.rate_limit.time.monotonic', lambda: now[0])
+        limiter = TokenBucketLimiter(rate=2, burst=2)
+
+        assert [limiter.allow('1.2.3.4')[0] for _ in range(3)] == [True, True, False]
+        assert limiter.allow('5.6.7.8')[0]
+        assert limiter.allow('1.2.3.4')[1] == pytest.approx(0.5)
+        now[0] += 0.5
+        assert limiter.allow('1.2.3.4')[0]
+
+    def test_endpoint_returns_429(self, app, lot_trace, monkeypatch):
+        monkeypatch.setattr(app_web3, 'public_trace_limiter', TokenBucketLimiter(rate=0.1, burst=1))
+
+        assert scan(app).status_code == 200
+        limited = scan(app)
+        assert limited.status_code == 429 and limited.headers['Retry-After'] == '10'
@@ -0,0 +1,158 @@
+# tests/test_report_jobs.py
+"""
+Tests para los trabajos de reportes con artefactos direccionados por contenido
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from services.report_jobs import ReportJobManager
+from services.reports import REPORT_RENDERERS, XLSX_MIMETYPE
+
+PAYLOAD = {'sheet_name': 'Lots', 'columns': ['farm_name', 'weight_kg'], 'rows': [['Finca 1', 1000]]}
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = ReportJobManager(str(tmp_path), executor=ThreadPoolExecutor(max_workers=1))
+    yield manager
+    manager.shutdown()
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    calls = []
+
+    def fake_renderer(payload):
+        calls.append(payload)
+        if payload.get('fail'):
+            raise RuntimeError('sin datos')
+        return b'xlsx-bytes'
+
+    monkeypatch.setitem(REPORT_RENDERERS, 'excel', (fake_renderer, 'xlsx', XLSX_MIMETYPE))
+    return calls
+
+
+class TestReportJobs:
+    """Tests para encolado, deduplicación y estado de reportes"""
+
+    def test_identical_reports_rendered_once(self, manager, renders):
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx')
+        assert manager.wait(job['id'], 5)['status'] == 'ready'
+
+        again = manager.submit('excel', dict(PAYLOAD), 'lots.xlsx')
+
+        assert again['id'] == job['id']
+        assert again['status'] == 'ready'
+        assert len(renders) == 1
+
+    def test_different_data_new_artifact(self, manager, renders):
+        first = manager.submit('excel', PAYLOAD, 'lots.xlsx')
+        second = manager.submit('excel', {**PAYLOAD, 'rows': [['Finca 2', 500]]}, 'lots.xlsx')
+        assert first['id'] != second['id']
+
+    def test_listener_notified(self, manager, renders):
+        finished = []
+        manager.add_listener(finished.append)
+
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx')
+        manager.wait(job['id'], 5)
+        manager.shutdown()
+
+        assert [j['status'] for j in finished] == ['ready']
+
+    def test_failed_render_reported(self, manager, renders):
+        job = manager.submit('excel', {**PAYLOAD, 'fail': True}, 'lots.xlsx')
+
+        status = manager.wait(job['id'], 5)
+
+        assert status['status'] == 'failed'
+        assert 'sin datos' in status['error']
+
+    def test_unknown_or_invalid_job(self, manager):
+        assert manager.status('0' * 64) is None
+        assert manager.status('../../etc/passwd') is None
+
+    def test_download_with_etag(self, app, manager, renders):
+        job = manager.wait(manager.submit('excel', PAYLOAD, 'lots.xlsx')['id'], 5)
+
+        with app.test_request_context():
+            response = manager.respond(job)
+            response.direct_passthrough = False
+            assert response.status_code == 200
+            assert response.get_etag()[0] == job['id']
+            assert response.get_data() == b'xlsx-bytes'
+
+        with app.test_request_context(headers={'If-None-Match': f'"{job["id"]}"'}):
+            assert manager.respond(job).status_code == 304
+
+    def test_pending_job_returns_202(self, app, manager, renders):
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx')
+        job['status'] = 'pending'
+
+        with app.test_request_context():
+            body, status = manager.respond(job)
+
+        assert status == 202
+        assert body.get_json()['job']['id'] == job['id']
+
+
+def test_deal_trace_pdf_rendered_in_process_pool(tmp_path):
+    manager = ReportJobManager(str(tmp_path), max_workers=1)
+    payload = {
+        'deal_info': [['ID del Acuerdo:', '1']],
+        'timeline': [{'timestamp': '2025-03-01T00:00:00', 'title': 'Acuerdo Creado',
+                      'actor': 'Sistema Triboka', 'description': 'Acuerdo #1'}],
+        'generated_by': 'Test User'
+    }
+    try:
+        job = manager.wait(manager.submit('deal_trace_pdf', payload, 'deal.pdf')['id'], 60)
+    finally:
+        manager.shutdown()
+
+    assert job['status'] == 'ready'
+    with open(tmp_path / f"{job['id']}.pdf", 'rb') as f:
+        assert f.read(4) == b'%PDF'
+
+
+class TestReportAccess:
+    """Tests para los permisos de los trabajos de reporte"""
+
+    def test_requesters_accumulate(self, manager, renders):
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx', owner={'user_id': 1, 'company_id': 10})
+        manager.wait(job['id'], 5)
+        manager.submit('excel', PAYLOAD, 'lots.xlsx', owner={'user_id': 2})
+
+        assert manager.is_allowed(job['id'], user_id=1)
+        assert manager.is_allowed(job['id'], user_id=2)
+        assert manager.is_allowed(job['id'], user_id=3, company_id=10)
+        assert not manager.is_allowed(job['id'], user_id=3, company_id=11)
+        assert len(renders) == 1
+
+    def test_deal_access(self, manager, renders):
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx', owner={'user_id': 1, 'deal_id': 7})
+
+        assert manager.is_allowed(job['id'], user_id=2, can_access_deal=lambda deal_id: deal_id == 7)
+        assert not manager.is_allowed(job['id'], user_id=2, can_access_deal=lambda deal_id: False)
+
+    def test_endpoints_hide_foreign_reports(self, app, db_session, test_user, manager, renders, monkeypatch):
+        import app_web3
+        from flask_jwt_extended import create_access_token
+        from models_simple import User
+
+        monkeypatch.setattr(app_web3, 'report_jobs', manager)
+        job = manager.submit('excel', PAYLOAD, 'lots.xlsx', owner={'user_id': -1})
+        manager.wait(job['id'], 5)
+        outsider = User(email='o@example.com', name='O', password_hash='x', role='producer')
+        db_session.session.add(outsider)
+        db_session.session.commit()
+
+        def call(view, user):
+            token = create_access_token(identity=str(user.id))
+            with app.app_context(), app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+                return app.make_response(view(job['id']))
+
+        assert call(app_web3.get_report_job, outsider).status_code == 404
+        assert call(app_web3.download_report, outsider).status_code == 404
+        assert call(app_web3.get_report_job, test_user).status_code == 200
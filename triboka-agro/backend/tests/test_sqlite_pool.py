@@ -0,0 +1,81 @@
+# tests/test_sqlite_pool.py
+"""
+Tests para el pool de conexiones SQLite del servidor de notificaciones
+"""
+
+import sqlite3
+import threading
+
+import pytest
+
+from services.sqlite_pool import SQLitePool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = SQLitePool(str(tmp_path / 'notifications.db'), size=3, busy_timeout=5)
+    with pool.transaction() as conn:
+        conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT, body TEXT)')
+    yield pool
+    pool.close()
+
+
+class TestSQLitePool:
+    """Tests para la reutilización de conexiones y las escrituras concurrentes"""
+
+    def test_connections_use_wal_and_are_reused(self, pool):
+        with pool.connection() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+            first = conn
+
+        with pool.connection() as conn:
+            assert conn is first
+
+    def test_pool_is_bounded(self, pool):
+        with pool.connection() as a, pool.connection() as b, pool.connection() as c:
+            assert len({id(a), id(b), id(c)}) == 3
+        assert pool._created == 3
+
+    def test_transaction_rolls_back_on_error(self, pool):
+        with pytest.raises(ValueError):
+            with pool.transaction() as conn:
+                conn.execute("INSERT INTO messages (room_id, body) VALUES ('r', 'perdido')")
+                raise ValueError('fallo')
+
+        with pool.connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+            assert not conn.in_transaction
+
+    def test_concurrent_writers_do_not_fail_with_locked(self, pool):
+        errors = []
+
+        def burst(room):
+            try:
+                for i in range(50):
+                    with pool.transaction() as conn:
+                        conn.executemany('INSERT INTO messages (room_id, body) VALUES (?, ?)',
+                                         [(room, f'{i}-{n}') for n in range(3)])
+                    with pool.connection() as conn:
+                        conn.execute('SELECT COUNT(*) FROM messages WHERE room_id = ?', (room,)).fetchone()
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=burst, args=(f'room-{t}',)) for t in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        with pool.connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 6 * 50 * 3
+
+    def test_batch_ids_are_consecutive(self, pool):
+        with pool.transaction() as conn:
+            conn.executemany('INSERT INTO messages (room_id, body) VALUES (?, ?)', [('r', str(n)) for n in range(4)])
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+        with pool.connection() as conn:
+            ids = [row[0] for row in conn.execute('SELECT id FROM messages ORDER BY id')]
+        assert ids == list(range(last_id - 3, last_id + 1))
@@ -0,0 +1,233 @@
+# tests/test_sync_delta.py
+"""
+Tests para la sincronización delta y las mutaciones offline de la app móvil
+"""
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+import routes.contracts
+import routes.sync_routes
+from models_simple import (
+    BlockchainTx, ContractFixation, Company, ExportContract, ProducerLot, SyncChange, SyncMutation, User
+)
+from services.change_log import backfill_change_log, compact_change_log, get_delta
+
+
+@pytest.fixture
+def companies(db_session):
+    producer = Company(name='Finca Norte', company_type='producer')
+    exporter = Company(name='Exportadora Sur', company_type='exporter')
+    buyer = Company(name='Chocolates Europa', company_type='buyer')
+    db_session.session.add_all([producer, exporter, buyer])
+    db_session.session.commit()
+    return producer, exporter, buyer
+
+
+@pytest.fixture
+def producer_user(db_session, companies):
+    user = User(email='p@example.com', name='P', password_hash='x', role='producer', company_id=companies[0].id)
+    db_session.session.add(user)
+    db_session.session.commit()
+    return user
+
+
+def headers(user):
+    return {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+
+
+def new_lot(db_session, company, code='L-1'):
+    lot = ProducerLot(lot_code=code, producer_company_id=company.id, weight_kg=1000,
+                      harvest_date=datetime(2025, 1, 1))
+    db_session.session.add(lot)
+    db_session.session.commit()
+    return lot
+
+
+class TestChangeLog:
+    """Tests para el registro de cambios y el delta por empresa"""
+
+    def test_delta_returns_only_changes_since_token(self, db_session, companies):
+        producer, exporter, _ = companies
+        lot = new_lot(db_session, producer)
+        new_lot(db_session, exporter, code='L-OTRA')
+
+        first = get_delta(producer.id)
+        assert [l['id'] for l in first['lots']] == [str(lot.id)]
+
+        assert get_delta(producer.id, first['sync_token']) == {
+            'lots': [], 'contracts': [], 'fixations': [], 'batches': [], 'dispatches': [],
+            'deleted': {}, 'sync_token': first['sync_token'], 'has_more': False
+        }
+
+        lot.farm_name = 'La Esperanza'
+        db_session.session.commit()
+        second = get_delta(producer.id, first['sync_token'])
+        assert [l['finca'] for l in second['lots']] == ['La Esperanza']
+        assert second['sync_token'] > first['sync_token']
+
+    def test_delete_leaves_tombstone(self, db_session, companies):
+        producer = companies[0]
+        lot = new_lot(db_session, producer)
+        lot_id = lot.id
+        token = get_delta(producer.id)['sync_token']
+
+        db_session.session.delete(lot)
+        db_session.session.commit()
+
+        delta = get_delta(producer.id, token)
+        assert delta['lots'] == []
+        assert delta['deleted'] == {'lots': [lot_id]}
+
+    def test_lost_visibility_is_a_tombstone(self, db_session, companies):
+        producer, exporter, buyer = companies
+        contract = ExportContract(contract_code='C-1', exporter_company_id=exporter.id, buyer_company_id=buyer.id)
+        db_session.session.add(contract)
+        db_session.session.flush()
+        db_session.session.add(ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=5))
+        db_session.session.commit()
+        buyer_token = get_delta(buyer.id)['sync_token']
+        assert get_delta(producer.id)['fixations'] == []
+
+        # El contrato pasa a otro comprador: el anterior recibe tombstones y el nuevo la fijación
+        contract.buyer_company_id = producer.id
+        db_session.session.commit()
+
+        assert get_delta(buyer.id, buyer_token)['deleted'] == {'contracts': [contract.id], 'fixations': [1]}
+        assert [f['export_contract_id'] for f in get_delta(producer.id)['fixations']] == [contract.id]
+
+    def test_pagination_and_compaction(self, db_session, companies):
+        producer = companies[0]
+        lots = [new_lot(db_session, producer, code=f'L-{i}') for i in range(3)]
+        for lot in lots:
+            lot.location = 'Manabí'
+        db_session.session.commit()
+
+        page = get_delta(producer.id, 0, limit=4)
+        assert page['has_more']
+        rest = get_delta(producer.id, page['sync_token'], limit=4)
+        assert not rest['has_more']
+        assert {l['id'] for l in page['lots'] + rest['lots']} == {str(l.id) for l in lots}
+
+        before = get_delta(producer.id)
+        assert compact_change_log(db_session.session.connection()) == 6  # 3 empresa + 3 plataforma
+        assert get_delta(producer.id) == before
+
+    def test_token_waits_for_recent_changes(self, db_session, companies):
+        producer = companies[0]
+        old, recent = new_lot(db_session, producer, code='L-VIEJO'), new_lot(db_session, producer, code='L-NUEVO')
+        entries = SyncChange.query.filter_by(company_id=producer.id).order_by(SyncChange.id).all()
+        entries[0].changed_at = datetime(2020, 1, 1)
+        db_session.session.commit()
+
+        # Un id menor sin confirmar aún no puede quedar detrás del token
+        settled = get_delta(producer.id, settle_seconds=60)
+        assert [l['id'] for l in settled['lots']] == [str(old.id)]
+        assert settled['sync_token'] == entries[0].id
+        assert not settled['has_more']
+
+        later = get_delta(producer.id, settled['sync_token'], settle_seconds=0)
+        assert [l['id'] for l in later['lots']] == [str(recent.id)]
+
+    def test_backfill_registers_existing_rows(self, db_session, companies):
+        producer = companies[0]
+        lot = new_lot(db_session, producer)
+        SyncChange.query.delete()
+        db_session.session.commit()
+
+        assert backfill_change_log(db_session.session.connection()) == 2
+        assert [l['id'] for l in get_delta(producer.id)['lots']] == [str(lot.id)]
+
+
+class TestSyncEndpoints:
+    """Tests para /api/sync/sync/delta y /api/sync/sync/push"""
+
+    def test_delta_endpoint(self, client, db_session, companies, producer_user):
+        new_lot(db_session, companies[0])
+
+        response = client.get('/api/sync/sync/delta?sync_token=0', headers=headers(producer_user))
+
+        assert response.status_code == 200
+        body = response.get_json()
+        assert len(body['lots']) == 1 and body['sync_token'] > 0 and 'server_timestamp' in body
+
+    def test_push_is_idempotent(self, client, db_session, companies, producer_user):
+        lot = new_lot(db_session, companies[0])
+        payload = {'mutations': [
+            {'mutation_id': 'm-1', 'entity': 'lot', 'op': 'create',
+             'data': {'producer_company_id': companies[0].id, 'farm_name': 'Finca', 'location': 'Chone',
+                      'product_type': 'Cacao CCN51', 'weight_kg': 500, 'quality_grade': 'A',
+                      'harvest_date': '2025-02-01'}},
+            {'mutation_id': 'm-2', 'entity': 'lot', 'op': 'update', 'entity_id': lot.id, 'data': {'weight_kg': 750}},
+            {'mutation_id': 'm-3', 'entity': 'lot', 'op': 'create', 'data': {'farm_name': 'Incompleto'}},
+            {'mutation_id': 'm-4', 'entity': 'fixation', 'op': 'create', 'data': {}},
+        ]}
+
+        first = client.post('/api/sync/sync/push', json=payload, headers=headers(producer_user)).get_json()
+        again = client.post('/api/sync/sync/push', json=payload, headers=headers(producer_user)).get_json()
+
+        assert [r['status'] for r in first['results']] == ['applied', 'applied', 'rejected', 'rejected']
+        assert first['applied'] == 2 and again['applied'] == 0
+        assert all(r['duplicate'] for r in again['results'])
+        assert [r.get('entity_id') for r in again['results'][:2]] == [r['entity_id'] for r in first['results'][:2]]
+        assert ProducerLot.query.count() == 2
+        assert float(db_session.session.get(ProducerLot, lot.id).weight_kg) == 750
+        assert SyncMutation.query.count() == 4
+
+    def test_push_rejects_foreign_lot(self, client, db_session, companies, producer_user):
+        lot = new_lot(db_session, companies[1])
+
+        body = client.post('/api/sync/sync/push', headers=headers(producer_user), json={'mutations': [
+            {'mutation_id': 'm-1', 'entity': 'lot', 'op': 'update', 'entity_id': lot.id, 'data': {'weight_kg': 1}}
+        ]}).get_json()
+
+        assert body['results'][0]['status'] == 'rejected'
+        assert float(db_session.session.get(ProducerLot, lot.id).weight_kg) == 1000
+
+    def test_push_invalidates_rest_caches(self, client, db_session, companies, producer_user, monkeypatch):
+        invalidated = []
+        monkeypatch.setattr(routes.sync_routes, 'invalidate_cache_tags', lambda *tags: invalidated.append(tags))
+        lot = new_lot(db_session, companies[0])
+        payload = {'mutations': [
+            {'mutation_id': 'm-1', 'entity': 'lot', 'op': 'update', 'entity_id': lot.id, 'data': {'weight_kg': 900}}
+        ]}
+
+        client.post('/api/sync/sync/push', json=payload, headers=headers(producer_user))
+        client.post('/api/sync/sync/push', json=payload, headers=headers(producer_user))
+
+        assert invalidated == [('lots',)]
+
+    def test_pushed_contract_is_editable_draft(self, client, db_session, companies, monkeypatch):
+        producer, exporter, buyer = companies
+        user = User(email='e@example.com', name='E', password_hash='x', role='exporter', company_id=exporter.id)
+        db_session.session.add(user)
+        db_session.session.commit()
+        contract_data = {'buyer_company_id': buyer.id, 'exporter_company_id': exporter.id, 'contract_code': 'OFF-1',
+                         'product_type': 'Cacao', 'product_grade': 'A', 'total_volume_mt': 10,
+                         'differential_usd': -150, 'start_date': '2025-01-01', 'end_date': '2025-06-01',
+                         'delivery_date': '2025-07-01'}
+
+        created = client.post('/api/sync/sync/push', headers=headers(user), json={'mutations': [
+            {'mutation_id': 'c-1', 'entity': 'contract', 'op': 'create', 'data': contract_data}
+        ]}).get_json()['results'][0]
+        updated = client.post('/api/sync/sync/push', headers=headers(user), json={'mutations': [
+            {'mutation_id': 'c-2', 'entity': 'contract', 'op': 'update', 'entity_id': created['entity_id'],
+             'data': {'total_volume_mt': 12}}
+        ]}).get_json()['results'][0]
+
+        assert updated['status'] == 'applied'
+        contract = db_session.session.get(ExportContract, created['entity_id'])
+        assert contract.status == 'draft' and float(contract.total_volume_mt) == 12
+        assert BlockchainTx.query.count() == 0
+
+        # Al activarlo se encola su registro en blockchain (una sola vez)
+        ready = SimpleNamespace(is_ready=lambda: True, agro_contract=SimpleNamespace(contract=object()))
+        monkeypatch.setattr(routes.contracts, 'get_blockchain_integration', lambda: ready)
+        response = client.put(f'/api/contracts/{contract.id}/status', json={'status': 'active'}, headers=headers(user))
+
+        assert response.status_code == 200
+        tx = BlockchainTx.query.one()
+        assert (tx.kind, tx.entity_id, tx.args['total_volume_mt']) == ('create_contract', contract.id, 12000)
@@ -0,0 +1,113 @@
+# tests/test_timeline.py
+"""
+Tests para el timeline append-only de trazabilidad
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from models_simple import TimelineEntry, TraceEvent, TraceTimeline
+from services import timeline as services_timeline
+from services.timeline import append_event, actor_names, load_timeline, load_timeline_page
+from routes.traceability import update_timeline
+
+
+def add_event(db_session, minutes, event_type='DRYING', entity_id='1', **kwargs):
+    event = TraceEvent(
+        event_type=event_type, entity_type='lot', entity_id=entity_id, title=event_type,
+        measurements=json.dumps({'moisture_content': 7.5}), actor_name='Ana',
+        event_timestamp=datetime(2025, 3, 1) + timedelta(minutes=minutes), **kwargs
+    )
+    db_session.session.add(event)
+    db_session.session.flush()
+    return event
+
+
+class TestTimeline:
+    """Tests para agregar y leer entradas del timeline"""
+
+    def test_append_is_one_row_per_event(self, db_session):
+        for minutes in range(5):
+            append_event(add_event(db_session, minutes))
+        db_session.session.commit()
+
+        assert TimelineEntry.query.count() == 5
+        timeline = TraceTimeline.query.one()
+        assert timeline.total_events == 5
+        assert timeline.started_at == datetime(2025, 3, 1)
+
+    def test_load_in_chronological_order(self, db_session):
+        late = add_event(db_session, 30, event_type='STORAGE')
+        early = add_event(db_session, 10, event_type='RECEPCIÓN')
+        append_event(late)
+        append_event(early)
+        append_event(add_event(db_session, 0, entity_id='2'))
+        db_session.session.commit()
+
+        timeline = load_timeline('lot', '1')
+
+        assert [e['id'] for e in timeline] == [f'event_{early.id}', f'event_{late.id}']
+        assert timeline[0]['measurements'] == {'moisture_content': 7.5}
+        assert timeline[0]['actor'] == 'Ana'
+
+    def test_blockchain_hash_read_from_event(self, db_session):
+        """Un anclaje posterior se refleja sin reescribir la entrada"""
+        event = add_event(db_session, 0)
+        append_event(event)
+        db_session.session.commit()
+
+        event.blockchain_tx_hash = '0xabc'
+        db_session.session.commit()
+
+        assert load_timeline('lot', '1')[0]['blockchain_tx_hash'] == '0xabc'
+
+    def test_aware_timestamp_normalized(self, db_session):
+        event = add_event(db_session, 0)
+        event.event_timestamp = datetime(2025, 3, 1, 12, tzinfo=timezone(timedelta(hours=-5)))
+        append_event(event)
+        db_session.session.commit()
+
+        assert TimelineEntry.query.one().occurred_at == datetime(2025, 3, 1, 17)
+
+    def test_update_timeline_uses_event_catalog(self, db_session):
+        event = add_event(db_session, 0, event_type='CALIDAD', description='Lote homogéneo')
+        update_timeline('lot', '1', event)
+        db_session.session.commit()
+
+        entry = load_timeline('lot', '1')[0]
+        assert entry['title'] == 'Control de Calidad'
+        assert entry['notes'] == 'Lote homogéneo'
+
+
+class TestTimelinePagination:
+    """Tests para páginas por cursor y resolución de actores"""
+
+    def test_pages_cover_timeline_in_order(self, db_session):
+        for minutes in [5, 1, 1, 3, 0, 4, 2]:
+            append_event(add_event(db_session, minutes))
+        db_session.session.commit()
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = load_timeline_page('lot', '1', 3, cursor=cursor)
+            seen.extend(page)
+            if cursor is None:
+                break
+
+        assert [e['id'] for e in seen] == [e['id'] for e in load_timeline('lot', '1')]
+        assert len(seen) == 7
+
+    def test_actor_names_resolved_in_one_query(self, db_session, test_user, count_queries):
+        events = [add_event(db_session, m, actor_id=test_user.id) for m in range(10)]
+        for event in events:
+            event.actor_name = None
+        db_session.session.flush()
+        services_timeline._user_names.clear()
+        count_queries.clear()
+
+        names = actor_names(events)
+
+        assert set(names.values()) == {'Test User'}
+        assert len(count_queries) == 1
@@ -0,0 +1,135 @@
+# tests/test_trace_anchoring.py
+"""
+Tests para el anclaje Merkle de eventos de trazabilidad
+"""
+
+import hashlib
+import pytest
+from types import SimpleNamespace
+
+from models_simple import BlockchainTx, TraceEvent, TraceAnchor, TraceEventProof
+from services.merkle import build_tree, leaf_hash, verify_proof
+from services.trace_anchoring import (
+    anchor_pending_events, load_proofs, verify_event_proof, summarize_verification
+)
+from tests.test_tx_outbox import AnvilStub, FakeCall, make_worker
+
+
+class FakeDocumentRegistry:
+    contract = object()
+
+    def anchor_root_call(self, **kwargs):
+        return FakeCall(kwargs)
+
+    def extract_document_id(self, receipt):
+        return f"doc-{receipt['blockNumber']}"
+
+
+def fake_event_hash(i):
+    return hashlib.sha256(f'evento-{i}'.encode()).hexdigest()
+
+
+class TestMerkleTree:
+    """Tests para construcción y verificación de pruebas"""
+
+    @pytest.mark.parametrize('size', [1, 2, 3, 5, 8, 13])
+    def test_every_proof_verifies(self, size):
+        """Cada hoja verifica contra la raíz, también con niveles impares"""
+        hashes = [fake_event_hash(i) for i in range(size)]
+        root, proofs = build_tree([leaf_hash(h) for h in hashes])
+
+        for event_hash, proof in zip(hashes, proofs):
+            assert verify_proof(event_hash, proof, root)
+
+    def test_wrong_event_fails(self):
+        """Una prueba no sirve para otro evento"""
+        hashes = [fake_event_hash(i) for i in range(4)]
+        root, proofs = build_tree([leaf_hash(h) for h in hashes])
+
+        assert not verify_proof(hashes[1], proofs[0], root)
+        assert not verify_proof(fake_event_hash(99), proofs[0], root)
+
+    def test_empty_tree_rejected(self):
+        with pytest.raises(ValueError):
+            build_tree([])
+
+
+class TestTraceAnchoring:
+    """Tests para el anclaje de eventos pendientes"""
+
+    @pytest.fixture
+    def events(self, db_session):
+        events = [TraceEvent(event_type='drying', entity_type='lot', entity_id='1',
+                             title=f'Secado día {i}', status='active') for i in range(5)]
+        db_session.session.add_all(events)
+        db_session.session.commit()
+        return events
+
+    def test_anchor_creates_one_root_for_all_events(self, events):
+        """Un anclaje cubre todos los eventos pendientes con una sola raíz"""
+        anchor = anchor_pending_events()
+
+        assert anchor.leaf_count == 5
+        assert anchor.status == 'offchain'
+        assert TraceEventProof.query.count() == 5
+        assert anchor_pending_events() is None
+
+    def test_verify_offline(self, events):
+        """Las pruebas guardadas verifican sin consultar la blockchain"""
+        anchor_pending_events()
+        proofs = load_proofs(e.id for e in events)
+
+        results = [verify_event_proof(e, proofs.get(e.id)) for e in events]
+
+        assert all(r['valid'] for r in results)
+        assert summarize_verification(results) == 'verified'
+
+    def test_modified_event_detected(self, events, db_session):
+        """Modificar un evento anclado invalida su prueba"""
+        anchor_pending_events()
+        events[2].description = 'Dato alterado'
+        db_session.session.commit()
+        proofs = load_proofs(e.id for e in events)
+
+        results = [verify_event_proof(e, proofs.get(e.id)) for e in events]
+
+        assert results[2]['valid'] is False
+        assert results[2]['status'] == 'modified_after_anchor'
+        assert summarize_verification(results) == 'tampered'
+
+    def test_new_events_pending_until_next_anchor(self, events, db_session):
+        """Los eventos posteriores al anclaje quedan pendientes hasta el siguiente"""
+        anchor_pending_events()
+        late = TraceEvent(event_type='weighing', entity_type='lot', entity_id='1', title='Pesaje', status='active')
+        db_session.session.add(late)
+        db_session.session.commit()
+
+        result = verify_event_proof(late, load_proofs([late.id]).get(late.id))
+        assert result['status'] == 'pending_anchor'
+
+        second = anchor_pending_events()
+        assert second.leaf_count == 1
+        assert TraceAnchor.query.count() == 2
+
+    def test_failed_anchor_is_reanchored(self, events):
+        """Si la transacción del anclaje revierte, sus eventos se vuelven a anclar"""
+        node = AnvilStub()
+        worker = make_worker(node)
+        worker.integration.document_registry = FakeDocumentRegistry()
+        worker.integration.is_ready = lambda: True
+
+        first = anchor_pending_events(worker.integration)
+        node.revert_next = True
+        worker.run_once()
+
+        assert first.status == 'failed'
+        assert TraceEventProof.query.count() == 0
+        assert verify_event_proof(events[0], load_proofs([events[0].id]).get(events[0].id))['status'] == 'pending_anchor'
+
+        retry = anchor_pending_events(worker.integration)
+        worker.run_once()
+
+        assert retry.id == first.id and retry.status == 'confirmed'
+        assert TraceEventProof.query.count() == 5
+        assert [tx.status for tx in BlockchainTx.query.order_by(BlockchainTx.id)] == ['failed', 'confirmed']
+        assert events[0].blockchain_tx_hash == BlockchainTx.query.filter_by(status='confirmed').one().tx_hash
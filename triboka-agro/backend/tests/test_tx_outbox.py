@@ -0,0 +1,363 @@
+# tests/test_tx_outbox.py
+"""
+Tests para el outbox de transacciones blockchain (nonces locales + recibos por lotes)
+"""
+
+import hashlib
+import json
+import pytest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from web3.exceptions import TransactionNotFound
+
+from flask_jwt_extended import create_access_token
+from flask_jwt_extended.exceptions import NoAuthorizationError
+
+from app_web3 import get_blockchain_transactions
+from models_simple import BlockchainTx, Company, ContractFixation, ExportContract, ProducerLot, User
+from blockchain_service import BlockchainService, NonceManager
+from services.tx_outbox import TxOutboxWorker, enqueue_transaction
+
+
+class AnvilStub:
+    """Nodo local estilo anvil/Hardhat con la parte de la API eth que usa el servicio
+
+    Exige nonces consecutivos y mina las transacciones al recibirlas
+    (automine) o al llamar a mine().
+    """
+
+    chain_id = 31337
+    gas_price = 1
+
+    def __init__(self, automine=True):
+        self.eth = self
+        self.account = self
+        self.automine = automine
+        self.block_number = 0
+        self.next_nonce = 0
+        self.count_calls = 0
+        self.fail_next_send = False
+        self.revert_next = False
+        self.on_send = None
+        self.sent = 0
+        self.mempool = []
+        self.receipts = {}
+
+    def get_transaction_count(self, address, block_identifier='latest'):
+        self.count_calls += 1
+        return self.next_nonce
+
+    def estimate_gas(self, transaction):
+        return 21000
+
+    def sign_transaction(self, transaction, key):
+        raw = json.dumps(transaction, sort_keys=True).encode()
+        return SimpleNamespace(rawTransaction=raw, hash=hashlib.sha256(raw).digest())
+
+    def send_raw_transaction(self, raw):
+        if self.fail_next_send:
+            self.fail_next_send = False
+            raise ConnectionError('nodo no disponible')
+        transaction = json.loads(raw)
+        if transaction['nonce'] != self.next_nonce:
+            raise ValueError(f"nonce inválido: esperado {self.next_nonce}, recibido {transaction['nonce']}")
+        self.next_nonce += 1
+        self.sent += 1
+        tx_hash = hashlib.sha256(raw).digest()
+        self.mempool.append((tx_hash.hex(), self.revert_next))
+        self.revert_next = False
+        if self.on_send:
+            on_send, self.on_send = self.on_send, None
+            on_send()
+        if self.automine:
+            self.mine()
+        return tx_hash
+
+    def mine(self):
+        self.block_number += 1
+        for tx_hash, reverted in self.mempool:
+            self.receipts[tx_hash] = {
+                'transactionHash': tx_hash,
+                'blockNumber': self.block_number,
+                'gasUsed': 21000,
+                'status': 0 if reverted else 1
+            }
+        self.mempool = []
+
+    def get_transaction(self, tx_hash):
+        if tx_hash not in self.receipts and tx_hash not in {h for h, _ in self.mempool}:
+            raise TransactionNotFound(tx_hash)
+        return {'hash': tx_hash}
+
+    def get_transaction_receipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(tx_hash)
+        return self.receipts[tx_hash]
+
+
+class FakeCall:
+    def __init__(self, args):
+        self.args = args
+
+    def build_transaction(self, base):
+        return dict(base, data=self.args)
+
+
+class FakeNFTService:
+    def create_lot_call(self, **kwargs):
+        return FakeCall(kwargs)
+
+    def extract_lot_id(self, receipt):
+        return 1000 + receipt['blockNumber']
+
+
+class FakeAgroContract:
+    def __init__(self):
+        self.fixation_args = []
+
+    def create_contract_call(self, **kwargs):
+        return FakeCall(kwargs)
+
+    def extract_contract_id(self, receipt):
+        return f"0x{receipt['blockNumber']:064x}"
+
+    def register_fixation_call(self, **kwargs):
+        self.fixation_args.append(kwargs)
+        return FakeCall(kwargs)
+
+    def extract_fixation_id(self, receipt):
+        return 'fix-1'
+
+
+def make_worker(node):
+    account = SimpleNamespace(address='0x' + 'ab' * 20, key=b'key')
+    service = BlockchainService.__new__(BlockchainService)
+    service.w3 = node
+    service.account = account
+    service.nonces = NonceManager(node, account.address)
+    integration = SimpleNamespace(blockchain=service, nft_service=FakeNFTService(),
+                                  agro_contract=FakeAgroContract())
+    return TxOutboxWorker(integration, batch_size=10)
+
+
+class TestTxOutbox:
+    """Tests para el envío y confirmación de transacciones encoladas"""
+
+    @pytest.fixture
+    def lots(self, db_session, test_company):
+        lots = [ProducerLot(lot_code=f'LOT-TX-{i}', producer_company_id=test_company.id,
+                            weight_kg=1000, status='available') for i in range(3)]
+        db_session.session.add_all(lots)
+        db_session.session.flush()
+        for lot in lots:
+            enqueue_transaction('create_lot', lot.id, {'farm_name': lot.lot_code})
+        db_session.session.commit()
+        return lots
+
+    def test_confirmed_receipt_updates_lot(self, lots):
+        """Al confirmarse el recibo se guarda el ID on-chain en el lote"""
+        worker = make_worker(AnvilStub())
+
+        result = worker.run_once()
+
+        assert result == {'submitted': 3, 'confirmed': 3}
+        txs = BlockchainTx.query.order_by(BlockchainTx.id).all()
+        assert [tx.status for tx in txs] == ['confirmed'] * 3
+        assert lots[0].blockchain_lot_id == '1001'
+        assert txs[0].block_number == 1
+
+    def test_nonces_assigned_locally(self, lots):
+        """El nonce se consulta al nodo una vez y luego se incrementa en memoria"""
+        node = AnvilStub()
+        make_worker(node).submit_pending()
+
+        nonces = [tx.nonce for tx in BlockchainTx.query.order_by(BlockchainTx.id)]
+        assert nonces == [0, 1, 2]
+        assert node.count_calls == 1
+
+    def test_stays_submitted_until_mined(self, lots):
+        """Sin bloque minado la transacción queda enviada y el lote sin ID"""
+        node = AnvilStub(automine=False)
+        worker = make_worker(node)
+
+        worker.run_once()
+        assert {tx.status for tx in BlockchainTx.query} == {'submitted'}
+        assert lots[0].blockchain_lot_id is None
+
+        node.mine()
+        assert worker.poll_receipts() == 3
+        assert {tx.status for tx in BlockchainTx.query} == {'confirmed'}
+
+    def test_failed_send_keeps_order_and_resyncs_nonce(self, lots):
+        """Un fallo detiene el lote y el siguiente intento reutiliza el nonce"""
+        node = AnvilStub()
+        node.fail_next_send = True
+        worker = make_worker(node)
+
+        assert worker.submit_pending() == 0
+        first = BlockchainTx.query.order_by(BlockchainTx.id).first()
+        assert first.status == 'pending'
+        assert first.attempts == 1
+
+        assert worker.submit_pending() == 3
+        assert [tx.nonce for tx in BlockchainTx.query.order_by(BlockchainTx.id)] == [0, 1, 2]
+
+    def test_reverted_transaction_marked_failed(self, lots):
+        """Un recibo con status 0 marca la transacción como fallida"""
+        node = AnvilStub()
+        node.revert_next = True
+        worker = make_worker(node)
+
+        worker.run_once()
+
+        first = BlockchainTx.query.order_by(BlockchainTx.id).first()
+        assert first.status == 'failed'
+        assert lots[0].blockchain_lot_id is None
+
+    def test_concurrent_workers_never_send_twice(self, lots):
+        """Un segundo worker que arranca a mitad del lote no reenvía las ya reclamadas"""
+        node = AnvilStub()
+        first, second = make_worker(node), make_worker(node)
+        node.on_send = second.submit_pending
+
+        first.submit_pending()
+
+        txs = BlockchainTx.query.order_by(BlockchainTx.id).all()
+        assert [tx.status for tx in txs] == ['submitted'] * 3
+        assert node.next_nonce == 3
+        assert len({tx.tx_hash for tx in txs}) == 3
+
+    def test_stale_claim_released(self, lots):
+        """Una transacción reclamada por un worker caído vuelve a enviarse tras el timeout"""
+        tx = BlockchainTx.query.order_by(BlockchainTx.id).first()
+        tx.status = 'sending'
+        tx.submitted_at = datetime.utcnow() - timedelta(minutes=10)
+        BlockchainTx.query.filter(BlockchainTx.id != tx.id).delete()
+        worker = make_worker(AnvilStub())
+
+        assert worker.submit_pending() == 1
+        assert tx.status == 'submitted'
+
+    def test_error_after_broadcast_does_not_resend(self, lots):
+        """Si el envío llega al nodo pero falla la respuesta, el reintento no crea otra transacción"""
+        node = AnvilStub(automine=False)
+
+        def lost_response():
+            raise ConnectionError('respuesta perdida')
+        node.on_send = lost_response
+        worker = make_worker(node)
+
+        assert worker.submit_pending() == 0
+        first = BlockchainTx.query.order_by(BlockchainTx.id).first()
+        assert (first.status, first.nonce) == ('pending', 0)
+        signed_hash = first.tx_hash
+
+        assert worker.submit_pending() == 3
+        assert node.sent == 3
+        assert first.tx_hash == signed_hash
+        node.mine()
+        assert worker.poll_receipts() == 3
+
+    def test_crashed_worker_rebroadcasts_signed_tx(self, lots):
+        """Una reclamada con la transacción ya firmada se reenvía igual (mismo nonce y hash)"""
+        node = AnvilStub()
+        worker = make_worker(node)
+        tx = BlockchainTx.query.order_by(BlockchainTx.id).first()
+        BlockchainTx.query.filter(BlockchainTx.id != tx.id).delete()
+        transaction = {'from': '0x' + 'ab' * 20, 'data': tx.args}
+        tx.tx_hash, tx.raw_tx = worker.integration.blockchain.sign_transaction(transaction)
+        tx.nonce = transaction['nonce']
+        tx.status = 'sending'
+        tx.submitted_at = datetime.utcnow() - timedelta(minutes=10)
+        signed_hash = tx.tx_hash
+
+        assert worker.submit_pending() == 1
+        assert (tx.status, tx.tx_hash, tx.nonce) == ('submitted', signed_hash, 0)
+        assert node.sent == 1 and signed_hash in node.receipts
+
+
+class TestFixationOutbox:
+    """Tests para fijaciones creadas antes de confirmarse su contrato"""
+
+    @pytest.fixture
+    def contract(self, db_session, test_company):
+        contract = ExportContract(contract_code='EC-TX-1', exporter_company_id=test_company.id,
+                                  total_volume_mt=10)
+        db_session.session.add(contract)
+        db_session.session.flush()
+        enqueue_transaction('create_contract', contract.id, {'contract_code': contract.contract_code})
+        db_session.session.commit()
+        return contract
+
+    @pytest.fixture
+    def fixation(self, db_session, contract):
+        fixation = ContractFixation(export_contract_id=contract.id, fixed_quantity_mt=1, spot_price_usd=2000)
+        db_session.session.add(fixation)
+        db_session.session.flush()
+        enqueue_transaction('register_fixation', fixation.id, {
+            'export_contract_id': contract.id, 'contract_id': None,
+            'fixed_quantity_mt': 1000, 'spot_price_usd': 200000, 'lot_ids': [], 'notes': ''
+        })
+        db_session.session.commit()
+        return fixation
+
+    def fixation_tx(self):
+        return BlockchainTx.query.filter_by(kind='register_fixation').one()
+
+    def test_fixation_waits_for_contract(self, contract, fixation):
+        node = AnvilStub(automine=False)
+        worker = make_worker(node)
+
+        assert worker.run_once() == {'submitted': 1, 'confirmed': 0}
+        assert self.fixation_tx().status == 'pending'
+
+        node.mine()
+        worker.run_once()
+        assert contract.blockchain_contract_id == f'0x{1:064x}'
+
+        assert worker.submit_pending() == 1
+        assert self.fixation_tx().status == 'submitted'
+        assert worker.integration.agro_contract.fixation_args[-1]['contract_id'] == contract.blockchain_contract_id
+
+    def test_fixation_fails_with_failed_contract(self, contract, fixation):
+        node = AnvilStub()
+        node.revert_next = True
+        worker = make_worker(node)
+
+        worker.run_once()
+        worker.submit_pending()
+
+        tx = self.fixation_tx()
+        assert tx.status == 'failed'
+        assert 'contrato' in tx.last_error
+        assert worker.integration.agro_contract.fixation_args == []
+
+
+class TestOutboxListing:
+    """Tests para GET /api/blockchain/transactions"""
+
+    def list_as(self, app, user):
+        token = create_access_token(identity=str(user.id))
+        with app.app_context(), app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+            return app.make_response(get_blockchain_transactions())
+
+    def test_requires_jwt(self, app, db_session):
+        with app.test_request_context(), pytest.raises(NoAuthorizationError):
+            get_blockchain_transactions()
+
+    def test_filtered_by_company(self, app, db_session, test_company, test_user):
+        other = Company(name='Otra', company_type='producer', email='o@x.com')
+        db_session.session.add(other)
+        db_session.session.flush()
+        own = ProducerLot(lot_code='LOT-OWN', producer_company_id=test_company.id)
+        foreign = ProducerLot(lot_code='LOT-OTHER', producer_company_id=other.id)
+        db_session.session.add_all([own, foreign])
+        db_session.session.flush()
+        for lot in (own, foreign):
+            enqueue_transaction('create_lot', lot.id, {})
+        producer = User(email='p@x.com', name='P', password_hash='x', role='producer', company_id=test_company.id)
+        db_session.session.add(producer)
+        db_session.session.commit()
+
+        assert len(self.list_as(app, producer).get_json()) == 1
+        assert len(self.list_as(app, test_user).get_json()) == 2
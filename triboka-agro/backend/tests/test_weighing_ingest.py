@@ -0,0 +1,102 @@
+# tests/test_weighing_ingest.py
+"""
+Tests para la ingesta por lotes de eventos de básculas (AgroWeight Cloud)
+"""
+
+import io
+import json
+
+import pytest
+
+from app_web3 import registrar_eventos_lotes
+from models_simple import IngestedEventKey, ProducerLot, TimelineEntry, TraceEvent, TraceTimeline
+from services.lot_import import iter_rows
+from services.timeline import load_timeline
+from services.weighing_ingest import ingest_weighing_events
+from services.api_keys import set_api_key
+from routes.performance import cache_layer
+
+
+@pytest.fixture
+def lots(db_session, test_company):
+    lots = [ProducerLot(lot_code=f'L-{i}', producer_company_id=test_company.id, weight_kg=1000) for i in range(2)]
+    db_session.session.add_all(lots)
+    db_session.session.commit()
+    return lots
+
+
+def readings(lot_ids, count, prefix='r'):
+    return [(i + 1, {'id_evento': f'{prefix}-{i}', 'lote_id': lot_ids[i % len(lot_ids)], 'tipo': 'PESAJE',
+                     'peso_kg': 100 + i, 'humedad': '7.5', 'timestamp': f'2025-03-01T10:{i % 60:02d}:00Z'})
+            for i in range(count)]
+
+
+class TestWeighingIngest:
+    """Tests para la validación, la idempotencia y los agregados del timeline"""
+
+    def test_batch_registers_events_and_timeline(self, db_session, test_company, lots):
+        report = ingest_weighing_events(readings([l.id for l in lots], 6), test_company)
+
+        assert (report['registrados'], report['duplicados'], report['rechazados']) == (6, 0, 0)
+        assert TraceEvent.query.count() == 6 and TimelineEntry.query.count() == 6
+        timeline = TraceTimeline.query.filter_by(entity_type='lot', entity_id=str(lots[0].id)).one()
+        assert timeline.total_events == 3
+        first = load_timeline('lot', str(lots[0].id))[0]
+        assert first['measurements'] == {'weight_kg': 100.0, 'moisture_content': 7.5}
+        assert first['actor'] == test_company.name
+
+    def test_resend_is_idempotent(self, db_session, test_company, lots):
+        first = ingest_weighing_events(readings([lots[0].id], 3), test_company)
+        again = ingest_weighing_events(readings([lots[0].id], 4), test_company)
+
+        assert (again['registrados'], again['duplicados']) == (1, 3)
+        assert [e['evento_id'] for e in again['eventos'] if e['estado'] == 'duplicado'] == \
+               [e['evento_id'] for e in first['eventos']]
+        assert TraceEvent.query.count() == 4 and IngestedEventKey.query.count() == 4
+        assert TraceTimeline.query.one().total_events == 4
+
+    def test_invalid_readings_reported_by_line(self, db_session, test_company, lots):
+        rows = readings([lots[0].id], 2) + [
+            (3, {'id_evento': 'r-0', 'lote_id': lots[0].id, 'tipo': 'PESAJE'}),
+            (4, {'id_evento': 'x', 'lote_id': 999, 'tipo': 'PESAJE'}),
+            (5, {'lote_id': lots[0].id, 'tipo': 'PESAJE', 'peso_kg': 'mucho'}),
+        ]
+
+        report = ingest_weighing_events(rows, test_company)
+
+        assert report['registrados'] == 2
+        assert {e['line']: e['errors'] for e in report['errores']} == {
+            3: ['id_evento repetido en el envío: r-0'],
+            4: ['Lote no encontrado: 999'],
+            5: ['Campo requerido: id_evento', 'peso_kg no es numérico'],
+        }
+
+    def test_ndjson_stream(self, db_session, test_company, lots):
+        lines = ''.join(json.dumps(row) + '\n' for _, row in readings([lots[1].id], 3)) + '{roto\n'
+
+        report = ingest_weighing_events(iter_rows(io.BytesIO(lines.encode()), 'ndjson'), test_company)
+
+        assert report['registrados'] == 3 and report['errores'][0]['line'] == 4
+
+    def test_statements_per_chunk_independent_of_size(self, db_session, test_company, lots, capture_queries):
+        statements = capture_queries()
+        ingest_weighing_events(readings([l.id for l in lots], 5, prefix='a'), test_company)
+        few = len(statements)
+        statements.clear()
+        ingest_weighing_events(readings([l.id for l in lots], 200, prefix='b'), test_company)
+
+        assert len(statements) <= few + 4
+
+
+def test_endpoint_invalidates_traceability_cache(app, db_session, test_company, lots):
+    """Registrar eventos invalida las métricas cacheadas con el tag 'traceability'"""
+    api_key = set_api_key(test_company)
+    db_session.session.commit()
+    cache_layer.set('analytics:test', {'total_events': 0}, ttl=300, tags=['traceability'])
+    body = {'eventos': [row for _, row in readings([lots[0].id], 2)]}
+
+    with app.app_context(), app.test_request_context(json=body, headers={'Authorization': f'Bearer {api_key}'}):
+        response = app.make_response(registrar_eventos_lotes())
+
+    assert response.status_code == 201
+    assert cache_layer.get('analytics:test') is None